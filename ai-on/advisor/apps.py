@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class AdvisorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'advisor'
+
+    def ready(self):
+        # Declare this app's agents; the agent registry loads them once per process
+        from agents.registry import agent_registry
+        from .services import ADVISOR_AGENT
+        agent_registry.define(ADVISOR_AGENT)
@@ -9,6 +9,11 @@ class AdvisorQuerySerializer(serializers.Serializer):
         required=True,
         help_text="Natural language query for the advisor (e.g., 'Recommend a laptop under 50000 DZD')"
     )
+    refresh = serializers.BooleanField(
+        required=False,
+        default=False,
+        help_text="Ignore any cached answer for this exact query and ask the AI again"
+    )
 
 class AdvisorResponseSerializer(serializers.Serializer):
     """
@@ -5,17 +5,31 @@ Handles product recommendations, purchase analysis, and product comparisons
 with budget-aware AI guidance.
 """
 
+import logging
+from contextlib import aclosing
 from django.contrib.auth.models import User
 from agents.models import agentModel
+from agents.services import (
+    generate_content,
+    agenerate_content,
+    agenerate_content_stream,
+    chunk_text,
+    get_agent_config,
+    AgentDefinition,
+    agent_registry,
+    trace_agent,
+    payload
+)
+from asgiref.sync import sync_to_async
 from budget.models import Budget
 from expense.models import Expense
 from .models import AdvisorSession
-from google import genai
 from google.genai import types
-from decouple import config
 from decimal import Decimal
 
-API_KEY = config('GEMINI_API_KEY')
+
+logger = logging.getLogger(__name__)
+
 
 ADVISOR_SYSTEM_INSTRUCTION = """
 IDENTITY
@@ -47,27 +61,34 @@ TONE
 - Professional but friendly
 """
 
+def _advisor_config(agent: agentModel, functions: dict = None) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        system_instruction=agent.system_instruction
+    )
+
+
+ADVISOR_AGENT = AgentDefinition(
+    name="advisor_agent",
+    description="Agent that provides smart product recommendations and purchase guidance",
+    system_instruction=ADVISOR_SYSTEM_INSTRUCTION,
+    gemini_model="gemini-2.5-flash",
+    thinking_budget=0,
+    config=_advisor_config
+)
+
+
 def get_or_create_advisor_agent() -> agentModel:
     """
-    Get or create the advisor agent.
+    Get the advisor agent from the agent registry (no DB query once loaded).
     """
-    agent, created = agentModel.objects.get_or_create(
-        name="advisor_agent",
-        defaults={
-            "description": "Agent that provides smart product recommendations and purchase guidance",
-            "system_instruction": ADVISOR_SYSTEM_INSTRUCTION,
-            "gemini_model": "gemini-2.5-flash",
-            "thinking_budget": 0
-        }
-    )
-    
-    # Update if needed
-    if not created and (agent.gemini_model != "gemini-2.5-flash" or agent.system_instruction != ADVISOR_SYSTEM_INSTRUCTION):
-        agent.gemini_model = "gemini-2.5-flash"
-        agent.system_instruction = ADVISOR_SYSTEM_INSTRUCTION
-        agent.save()
-    
-    return agent
+    return agent_registry.get(ADVISOR_AGENT.name).agent
+
+
+async def aget_or_create_advisor_agent() -> agentModel:
+    """
+    Async version of get_or_create_advisor_agent().
+    """
+    return (await agent_registry.aget(ADVISOR_AGENT.name)).agent
 
 
 def _get_user_financial_context(user: User) -> str:
@@ -117,202 +138,244 @@ IMPORTANT: Consider these financial constraints when providing advice. If a purc
         return context
         
     except Exception as e:
-        print(f"DEBUG: Error getting financial context: {str(e)}")
+        logger.warning("Error getting financial context: %s", e)
         return "USER FINANCIAL PROFILE: Not available. Provide general advice."
 
 
-def process_product_recommendation(user: User, message: str) -> dict:
+RECOMMEND_TASK = """TASK: Provide product recommendations that fit the user's budget and financial situation. If the request is vague, ask clarifying questions or provide a range of options at different price points."""
+
+ANALYZE_TASK = """TASK: Analyze if this purchase is financially wise for the user. Consider:
+1. Does it fit within their budget?
+2. Which budget category would it come from?
+3. Would it cause overspending?
+4. Are there more affordable alternatives?
+5. Is this a need or a want?
+
+Provide a clear recommendation: "Go ahead", "Consider alternatives", or "Not recommended right now" with detailed reasoning."""
+
+COMPARE_TASK = """TASK: Compare the products mentioned and recommend the best option considering:
+1. Price and value for money
+2. User's budget constraints
+3. Features and quality
+4. Long-term value
+5. Financial impact
+
+Provide a structured comparison with pros/cons and a clear recommendation."""
+
+
+def _build_advisor_prompt(user: User, message: str, task: str) -> str:
     """
-    Generate product recommendations based on user needs and budget.
-    
-    Args:
-        user: The Django User object
-        message: User's request for product recommendations
-        
-    Returns:
-        Dictionary with AI-generated advice
+    Combine the user's financial context, their request and the task.
     """
-    print(f"DEBUG: Advisor Agent (Recommend) is running now... processing message: {message}")
-    agent = get_or_create_advisor_agent()
-    
-    # Build context
     financial_context = _get_user_financial_context(user)
     
-    prompt = f"""
+    return f"""
 {financial_context}
 
 USER REQUEST: {message}
 
-TASK: Provide product recommendations that fit the user's budget and financial situation. If the request is vague, ask clarifying questions or provide a range of options at different price points.
+{task}
 """
+
+
+def _advisor_request(agent: agentModel, prompt: str) -> dict:
+    """
+    Contents and config for the advisor's generate_content call.
+    """
+    return {
+        "contents": [types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+        "config": get_agent_config(agent)
+    }
+
+
+def _save_advisor_session(user: User, query_type: str, message: str, advice: str) -> dict:
+    """
+    Save the session and build the success response.
+    """
+    session = AdvisorSession.objects.create(
+        user=user,
+        query_type=query_type,
+        user_query=message,
+        ai_response=advice
+    )
     
-    try:
-        client = genai.Client(api_key=API_KEY)
-        response = client.models.generate_content(
-            model=agent.gemini_model,
-            contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
-            config=types.GenerateContentConfig(
-                system_instruction=agent.system_instruction
-            )
-        )
+    return {
+        "type": "success",
+        "data": {
+            "advice": advice,
+            "session_id": session.id
+        }
+    }
+
+
+@trace_agent(ADVISOR_AGENT.name)
+def _run_advisor_query(user: User, message: str, query_type: str, task: str, error_label: str, bypass_cache: bool = False) -> dict:
+    """
+    Run one advisor query (recommend / analyze / compare).
+    
+    Args:
+        user: The Django User object
+        message: User's request
+        query_type: AdvisorSession query type
+        task: Task instructions appended to the prompt
+        error_label: Prefix for the error message on failure
+        bypass_cache: Ignore a cached answer and ask Gemini again
         
-        advice = response.text
+    Returns:
+        Dictionary with AI-generated advice
+    """
+    agent = get_or_create_advisor_agent()
+    prompt = _build_advisor_prompt(user, message, task)
+    
+    try:
+        response = generate_content(agent, **_advisor_request(agent, prompt), bypass_cache=bypass_cache)
         
-        # Save session
-        session = AdvisorSession.objects.create(
-            user=user,
-            query_type='recommend',
-            user_query=message,
-            ai_response=advice
-        )
+        return _save_advisor_session(user, query_type, message, response.text)
         
+    except Exception as e:
+        logger.exception("Error in advisor %s query", query_type)
         return {
-            "type": "success",
-            "data": {
-                "advice": advice,
-                "session_id": session.id
-            }
+            "type": "error",
+            "data": {"error": f"{error_label}: {str(e)}"}
         }
+
+
+@trace_agent(ADVISOR_AGENT.name)
+async def _arun_advisor_query(user: User, message: str, query_type: str, task: str, error_label: str, bypass_cache: bool = False) -> dict:
+    """
+    Async version of _run_advisor_query().
+    """
+    agent = await aget_or_create_advisor_agent()
+    prompt = await sync_to_async(_build_advisor_prompt)(user, message, task)
+    
+    try:
+        response = await agenerate_content(agent, **_advisor_request(agent, prompt), bypass_cache=bypass_cache)
+        
+        return await sync_to_async(_save_advisor_session)(user, query_type, message, response.text)
         
     except Exception as e:
-        print(f"DEBUG: Error in process_product_recommendation: {str(e)}")
+        logger.exception("Error in advisor %s query", query_type)
         return {
             "type": "error",
-            "data": {"error": f"Failed to generate recommendation: {str(e)}"}
+            "data": {"error": f"{error_label}: {str(e)}"}
         }
 
 
-def process_purchase_analysis(user: User, message: str) -> dict:
+@trace_agent(ADVISOR_AGENT.name)
+async def _astream_advisor_query(user: User, message: str, query_type: str, task: str, error_label: str, bypass_cache: bool = False):
     """
-    Analyze if a specific purchase fits the user's budget.
+    Streaming version of _arun_advisor_query(). The session is saved once the
+    full answer has arrived.
+    
+    Yields:
+        (event, data) tuples, see agents.streaming
+    """
+    agent = await aget_or_create_advisor_agent()
+    prompt = await sync_to_async(_build_advisor_prompt)(user, message, task)
+    
+    try:
+        advice = []
+        stream = agenerate_content_stream(agent, **_advisor_request(agent, prompt), bypass_cache=bypass_cache)
+        async with aclosing(stream):
+            async for chunk in stream:
+                text = chunk_text(chunk)
+                if text:
+                    advice.append(text)
+                    yield "delta", {"text": text}
+        
+        result = await sync_to_async(_save_advisor_session)(user, query_type, message, "".join(advice))
+        yield "done", result["data"]
+        
+    except Exception as e:
+        logger.exception("Error in advisor %s stream", query_type)
+        yield "error", {"error": f"{error_label}: {str(e)}"}
+
+
+def process_product_recommendation(user: User, message: str, bypass_cache: bool = False) -> dict:
+    """
+    Generate product recommendations based on user needs and budget.
     
     Args:
         user: The Django User object
-        message: User's purchase analysis request
+        message: User's request for product recommendations
+        bypass_cache: Ignore a cached answer and ask Gemini again
         
     Returns:
-        Dictionary with AI-generated analysis
+        Dictionary with AI-generated advice
     """
-    print(f"DEBUG: Advisor Agent (Analyze) is running now... processing message: {message}")
-    agent = get_or_create_advisor_agent()
-    
-    # Build context
-    financial_context = _get_user_financial_context(user)
-    
-    prompt = f"""
-{financial_context}
+    logger.debug("Advisor Agent (Recommend) is running now... processing message: %s", payload(message))
+    return _run_advisor_query(user, message, 'recommend', RECOMMEND_TASK, "Failed to generate recommendation", bypass_cache)
 
-USER REQUEST: {message}
-
-TASK: Analyze if this purchase is financially wise for the user. Consider:
-1. Does it fit within their budget?
-2. Which budget category would it come from?
-3. Would it cause overspending?
-4. Are there more affordable alternatives?
-5. Is this a need or a want?
 
-Provide a clear recommendation: "Go ahead", "Consider alternatives", or "Not recommended right now" with detailed reasoning.
-"""
+def process_purchase_analysis(user: User, message: str, bypass_cache: bool = False) -> dict:
+    """
+    Analyze if a specific purchase fits the user's budget.
     
-    try:
-        client = genai.Client(api_key=API_KEY)
-        response = client.models.generate_content(
-            model=agent.gemini_model,
-            contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
-            config=types.GenerateContentConfig(
-                system_instruction=agent.system_instruction
-            )
-        )
-        
-        advice = response.text
-        
-        # Save session
-        session = AdvisorSession.objects.create(
-            user=user,
-            query_type='analyze',
-            user_query=message,
-            ai_response=advice
-        )
-        
-        return {
-            "type": "success",
-            "data": {
-                "advice": advice,
-                "session_id": session.id
-            }
-        }
+    Args:
+        user: The Django User object
+        message: User's purchase analysis request
+        bypass_cache: Ignore a cached answer and ask Gemini again
         
-    except Exception as e:
-        print(f"DEBUG: Error in process_purchase_analysis: {str(e)}")
-        return {
-            "type": "error",
-            "data": {"error": f"Failed to analyze purchase: {str(e)}"}
-        }
+    Returns:
+        Dictionary with AI-generated analysis
+    """
+    logger.debug("Advisor Agent (Analyze) is running now... processing message: %s", payload(message))
+    return _run_advisor_query(user, message, 'analyze', ANALYZE_TASK, "Failed to analyze purchase", bypass_cache)
 
 
-def process_product_comparison(user: User, message: str) -> dict:
+def process_product_comparison(user: User, message: str, bypass_cache: bool = False) -> dict:
     """
     Compare multiple products and recommend the best option.
     
     Args:
         user: The Django User object
         message: User's product comparison request
+        bypass_cache: Ignore a cached answer and ask Gemini again
         
     Returns:
         Dictionary with AI-generated comparison
     """
-    print(f"DEBUG: Advisor Agent (Compare) is running now... processing message: {message}")
-    agent = get_or_create_advisor_agent()
-    
-    # Build context
-    financial_context = _get_user_financial_context(user)
-    
-    prompt = f"""
-{financial_context}
+    logger.debug("Advisor Agent (Compare) is running now... processing message: %s", payload(message))
+    return _run_advisor_query(user, message, 'compare', COMPARE_TASK, "Failed to compare products", bypass_cache)
 
-USER REQUEST: {message}
 
-TASK: Compare the products mentioned and recommend the best option considering:
-1. Price and value for money
-2. User's budget constraints
-3. Features and quality
-4. Long-term value
-5. Financial impact
+async def aprocess_product_recommendation(user: User, message: str, bypass_cache: bool = False) -> dict:
+    """
+    Async version of process_product_recommendation().
+    """
+    return await _arun_advisor_query(user, message, 'recommend', RECOMMEND_TASK, "Failed to generate recommendation", bypass_cache)
 
-Provide a structured comparison with pros/cons and a clear recommendation.
-"""
-    
-    try:
-        client = genai.Client(api_key=API_KEY)
-        response = client.models.generate_content(
-            model=agent.gemini_model,
-            contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
-            config=types.GenerateContentConfig(
-                system_instruction=agent.system_instruction
-            )
-        )
-        
-        advice = response.text
-        
-        # Save session
-        session = AdvisorSession.objects.create(
-            user=user,
-            query_type='compare',
-            user_query=message,
-            ai_response=advice
-        )
-        
-        return {
-            "type": "success",
-            "data": {
-                "advice": advice,
-                "session_id": session.id
-            }
-        }
-        
-    except Exception as e:
-        print(f"DEBUG: Error in process_product_comparison: {str(e)}")
-        return {
-            "type": "error",
-            "data": {"error": f"Failed to compare products: {str(e)}"}
-        }
+
+async def aprocess_purchase_analysis(user: User, message: str, bypass_cache: bool = False) -> dict:
+    """
+    Async version of process_purchase_analysis().
+    """
+    return await _arun_advisor_query(user, message, 'analyze', ANALYZE_TASK, "Failed to analyze purchase", bypass_cache)
+
+
+async def aprocess_product_comparison(user: User, message: str, bypass_cache: bool = False) -> dict:
+    """
+    Async version of process_product_comparison().
+    """
+    return await _arun_advisor_query(user, message, 'compare', COMPARE_TASK, "Failed to compare products", bypass_cache)
+
+
+def astream_product_recommendation(user: User, message: str, bypass_cache: bool = False):
+    """
+    Streaming version of process_product_recommendation().
+    """
+    return _astream_advisor_query(user, message, 'recommend', RECOMMEND_TASK, "Failed to generate recommendation", bypass_cache)
+
+
+def astream_purchase_analysis(user: User, message: str, bypass_cache: bool = False):
+    """
+    Streaming version of process_purchase_analysis().
+    """
+    return _astream_advisor_query(user, message, 'analyze', ANALYZE_TASK, "Failed to analyze purchase", bypass_cache)
+
+
+def astream_product_comparison(user: User, message: str, bypass_cache: bool = False):
+    """
+    Streaming version of process_product_comparison().
+    """
+    return _astream_advisor_query(user, message, 'compare', COMPARE_TASK, "Failed to compare products", bypass_cache)
@@ -3,6 +3,9 @@ from .views import (
     ProductRecommendationView,
     PurchaseAnalysisView,
     ProductComparisonView,
+    ProductRecommendationStreamView,
+    PurchaseAnalysisStreamView,
+    ProductComparisonStreamView,
     AdvisorHistoryView
 )
 
@@ -10,5 +13,8 @@ urlpatterns = [
     path('recommend/', ProductRecommendationView.as_view(), name='advisor-recommend'),
     path('analyze-purchase/', PurchaseAnalysisView.as_view(), name='advisor-analyze'),
     path('compare/', ProductComparisonView.as_view(), name='advisor-compare'),
+    path('recommend/stream/', ProductRecommendationStreamView.as_view(), name='advisor-recommend-stream'),
+    path('analyze-purchase/stream/', PurchaseAnalysisStreamView.as_view(), name='advisor-analyze-stream'),
+    path('compare/stream/', ProductComparisonStreamView.as_view(), name='advisor-compare-stream'),
     path('history/', AdvisorHistoryView.as_view(), name='advisor-history'),
 ]
\ No newline at end of file
@@ -1,13 +1,22 @@
 from rest_framework import status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.utils import extend_schema, OpenApiResponse
 from .serializers import AdvisorQuerySerializer, AdvisorResponseSerializer, AdvisorSessionSerializer
-from .services import process_product_recommendation, process_purchase_analysis, process_product_comparison
+from .services import (
+    aprocess_product_recommendation,
+    aprocess_purchase_analysis,
+    aprocess_product_comparison,
+    astream_product_recommendation,
+    astream_purchase_analysis,
+    astream_product_comparison
+)
 from .models import AdvisorSession
+from agents.streaming import event_stream_response
+from agents.views import AsyncAPIView, AsyncStreamView
 
 
-class ProductRecommendationView(APIView):
+class ProductRecommendationView(AsyncAPIView):
     """
     Get AI-powered product recommendations based on budget and preferences.
     """
@@ -18,13 +27,13 @@ class ProductRecommendationView(APIView):
         responses=AdvisorResponseSerializer,
         description="Get product recommendations based on your budget and preferences. The AI will suggest products that fit your financial situation."
     )
-    def post(self, request):
+    async def post(self, request):
         serializer = AdvisorQuerySerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         message = serializer.validated_data['message']
-        result = process_product_recommendation(request.user, message)
+        result = await aprocess_product_recommendation(request.user, message, bypass_cache=serializer.validated_data['refresh'])
         
         if result['type'] == 'error':
             return Response(result['data'], status=status.HTTP_400_BAD_REQUEST)
@@ -32,7 +41,7 @@ class ProductRecommendationView(APIView):
         return Response(result['data'])
 
 
-class PurchaseAnalysisView(APIView):
+class PurchaseAnalysisView(AsyncAPIView):
     """
     Analyze if a specific purchase fits your budget.
     """
@@ -43,13 +52,13 @@ class PurchaseAnalysisView(APIView):
         responses=AdvisorResponseSerializer,
         description="Analyze if a specific purchase is financially wise. The AI will consider your budget, spending patterns, and financial health."
     )
-    def post(self, request):
+    async def post(self, request):
         serializer = AdvisorQuerySerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         message = serializer.validated_data['message']
-        result = process_purchase_analysis(request.user, message)
+        result = await aprocess_purchase_analysis(request.user, message, bypass_cache=serializer.validated_data['refresh'])
         
         if result['type'] == 'error':
             return Response(result['data'], status=status.HTTP_400_BAD_REQUEST)
@@ -57,7 +66,7 @@ class PurchaseAnalysisView(APIView):
         return Response(result['data'])
 
 
-class ProductComparisonView(APIView):
+class ProductComparisonView(AsyncAPIView):
     """
     Compare multiple products and get a recommendation.
     """
@@ -68,13 +77,13 @@ class ProductComparisonView(APIView):
         responses=AdvisorResponseSerializer,
         description="Compare multiple products and get AI-powered recommendations on which is the best choice for your budget."
     )
-    def post(self, request):
+    async def post(self, request):
         serializer = AdvisorQuerySerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         message = serializer.validated_data['message']
-        result = process_product_comparison(request.user, message)
+        result = await aprocess_product_comparison(request.user, message, bypass_cache=serializer.validated_data['refresh'])
         
         if result['type'] == 'error':
             return Response(result['data'], status=status.HTTP_400_BAD_REQUEST)
@@ -82,6 +91,55 @@ class ProductComparisonView(APIView):
         return Response(result['data'])
 
 
+class AdvisorStreamView(AsyncStreamView):
+    """
+    Base for the streaming (Server-Sent Events) advisor endpoints.
+    
+    Subclasses set `stream_function` to one of the astream_* services.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    stream_function = None
+    
+    @extend_schema(
+        request=AdvisorQuerySerializer,
+        responses={
+            (200, 'text/event-stream'): OpenApiResponse(description="SSE stream: `delta` events with {text}, then `done` with {advice, session_id} or `error` with {error}")
+        },
+        description="Same as the non-streaming advisor endpoint, but the advice is sent as it is generated. The session is saved when the stream completes."
+    )
+    async def post(self, request):
+        serializer = AdvisorQuerySerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        return event_stream_response(type(self).stream_function(
+            request.user,
+            serializer.validated_data['message'],
+            bypass_cache=serializer.validated_data['refresh']
+        ))
+
+
+class ProductRecommendationStreamView(AdvisorStreamView):
+    """
+    Streaming variant of ProductRecommendationView.
+    """
+    stream_function = astream_product_recommendation
+
+
+class PurchaseAnalysisStreamView(AdvisorStreamView):
+    """
+    Streaming variant of PurchaseAnalysisView.
+    """
+    stream_function = astream_purchase_analysis
+
+
+class ProductComparisonStreamView(AdvisorStreamView):
+    """
+    Streaming variant of ProductComparisonView.
+    """
+    stream_function = astream_product_comparison
+
+
 class AdvisorHistoryView(APIView):
     """
     Get past advisor sessions.
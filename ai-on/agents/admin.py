@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import agentModel, ConversationHistory
+from .models import agentModel, ConversationHistory, ConversationSummary
 # Register your models here.
 
 admin.site.register(agentModel)
 admin.site.register(ConversationHistory)
+admin.site.register(ConversationSummary)
@@ -4,3 +4,25 @@ from django.apps import AppConfig
 class AgentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'agents'
+
+    def ready(self):
+        # Saving or deleting an agent row reloads this process's agent registry
+        from django.db import transaction
+        from django.db.models.signals import post_save, post_delete
+        from .models import agentModel
+        from .registry import agent_registry
+
+        def reload_agent_registry(sender, **kwargs):
+            transaction.on_commit(agent_registry.invalidate)
+
+        post_save.connect(reload_agent_registry, sender=agentModel, dispatch_uid="agents.reload_registry")
+        post_delete.connect(reload_agent_registry, sender=agentModel, dispatch_uid="agents.reload_registry")
+
+        # Time every database query for the /metrics endpoint
+        from django.db.backends.signals import connection_created
+        from .metrics import install_query_timer
+        connection_created.connect(install_query_timer, dispatch_uid="agents.metrics.query_timer")
+
+        # Attribute queries to the current request's Server-Timing profile
+        from .profiling import install_query_profiler
+        connection_created.connect(install_query_profiler, dispatch_uid="agents.profiling.query_profiler")
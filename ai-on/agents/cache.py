@@ -0,0 +1,211 @@
+"""
+LLM Response Cache
+
+Content-addressed cache for Gemini generate_content responses, used by
+agents.services.generate_content / agenerate_content.
+
+Two tiers:
+- an in-process LRU (per worker, bounded by LLM_CACHE_MEMORY_ENTRIES)
+- a persistent tier on the Django cache alias LLM_CACHE_BACKEND
+  (file-based by default, shared by all workers on the host; point it at a
+  DatabaseCache or Redis alias to share it wider)
+
+Entries are keyed by a SHA-256 of the model, system instruction, tool
+declarations, generation config and contents, so any change in the user's
+data produces a new key. TTLs are set per agent in LLM_CACHE_TTLS.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from google.genai import types
+from pydantic import BaseModel
+
+
+# Config fields hashed separately (system_instruction, tools) or not part of
+# the request semantics (http_options).
+_CONFIG_EXCLUDE = {'system_instruction', 'tools', 'response_schema', 'http_options'}
+
+
+def _dump(value):
+    """JSON-safe dump of SDK objects, dicts and lists."""
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode='json', exclude_none=True)
+    if isinstance(value, (list, tuple)):
+        return [_dump(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _dump(v) for k, v in value.items()}
+    return value
+
+
+def _dump_schema(schema):
+    if isinstance(schema, type) and issubclass(schema, BaseModel):
+        return schema.model_json_schema()
+    return _dump(schema)
+
+
+def make_cache_key(model: str, contents, config: types.GenerateContentConfig | None) -> str:
+    """
+    Hash everything that determines the model's answer.
+
+    Args:
+        model: Gemini model name
+        contents: The contents sent to generate_content
+        config: The GenerateContentConfig (may be None)
+
+    Returns:
+        Hex SHA-256 digest
+    """
+    payload = {
+        "model": model,
+        "system_instruction": _dump(config.system_instruction) if config else None,
+        "tools": _dump(config.tools) if config else None,
+        "response_schema": _dump_schema(config.response_schema) if config else None,
+        "config": config.model_dump(mode='json', exclude_none=True, exclude=_CONFIG_EXCLUDE) if config else None,
+        "contents": _dump(contents),
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def serialize_response(response: types.GenerateContentResponse) -> dict:
+    return response.model_dump(mode='json', exclude_none=True, exclude={'parsed', 'sdk_http_response'})
+
+
+def deserialize_response(data: dict, config: types.GenerateContentConfig | None) -> types.GenerateContentResponse:
+    """
+    Rebuild a response, re-deriving .parsed for structured-output configs.
+    """
+    response = types.GenerateContentResponse.model_validate(data)
+    schema = config.response_schema if config else None
+    if isinstance(schema, type) and issubclass(schema, BaseModel) and response.text:
+        try:
+            response.parsed = schema.model_validate_json(response.text)
+        except ValueError:
+            response.parsed = None
+    return response
+
+
+def is_cacheable(response: types.GenerateContentResponse) -> bool:
+    """Only cache complete answers (no blocked or empty candidates)."""
+    return bool(
+        response.candidates
+        and response.candidates[0].content
+        and response.candidates[0].content.parts
+    )
+
+
+class LLMResponseCache:
+    """
+    Two-tier (memory LRU + persistent) response cache with hit/miss counters.
+    """
+
+    def __init__(self, max_memory_entries: int, backend_alias: str | None):
+        self.max_memory_entries = max_memory_entries
+        self.backend_alias = backend_alias
+        self._memory = OrderedDict()  # key -> (expires_at, payload)
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "stores": 0})
+
+    @property
+    def backend(self):
+        return caches[self.backend_alias] if self.backend_alias else None
+
+    def _count(self, agent_name: str, counter: str):
+        with self._lock:
+            self._stats[agent_name][counter] += 1
+
+    def _memory_get(self, key: str):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at <= time.monotonic():
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return payload
+
+    def _memory_set(self, key: str, payload: dict, ttl: int):
+        with self._lock:
+            self._memory[key] = (time.monotonic() + ttl, payload)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def _record_lookup(self, agent_name: str, key: str, payload, persistent_payload, ttl: int):
+        if payload is not None:
+            self._count(agent_name, "memory_hits")
+            return payload
+        if persistent_payload is not None:
+            self._count(agent_name, "persistent_hits")
+            self._memory_set(key, persistent_payload, ttl)
+            return persistent_payload
+        self._count(agent_name, "misses")
+        return None
+
+    def get(self, agent_name: str, key: str, ttl: int) -> dict | None:
+        payload = self._memory_get(key)
+        persistent_payload = None
+        if payload is None and self.backend is not None:
+            persistent_payload = self.backend.get(key)
+        return self._record_lookup(agent_name, key, payload, persistent_payload, ttl)
+
+    async def aget(self, agent_name: str, key: str, ttl: int) -> dict | None:
+        payload = self._memory_get(key)
+        persistent_payload = None
+        if payload is None and self.backend is not None:
+            persistent_payload = await self.backend.aget(key)
+        return self._record_lookup(agent_name, key, payload, persistent_payload, ttl)
+
+    def set(self, agent_name: str, key: str, payload: dict, ttl: int):
+        self._memory_set(key, payload, ttl)
+        if self.backend is not None:
+            self.backend.set(key, payload, ttl)
+        self._count(agent_name, "stores")
+
+    async def aset(self, agent_name: str, key: str, payload: dict, ttl: int):
+        self._memory_set(key, payload, ttl)
+        if self.backend is not None:
+            await self.backend.aset(key, payload, ttl)
+        self._count(agent_name, "stores")
+
+    def stats(self) -> dict:
+        """
+        Per-agent counters plus the current memory tier size.
+        """
+        with self._lock:
+            agents = {name: dict(counters) for name, counters in self._stats.items()}
+            memory_entries = len(self._memory)
+        for counters in agents.values():
+            lookups = counters["memory_hits"] + counters["persistent_hits"] + counters["misses"]
+            counters["hit_rate"] = round((lookups - counters["misses"]) / lookups, 4) if lookups else 0.0
+        return {"memory_entries": memory_entries, "agents": agents}
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._stats.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+
+response_cache = LLMResponseCache(
+    max_memory_entries=settings.LLM_CACHE_MEMORY_ENTRIES,
+    backend_alias=settings.LLM_CACHE_BACKEND,
+)
+
+
+def get_cache_ttl(agent_name: str) -> int:
+    """
+    TTL in seconds for an agent's responses (0 disables caching).
+    """
+    if not settings.LLM_CACHE_ENABLED:
+        return 0
+    return settings.LLM_CACHE_TTLS.get(agent_name, 0)
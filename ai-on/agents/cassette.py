@@ -0,0 +1,349 @@
+"""
+Gemini Cassettes
+
+Record / replay of the Gemini traffic of the agent layer, selected with
+GEMINI_CASSETTE_MODE:
+
+- 'record': every generate_content / generate_content_stream call (sync and
+  client.aio) goes to the configured backend (GEMINI_BACKEND) and is
+  appended, with its latency, to the cassette directory
+- 'replay': calls are answered from the cassette, sleeping the recorded
+  latency times GEMINI_CASSETTE_LATENCY_SCALE (0 for none); nothing is sent
+
+Replaying a production trace through process_chatbot_message and friends
+then measures our own overhead (ORM, serialization, history handling) on a
+fixed model time: wall time minus Cassette.stats()['model_seconds'].
+
+Storage: one gzip'd JSON-lines file per recording process
+(gemini-<pid>-<timestamp>.jsonl.gz), one entry per call:
+
+    {"key": <make_cache_key hash>, "agent": <model + system instruction hash>,
+     "model": "gemini-2.5-flash", "latency": 0.84,
+     "response": {...}}                        # generate_content
+     "chunks": [[0.31, {...}], [0.52, {...}]]  # stream, with arrival offsets
+     "error": {"code": 503, "details": {...}}  # the call raised an APIError
+
+Lookups are by request hash. Requests that embed volatile data (dates, ids,
+other users' budgets) will not hash the same in CI, so with
+GEMINI_CASSETTE_MATCH = 'agent' a miss falls back to the next recorded
+answer of the same agent and model, in recording order; 'exact' raises
+CassetteMiss instead. Record with the LLM response cache cold (or disabled):
+cache hits never reach the client and so are not recorded.
+"""
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+
+from google.genai import errors, types
+
+from .cache import deserialize_response, make_cache_key, serialize_response
+
+
+logger = logging.getLogger(__name__)
+
+
+class CassetteMiss(LookupError):
+    """No recorded answer for a replayed request."""
+
+
+def agent_key(model: str, config: types.GenerateContentConfig | None) -> str:
+    """
+    Hash of the model and system instruction: identifies the calling agent.
+    """
+    system = types.GenerateContentConfig(system_instruction=config.system_instruction) if config else None
+    return make_cache_key(model, [], system)
+
+
+def _api_error(error: dict) -> errors.APIError:
+    if error["code"] >= 500:
+        return errors.ServerError(error["code"], error["details"])
+    return errors.ClientError(error["code"], error["details"])
+
+
+class Cassette:
+    """
+    The entries of a cassette directory, plus the writer of a recording.
+    """
+
+    def __init__(self, path, match: str = "agent", latency_scale: float = 1.0):
+        self.path = Path(path)
+        self.match = match
+        self.latency_scale = latency_scale
+        self._by_key = defaultdict(deque)
+        self._by_agent = defaultdict(deque)
+        self._played = set()  # ids of served entries (agent fallback skips them)
+        self._writer = None
+        self._lock = threading.Lock()
+        self._stats = {"recorded": 0, "replayed": 0, "fallbacks": 0, "misses": 0, "model_seconds": 0.0}
+
+    # -- replay ---------------------------------------------------------------
+
+    def load(self) -> int:
+        """
+        Read every *.jsonl.gz file of the directory (oldest first).
+
+        Returns:
+            Number of entries loaded
+        """
+        count = 0
+        for file in sorted(self.path.glob("*.jsonl.gz"), key=lambda p: p.stat().st_mtime):
+            for entry in self._read(file):
+                self._by_key[entry["key"]].append(entry)
+                self._by_agent[entry["agent"]].append(entry)
+                count += 1
+        logger.info("Cassette loaded %d entries from %s", count, self.path)
+        return count
+
+    @staticmethod
+    def _read(file: Path):
+        with gzip.open(file, "rt", encoding="utf-8") as fh:
+            try:
+                for line in fh:
+                    if line.strip():
+                        yield json.loads(line)
+            except EOFError:
+                # Recording process was killed before closing the file
+                pass
+
+    def lookup(self, model: str, contents, config: types.GenerateContentConfig | None) -> dict:
+        """
+        Next recorded entry for a request.
+
+        An exact key is served in recording order; its last entry keeps being
+        served once the others are used.
+
+        Raises:
+            CassetteMiss: nothing recorded for this request (or agent)
+        """
+        key = make_cache_key(model, contents, config)
+        with self._lock:
+            entries = self._by_key.get(key)
+            if entries:
+                entry = entries.popleft() if len(entries) > 1 else entries[0]
+            elif self.match == "agent":
+                entry = self._next_for_agent(agent_key(model, config))
+                self._stats["fallbacks"] += entry is not None
+            else:
+                entry = None
+
+            if entry is None:
+                self._stats["misses"] += 1
+                raise CassetteMiss(f"No recorded Gemini answer for {model} request {key[:12]}")
+
+            self._played.add(id(entry))
+            self._stats["replayed"] += 1
+            self._stats["model_seconds"] += entry["latency"]
+        return entry
+
+    def _next_for_agent(self, key: str) -> dict | None:
+        entries = self._by_agent.get(key)
+        while entries:
+            entry = entries.popleft()
+            if id(entry) not in self._played:
+                return entry
+        return None
+
+    def delay(self, seconds: float) -> float:
+        return seconds * self.latency_scale
+
+    # -- record ---------------------------------------------------------------
+
+    def record(self, model: str, contents, config: types.GenerateContentConfig | None, latency: float,
+               response: types.GenerateContentResponse = None, chunks: list = None,
+               error: errors.APIError = None):
+        """
+        Append one call to this process's cassette file.
+
+        Args:
+            latency: Seconds from the call to its answer (or to the last chunk)
+            response: The GenerateContentResponse of a generate_content call
+            chunks: (offset, chunk) pairs of a stream
+            error: The APIError the call raised
+        """
+        entry = {
+            "key": make_cache_key(model, contents, config),
+            "agent": agent_key(model, config),
+            "model": model,
+            "latency": round(latency, 4),
+        }
+        if error is not None:
+            entry["error"] = {"code": error.code, "details": error.details}
+        elif chunks is not None:
+            entry["chunks"] = [[round(offset, 4), serialize_response(chunk)] for offset, chunk in chunks]
+        else:
+            entry["response"] = serialize_response(response)
+        line = json.dumps(entry, separators=(",", ":"), default=str) + "\n"
+
+        with self._lock:
+            if self._writer is None:
+                self.path.mkdir(parents=True, exist_ok=True)
+                file = self.path / f"gemini-{os.getpid()}-{int(time.time())}.jsonl.gz"
+                self._writer = gzip.open(file, "at", encoding="utf-8")
+                logger.info("Recording Gemini traffic to %s", file)
+            self._writer.write(line)
+            # Sync-flush so a killed worker leaves a readable file
+            self._writer.flush()
+            self._stats["recorded"] += 1
+            self._stats["model_seconds"] += latency
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, model_seconds=round(self._stats["model_seconds"], 3))
+
+
+class _CassetteModels:
+
+    def __init__(self, cassette: Cassette, backend=None):
+        self._cassette = cassette
+        self._backend = backend  # callable returning the recorded client, None when replaying
+
+    def generate_content(self, *, model: str, contents, config: types.GenerateContentConfig = None):
+        if self._backend is None:
+            entry = self._cassette.lookup(model, contents, config)
+            time.sleep(self._cassette.delay(entry["latency"]))
+            if "error" in entry:
+                raise _api_error(entry["error"])
+            if "chunks" in entry:
+                # Recorded as a stream, replayed whole
+                from .services import merge_stream_chunks
+                return merge_stream_chunks([deserialize_response(chunk, config) for _, chunk in entry["chunks"]])
+            return deserialize_response(entry["response"], config)
+
+        started = time.perf_counter()
+        try:
+            response = self._backend().models.generate_content(model=model, contents=contents, config=config)
+        except errors.APIError as e:
+            self._cassette.record(model, contents, config, time.perf_counter() - started, error=e)
+            raise
+        self._cassette.record(model, contents, config, time.perf_counter() - started, response=response)
+        return response
+
+    def generate_content_stream(self, *, model: str, contents, config: types.GenerateContentConfig = None):
+        if self._backend is None:
+            entry = self._cassette.lookup(model, contents, config)
+            if "error" in entry:
+                time.sleep(self._cassette.delay(entry["latency"]))
+                raise _api_error(entry["error"])
+            elapsed = 0.0
+            for offset, chunk in _replay_chunks(entry):
+                time.sleep(self._cassette.delay(offset - elapsed))
+                elapsed = offset
+                yield deserialize_response(chunk, config)
+            return
+
+        started = time.perf_counter()
+        chunks = []
+        try:
+            for chunk in self._backend().models.generate_content_stream(model=model, contents=contents, config=config):
+                chunks.append((time.perf_counter() - started, chunk))
+                yield chunk
+        except errors.APIError as e:
+            if not chunks:
+                self._cassette.record(model, contents, config, time.perf_counter() - started, error=e)
+            raise
+        self._cassette.record(model, contents, config, time.perf_counter() - started, chunks=chunks)
+
+
+class _CassetteAsyncModels:
+
+    def __init__(self, cassette: Cassette, backend=None):
+        self._cassette = cassette
+        self._backend = backend
+
+    async def generate_content(self, *, model: str, contents, config: types.GenerateContentConfig = None):
+        if self._backend is None:
+            entry = self._cassette.lookup(model, contents, config)
+            await asyncio.sleep(self._cassette.delay(entry["latency"]))
+            if "error" in entry:
+                raise _api_error(entry["error"])
+            if "chunks" in entry:
+                from .services import merge_stream_chunks
+                return merge_stream_chunks([deserialize_response(chunk, config) for _, chunk in entry["chunks"]])
+            return deserialize_response(entry["response"], config)
+
+        started = time.perf_counter()
+        try:
+            response = await self._backend().models.generate_content(model=model, contents=contents, config=config)
+        except errors.APIError as e:
+            self._cassette.record(model, contents, config, time.perf_counter() - started, error=e)
+            raise
+        self._cassette.record(model, contents, config, time.perf_counter() - started, response=response)
+        return response
+
+    async def generate_content_stream(self, *, model: str, contents, config: types.GenerateContentConfig = None):
+        cassette = self._cassette
+
+        if self._backend is None:
+            entry = cassette.lookup(model, contents, config)
+            if "error" in entry:
+                await asyncio.sleep(cassette.delay(entry["latency"]))
+                raise _api_error(entry["error"])
+
+            async def _replay():
+                elapsed = 0.0
+                for offset, chunk in _replay_chunks(entry):
+                    await asyncio.sleep(cassette.delay(offset - elapsed))
+                    elapsed = offset
+                    yield deserialize_response(chunk, config)
+
+            return _replay()
+
+        started = time.perf_counter()
+        try:
+            stream = await self._backend().models.generate_content_stream(model=model, contents=contents, config=config)
+        except errors.APIError as e:
+            cassette.record(model, contents, config, time.perf_counter() - started, error=e)
+            raise
+
+        async def _record():
+            chunks = []
+            async for chunk in stream:
+                chunks.append((time.perf_counter() - started, chunk))
+                yield chunk
+            cassette.record(model, contents, config, time.perf_counter() - started, chunks=chunks)
+
+        return _record()
+
+
+def _replay_chunks(entry: dict) -> list:
+    if "chunks" in entry:
+        return entry["chunks"]
+    # Recorded whole, replayed as a single chunk
+    return [[entry["latency"], entry["response"]]]
+
+
+class _CassetteAsyncClient:
+
+    def __init__(self, cassette: Cassette, backend=None):
+        self.models = _CassetteAsyncModels(cassette, backend)
+
+
+class CassetteClient:
+    """
+    genai.Client look-alike (client.models and client.aio.models) that records
+    or replays through a Cassette.
+
+    Args:
+        cassette: The Cassette to read from / append to
+        backend: When recording, callable returning the real sync client
+        async_backend: When recording, callable returning the real async client
+            (client.aio) of the running loop
+    """
+
+    def __init__(self, cassette: Cassette, backend=None, async_backend=None):
+        self.cassette = cassette
+        self.models = _CassetteModels(cassette, backend)
+        self.aio = _CassetteAsyncClient(cassette, async_backend)
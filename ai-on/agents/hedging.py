@@ -0,0 +1,327 @@
+"""
+Hedged Gemini Calls
+
+Opt-in per-agent policies (LLM_HEDGE_POLICIES, empty by default) that trade
+a little quota for the latency tail of agents.services.generate_content /
+agenerate_content:
+
+    'budget_agent': {'hedge_after': 12.0, 'deadline': 25.0, 'fallback_model': 'gemini-2.5-flash'}
+
+- hedge_after: seconds the agent's model (its agentModel.gemini_model) has
+  had the request without answering, after which it is sent again
+- deadline: seconds after which fallback_model, a faster tier, is asked too
+- both timers start once the primary request is admitted by agents.scheduler
+  and stop when it ends: time spent queued for quota or waiting out a retry
+  backoff never hedges
+- a hedge or fallback leg is one attempt, without retries, sent only if its
+  model has room right now (scheduler) and a closed circuit; otherwise it is
+  skipped
+- when the primary fails for good, a leg in flight is waited for and the
+  fallback is asked at once if it wasn't yet
+
+Every attempt runs concurrently, the primary with its usual retries: in the
+hedge pool for sync calls (the caller waits for the first answer), as tasks
+for async ones. The first answer wins. Async attempts that lose are
+cancelled; a sync one can't be interrupted mid-request, so it runs to its
+end unwatched, while one not started yet (or a primary between retries)
+is never sent. LLM_HEDGE_MAX_WORKERS therefore also bounds the sync hedged
+calls in flight.
+
+Tuning: agent_llm_hedge_total{agent, winner} counts which attempt answered
+(primary, hedge, fallback, none) and agent_llm_hedge_requests_total{agent,
+kind, outcome} the legs sent or skipped. hedge_after is usually set near the
+p95 of agent_llm_call_seconds for the agent; a hedge that rarely wins
+(hedge requests >> hedge wins) is set too early.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .metrics import observe_hedge, observe_hedge_request
+from .resilience import ModelUnavailable
+
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = "primary"
+HEDGE = "hedge"
+FALLBACK = "fallback"
+
+_hedge_pool = ThreadPoolExecutor(max_workers=settings.LLM_HEDGE_MAX_WORKERS, thread_name_prefix="gemini-hedge")
+
+
+class HedgeSkipped(Exception):
+    """A hedge or fallback leg was not sent (no room on its model, or the race was over)."""
+
+
+def get_hedge_policy(agent_name: str, model: str, agent_model: str) -> dict | None:
+    """
+    Hedge policy for a call, or None to call the model once.
+    """
+    if not settings.LLM_HEDGING_ENABLED or model != agent_model:
+        return None
+    return settings.LLM_HEDGE_POLICIES.get(agent_name)
+
+
+class _Timer:
+    __slots__ = ("due", "callback", "args", "cancelled")
+
+    def __init__(self, due: float, callback, args: tuple):
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _Timers:
+    """
+    One thread running the hedge timers of every sync call in the process.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._order = itertools.count()
+        self._pid = None
+
+    def schedule(self, delay: float, callback, *args) -> _Timer:
+        timer = _Timer(time.monotonic() + delay, callback, args)
+        with self._cond:
+            if self._pid != os.getpid():
+                # First timer of this (possibly forked) process
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="gemini-hedge-timers", daemon=True).start()
+            heapq.heappush(self._heap, (timer.due, next(self._order), timer))
+            self._cond.notify()
+        return timer
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, timer = heapq.heappop(self._heap)
+            if not timer.cancelled:
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logger.exception("Hedge timer failed")
+
+
+_timers = _Timers()
+
+
+class _Race:
+    """
+    When to send which leg, shared by the sync and async runners.
+
+    arm() / disarm() are called by the primary around each request it has
+    with the model; schedule(delay, callback, *args) starts a cancellable
+    timer and send(kind, model) starts a leg.
+    """
+
+    def __init__(self, agent_name: str, model: str, policy: dict, schedule, send):
+        self.agent_name = agent_name
+        self.model = model
+        self.started = time.monotonic()
+        self.hedge_after = policy.get("hedge_after")
+        self.fallback_model = policy.get("fallback_model")
+        self.deadline = policy.get("deadline") if self.fallback_model else None
+        self.sent = set()
+        self.error = None
+        self.closed = False   # no more legs are sent
+        self.decided = False  # legs not started yet are skipped
+        self._schedule = schedule
+        self._send = send
+        self._timers = []
+        self._lock = threading.Lock()
+
+    def arm(self):
+        with self._lock:
+            if self.closed:
+                return
+            if self.hedge_after is not None and HEDGE not in self.sent:
+                self._timers.append(self._schedule(self.hedge_after, self.fire, HEDGE))
+            if self.deadline is not None and FALLBACK not in self.sent:
+                self._timers.append(self._schedule(self.deadline, self.fire, FALLBACK))
+
+    def disarm(self):
+        with self._lock:
+            timers, self._timers = self._timers, []
+        for timer in timers:
+            timer.cancel()
+
+    def fire(self, kind: str):
+        # Send the `kind` leg, once per race
+        with self._lock:
+            if self.closed or kind in self.sent or (kind == FALLBACK and not self.fallback_model):
+                return
+            self.sent.add(kind)
+            self._send(kind, self.fallback_model if kind == FALLBACK else self.model)
+
+    def fall_back(self):
+        # The primary failed for good
+        self.disarm()
+        if self.fallback_model and FALLBACK not in self.sent:
+            logger.info("%s failed for %s, falling back to %s", self.model, self.agent_name, self.fallback_model)
+        self.fire(FALLBACK)
+
+    def stop(self):
+        with self._lock:
+            self.closed = True
+        self.disarm()
+
+    def finish(self):
+        self.decided = True
+        self.stop()
+
+    def skipped(self, kind: str, attempt_model: str) -> HedgeSkipped:
+        observe_hedge_request(self.agent_name, kind, "skipped")
+        return HedgeSkipped(f"{kind} to {attempt_model} not sent")
+
+    def failed(self, error: Exception):
+        if not isinstance(error, HedgeSkipped):
+            self.error = self.error or error
+
+    def won(self, kind: str):
+        observe_hedge(self.agent_name, kind)
+        if kind == FALLBACK:
+            logger.info("%s answered for %s after %.1fs", self.fallback_model, self.agent_name,
+                        time.monotonic() - self.started)
+
+    def lost(self) -> Exception:
+        observe_hedge(self.agent_name, "none")
+        return self.error
+
+    def leg(self, attempt, kind: str, attempt_model: str):
+        if self.decided:
+            raise self.skipped(kind, attempt_model)
+        sent = True
+        try:
+            return attempt(attempt_model, kind)
+        except (HedgeSkipped, ModelUnavailable):
+            sent = False
+            raise self.skipped(kind, attempt_model) from None
+        finally:
+            if sent:
+                observe_hedge_request(self.agent_name, kind, "sent")
+
+    async def aleg(self, attempt, kind: str, attempt_model: str):
+        sent = True
+        try:
+            return await attempt(attempt_model, kind)
+        except (HedgeSkipped, ModelUnavailable):
+            sent = False
+            raise self.skipped(kind, attempt_model) from None
+        finally:
+            if sent:
+                observe_hedge_request(self.agent_name, kind, "sent")
+
+
+def run_hedged(agent_name: str, model: str, policy: dict, attempt):
+    """
+    Make the call attempt(model, kind, race=None) describes under `policy`.
+
+    Args:
+        agent_name: Agent making the call (metrics label)
+        model: The agent's model
+        policy: Its LLM_HEDGE_POLICIES entry
+        attempt: Blocking callable, run in the hedge pool. The primary is
+            attempt(model, PRIMARY, race), which must call race.arm() once
+            its request is admitted and race.disarm() when it ends; legs are
+            attempt(leg_model, kind)
+
+    Returns:
+        The first response, whichever attempt gave it
+
+    Raises:
+        The primary's exception when every attempt failed
+    """
+    context = contextvars.copy_context()
+    finished = queue.SimpleQueue()
+    legs = {}
+
+    def start(kind: str, call, *args):
+        future = _hedge_pool.submit(context.copy().run, call, *args)
+        legs[future] = kind
+        future.add_done_callback(finished.put)
+
+    def send(kind: str, attempt_model: str):
+        start(kind, race.leg, attempt, kind, attempt_model)
+
+    race = _Race(agent_name, model, policy, _timers.schedule, send)
+    start(PRIMARY, attempt, model, PRIMARY, race)
+    try:
+        while legs:
+            future = finished.get()
+            kind = legs.pop(future)
+            try:
+                response = future.result()
+            except Exception as e:
+                race.failed(e)
+                if kind == PRIMARY:
+                    race.fall_back()
+                continue
+            race.won(kind)
+            return response
+        raise race.lost()
+    finally:
+        race.finish()
+        for future in legs:
+            future.cancel()
+
+
+async def arun_hedged(agent_name: str, model: str, policy: dict, attempt):
+    """
+    Async version of run_hedged(); attempt is a coroutine function. The
+    attempts run as tasks, and those that lose are cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    finished = asyncio.Queue()
+    legs = {}
+
+    def start(kind: str, coroutine):
+        task = loop.create_task(coroutine, context=context.copy())
+        task.add_done_callback(finished.put_nowait)
+        legs[task] = kind
+
+    def send(kind: str, attempt_model: str):
+        start(kind, race.aleg(attempt, kind, attempt_model))
+
+    def schedule(delay: float, callback, *args):
+        return loop.call_later(delay, callback, *args)
+
+    race = _Race(agent_name, model, policy, schedule, send)
+    start(PRIMARY, attempt(model, PRIMARY, race))
+    try:
+        while legs:
+            task = await finished.get()
+            kind = legs.pop(task)
+            try:
+                response = task.result()
+            except Exception as e:
+                race.failed(e)
+                if kind == PRIMARY:
+                    race.fall_back()
+                continue
+            race.won(kind)
+            return response
+        raise race.lost()
+    finally:
+        race.finish()
+        for task in legs:
+            task.cancel()
@@ -0,0 +1,211 @@
+"""
+Agent History Window
+
+Bounds the conversation history sent to Gemini for agents that have a
+policy in AGENT_HISTORY_POLICIES:
+
+- the last `keep_turns` turns are sent verbatim, trimmed further (oldest
+  first, never below one turn) to fit `max_tokens`
+- older turns are folded into a persisted rolling summary
+  (ConversationSummary), refreshed incrementally every `summarize_every`
+  turns or sooner when the token budget requires it
+
+A turn starts at a user text message and runs until the next one, so a
+function call and its response always land on the same side of the window
+boundary.
+
+Only the unsummarized tail of the history is read (from the in-process
+history cache, see history_cache.py), so the cost of building a prompt does
+not grow with the number of stored turns.
+"""
+
+import json
+
+from django.conf import settings
+from google.genai import types
+
+from .history_cache import history_cache, CHARS_PER_TOKEN
+from .models import ConversationSummary
+
+
+SUMMARY_SYSTEM_INSTRUCTION = """
+You maintain a running summary of a conversation between a user and a personal finance assistant.
+Update the existing summary with the new turns. Keep facts about the user's finances, goals,
+preferences and any decisions or actions taken (profile edits, budgets, expenses). Drop small talk.
+Write plain text, at most a few short paragraphs.
+"""
+
+def get_history_policy(agent_name: str) -> dict | None:
+    """
+    History policy for an agent, or None to send the full history.
+    """
+    return settings.AGENT_HISTORY_POLICIES.get(agent_name)
+
+
+def is_turn_start(role: str, part: dict) -> bool:
+    """
+    Whether a history row opens a new turn (a user text message).
+    """
+    return role == "user" and any("text" in p for p in part.get("parts", []))
+
+
+def estimate_tokens(content_data: dict) -> int:
+    return len(json.dumps(content_data, default=str)) // CHARS_PER_TOKEN + 1
+
+
+def _group_turns(rows: list) -> list:
+    turns = []
+    for row in rows:
+        if row.is_turn_start or not turns:
+            turns.append([row])
+        else:
+            turns[-1].append(row)
+    return turns
+
+
+def _turn_tokens(turn: list) -> int:
+    return sum(row.tokens for row in turn)
+
+
+class HistoryWindow:
+    """
+    What to send for one agent call: the rolling summary, the verbatim rows
+    and any rows that should be folded into the summary first.
+    """
+
+    def __init__(self, agent, user, summary: str, verbatim: list, pending: list,
+                 fold: bool, covered_until: int, token_budget_exceeded: bool):
+        self.agent = agent
+        self.user = user
+        self.summary = summary
+        self.verbatim = verbatim
+        self.pending = pending
+        self.fold = fold
+        self.covered_until = covered_until
+        self.token_budget_exceeded = token_budget_exceeded
+
+    def summary_request(self) -> dict:
+        """
+        Contents and config for the incremental summary call.
+        """
+        lines = []
+        for row in self.pending:
+            lines.extend(_render_row(row))
+        prompt = (
+            f"EXISTING SUMMARY:\n{self.summary or '(none)'}\n\n"
+            f"NEW TURNS:\n" + "\n".join(lines)
+        )
+        return {
+            "contents": [types.Content(role="user", parts=[types.Part(text=prompt)])],
+            "config": types.GenerateContentConfig(
+                system_instruction=SUMMARY_SYSTEM_INSTRUCTION,
+                max_output_tokens=settings.AGENT_HISTORY_SUMMARY_MAX_TOKENS,
+                temperature=0.2
+            ),
+        }
+
+    def apply_summary(self, summary: str):
+        """
+        Persist the refreshed summary and drop the folded rows from the window.
+        """
+        ConversationSummary.objects.update_or_create(
+            user=self.user,
+            agent=self.agent,
+            defaults={"summary": summary, "covered_until": self.covered_until},
+        )
+        self.summary = summary
+        self.pending = []
+
+    def summary_failed(self):
+        """
+        Keep the unsummarized rows verbatim if they fit; they are folded on a later turn.
+        """
+        if not self.token_budget_exceeded:
+            self.verbatim = self.pending + self.verbatim
+        self.pending = []
+
+    def contents(self) -> list[types.Content]:
+        content = []
+        if self.summary:
+            content.append(types.Content(
+                role="user",
+                parts=[types.Part(text=f"SUMMARY OF THE EARLIER CONVERSATION:\n{self.summary}")]
+            ))
+        content.extend(row.content for row in self.verbatim)
+        return content
+
+
+def _render_row(row) -> list:
+    speaker = "User" if row.role == "user" else "Assistant"
+    lines = []
+    for part in row.content_data.get("parts", []):
+        if "text" in part:
+            lines.append(f"{speaker}: {part['text']}")
+        elif "function_call" in part:
+            call = part["function_call"]
+            lines.append(f"Assistant called {call.get('name')}({json.dumps(call.get('args'), default=str)})")
+        elif "function_response" in part:
+            response = part["function_response"]
+            lines.append(f"{response.get('name')} returned: {json.dumps(response.get('response'), default=str)[:500]}")
+    return lines
+
+
+def load_window(agent, user, policy: dict) -> HistoryWindow:
+    """
+    Read the unsummarized tail of the history and split it into the verbatim
+    window and the rows to fold into the summary.
+
+    Args:
+        agent: The agent model instance
+        user: The user
+        policy: The agent's entry in AGENT_HISTORY_POLICIES
+
+    Returns:
+        HistoryWindow
+    """
+    summary = ConversationSummary.objects.filter(user=user, agent=agent).first()
+    summary_text = summary.summary if summary else ""
+    covered_until = summary.covered_until if summary else 0
+    keep_turns = policy["keep_turns"]
+    catch_up = settings.AGENT_HISTORY_SUMMARY_MAX_TURNS
+
+    max_turns = keep_turns + catch_up
+    rows = history_cache.rows(agent, user, floor=covered_until + 1, max_turns=max_turns)
+    starts = [row.id for row in reversed(rows) if row.is_turn_start]
+    # A long history with no summary yet: only the most recent `catch_up`
+    # turns before the window are summarized, anything older is skipped.
+    skipped_older = len(starts) >= max_turns
+    if len(starts) > max_turns:
+        rows = [row for row in rows if row.id >= starts[max_turns - 1]]
+    window_start = starts[keep_turns - 1] if len(starts) >= keep_turns else None
+
+    turns = _group_turns(rows)
+    pending_turns = [t for t in turns if window_start is not None and t[0].id < window_start]
+    window_turns = turns[len(pending_turns):]
+
+    total = len(summary_text) // CHARS_PER_TOKEN + sum(_turn_tokens(t) for t in window_turns)
+    while total > policy["max_tokens"] and len(window_turns) > 1:
+        dropped = window_turns.pop(0)
+        total -= _turn_tokens(dropped)
+        pending_turns.append(dropped)
+
+    pending = [row for turn in pending_turns for row in turn]
+    window = [row for turn in window_turns for row in turn]
+    budget_exceeded = total + sum(row.tokens for row in pending) > policy["max_tokens"]
+    fold = bool(pending) and (
+        len(pending_turns) >= policy["summarize_every"] or budget_exceeded or skipped_older
+    )
+    if not fold:
+        # Not worth a summary call yet: the few unsummarized turns go verbatim
+        window, pending = pending + window, []
+
+    return HistoryWindow(
+        agent=agent,
+        user=user,
+        summary=summary_text,
+        verbatim=window,
+        pending=pending,
+        fold=fold,
+        covered_until=pending[-1].id if pending else covered_until,
+        token_budget_exceeded=budget_exceeded,
+    )
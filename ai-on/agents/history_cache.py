@@ -0,0 +1,234 @@
+"""
+Agent History Cache
+
+Per-process cache of the already-converted types.Content rows of each
+(agent, user) conversation, so a turn does not rebuild the whole history
+from JSON.
+
+- Bounded LRU, accounted in (estimated) bytes: AGENT_HISTORY_CACHE_MAX_BYTES
+- Writes append to the cached entry (add_to_history, TurnJournal)
+- clear_agent_history invalidates it
+- Every read checks a version stamp, (row count, max id) of the
+  conversation, with one indexed query. A matching stamp is a hit; writes
+  made by other workers are fetched as a delta (only the new rows), and
+  anything else (deletes) triggers a reload.
+
+Only the conversation tail a caller asks for (id >= floor) is kept, so
+windowed agents (see history.py) cache just their unsummarized turns.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Count, Max
+from google.genai import types
+
+from .models import ConversationHistory
+
+
+# Characters per token for the size estimate (Gemini averages ~4 for English text)
+CHARS_PER_TOKEN = 4
+
+# Rough in-memory cost of a cached row relative to its JSON size
+# (dict + Content/Part objects), plus fixed per-row overhead
+ROW_SIZE_FACTOR = 4
+ROW_OVERHEAD_BYTES = 400
+
+
+class CachedRow:
+    """
+    A history row with its converted Content and size estimates.
+    """
+    __slots__ = ("id", "role", "is_turn_start", "content_data", "content", "tokens", "size")
+
+    def __init__(self, id: int, role: str, is_turn_start: bool, content_data: dict):
+        self.id = id
+        self.role = role
+        self.is_turn_start = is_turn_start
+        self.content_data = content_data
+        self.content = types.Content(role=role, parts=content_data.get("parts", []))
+        encoded = len(json.dumps(content_data, default=str))
+        self.tokens = encoded // CHARS_PER_TOKEN + 1
+        self.size = encoded * ROW_SIZE_FACTOR + ROW_OVERHEAD_BYTES
+
+    @classmethod
+    def from_model(cls, row: ConversationHistory) -> "CachedRow":
+        return cls(row.id, row.role, row.is_turn_start, row.content_data)
+
+
+class _Entry:
+    __slots__ = ("rows", "floor", "count", "last_id", "synced_until", "size")
+
+    def __init__(self, rows: list, floor: int, count: int, last_id: int):
+        self.rows = rows
+        self.floor = floor
+        self.count = count
+        self.last_id = last_id
+        # Highest id up to which the entry is known to match the DB
+        self.synced_until = last_id
+        self.size = sum(row.size for row in rows)
+
+
+def _conversation(agent, user):
+    return ConversationHistory.objects.filter(user=user, agent=agent)
+
+
+ROW_FIELDS = ("id", "role", "is_turn_start", "content_data")
+
+
+class HistoryCache:
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (agent_id, user_id) -> _Entry
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "deltas": 0, "reloads": 0, "evictions": 0}
+
+    def _stamp(self, agent, user) -> tuple:
+        stamp = _conversation(agent, user).aggregate(count=Count("id"), last_id=Max("id"))
+        return stamp["count"], stamp["last_id"] or 0
+
+    def _store(self, key: tuple, entry: _Entry):
+        # Caller holds the lock
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old.size
+        if entry.size > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._size += entry.size
+        while self._size > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+            self._stats["evictions"] += 1
+
+    def _trim(self, entry: _Entry, floor: int):
+        # Caller holds the lock
+        if floor <= entry.floor:
+            return
+        kept = [row for row in entry.rows if row.id >= floor]
+        removed = sum(row.size for row in entry.rows) - sum(row.size for row in kept)
+        entry.rows = kept
+        entry.floor = floor
+        entry.size -= removed
+        self._size -= removed
+
+    def _reload(self, agent, user, floor: int, count: int, last_id: int, max_turns: int = None) -> _Entry:
+        if max_turns:
+            # Bound the first load of a very long conversation to its last `max_turns` turns
+            starts = list(
+                _conversation(agent, user)
+                .filter(is_turn_start=True, id__gte=floor)
+                .order_by("-id")
+                .values_list("id", flat=True)[max_turns - 1:max_turns]
+            )
+            if starts:
+                floor = starts[0]
+        rows = [
+            CachedRow(*values)
+            for values in _conversation(agent, user).filter(id__gte=floor).order_by("id").values_list(*ROW_FIELDS)
+        ]
+        return _Entry(rows, floor, count, last_id)
+
+    def rows(self, agent, user, floor: int = 0, max_turns: int = None) -> list:
+        """
+        The conversation's rows with id >= floor, in order.
+
+        Args:
+            agent: The agent model instance
+            user: The user
+            floor: Lowest row id the caller needs
+            max_turns: On a cold load, keep at most this many recent turns
+
+        Returns:
+            List of CachedRow (the list is a copy; rows are shared, read-only)
+        """
+        key = (agent.id, user.id)
+        count, last_id = self._stamp(agent, user)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.floor <= floor:
+                self._entries.move_to_end(key)
+                if (entry.count, entry.last_id) == (count, last_id):
+                    self._stats["hits"] += 1
+                    entry.synced_until = last_id
+                    self._trim(entry, floor)
+                    return list(entry.rows)
+                known = [row.id for row in entry.rows if row.id > entry.synced_until]
+                synced_until, cached_count = entry.synced_until, entry.count
+            else:
+                entry = None
+
+        if entry is not None and count > cached_count:
+            # Rows written by other workers since the last sync
+            foreign = [
+                CachedRow(*values)
+                for values in _conversation(agent, user)
+                .filter(id__gt=synced_until)
+                .exclude(id__in=known)
+                .order_by("id")
+                .values_list(*ROW_FIELDS)
+            ]
+            if cached_count + len(foreign) == count:
+                with self._lock:
+                    # Merge unless the entry changed meanwhile (then reload)
+                    if self._entries.get(key) is entry and entry.count == cached_count:
+                        entry.rows = sorted(entry.rows + foreign, key=lambda row: row.id)
+                        entry.count, entry.last_id, entry.synced_until = count, last_id, last_id
+                        entry.size += sum(row.size for row in foreign)
+                        self._size += sum(row.size for row in foreign)
+                        self._trim(entry, floor)
+                        self._store(key, entry)
+                        self._stats["deltas"] += 1
+                        return list(entry.rows)
+
+        entry = self._reload(agent, user, floor, count, last_id, max_turns)
+        with self._lock:
+            self._stats["reloads"] += 1
+            self._store(key, entry)
+        return list(entry.rows)
+
+    def append(self, agent, user, rows: list):
+        """
+        Add freshly written ConversationHistory rows to a cached conversation.
+        """
+        key = (agent.id, user.id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if any(row.pk is None for row in rows):
+                # The backend did not return ids; resync on the next read
+                self._size -= entry.size
+                del self._entries[key]
+                return
+            cached = [CachedRow.from_model(row) for row in rows]
+            entry.rows.extend(cached)
+            entry.count += len(cached)
+            entry.last_id = max(entry.last_id, max(row.id for row in cached))
+            added = sum(row.size for row in cached)
+            entry.size += added
+            self._size += added
+            self._store(key, entry)
+
+    def invalidate(self, agent, user):
+        with self._lock:
+            entry = self._entries.pop((agent.id, user.id), None)
+            if entry is not None:
+                self._size -= entry.size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "bytes": self._size}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+history_cache = HistoryCache(max_bytes=settings.AGENT_HISTORY_CACHE_MAX_BYTES)
@@ -0,0 +1,246 @@
+"""
+Turn Journal
+
+Collects the ConversationHistory rows of one agent turn (user message,
+function calls and responses, final answer) in memory and writes them with
+a single bulk_create when the turn ends, instead of one INSERT per part.
+
+Two write modes (AGENT_HISTORY_WRITE_MODE, or per journal via `durable`):
+- 'sync': one transaction at the end of the turn, before the response is
+  returned. A turn is either fully recorded or not at all.
+- 'background': rows are handed to a per-process writer thread that batches
+  several turns into one transaction. Lower latency and fewer SQLite write
+  locks; a crash can lose the last few turns. Reads of the same
+  conversation wait for its pending writes first.
+
+A turn that raises, or that the caller gives up on with discard() (a
+model error answered with an error result), is not written at all.
+
+Usage:
+    with TurnJournal(agent, user) as journal:
+        journal.add({"parts": [{"text": message}]}, "user")
+        ...
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .history import is_turn_start
+from .history_cache import history_cache
+from .metrics import observe_turn
+from .models import ConversationHistory
+
+
+logger = logging.getLogger(__name__)
+
+
+# Rows of several turns written by the background writer in one transaction
+WRITER_BATCH_SIZE = 50
+
+# How long a history read waits for the conversation's pending background writes
+PENDING_WRITE_TIMEOUT = 5.0
+
+
+def new_history_row(agent, user, part: dict, role: str) -> ConversationHistory:
+    """
+    Unsaved ConversationHistory row for a content part.
+    """
+    return ConversationHistory(
+        user=user,
+        agent=agent,
+        role=role,
+        content_data=part,
+        is_turn_start=is_turn_start(role, part)
+    )
+
+
+def _cache_rows(rows: list):
+    # Rows of a batch may span conversations; append each to its own entry
+    conversations = {}
+    for row in rows:
+        conversations.setdefault((row.agent_id, row.user_id), (row.agent, row.user, []))[2].append(row)
+    for agent, user, conversation_rows in conversations.values():
+        history_cache.append(agent, user, conversation_rows)
+
+
+class _BackgroundWriter:
+    """
+    Per-process writer thread. Tracks pending journals per (agent, user) so
+    readers can wait for their own conversation only.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = Counter()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, key: tuple, rows: list):
+        with self._cond:
+            self._pending[key] += 1
+        self._ensure_started()
+        self._queue.put((key, rows))
+
+    def has_pending(self, key: tuple) -> bool:
+        return self._pending.get(key, 0) > 0
+
+    def wait(self, key: tuple, timeout: float = PENDING_WRITE_TIMEOUT) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.has_pending(key), timeout)
+
+    def drain(self, timeout: float = PENDING_WRITE_TIMEOUT) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def _write(self, rows: list):
+        with transaction.atomic():
+            ConversationHistory.objects.bulk_create(rows)
+        _cache_rows(rows)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < WRITER_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            close_old_connections()
+            try:
+                self._write([row for _, rows in batch for row in rows])
+            except Exception as e:
+                # Retry turn by turn so one bad journal doesn't drop the others
+                logger.warning("Batched history write failed (%s), retrying per turn", e)
+                for key, rows in batch:
+                    try:
+                        self._write(rows)
+                    except Exception as e:
+                        logger.error("Dropping %d history rows for %s: %s", len(rows), key, e)
+            finally:
+                close_old_connections()
+                with self._cond:
+                    for key, _ in batch:
+                        self._pending[key] -= 1
+                        if self._pending[key] <= 0:
+                            del self._pending[key]
+                    self._cond.notify_all()
+
+
+history_writer = _BackgroundWriter()
+atexit.register(history_writer.drain)
+
+
+def wait_for_pending_writes(agent, user):
+    """
+    Block until the conversation's background writes have landed.
+    """
+    key = (agent.id, user.id)
+    if history_writer.has_pending(key):
+        history_writer.wait(key)
+
+
+async def await_pending_writes(agent, user):
+    """
+    Async version of wait_for_pending_writes().
+    """
+    key = (agent.id, user.id)
+    if history_writer.has_pending(key):
+        await sync_to_async(history_writer.wait, thread_sensitive=False)(key)
+
+
+class TurnJournal:
+    """
+    In-memory journal of one agent turn, flushed once on exit.
+
+    If the turn raises, or discard() was called, nothing is written: a user
+    message without its answer would make the next call send two user turns
+    in a row, and Gemini rejects a history ending in an unanswered function
+    call.
+    """
+
+    def __init__(self, agent, user, durable: bool = None):
+        self.agent = agent
+        self.user = user
+        self.durable = settings.AGENT_HISTORY_WRITE_MODE != 'background' if durable is None else durable
+        self.rows = []
+
+    def add(self, part: dict, role: str):
+        """
+        Record a content part (same arguments as add_to_history()).
+        """
+        self.rows.append(new_history_row(self.agent, self.user, part, role))
+
+    def discard(self):
+        """
+        Drop the rows recorded so far: the turn failed and is not written.
+        """
+        self.rows = []
+
+    def flush(self, failed: bool = False):
+        """
+        Write the recorded rows (one transaction, or queued for the writer).
+
+        Args:
+            failed: The turn was aborted; roll it back instead
+        """
+        rows, self.rows = self.rows, []
+        if failed or not rows:
+            return
+        if self.durable:
+            with transaction.atomic():
+                ConversationHistory.objects.bulk_create(rows)
+            history_cache.append(self.agent, self.user, rows)
+        else:
+            history_writer.submit((self.agent.id, self.user.id), rows)
+
+    async def aflush(self, failed: bool = False):
+        """
+        Async version of flush().
+        """
+        if failed:
+            self.discard()
+        if not self.rows:
+            return
+        if self.durable:
+            await sync_to_async(self.flush)(failed)
+        else:
+            self.flush(failed)
+
+    def _observe(self):
+        # One model row per iteration of the turn's function-calling loop
+        if self.rows:
+            observe_turn(self.agent.name, sum(1 for row in self.rows if row.role == "model"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._observe()
+        self.flush(failed=exc_type is not None)
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._observe()
+        await self.aflush(failed=exc_type is not None)
+        return False
@@ -0,0 +1,146 @@
+"""
+Agent Logging
+
+Handlers, filters and helpers behind the LOGGING setting. Modules log
+through the standard library:
+
+    logger = logging.getLogger(__name__)
+    logger.debug("Model response iteration %d: %s", iteration, payload(response))
+
+- Arguments are only formatted when the record passes its logger's level
+  (LOG_LEVEL, overridden per module with LOG_LEVELS), so a disabled DEBUG
+  line no longer stringifies Gemini responses.
+- payload() wraps prompts, model responses and tool results: they are cut
+  to LOG_PAYLOAD_CHARS, or replaced by their type with LOG_PAYLOAD_CHARS = 0
+  (no user data in the logs).
+- DEBUG records are sampled with LOG_DEBUG_SAMPLE_RATE.
+- QueuedHandler hands records to a background thread that formats and
+  writes them (text, or one JSON object per line with LOG_FORMAT = 'json'),
+  so request threads never block on stdout.
+- Records carry the current trace id (agents.tracing) and any `extra=`
+  fields, which the JSON formatter emits as keys.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s"
+
+_TRACEBACKS = logging.Formatter()
+
+# Attributes of every LogRecord; anything else on a record came from `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "trace_id"}
+
+
+class _Payload:
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int | None):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        limit = settings.LOG_PAYLOAD_CHARS if self.limit is None else self.limit
+        if limit <= 0:
+            return f"<{type(self.value).__name__}>"
+        text = str(self.value)
+        if len(text) > limit:
+            return f"{text[:limit]}... ({len(text)} chars)"
+        return text
+
+
+def payload(value, limit: int = None) -> _Payload:
+    """
+    Lazily truncated log argument for prompts, responses and tool results.
+
+    Args:
+        value: Anything; str() is only taken when the record is emitted
+        limit: Max characters (default LOG_PAYLOAD_CHARS, 0 hides the value)
+    """
+    return _Payload(value, limit)
+
+
+class TraceContextFilter(logging.Filter):
+    """
+    Stamps records with the trace id of the emitting request (or "-").
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        from .tracing import current_span
+        span = current_span()
+        record.trace_id = span.trace.trace_id if span is not None else "-"
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps a `rate` share of the records at or below `level`.
+    """
+
+    def __init__(self, rate: float = 1.0, level: str = "DEBUG"):
+        super().__init__()
+        self.rate = rate
+        self.level = logging.getLevelName(level)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > self.level or self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record: ts, level, logger, trace_id, msg, extra fields, exc.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, "trace_id", "-"),
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class QueuedHandler(QueueHandler):
+    """
+    Queue in front of a stream handler drained by a listener thread.
+
+    Args:
+        structured: Format records with JsonFormatter instead of TEXT_FORMAT
+        stream: Output stream (default sys.stderr)
+    """
+
+    def __init__(self, structured: bool = False, stream=None):
+        super().__init__(queue.SimpleQueue())
+        target = logging.StreamHandler(stream or sys.stderr)
+        target.setFormatter(JsonFormatter() if structured else logging.Formatter(TEXT_FORMAT))
+        self.listener = QueueListener(self.queue, target, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Queued as is, for the listener's formatter to interpolate; only the
+        # traceback is rendered here, while its frames are still current
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = record.exc_text or _TRACEBACKS.formatException(record.exc_info)
+            record.exc_info = None
+        return record
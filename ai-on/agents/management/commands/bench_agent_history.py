@@ -0,0 +1,145 @@
+"""
+Benchmark: per-turn history cost as a conversation grows.
+
+Fills a throwaway conversation up to each checkpoint and times one agent
+turn's history work (load the history + record the new turn) in three modes:
+- full: every row read and converted from the DB (no policy, no cache)
+- cached: full history served by the in-process history cache
+- window: the windowed policy (summary + recent turns), also cached
+Everything runs in a transaction that is rolled back at the end.
+
+The summarizer call is replaced by a local stub so only the history path is
+timed; the number of summary refreshes is reported instead.
+
+Usage:
+    python manage.py bench_agent_history --checkpoints 100,500,1000,2000 --samples 20
+"""
+
+import statistics
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from google.genai import types
+
+from agents import services
+from agents.history import estimate_tokens
+from agents.models import agentModel, ConversationHistory
+
+
+BENCH_AGENT = "bench_history_agent"
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _turn_rows(user, agent, index: int) -> list:
+    """One stored turn; every third turn includes a function call/response pair."""
+    rows = [ConversationHistory(
+        user=user, agent=agent, role="user", is_turn_start=True,
+        content_data={"parts": [{"text": f"Turn {index}: I spent {index % 90 + 10} DZD on groceries today, update my numbers please."}]}
+    )]
+    if index % 3 == 0:
+        rows.append(ConversationHistory(
+            user=user, agent=agent, role="model",
+            content_data={"parts": [{"function_call": {"name": "edit_user_profile", "args": {"savings": index}}}]}
+        ))
+        rows.append(ConversationHistory(
+            user=user, agent=agent, role="user",
+            content_data={"parts": [{"function_response": {"name": "edit_user_profile", "response": {"status": "success", "updated_fields": ["savings"]}}}]}
+        ))
+    rows.append(ConversationHistory(
+        user=user, agent=agent, role="model",
+        content_data={"parts": [{"text": f"Done! I recorded turn {index}. Your groceries budget has some room left this month."}]}
+    ))
+    return rows
+
+
+def _prompt_tokens(history: list) -> int:
+    return sum(estimate_tokens(content.model_dump(mode="json", exclude_none=True)) for content in history)
+
+
+class Command(BaseCommand):
+    help = "Measure per-turn agent history latency and prompt size (full vs windowed) as stored turns grow."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--checkpoints", default="100,500,1000,2000", help="Comma-separated stored-turn counts")
+        parser.add_argument("--samples", type=int, default=20, help="Timed turns per checkpoint and mode")
+        parser.add_argument("--policy-from", default="chatbot_agent", help="Agent whose AGENT_HISTORY_POLICIES entry is benchmarked")
+
+    def handle(self, *args, **options):
+        checkpoints = sorted(int(n) for n in options["checkpoints"].split(","))
+        policy = settings.AGENT_HISTORY_POLICIES[options["policy_from"]]
+        summary_calls = []
+
+        def stub_summarizer(agent, contents, config=None, model=None, cache_ttl=None, bypass_cache=False):
+            summary_calls.append(model)
+            return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(
+                role="model", parts=[types.Part(text="User tracks groceries daily and updates savings often. " * 8)]
+            ))])
+
+        rows = []
+        windowed = {**settings.AGENT_HISTORY_POLICIES, BENCH_AGENT: policy}
+        modes = (
+            ("full", True, settings.AGENT_HISTORY_POLICIES),
+            ("cached", False, settings.AGENT_HISTORY_POLICIES),
+            ("window", False, windowed),
+        )
+        try:
+            with transaction.atomic(), mock.patch.object(services, "generate_content", stub_summarizer):
+                user = User.objects.create_user(username="bench_history_user")
+                agent = agentModel.objects.create(
+                    name=BENCH_AGENT, description="bench", system_instruction="bench", gemini_model="bench"
+                )
+                stored = 0
+                for checkpoint in checkpoints:
+                    batch = []
+                    for index in range(stored, checkpoint):
+                        batch.extend(_turn_rows(user, agent, index))
+                    ConversationHistory.objects.bulk_create(batch, batch_size=500)
+                    stored = checkpoint
+
+                    result = {"turns": checkpoint}
+                    for mode, full, policies in modes:
+                        calls_before = len(summary_calls)
+                        samples, tokens = [], 0
+                        with override_settings(AGENT_HISTORY_POLICIES=policies):
+                            # Warm-up: first-contact catch-up summary / cold cache load
+                            services.get_agent_history(agent, user, full=full)
+                            for i in range(options["samples"]):
+                                start = time.perf_counter()
+                                history = services.get_agent_history(agent, user, full=full)
+                                with services.TurnJournal(agent, user, durable=True) as journal:
+                                    for row in _turn_rows(user, agent, stored):
+                                        journal.add(row.content_data, row.role)
+                                samples.append((time.perf_counter() - start) * 1000)
+                                tokens = _prompt_tokens(history)
+                                stored += 1
+                        result[mode] = (statistics.mean(samples), tokens, len(summary_calls) - calls_before)
+                    rows.append(result)
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        self.stdout.write(
+            f"policy {options['policy_from']}: {policy}\n"
+            f"{'stored turns':>12}{'full ms':>10}{'cached ms':>11}{'full tok':>10}"
+            f"{'window ms':>11}{'window tok':>12}{'summaries':>11}"
+        )
+        for result in rows:
+            full_ms, full_tok, _ = result["full"]
+            cached_ms, _, _ = result["cached"]
+            window_ms, window_tok, summaries = result["window"]
+            self.stdout.write(
+                f"{result['turns']:>12}{full_ms:>10.2f}{cached_ms:>11.2f}{full_tok:>10}"
+                f"{window_ms:>11.2f}{window_tok:>12}{summaries:>11}"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            "Windowed cost stays flat as stored turns grow; summary refreshes are stubbed "
+            f"(one real Gemini call every {policy['summarize_every']} turns)."
+        ))
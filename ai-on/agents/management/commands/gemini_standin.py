@@ -0,0 +1,62 @@
+"""
+Run the Gemini stand-in server (see agents/standin.py).
+
+Point the app at it with GEMINI_BACKEND=standin (and GEMINI_STANDIN_URL if
+you change the port); the real google-genai client, connection pool and SSE
+parsing are then exercised against scripted answers, simulated latency and
+injected errors instead of the Gemini API.
+
+Usage:
+    python manage.py gemini_standin --port 8765
+    python manage.py gemini_standin --scenario load.json --error-rate 0.05 --seed 7
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from agents.standin import StandinResponder, load_scenario, make_standin_server
+
+
+class Command(BaseCommand):
+    help = "Serve a local stand-in for the Gemini generateContent / streamGenerateContent API."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--scenario", default=None, help="Scenario JSON (defaults to GEMINI_STANDIN_SCENARIO)")
+        parser.add_argument("--error-rate", type=float, default=None, help="Override the scenario's injected error rate")
+        parser.add_argument("--latency-scale", type=float, default=None, help="Multiply every latency (0 for none)")
+        parser.add_argument("--seed", type=int, default=None, help="Seed for latency and error sampling")
+
+    def handle(self, *args, **options):
+        scenario = load_scenario(options["scenario"] or settings.GEMINI_STANDIN_SCENARIO)
+        if options["error_rate"] is not None:
+            scenario["errors"] = {**scenario.get("errors", {}), "rate": options["error_rate"]}
+        if options["latency_scale"] is not None:
+            scenario["latency"] = _scaled(scenario.get("latency", {}), options["latency_scale"])
+
+        server = make_standin_server(options["host"], options["port"], StandinResponder(scenario, seed=options["seed"]))
+        self.stdout.write(self.style.SUCCESS(
+            f"Gemini stand-in listening on http://{options['host']}:{server.server_port}/ "
+            f"({len(scenario.get('rules', []))} rules, error rate {scenario.get('errors', {}).get('rate', 0)})"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            stats = server.responder.stats
+            self.stdout.write(f"Served {stats['requests']} requests, {stats['errors']} injected errors.")
+
+
+def _scaled(latency: dict, factor: float) -> dict:
+    keys = ("ms", "min_ms", "max_ms", "mean_ms", "stddev_ms", "median_ms")
+    scaled = {key: value * factor if key in keys else value for key, value in latency.items() if key != "models"}
+    if factor == 0:
+        return {"distribution": "fixed", "ms": 0}
+    scaled["models"] = {
+        model: {key: value * factor if key in keys else value for key, value in spec.items()}
+        for model, spec in latency.get("models", {}).items()
+    }
+    return scaled
@@ -0,0 +1,366 @@
+"""
+Load test: concurrent scripted user sessions against the real URL routes.
+
+Creates N synthetic users and runs each through a scripted session
+(onboarding turns, chat messages, a receipt upload, budget generation and
+edits, notification polling) on a pool of concurrent workers. Requests go
+through the DRF test client in this process, or to a live server with --url
+(JWT login per user; run the server against the same database).
+
+Gemini is replaced by the in-process stand-in (agents.standin, scenario and
+latency from --scenario / --latency-scale) unless `--gemini configured`,
+which keeps whatever GEMINI_BACKEND / GEMINI_CASSETTE_MODE select (the
+stand-in server, a recorded cassette, or the real API).
+
+Reports per endpoint: requests, errors (by exception type or HTTP status),
+p50/p95/p99 latency and, in process, the SQL queries and LLM calls per
+request; plus overall throughput. Queries made outside the request
+(background history writes) are not attributed.
+Synthetic users are deleted at the end unless --keep.
+
+Usage:
+    python manage.py loadtest --users 50 --concurrency 16
+    python manage.py loadtest --users 20 --latency-scale 0 --json loadtest.json
+    python manage.py loadtest --url http://127.0.0.1:8000 --gemini configured
+"""
+
+import contextvars
+import io
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from unittest import mock
+
+import httpx
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from PIL import Image
+from rest_framework.test import APIClient
+
+from agents import services
+from agents.standin import FakeGenaiClient, StandinResponder, load_scenario
+from notify.models import Notification
+from users.models import UserProfile
+
+
+logger = logging.getLogger(__name__)
+
+PASSWORD = "loadtest-password"
+
+# One user's session: (method, path, payload). "{budget_id}" is filled from
+# the budget list response; "receipt" uploads a generated receipt image.
+SESSION = [
+    ("GET", "/api/onboarding/", None),
+    ("POST", "/api/onboarding/", {"answer": "I earn about 5000 a month and save 500"}),
+    ("POST", "/api/onboarding/", {"answer": "That's all, I'm done"}),
+    ("GET", "/api/notify/unread-count/", None),
+    ("POST", "/api/chat/", {"msg": "Hi! How is my month going?"}),
+    ("POST", "/api/chat/", {"msg": "I spent 12 on coffee and lunch today"}),
+    ("POST", "/api/expenses/", "receipt"),
+    ("POST", "/api/budget/generate/", None),
+    ("GET", "/api/budget/", None),
+    ("PATCH", "/api/budget/{budget_id}/", {"spent": 42}),
+    ("GET", "/api/notify/", None),
+    ("POST", "/api/chat/", {"msg": "Can you give me a report of my spending?"}),
+    ("GET", "/api/notify/unread-count/", None),
+]
+
+# SQL / LLM counters of the request being made (None outside requests)
+_request_counters = contextvars.ContextVar("loadtest_request_counters", default=None)
+
+
+def _count(name: str):
+    counters = _request_counters.get()
+    if counters is not None:
+        counters[name] += 1
+
+
+def _count_queries(execute, sql, params, many, context):
+    _count("sql")
+    return execute(sql, params, many, context)
+
+
+def _install_query_counter(sender=None, connection=None, **kwargs):
+    if _count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_queries)
+
+
+class _CountedModels:
+    """Counts generate_content(_stream) calls; works for client.models and client.aio.models."""
+
+    def __init__(self, models):
+        self._models = models
+
+    def generate_content(self, **kwargs):
+        _count("llm")
+        return self._models.generate_content(**kwargs)
+
+    def generate_content_stream(self, **kwargs):
+        _count("llm")
+        return self._models.generate_content_stream(**kwargs)
+
+
+class _CountedClient:
+
+    def __init__(self, client):
+        self.models = _CountedModels(client.models)
+
+
+def _receipt_bytes() -> bytes:
+    image = Image.new("RGB", (480, 640), "white")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class _InProcessSession:
+
+    def __init__(self, user: User, receipt: bytes):
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.receipt = receipt
+
+    def request(self, method: str, path: str, payload):
+        if payload == "receipt":
+            upload = io.BytesIO(self.receipt)
+            upload.name = "receipt.jpg"
+            return self.client.post(path, {"message": "Receipt from the corner shop", "file": upload}, format="multipart")
+        if method == "GET":
+            return self.client.get(path)
+        return getattr(self.client, method.lower())(path, payload or {}, format="json")
+
+
+class _LiveSession:
+
+    def __init__(self, base_url: str, user: User, receipt: bytes):
+        self.client = httpx.Client(base_url=base_url, timeout=300)
+        self.receipt = receipt
+        token = self.client.post("/api/token/", json={"username": user.username, "password": PASSWORD})
+        token.raise_for_status()
+        self.client.headers["Authorization"] = f"Bearer {token.json()['access']}"
+
+    def request(self, method: str, path: str, payload):
+        if payload == "receipt":
+            return self.client.post(
+                path,
+                data={"message": "Receipt from the corner shop"},
+                files={"file": ("receipt.jpg", self.receipt, "image/jpeg")},
+            )
+        return self.client.request(method, path, json=payload)
+
+
+class _Recorder:
+
+    def __init__(self):
+        self.samples = defaultdict(list)  # endpoint -> [(seconds, ok, sql, llm)]
+        self.errors = defaultdict(Counter)  # endpoint -> {exception type or "HTTP <status>": count}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint: str, seconds: float, ok: bool, counters: dict, error: str = None):
+        with self._lock:
+            self.samples[endpoint].append((seconds, ok, counters["sql"], counters["llm"]))
+            if error:
+                self.errors[endpoint][error] += 1
+
+
+def _first_budget_id(response) -> int | None:
+    data = response.json()
+    if isinstance(data, dict):
+        data = data.get("results", [])
+    return data[0]["id"] if data else None
+
+
+class Command(BaseCommand):
+    help = "Run concurrent scripted user sessions against the API and report per-endpoint latency, SQL and LLM call counts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="Synthetic users to create")
+        parser.add_argument("--sessions", type=int, default=1, help="Scripted sessions per user")
+        parser.add_argument("--concurrency", type=int, default=8, help="Sessions running at once")
+        parser.add_argument("--think-ms", type=int, default=0, help="Mean pause between a session's requests")
+        parser.add_argument("--url", default=None, help="Base URL of a live server (default: in-process test client)")
+        parser.add_argument("--gemini", choices=["fake", "configured"], default="fake",
+                            help="'fake': in-process stand-in; 'configured': keep GEMINI_BACKEND / GEMINI_CASSETTE_MODE")
+        parser.add_argument("--scenario", default=None, help="Stand-in scenario JSON (defaults to GEMINI_STANDIN_SCENARIO)")
+        parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiply the stand-in's latencies (0 for none)")
+        parser.add_argument("--seed", type=int, default=None, help="Seed for stand-in latency sampling and think times")
+        parser.add_argument("--json", default=None, help="Also write the report to this file")
+        parser.add_argument("--keep", action="store_true", help="Keep the synthetic users and their data")
+
+    def handle(self, *args, **options):
+        run_id = uuid.uuid4().hex[:6]
+        prefix = f"loadtest_{run_id}_"
+        users = self._create_users(prefix, options["users"])
+        receipt = _receipt_bytes()
+        rng = random.Random(options["seed"])
+        think = options["think_ms"] / 1000
+        recorder = _Recorder()
+
+        if options["url"]:
+            base_url = options["url"].rstrip("/")
+            make_session = lambda user: _LiveSession(base_url, user, receipt)
+        else:
+            make_session = lambda user: _InProcessSession(user, receipt)
+
+        def run_session(user):
+            try:
+                session = make_session(user)
+                budget_id = None
+                for method, path, payload in SESSION:
+                    if "{budget_id}" in path:
+                        if budget_id is None:
+                            continue
+                        url = path.format(budget_id=budget_id)
+                    else:
+                        url = path
+                    counters = defaultdict(int)
+                    token = _request_counters.set(counters)
+                    started = time.perf_counter()
+                    error = None
+                    try:
+                        response = session.request(method, url, payload)
+                        ok = response.status_code < 400
+                        if not ok:
+                            error = f"HTTP {response.status_code}"
+                    except Exception as e:
+                        logger.warning("loadtest %s %s failed: %s: %s", method, url, type(e).__name__, e)
+                        response, ok, error = None, False, type(e).__name__
+                    finally:
+                        elapsed = time.perf_counter() - started
+                        _request_counters.reset(token)
+                    recorder.add(f"{method} {path}", elapsed, ok, counters, error)
+                    if path == "/api/budget/" and ok:
+                        budget_id = _first_budget_id(response)
+                    if think:
+                        time.sleep(rng.uniform(0, 2 * think))
+            finally:
+                connections.close_all()
+
+        jobs = [user for _ in range(options["sessions"]) for user in users]
+        self.stdout.write(
+            f"Running {len(jobs)} sessions ({len(SESSION)} requests each) for {len(users)} users, "
+            f"concurrency {options['concurrency']}, {'live ' + options['url'] if options['url'] else 'in-process'}, "
+            f"Gemini: {options['gemini']}"
+        )
+
+        with ExitStack() as stack:
+            if not options["url"]:
+                stack.enter_context(override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]))
+                self._instrument(stack)
+                if options["gemini"] == "fake":
+                    self._use_fake_gemini(stack, options)
+            started = time.perf_counter()
+            try:
+                with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+                    for future in [pool.submit(run_session, user) for user in jobs]:
+                        future.result()
+            finally:
+                wall = time.perf_counter() - started
+                if not options["keep"]:
+                    User.objects.filter(username__startswith=prefix).delete()
+
+        report = self._report(recorder, wall, len(jobs), in_process=not options["url"])
+        if options["json"]:
+            with open(options["json"], "w") as fh:
+                json.dump(report, fh, indent=2)
+            self.stdout.write(f"Report written to {options['json']}")
+
+    def _create_users(self, prefix: str, count: int) -> list:
+        # One password hash for everyone: hashing per user would dominate setup
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([User(username=f"{prefix}{i}", password=password) for i in range(count)])
+        users = list(User.objects.filter(username__startswith=prefix).order_by("id"))
+        UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+        Notification.objects.bulk_create([
+            Notification(user=user, notification_type="system", title=f"Welcome #{n}", message="Seeded by loadtest")
+            for user in users for n in range(5)
+        ])
+        return users
+
+    def _instrument(self, stack: ExitStack):
+        """Count SQL queries and Gemini calls per request (in-process only)."""
+        connection_created.connect(_install_query_counter)
+        stack.callback(connection_created.disconnect, _install_query_counter)
+        for connection in connections.all():
+            _install_query_counter(connection=connection)
+
+        get_client = services.get_genai_client
+        get_async_client = services.get_async_genai_client
+        stack.enter_context(mock.patch.object(services, "get_genai_client", lambda: _CountedClient(get_client())))
+        stack.enter_context(mock.patch.object(services, "get_async_genai_client", lambda: _CountedClient(get_async_client())))
+
+    def _use_fake_gemini(self, stack: ExitStack, options: dict):
+        scenario = load_scenario(options["scenario"] or settings.GEMINI_STANDIN_SCENARIO)
+        if options["latency_scale"] != 1.0:
+            from .gemini_standin import _scaled
+            scenario["latency"] = _scaled(scenario.get("latency", {}), options["latency_scale"])
+        stack.enter_context(override_settings(GEMINI_BACKEND="fake", GEMINI_CASSETTE_MODE="off"))
+        stack.enter_context(mock.patch.object(
+            services, "_fake_genai_client", FakeGenaiClient(StandinResponder(scenario, seed=options["seed"]))
+        ))
+
+    def _report(self, recorder: _Recorder, wall: float, sessions: int, in_process: bool) -> dict:
+        rows = {}
+        total = 0
+        self.stdout.write("")
+        self.stdout.write(
+            f"{'endpoint':<34} {'n':>5} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql/req':>8} {'llm/req':>8}"
+        )
+        for endpoint, samples in sorted(recorder.samples.items()):
+            latencies = [s[0] * 1000 for s in samples]
+            total += len(samples)
+            row = {
+                "requests": len(samples),
+                "errors": sum(1 for s in samples if not s[1]),
+                "p50_ms": round(_percentile(latencies, 50), 1),
+                "p95_ms": round(_percentile(latencies, 95), 1),
+                "p99_ms": round(_percentile(latencies, 99), 1),
+                "sql_per_request": round(sum(s[2] for s in samples) / len(samples), 1) if in_process else None,
+                "llm_per_request": round(sum(s[3] for s in samples) / len(samples), 2) if in_process else None,
+                "error_types": dict(recorder.errors[endpoint].most_common()),
+            }
+            rows[endpoint] = row
+            sql = f"{row['sql_per_request']:>8}" if in_process else f"{'-':>8}"
+            llm = f"{row['llm_per_request']:>8}" if in_process else f"{'-':>8}"
+            self.stdout.write(
+                f"{endpoint:<34} {row['requests']:>5} {row['errors']:>4} {row['p50_ms']:>8} "
+                f"{row['p95_ms']:>8} {row['p99_ms']:>8} {sql} {llm}"
+            )
+            if row["error_types"]:
+                self.stdout.write(self.style.WARNING(
+                    "    errors: " + ", ".join(f"{kind} x{count}" for kind, count in row["error_types"].items())
+                ))
+
+        errors = sum(row["errors"] for row in rows.values())
+        summary = {
+            "sessions": sessions,
+            "requests": total,
+            "errors": errors,
+            "wall_seconds": round(wall, 2),
+            "requests_per_second": round(total / wall, 2) if wall else None,
+            "sessions_per_second": round(sessions / wall, 3) if wall else None,
+        }
+        self.stdout.write("")
+        style = self.style.SUCCESS if not errors else self.style.WARNING
+        self.stdout.write(style(
+            f"{total} requests ({errors} errors) in {summary['wall_seconds']}s: "
+            f"{summary['requests_per_second']} req/s, {summary['sessions_per_second']} sessions/s"
+        ))
+        return {"summary": summary, "endpoints": rows}
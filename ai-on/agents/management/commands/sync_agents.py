@@ -0,0 +1,30 @@
+"""
+Seed the agent table from the code definitions (see agents/registry.py).
+
+Creates missing agent rows and updates rows whose config version differs
+from their definition. Run after deploying (next to `migrate`) so workers
+start with an in-sync table; otherwise the first request of each worker
+does it.
+
+Usage:
+    python manage.py sync_agents
+"""
+
+from django.core.management.base import BaseCommand
+
+from agents.registry import agent_registry
+
+
+class Command(BaseCommand):
+    help = "Create or update the agent rows from their code definitions and report their tool tables."
+
+    def handle(self, *args, **options):
+        entries = agent_registry.reload()
+        for name, entry in sorted(entries.items()):
+            agent = entry.agent
+            tools = ", ".join(entry.functions) or "-"
+            self.stdout.write(
+                f"{name:<22} id={agent.id:<4} model={agent.gemini_model:<24} "
+                f"version={agent.config_version[:8]}  tools: {tools}"
+            )
+        self.stdout.write(self.style.SUCCESS(f"{len(entries)} agents in sync."))
@@ -0,0 +1,322 @@
+"""
+Agent Metrics
+
+In-process counters and histograms for the agent layer, rendered in the
+Prometheus text format by the /metrics endpoint (agents.views.metrics_view).
+
+- LLM calls, latency and time to first chunk per agent and model, from
+  agents.services.generate_content / agenerate_content / agenerate_content_stream
+- prompt, completion and thinking tokens from usage_metadata
+- tool execution time per agent and function name
+- model calls per agent turn (the max_iterations loops), from TurnJournal
+- history length (contents) loaded per agent
+- hedged calls: which attempt answered and the extra requests sent (agents.hedging)
+- routed calls: latency per agent, route and model (agents.routing)
+- retried attempts and open circuit breakers per model (agents.resilience)
+- Gemini admission queue depth and wait per model and lane (agents.scheduler)
+- receipt image preprocessing time and bytes before/after (expense.receipts)
+- receipts matching one already extracted, exactly or by perceptual hash
+  (expense.services receipt store)
+- text expenses booked by the local parser or passed to the model, and
+  their handling time by path (expense.parsing)
+- DB query time per connection alias
+
+Recording is a lock, a dict lookup and a bisect per observation; set
+AGENT_METRICS_ENABLED = False to turn it off. Values live in the worker
+process: each worker exposes its own, so scrape every worker (or give the
+metrics endpoint its own single-worker deployment).
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (1, 2, 3, 4, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in sorted(values):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+
+    def set(self, *label_values, value: float):
+        with self._lock:
+            self._values[label_values] = value
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(labels, (list(series[0]), series[1], series[2])) for labels, series in self._values.items()]
+        for label_values, (counts, total, count) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == "+Inf" else f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {_format_value(round(total, 6))}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, labels: tuple = ()) -> Gauge:
+        metric = Gauge(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(enabled=settings.AGENT_METRICS_ENABLED)
+
+LLM_CALLS = metrics.counter(
+    "agent_llm_calls_total", "Gemini calls by agent, model and outcome (ok, error, cancelled, cache_hit).", ("agent", "model", "outcome"))
+LLM_SECONDS = metrics.histogram(
+    "agent_llm_call_seconds", "Gemini call latency (to the last chunk for streams).", ("agent", "model"))
+LLM_FIRST_CHUNK_SECONDS = metrics.histogram(
+    "agent_llm_first_chunk_seconds", "Time to the first chunk of streamed Gemini calls.", ("agent", "model"))
+LLM_TOKENS = metrics.counter(
+    "agent_llm_tokens_total", "Tokens reported in usage_metadata, by kind (prompt, completion, thinking).", ("agent", "model", "kind"))
+TOOL_SECONDS = metrics.histogram(
+    "agent_tool_seconds", "Tool (function call) execution time.", ("agent", "function", "outcome"))
+TURN_ITERATIONS = metrics.histogram(
+    "agent_turn_iterations", "Model calls per agent turn (function-call rounds plus the answer).", ("agent",), COUNT_BUCKETS)
+HISTORY_CONTENTS = metrics.histogram(
+    "agent_history_contents", "History contents loaded for an agent turn.", ("agent",), COUNT_BUCKETS)
+HEDGE_WINNERS = metrics.counter(
+    "agent_llm_hedge_total", "Hedged Gemini calls by the attempt that answered (primary, hedge, fallback, none).", ("agent", "winner"))
+HEDGE_REQUESTS = metrics.counter(
+    "agent_llm_hedge_requests_total", "Hedge and fallback legs of hedged calls, by kind and outcome (sent, skipped).",
+    ("agent", "kind", "outcome"))
+ROUTE_SECONDS = metrics.histogram(
+    "agent_llm_route_seconds", "Latency of routed Gemini calls by route, model and outcome.", ("agent", "route", "model", "outcome"))
+LLM_RETRIES = metrics.counter(
+    "agent_llm_retries_total", "Gemini attempts retried, by model and reason (HTTP code or exception).", ("model", "reason"))
+CIRCUIT_OPEN = metrics.gauge(
+    "agent_llm_circuit_open", "1 while a model's circuit breaker is open.", ("model",))
+QUEUE_DEPTH = metrics.gauge(
+    "agent_llm_queue_depth", "Gemini calls waiting for admission, by model and lane.", ("model", "lane"))
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    "agent_llm_queue_wait_seconds", "Time Gemini calls waited for admission.", ("model", "lane"))
+RECEIPT_PREPROCESS_SECONDS = metrics.histogram(
+    "receipt_preprocess_seconds", "Receipt image preprocessing time, by outcome (shrunk, kept, failed).", ("outcome",))
+RECEIPT_BYTES = metrics.counter(
+    "receipt_bytes_total", "Receipt image bytes received and sent to Gemini after preprocessing.", ("stage",))
+RECEIPT_DUPLICATES = metrics.counter(
+    "receipt_duplicates_total", "Uploaded receipts matching a stored one (exact, similar), by action (flagged, reused).",
+    ("match", "action"))
+EXPENSE_RULES = metrics.counter(
+    "expense_rules_total", "Text expenses tried by the local parser, by outcome (hit, or why the model got it).", ("outcome",))
+EXPENSE_TEXT_SECONDS = metrics.histogram(
+    "expense_text_seconds", "Time to book a text expense, by path (rules, model).", ("path",))
+DB_QUERY_SECONDS = metrics.histogram(
+    "db_query_seconds", "Database query execution time.", ("alias",), DB_BUCKETS)
+
+
+def observe_llm_call(agent_name: str, model: str, seconds: float, response=None, outcome: str = "ok"):
+    """
+    Record one Gemini call (its latency and, for a response, its token usage).
+    """
+    if not metrics.enabled:
+        return
+    LLM_CALLS.inc(agent_name, model, outcome)
+    if outcome == "cache_hit":
+        return
+    LLM_SECONDS.observe(seconds, agent_name, model)
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        if usage.prompt_token_count:
+            LLM_TOKENS.inc(agent_name, model, "prompt", amount=usage.prompt_token_count)
+        if usage.candidates_token_count:
+            LLM_TOKENS.inc(agent_name, model, "completion", amount=usage.candidates_token_count)
+        if usage.thoughts_token_count:
+            LLM_TOKENS.inc(agent_name, model, "thinking", amount=usage.thoughts_token_count)
+
+
+def observe_first_chunk(agent_name: str, model: str, seconds: float):
+    if metrics.enabled:
+        LLM_FIRST_CHUNK_SECONDS.observe(seconds, agent_name, model)
+
+
+def observe_hedge(agent_name: str, winner: str):
+    if metrics.enabled:
+        HEDGE_WINNERS.inc(agent_name, winner)
+
+
+def observe_hedge_request(agent_name: str, kind: str, outcome: str):
+    if metrics.enabled:
+        HEDGE_REQUESTS.inc(agent_name, kind, outcome)
+
+
+def observe_route(agent_name: str, route: str, model: str, seconds: float, outcome: str):
+    if metrics.enabled:
+        ROUTE_SECONDS.observe(seconds, agent_name, route, model, outcome)
+
+
+def observe_retry(model: str, reason):
+    if metrics.enabled:
+        LLM_RETRIES.inc(model, str(reason))
+
+
+def observe_breaker(model: str, is_open: bool):
+    if metrics.enabled:
+        CIRCUIT_OPEN.set(model, value=1 if is_open else 0)
+
+
+def observe_queue_wait(model: str, lane: str, seconds: float):
+    if metrics.enabled:
+        QUEUE_WAIT_SECONDS.observe(seconds, model, lane)
+
+
+def observe_receipt(seconds: float, outcome: str, received: int, sent: int):
+    if metrics.enabled:
+        RECEIPT_PREPROCESS_SECONDS.observe(seconds, outcome)
+        RECEIPT_BYTES.inc("received", amount=received)
+        RECEIPT_BYTES.inc("sent", amount=sent)
+
+
+def observe_receipt_duplicate(match: str, action: str):
+    if metrics.enabled:
+        RECEIPT_DUPLICATES.inc(match, action)
+
+
+def observe_expense_rules(outcome: str):
+    if metrics.enabled:
+        EXPENSE_RULES.inc(outcome)
+
+
+def observe_text_expense(path: str, seconds: float):
+    if metrics.enabled:
+        EXPENSE_TEXT_SECONDS.observe(seconds, path)
+
+
+def observe_turn(agent_name: str, iterations: int):
+    if metrics.enabled:
+        TURN_ITERATIONS.observe(iterations, agent_name)
+
+
+def observe_history(agent_name: str, length: int):
+    if metrics.enabled:
+        HISTORY_CONTENTS.observe(length, agent_name)
+
+
+@contextmanager
+def time_tool(agent_name: str, function: str):
+    """
+    Time one tool execution:
+
+        with time_tool(agent.name, func_name):
+            result = function(**args)
+    """
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        if metrics.enabled:
+            TOOL_SECONDS.observe(time.perf_counter() - started, agent_name, function, outcome)
+
+
+def _time_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started, context["connection"].alias)
+
+
+def install_query_timer(sender=None, connection=None, **kwargs):
+    """
+    connection_created receiver: time every query of the new connection.
+    """
+    if metrics.enabled and _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_turn_starts(apps, schema_editor):
+    ConversationHistory = apps.get_model('agents', 'ConversationHistory')
+    turn_starts = [
+        row.id
+        for row in ConversationHistory.objects.filter(role='user').only('id', 'content_data').iterator()
+        if any('text' in part for part in (row.content_data or {}).get('parts', []))
+    ]
+    for start in range(0, len(turn_starts), 500):
+        ConversationHistory.objects.filter(id__in=turn_starts[start:start + 500]).update(is_turn_start=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agents', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('summary', models.TextField(blank=True, default='')),
+                ('covered_until', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversationhistory',
+            name='is_turn_start',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='conversationhistory',
+            index=models.Index(fields=['user', 'agent', 'is_turn_start', 'id'], name='history_turn_start_idx'),
+        ),
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='agent',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='agents.agentmodel'),
+        ),
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='conversationsummary',
+            constraint=models.UniqueConstraint(fields=('user', 'agent'), name='unique_conversation_summary'),
+        ),
+        migrations.RunPython(mark_turn_starts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agents', '0002_history_window'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversationhistory',
+            index=models.Index(fields=['user', 'agent', 'id'], name='history_conversation_idx'),
+        ),
+    ]
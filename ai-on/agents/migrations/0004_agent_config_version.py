@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agents', '0003_history_conversation_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agentmodel',
+            name='config_version',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agents', '0004_agent_config_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TraceSpan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trace_id', models.CharField(max_length=32)),
+                ('span_id', models.CharField(max_length=16)),
+                ('parent_id', models.CharField(blank=True, default='', max_length=16)),
+                ('name', models.CharField(max_length=200)),
+                ('kind', models.CharField(max_length=16)),
+                ('status', models.CharField(default='ok', max_length=8)),
+                ('started_at', models.DateTimeField()),
+                ('duration_ms', models.FloatField()),
+                ('attributes', models.JSONField(blank=True, default=dict)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['trace_id'], name='trace_span_trace_idx'), models.Index(fields=['parent_id', 'started_at'], name='trace_span_root_idx'), models.Index(fields=['started_at'], name='trace_span_started_idx')],
+            },
+        ),
+    ]
@@ -13,6 +13,8 @@ class agentModel(models.Model):
     system_instruction = models.TextField()
     gemini_model = models.CharField(max_length=100)
     thinking_budget = models.IntegerField(default=0)
+    # Version of the code definition this row was last synced to (see registry.py)
+    config_version = models.CharField(max_length=64, blank=True, default="")
     
     def __str__(self):
         return self.name
@@ -48,10 +50,81 @@ class ConversationHistory(models.Model):
     
     # Timestamp to ensure correct ordering when loading
     timestamp = models.DateTimeField(auto_now_add=True) 
+    
+    # True for user text messages, which open a new turn. History windows are
+    # cut on these rows so function call/response pairs are never split.
+    is_turn_start = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['user', 'agent', 'is_turn_start', 'id'], name='history_turn_start_idx'),
+            # Version stamp (count, max id) and delta reads of the history cache
+            models.Index(fields=['user', 'agent', 'id'], name='history_conversation_idx'),
+        ]
     
     def __str__(self):
         return f"ConversationHistory(id={self.id}, user={self.user.username}, agent={self.agent}, role={self.role})"
-    
\ No newline at end of file
+    
+
+
+class ConversationSummary(models.Model):
+    """
+    Rolling summary of the turns that have slid out of an agent's history
+    window (see agents.history).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    agent = models.ForeignKey(agentModel, on_delete=models.CASCADE)
+    summary = models.TextField(blank=True, default="")
+    
+    # Highest ConversationHistory id folded into the summary
+    covered_until = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'agent'], name='unique_conversation_summary'),
+        ]
+    
+    def __str__(self):
+        return f"ConversationSummary(user={self.user.username}, agent={self.agent}, covered_until={self.covered_until})"
+
+
+class TraceSpan(models.Model):
+    """
+    One span of a kept request trace (see agents.tracing). Root spans have
+    an empty parent_id.
+    """
+    trace_id = models.CharField(max_length=32)
+    span_id = models.CharField(max_length=16)
+    parent_id = models.CharField(max_length=16, blank=True, default="")
+    name = models.CharField(max_length=200)
+    kind = models.CharField(max_length=16)  # request, agent, llm, tool
+    status = models.CharField(max_length=8, default="ok")
+    started_at = models.DateTimeField()
+    duration_ms = models.FloatField()
+    attributes = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['trace_id'], name='trace_span_trace_idx'),
+            # Recent-traces listing of the viewer, and retention deletes
+            models.Index(fields=['parent_id', 'started_at'], name='trace_span_root_idx'),
+            models.Index(fields=['started_at'], name='trace_span_started_idx'),
+        ]
+
+    def as_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+        }
+
+    def __str__(self):
+        return f"TraceSpan(trace={self.trace_id[:8]}, {self.kind}: {self.name}, {self.duration_ms:.1f}ms)"
@@ -0,0 +1,187 @@
+"""
+Request Profiling
+
+Per-request breakdown sent back as a `Server-Timing` header, so browser
+devtools and client-side traces show where a response's time went:
+
+    Server-Timing: db;dur=12.4;desc="9 queries", llm;dur=840.2;desc="2 calls",
+                   render;dur=0.6, app;dur=31.0, total;dur=884.2
+
+- db: time in database queries and their count (every connection of the
+  request, including sync_to_async hops and tool threads)
+- llm: time in Gemini calls and their count (summed: concurrent tool calls
+  can add up to more than the wall time)
+- render: DRF/template response rendering (serializing to JSON)
+- app: the rest (views, serializers' to_representation, middleware)
+- total: wall time until the response is returned (for streamed responses,
+  until the first byte; the body is produced afterwards)
+
+Requests slower than SERVER_TIMING_SLOW_MS are logged with their profile
+and their most repeated query, which is how N+1 patterns show up.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+logger = logging.getLogger(__name__)
+
+
+_current_profile = contextvars.ContextVar("request_profile", default=None)
+
+# Transaction control repeats on every atomic() block; not an N+1 hint
+_TRANSACTION_SQL = ("BEGIN", "SAVEPOINT", "RELEASE", "ROLLBACK", "COMMIT")
+
+
+class RequestProfile:
+
+    __slots__ = ("started", "db_seconds", "db_queries", "llm_seconds", "llm_calls",
+                 "render_started", "render_seconds", "queries", "_lock")
+
+    def __init__(self, count_queries: bool = False):
+        self.started = time.perf_counter()
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.llm_seconds = 0.0
+        self.llm_calls = 0
+        self.render_started = None
+        self.render_seconds = 0.0
+        # Query text -> executions, kept only when slow requests are logged
+        self.queries = Counter() if count_queries else None
+        self._lock = threading.Lock()
+
+    def add_query(self, sql: str, seconds: float):
+        with self._lock:
+            self.db_seconds += seconds
+            self.db_queries += 1
+            if self.queries is not None and not sql.lstrip().upper().startswith(_TRANSACTION_SQL):
+                self.queries[sql] += 1
+
+    def add_llm_call(self, seconds: float):
+        with self._lock:
+            self.llm_seconds += seconds
+            self.llm_calls += 1
+
+    def timings(self) -> dict:
+        total = time.perf_counter() - self.started
+        return {
+            "db": self.db_seconds * 1000,
+            "llm": self.llm_seconds * 1000,
+            "render": self.render_seconds * 1000,
+            "app": max(total - self.db_seconds - self.llm_seconds - self.render_seconds, 0) * 1000,
+            "total": total * 1000,
+        }
+
+    def header(self, timings: dict) -> str:
+        return ", ".join([
+            f'db;dur={timings["db"]:.1f};desc="{self.db_queries} queries"',
+            f'llm;dur={timings["llm"]:.1f};desc="{self.llm_calls} calls"',
+            f'render;dur={timings["render"]:.1f}',
+            f'app;dur={timings["app"]:.1f}',
+            f'total;dur={timings["total"]:.1f}',
+        ])
+
+
+def record_llm_call(seconds: float):
+    """
+    Add a Gemini call to the current request's profile (no-op outside requests).
+    """
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.add_llm_call(seconds)
+
+
+def _profile_query(execute, sql, params, many, context):
+    profile = _current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add_query(sql, time.perf_counter() - started)
+
+
+def install_query_profiler(sender=None, connection=None, **kwargs):
+    """
+    connection_created receiver: attribute the connection's queries to the current request.
+    """
+    if _profile_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_profile_query)
+
+
+class ServerTimingMiddleware:
+    """
+    Profiles each request and adds the Server-Timing header (see module docstring).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.SERVER_TIMING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        profile = RequestProfile(count_queries=settings.SERVER_TIMING_SLOW_MS > 0)
+        token = _current_profile.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+        return self._finish(request, response, profile)
+
+    async def __acall__(self, request):
+        profile = RequestProfile(count_queries=settings.SERVER_TIMING_SLOW_MS > 0)
+        token = _current_profile.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+        return self._finish(request, response, profile)
+
+    def process_template_response(self, request, response):
+        # Runs right before the response is rendered; the callback right after
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.render_started = time.perf_counter()
+
+            def _rendered(rendered):
+                profile.render_seconds += time.perf_counter() - profile.render_started
+                return None
+
+            response.add_post_render_callback(_rendered)
+        return response
+
+    def _finish(self, request, response, profile: RequestProfile):
+        timings = profile.timings()
+        response["Server-Timing"] = profile.header(timings)
+        if settings.SERVER_TIMING_ALLOW_ORIGIN:
+            response["Timing-Allow-Origin"] = settings.SERVER_TIMING_ALLOW_ORIGIN
+
+        if 0 < settings.SERVER_TIMING_SLOW_MS <= timings["total"]:
+            repeated = ""
+            if profile.queries:
+                sql, count = profile.queries.most_common(1)[0]
+                if count > 1:
+                    repeated = f", most repeated query ({count}x): {sql[:200]}"
+            logger.warning(
+                "Slow request %s %s -> %s: total %.0fms, db %.0fms/%d queries, llm %.0fms/%d calls, "
+                "render %.1fms, app %.0fms%s",
+                request.method, request.path, response.status_code, timings["total"], timings["db"],
+                profile.db_queries, timings["llm"], profile.llm_calls, timings["render"], timings["app"], repeated,
+                extra={"server_timing": {key: round(value, 1) for key, value in timings.items()},
+                       "queries": profile.db_queries, "llm_calls": profile.llm_calls},
+            )
+        return response
@@ -0,0 +1,173 @@
+"""
+Agent Registry
+
+Agent definitions (instruction, model, tools, config) live in code; each app
+declares its agents in AppConfig.ready(). The registry turns them into
+RegisteredAgent entries (the agentModel row, its tool table and its
+GenerateContentConfig) once per process, so request handling does no agent
+table queries and no config building.
+
+- The agent rows are synced when a definition's version (a hash of its
+  fields) differs from the row's `config_version`, i.e. after a deploy that
+  changed it. Rows edited in the admin keep their edits until then.
+- The registry loads lazily on first use (one SELECT), or ahead of time with
+  `python manage.py sync_agents`.
+- Saving or deleting an agentModel row reloads the registry of this process;
+  other workers pick it up on restart or via sync_agents.
+
+Entries are shared between requests: treat the agent, its tool table and its
+config as read-only.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable
+
+from asgiref.sync import sync_to_async
+from google.genai import types
+
+from .models import agentModel
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class AgentDefinition:
+    """
+    Code-side definition of an agent.
+
+    tools: callable returning (func_name, declaration, function) tuples, called
+           at load time (so tool modules can import the app's services)
+    config: callable (agent, functions) -> GenerateContentConfig; defaults to
+            agents.services.build_config
+    """
+    name: str
+    description: str
+    system_instruction: str
+    gemini_model: str
+    thinking_budget: int = 0
+    tools: Callable[[], list] | None = None
+    config: Callable | None = None
+
+    @property
+    def version(self) -> str:
+        fields = [self.name, self.description, self.system_instruction, self.gemini_model, self.thinking_budget]
+        return hashlib.sha1(json.dumps(fields).encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class RegisteredAgent:
+    agent: agentModel
+    functions: MappingProxyType
+    config: types.GenerateContentConfig
+
+
+class AgentRegistry:
+
+    def __init__(self):
+        self._definitions = {}
+        self._entries = None  # name -> RegisteredAgent
+        self._by_id = {}
+        self._lock = threading.Lock()
+
+    def define(self, definition: AgentDefinition):
+        """
+        Declare an agent (call from AppConfig.ready()).
+        """
+        self._definitions[definition.name] = definition
+        self.invalidate()
+
+    def _sync_rows(self) -> dict:
+        rows = {agent.name: agent for agent in agentModel.objects.filter(name__in=list(self._definitions))}
+        missing = []
+        for name, definition in self._definitions.items():
+            fields = {
+                "description": definition.description,
+                "system_instruction": definition.system_instruction,
+                "gemini_model": definition.gemini_model,
+                "thinking_budget": definition.thinking_budget,
+                "config_version": definition.version,
+            }
+            agent = rows.get(name)
+            if agent is None:
+                missing.append(agentModel(name=name, **fields))
+            elif agent.config_version != definition.version:
+                # queryset.update() skips the save signals that would reload the registry again
+                agentModel.objects.filter(pk=agent.pk).update(**fields)
+                for field, value in fields.items():
+                    setattr(agent, field, value)
+                logger.info("Agent '%s' synced to config version %s", name, definition.version[:8])
+        if missing:
+            agentModel.objects.bulk_create(missing)
+            if any(agent.pk is None for agent in missing):
+                # The backend did not return ids
+                missing = list(agentModel.objects.filter(name__in=[agent.name for agent in missing]))
+            rows.update((agent.name, agent) for agent in missing)
+        return rows
+
+    def load(self) -> dict:
+        """
+        Build every entry unless already loaded.
+
+        Returns:
+            Mapping of agent name to RegisteredAgent
+        """
+        entries = self._entries
+        if entries is not None:
+            return entries
+
+        with self._lock:
+            if self._entries is not None:
+                return self._entries
+
+            from .services import build_config
+
+            entries = {}
+            for name, agent in self._sync_rows().items():
+                definition = self._definitions[name]
+                functions = {}
+                for func_name, declaration, function in (definition.tools() if definition.tools else []):
+                    functions[func_name] = MappingProxyType({'declaration': declaration, 'function': function})
+                functions = MappingProxyType(functions)
+                config = (definition.config or build_config)(agent, functions)
+                entries[name] = RegisteredAgent(agent=agent, functions=functions, config=config)
+
+            self._by_id = {entry.agent.id: entry for entry in entries.values()}
+            self._entries = MappingProxyType(entries)
+            return self._entries
+
+    def invalidate(self):
+        """
+        Drop the loaded entries; the next lookup reloads them.
+        """
+        self._entries = None
+
+    def reload(self) -> dict:
+        self.invalidate()
+        return self.load()
+
+    def get(self, name: str) -> RegisteredAgent:
+        entries = self.load()
+        if name not in entries:
+            raise ValueError(f"Agent '{name}' is not defined.")
+        return entries[name]
+
+    async def aget(self, name: str) -> RegisteredAgent:
+        """
+        Async version of get(); only the first load touches the database.
+        """
+        if self._entries is None:
+            await sync_to_async(self.load)()
+        return self.get(name)
+
+    def by_id(self, agent_id: int) -> RegisteredAgent | None:
+        self.load()
+        return self._by_id.get(agent_id)
+
+
+agent_registry = AgentRegistry()
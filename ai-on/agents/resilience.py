@@ -0,0 +1,366 @@
+"""
+Model Call Resilience
+
+Retries and circuit breaking for every Gemini call of the agent layer
+(agents.services wraps each generate_content / agenerate_content attempt,
+and the opening of agenerate_content_stream, in call_model / acall_model):
+
+- transient failures (429, 500, 502, 503, 504, connection errors and
+  timeouts) are retried up to LLM_RETRY_ATTEMPTS attempts with full-jitter
+  exponential backoff (LLM_RETRY_BASE_SECONDS .. LLM_RETRY_MAX_SECONDS)
+- a Retry-After header, or the RetryInfo delay of a Gemini 429, is honoured;
+  a delay longer than LLM_RETRY_MAX_SECONDS fails the call right away
+- retries are only made at the model call: agent hops (tools calling other
+  agents) are never retried as a whole, and all the hops of a request share
+  one retry budget (LLM_RETRY_BUDGET retries, set per request by
+  RetryBudgetMiddleware or around other work with retry_scope()), so a
+  degraded upstream can't turn one chat message into dozens of calls
+- per model, LLM_BREAKER_FAILURES consecutive failed attempts open the
+  circuit: calls then fail fast with ModelUnavailable for
+  LLM_BREAKER_COOLDOWN seconds, after which a single probe call decides
+  whether it closes again (hedged calls fall back to their faster tier
+  meanwhile)
+"""
+
+import contextvars
+import email.utils
+import logging
+import math
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from google.genai import errors
+from tenacity import AsyncRetrying, Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from .metrics import observe_breaker, observe_retry
+
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+
+
+class ModelUnavailable(Exception):
+    """A model's circuit is open: the call was not sent."""
+
+    def __init__(self, model: str, retry_after: float):
+        self.model = model
+        self.retry_after = retry_after
+        super().__init__(f"{model} is unavailable (circuit open), retry in {retry_after:.0f}s")
+
+
+# What a model call raises once retries are exhausted (or not allowed)
+MODEL_ERRORS = (errors.APIError, ModelUnavailable, httpx.TransportError)
+
+
+def unavailable_for(error: BaseException) -> int:
+    """
+    Seconds a client should wait before sending the request again.
+    """
+    delay = error.retry_after if isinstance(error, ModelUnavailable) else retry_after(error)
+    return max(math.ceil(delay if delay is not None else settings.LLM_RETRY_MAX_SECONDS), 1)
+
+
+class AgentUnavailable(ModelUnavailable):
+    """A nested agent's model call failed for good (see unavailable_result())."""
+
+    def __init__(self, agent: str, retry_after: float):
+        self.model = agent
+        self.retry_after = retry_after
+        Exception.__init__(self, f"{agent} is unavailable, retry in {retry_after:.0f}s")
+
+
+def unavailable_result(agent: str, error: BaseException) -> dict:
+    """
+    Error result of an agent whose model stayed rate limited or down: views
+    answer it with a 503 and Retry-After, calling agents re-raise it (see
+    raise_unavailable()).
+    """
+    logger.warning("%s model call failed: %s", agent, error)
+    return {"type": "error", "data": {"error": str(error), "agent": agent, "retry_after": unavailable_for(error)}}
+
+
+def raise_unavailable(results: list):
+    """
+    Fail an agent turn whose tools include an unavailable_result(), the same
+    way as when its own model call fails, rather than letting the model
+    answer around the missing hop.
+
+    Raises:
+        AgentUnavailable: for the first such result
+    """
+    for result in results:
+        data = result.get("data") if isinstance(result, dict) and result.get("type") == "error" else None
+        if isinstance(data, dict) and "retry_after" in data:
+            raise AgentUnavailable(data.get("agent", "agent"), data["retry_after"])
+
+
+# -- retry budget ---------------------------------------------------------------
+
+class _RetryBudget:
+
+    def __init__(self, retries: int):
+        self.remaining = retries
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+_retry_budget = contextvars.ContextVar("llm_retry_budget", default=None)
+
+
+@contextmanager
+def retry_scope(retries: int = None):
+    """
+    Share one budget of `retries` (default LLM_RETRY_BUDGET) between every
+    model call made inside the block, tool threads included.
+    """
+    token = _retry_budget.set(_RetryBudget(settings.LLM_RETRY_BUDGET if retries is None else retries))
+    try:
+        yield
+    finally:
+        _retry_budget.reset(token)
+
+
+class RetryBudgetMiddleware:
+    """
+    One retry budget per request (see retry_scope()).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with retry_scope():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with retry_scope():
+            return await self.get_response(request)
+
+
+# -- circuit breaker ------------------------------------------------------------
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker of one model: closed -> open -> half-open (one probe).
+    """
+
+    def __init__(self, model: str, failures: int, cooldown: float):
+        self.model = model
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raises:
+            ModelUnavailable: the circuit is open (or another call is probing)
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0 or self.probing:
+                raise ModelUnavailable(self.model, max(remaining, 1))
+            self.probing = True
+
+    def succeeded(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("Circuit for %s closed", self.model)
+                observe_breaker(self.model, False)
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                if self.opened_at is None:
+                    logger.warning("Circuit for %s opened after %d failed calls", self.model, self.failures)
+                    observe_breaker(self.model, True)
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def released(self):
+        # The probe ended without an upstream verdict (e.g. a 400 or a cancel)
+        with self._lock:
+            self.probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(model: str) -> CircuitBreaker:
+    breaker = _breakers.get(model)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(
+                model, CircuitBreaker(model, settings.LLM_BREAKER_FAILURES, settings.LLM_BREAKER_COOLDOWN)
+            )
+    return breaker
+
+
+def breaker_states() -> dict:
+    """
+    Open circuits and failure counts per model.
+    """
+    return {
+        model: {"open": breaker.opened_at is not None, "failures": breaker.failures}
+        for model, breaker in list(_breakers.items())
+    }
+
+
+# -- retries --------------------------------------------------------------------
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether a failed model call may succeed when sent again.
+    """
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_CODES
+    return isinstance(error, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError))
+
+
+def retry_after(error: BaseException) -> float | None:
+    """
+    Delay the upstream asked for: a Retry-After header or a RetryInfo detail.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for item in (details.get("error") or {}).get("details") or []:
+            if isinstance(item, dict) and str(item.get("@type", "")).endswith("RetryInfo"):
+                match = re.fullmatch(r"([\d.]+)s", str(item.get("retryDelay", "")))
+                if match:
+                    return float(match.group(1))
+    return None
+
+
+def _should_retry(error: BaseException) -> bool:
+    if not is_transient(error):
+        return False
+    delay = retry_after(error)
+    if delay is not None and delay > settings.LLM_RETRY_MAX_SECONDS:
+        return False
+    budget = _retry_budget.get()
+    return budget is None or budget.take()
+
+
+def _wait(backoff):
+    def wait(retry_state) -> float:
+        delay = retry_after(retry_state.outcome.exception())
+        return backoff(retry_state) if delay is None else delay
+    return wait
+
+
+def _before_sleep(model: str):
+    def log(retry_state):
+        error = retry_state.outcome.exception()
+        observe_retry(model, getattr(error, "code", None) or type(error).__name__)
+        logger.info("Retrying %s in %.1fs (attempt %d failed: %s)",
+                    model, retry_state.next_action.sleep, retry_state.attempt_number, error)
+    return log
+
+
+def _retrying_options(model: str) -> dict:
+    return {
+        "retry": retry_if_exception(_should_retry),
+        "wait": _wait(wait_random_exponential(multiplier=settings.LLM_RETRY_BASE_SECONDS,
+                                              max=settings.LLM_RETRY_MAX_SECONDS)),
+        "stop": stop_after_attempt(settings.LLM_RETRY_ATTEMPTS),
+        "before_sleep": _before_sleep(model),
+        "reraise": True,
+    }
+
+
+def _verdict(breaker: CircuitBreaker, error: BaseException | None):
+    if error is None:
+        breaker.succeeded()
+    elif is_transient(error):
+        breaker.failed()
+    else:
+        breaker.released()
+
+
+def call_model(model: str, attempt, retries: bool = True):
+    """
+    Run attempt() (one Gemini request) with retries behind the model's breaker.
+
+    Args:
+        model: Model the request goes to
+        attempt: Blocking callable sending it
+        retries: False to send it once (hedge and fallback legs)
+
+    Raises:
+        ModelUnavailable: the circuit is open
+        The last attempt's exception once retries are exhausted
+    """
+    breaker = get_breaker(model)
+
+    def guarded():
+        breaker.before_call()
+        try:
+            result = attempt()
+        except BaseException as e:
+            _verdict(breaker, e)
+            raise
+        _verdict(breaker, None)
+        return result
+
+    if not retries:
+        return guarded()
+    return Retrying(**_retrying_options(model))(guarded)
+
+
+async def acall_model(model: str, attempt, retries: bool = True):
+    """
+    Async version of call_model(); attempt is a coroutine function.
+    """
+    breaker = get_breaker(model)
+
+    async def guarded():
+        breaker.before_call()
+        try:
+            result = await attempt()
+        except BaseException as e:
+            _verdict(breaker, e)
+            raise
+        _verdict(breaker, None)
+        return result
+
+    if not retries:
+        return await guarded()
+    return await AsyncRetrying(**_retrying_options(model))(guarded)
@@ -0,0 +1,191 @@
+"""
+Model Routing
+
+Picks the model tier and thinking budget of each Gemini call from cheap
+local features, so simple requests don't pay for the agent's heaviest model.
+Applied by agents.services.generate_content / agenerate_content /
+agenerate_content_stream whenever the caller doesn't pass a model:
+
+    'budget_agent': [
+        {'name': 'edit', 'operation': ['edit', 'delete'], 'max_history': 16,
+         'model': 'gemini-2.5-flash', 'thinking_budget': 0},
+    ]
+
+- rules (LLM_ROUTES, per agent) are tried in order and the first match wins;
+  when none matches the call keeps the agent's model and config ('default')
+- conditions, all optional:
+    operation: the llm_operation() the call runs in (one name or a list)
+    min_input_chars / max_input_chars: text of the last content (the new turn)
+    has_file: whether the last content carries an inline or uploaded file
+    max_history: contents sent before the last one
+- outcome: model, and thinking_budget (set on a copy of the agent's config;
+  gemini-2.5-pro can't go below 128)
+
+Routed calls are logged with their features, latency and outcome, and timed
+in agent_llm_route_seconds{agent, route, model}: compare a route's latency
+and error rate with 'default' before widening it.
+"""
+
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from google.genai import types
+
+from .metrics import observe_route
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROUTE = "default"
+
+_current_operation = contextvars.ContextVar("llm_operation", default=None)
+
+
+@contextmanager
+def llm_operation(name: str):
+    """
+    Tag the enclosed Gemini calls (including tool threads) with an
+    operation name for the routing rules.
+    """
+    token = _current_operation.set(name)
+    try:
+        yield
+    finally:
+        _current_operation.reset(token)
+
+
+class RouteFeatures:
+    """
+    What the routing rules look at.
+    """
+    __slots__ = ("operation", "input_chars", "has_file", "history")
+
+    def __init__(self, operation: str = None, input_chars: int = 0, has_file: bool = False, history: int = 0):
+        self.operation = operation
+        self.input_chars = input_chars
+        self.has_file = has_file
+        self.history = history
+
+    def __str__(self):
+        return (f"operation={self.operation or '-'} chars={self.input_chars} "
+                f"file={'yes' if self.has_file else 'no'} history={self.history}")
+
+
+def _scan(value) -> tuple[int, bool]:
+    # (text characters, has a file part)
+    if value is None:
+        return 0, False
+    if isinstance(value, str):
+        return len(value), False
+    if isinstance(value, (bytes, bytearray)):
+        return 0, True
+    if isinstance(value, types.Content):
+        return _scan(value.parts)
+    if isinstance(value, types.Part):
+        if value.text is not None:
+            return (0 if value.thought else len(value.text)), False
+        return 0, value.inline_data is not None or value.file_data is not None
+    if isinstance(value, (list, tuple)):
+        chars, has_file = 0, False
+        for item in value:
+            item_chars, item_file = _scan(item)
+            chars += item_chars
+            has_file = has_file or item_file
+        return chars, has_file
+    return 0, False
+
+
+def route_features(contents) -> RouteFeatures:
+    """
+    Features of a call's contents, in the current llm_operation().
+    """
+    history = 0
+    last = contents
+    if isinstance(contents, (list, tuple)) and contents and isinstance(contents[-1], types.Content):
+        history = len(contents) - 1
+        last = contents[-1]
+    input_chars, has_file = _scan(last)
+    return RouteFeatures(_current_operation.get(), input_chars, has_file, history)
+
+
+def _matches(rule: dict, features: RouteFeatures) -> bool:
+    operation = rule.get("operation")
+    if operation is not None:
+        allowed = (operation,) if isinstance(operation, str) else operation
+        if features.operation not in allowed:
+            return False
+    if "has_file" in rule and bool(rule["has_file"]) != features.has_file:
+        return False
+    if features.input_chars < rule.get("min_input_chars", 0):
+        return False
+    if "max_input_chars" in rule and features.input_chars > rule["max_input_chars"]:
+        return False
+    if "max_history" in rule and features.history > rule["max_history"]:
+        return False
+    return True
+
+
+def _routed_config(config: types.GenerateContentConfig, thinking_budget: int) -> types.GenerateContentConfig:
+    # Agent configs are shared: the override goes on a copy
+    thinking = types.ThinkingConfig(thinking_budget=thinking_budget)
+    if config is None:
+        return types.GenerateContentConfig(thinking_config=thinking)
+    return config.model_copy(update={"thinking_config": thinking})
+
+
+class Route:
+    """
+    A routing decision: the rule that matched and the call's model and config.
+    """
+    __slots__ = ("name", "model", "config", "features")
+
+    def __init__(self, name: str, model: str, config: types.GenerateContentConfig, features: RouteFeatures):
+        self.name = name
+        self.model = model
+        self.config = config
+        self.features = features
+
+
+def route_call(agent_name: str, model: str, contents, config: types.GenerateContentConfig = None) -> Route | None:
+    """
+    Route a call of an agent whose own model is `model`.
+
+    Returns:
+        The Route, or None when routing is off or the agent has no rules
+    """
+    rules = settings.LLM_ROUTES.get(agent_name) if settings.LLM_ROUTING_ENABLED else None
+    if not rules:
+        return None
+
+    features = route_features(contents)
+    for index, rule in enumerate(rules):
+        if _matches(rule, features):
+            routed_config = config
+            if rule.get("thinking_budget") is not None:
+                routed_config = _routed_config(config, rule["thinking_budget"])
+            return Route(rule.get("name", f"rule{index}"), rule.get("model", model), routed_config, features)
+    return Route(DEFAULT_ROUTE, model, config, features)
+
+
+@contextmanager
+def timed_route(agent_name: str, route: Route | None):
+    """
+    Log a routed call's decision with its latency and outcome.
+    """
+    if route is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        seconds = time.perf_counter() - started
+        observe_route(agent_name, route.name, route.model, seconds, outcome)
+        logger.info("Routed %s to %s (route %s, %s): %s in %.2fs",
+                    agent_name, route.model, route.name, route.features, outcome, seconds)
@@ -0,0 +1,348 @@
+"""
+LLM Admission Scheduler
+
+Every Gemini call of the agent layer (agents.services.generate_content,
+agenerate_content, agenerate_content_stream) is admitted here first, so
+one process never sends a model more than its quota:
+
+- per model, a requests-per-minute and a tokens-per-minute bucket
+  (LLM_RATE_LIMITS), refilled continuously
+- a call reserves 1 request and its estimated tokens (prompt characters / 4
+  plus the expected output); once answered, the reservation is settled
+  against usage_metadata.total_token_count
+- a call that doesn't fit waits in its model's queue instead of failing;
+  queues are ordered by lane, then arrival. Only the head of a queue is
+  admitted: it sleeps until its buckets have refilled enough, and is woken
+  early (as is the next head) whenever a call is admitted, leaves the queue
+  or gives tokens back
+- two lanes: 'interactive' (default) and 'background'. Background calls
+  also leave LLM_BACKGROUND_RESERVE of each bucket to interactive ones, so
+  a burst of budget rebalances can't take the quota chat needs:
+
+    with llm_priority(BACKGROUND):
+        process_budget_operation(user, message)
+
+Models without limits skip the scheduler. Buckets live in the worker
+process: LLM_RATE_LIMIT_WORKERS splits the project quota between workers.
+Queue depth and wait time are exported as agent_llm_queue_depth and
+agent_llm_queue_wait_seconds.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from google.genai import types
+
+from .metrics import QUEUE_DEPTH, metrics, observe_queue_wait
+
+
+logger = logging.getLogger(__name__)
+
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+LANES = (INTERACTIVE, BACKGROUND)
+
+# Tokens billed for an inline image or document part
+INLINE_DATA_TOKENS = 258
+
+# Longest a sync waiter sleeps before re-checking
+MAX_POLL_SECONDS = 0.25
+
+# Wait of a waiter behind the head of its queue: until woken
+UNTIL_WOKEN = math.inf
+
+_current_lane = contextvars.ContextVar("llm_lane", default=INTERACTIVE)
+
+
+@contextmanager
+def llm_priority(lane: str):
+    """
+    Run the enclosed Gemini calls (including tool threads and
+    sync_to_async hops) in `lane`.
+    """
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def _chars(value) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_chars(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_chars(item) for item in value.values())
+    if isinstance(value, types.Content):
+        return _chars(value.parts)
+    if isinstance(value, types.Part):
+        if value.text is not None:
+            return len(value.text)
+        if value.inline_data is not None or value.file_data is not None:
+            return INLINE_DATA_TOKENS * 4
+        if value.function_call is not None:
+            return len(json.dumps(value.function_call.args or {}, default=str))
+        if value.function_response is not None:
+            return len(json.dumps(value.function_response.response or {}, default=str))
+        return 0
+    if isinstance(value, (bytes, bytearray)):
+        return INLINE_DATA_TOKENS * 4
+    return len(str(value))
+
+
+def estimate_tokens(contents, config: types.GenerateContentConfig = None) -> int:
+    """
+    Rough token cost of a request: prompt characters / 4 plus the expected output.
+    """
+    prompt = _chars(contents)
+    output = settings.LLM_OUTPUT_TOKENS_ESTIMATE
+    if config is not None:
+        prompt += _chars(config.system_instruction)
+        output = config.max_output_tokens or output
+    return prompt // 4 + output
+
+
+class _Bucket:
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float, reserve: float = 0.0) -> float:
+        # Seconds until `amount` can be taken while leaving `reserve` of the capacity
+        needed = min(amount, self.capacity) + reserve * self.capacity - self.level
+        return needed / self.rate if needed > 0 else 0.0
+
+
+class _ModelQueue:
+
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = _Bucket(rpm)
+        self.tokens = _Bucket(tpm)
+        self.waiters = []  # heap of (lane rank, arrival, _Waiter)
+
+
+class _Waiter:
+    """
+    A queued call; an async one is woken through its event loop.
+    """
+    __slots__ = ("loop", "event")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else None
+
+    def wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+
+class Admission:
+    """
+    A granted call: what it reserved and how long it queued.
+    """
+    __slots__ = ("model", "lane", "tokens", "waited")
+
+    def __init__(self, model: str, lane: str, tokens: int = 0, waited: float = 0.0):
+        self.model = model
+        self.lane = lane
+        self.tokens = tokens
+        self.waited = waited
+
+
+class LLMScheduler:
+
+    def __init__(self, limits: dict, workers: int = 1, background_reserve: float = 0.0, enabled: bool = True):
+        self.enabled = enabled
+        self.background_reserve = background_reserve
+        self._queues = {
+            model: _ModelQueue(limit["rpm"] / workers, limit["tpm"] / workers)
+            for model, limit in limits.items()
+        }
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._arrivals = itertools.count()
+
+    def _enqueue(self, queue: _ModelQueue, model: str, lane: str, loop: asyncio.AbstractEventLoop = None) -> tuple:
+        ticket = (LANES.index(lane), next(self._arrivals), _Waiter(loop))
+        with self._lock:
+            heapq.heappush(queue.waiters, ticket)
+        if metrics.enabled:
+            QUEUE_DEPTH.inc(model, lane)
+        return ticket
+
+    def _dequeue(self, queue: _ModelQueue, model: str, lane: str, ticket: tuple):
+        with self._lock:
+            if ticket in queue.waiters:
+                queue.waiters.remove(ticket)
+                heapq.heapify(queue.waiters)
+            self._changed(queue)
+        if metrics.enabled:
+            QUEUE_DEPTH.dec(model, lane)
+
+    def _changed(self, queue: _ModelQueue):
+        # Called with the lock held: the head of `queue` may be admitted now
+        self._cond.notify_all()
+        if queue.waiters:
+            queue.waiters[0][2].wake()
+
+    def _take(self, queue: _ModelQueue, tokens: int, lane: str) -> float:
+        # Called with the lock held: 0 when taken, else seconds until it fits
+        now = time.monotonic()
+        queue.requests.refill(now)
+        queue.tokens.refill(now)
+        reserve = self.background_reserve if lane == BACKGROUND else 0.0
+        wait = max(queue.requests.wait_for(1, reserve), queue.tokens.wait_for(tokens, reserve))
+        if wait > 0:
+            return wait
+        queue.requests.level -= 1
+        queue.tokens.level -= tokens
+        return 0.0
+
+    def _try_admit(self, queue: _ModelQueue, ticket: tuple, tokens: int, lane: str) -> float:
+        # Called with the lock held: 0 when admitted, else seconds to wait
+        if queue.waiters[0] is not ticket:
+            return UNTIL_WOKEN
+        wait = self._take(queue, tokens, lane)
+        if wait > 0:
+            return wait
+        heapq.heappop(queue.waiters)
+        self._changed(queue)
+        return 0.0
+
+    def acquire(self, model: str, tokens: int) -> Admission:
+        """
+        Wait until `model` has room for one request of `tokens` tokens.
+        """
+        lane = _current_lane.get()
+        queue = self._queues.get(model) if self.enabled else None
+        if queue is None:
+            return Admission(model, lane)
+
+        started = time.perf_counter()
+        ticket = self._enqueue(queue, model, lane)
+        try:
+            with self._lock:
+                while (wait := self._try_admit(queue, ticket, tokens, lane)) > 0:
+                    self._cond.wait(min(wait, MAX_POLL_SECONDS))
+        finally:
+            self._dequeue(queue, model, lane, ticket)
+        return self._admitted(model, lane, tokens, time.perf_counter() - started)
+
+    async def aacquire(self, model: str, tokens: int) -> Admission:
+        """
+        Async version of acquire(): waits without blocking the event loop.
+        """
+        lane = _current_lane.get()
+        queue = self._queues.get(model) if self.enabled else None
+        if queue is None:
+            return Admission(model, lane)
+
+        started = time.perf_counter()
+        ticket = self._enqueue(queue, model, lane, asyncio.get_running_loop())
+        event = ticket[2].event
+        try:
+            while True:
+                with self._lock:
+                    wait = self._try_admit(queue, ticket, tokens, lane)
+                    if wait <= 0:
+                        break
+                    # Under the lock, so a wake from another thread isn't lost
+                    event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), None if wait == UNTIL_WOKEN else wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._dequeue(queue, model, lane, ticket)
+        return self._admitted(model, lane, tokens, time.perf_counter() - started)
+
+    def try_acquire(self, model: str, tokens: int) -> Admission | None:
+        """
+        Admit a call only if `model` has room right now and nobody is queued.
+
+        Returns:
+            The Admission, or None (nothing was reserved)
+        """
+        lane = _current_lane.get()
+        queue = self._queues.get(model) if self.enabled else None
+        if queue is None:
+            return Admission(model, lane)
+
+        with self._lock:
+            if queue.waiters or self._take(queue, tokens, lane) > 0:
+                return None
+        return self._admitted(model, lane, tokens, 0.0)
+
+    @staticmethod
+    def _admitted(model: str, lane: str, tokens: int, waited: float) -> Admission:
+        observe_queue_wait(model, lane, waited)
+        if waited >= 1:
+            logger.info("Gemini call to %s queued %.1fs in the %s lane", model, waited, lane)
+        return Admission(model, lane, tokens, waited)
+
+    def settle(self, admission: Admission, response=None):
+        """
+        Replace a call's token estimate with its usage_metadata (kept when none was reported).
+        """
+        usage = getattr(response, "usage_metadata", None)
+        if usage and usage.total_token_count:
+            self._credit(admission, admission.tokens - usage.total_token_count)
+
+    def refund(self, admission: Admission):
+        """
+        Return the tokens of a call that failed (its request still counts).
+        """
+        self._credit(admission, admission.tokens)
+
+    def _credit(self, admission: Admission, tokens: int):
+        queue = self._queues.get(admission.model)
+        if queue is None or not admission.tokens:
+            return
+        with self._lock:
+            queue.tokens.level = min(queue.tokens.capacity, queue.tokens.level + tokens)
+            self._changed(queue)
+
+    def stats(self) -> dict:
+        """
+        Bucket levels and waiters per model.
+        """
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for model, queue in self._queues.items():
+                queue.requests.refill(now)
+                queue.tokens.refill(now)
+                result[model] = {
+                    "requests_available": int(queue.requests.level),
+                    "tokens_available": int(queue.tokens.level),
+                    "waiting": len(queue.waiters),
+                }
+            return result
+
+
+llm_scheduler = LLMScheduler(
+    settings.LLM_RATE_LIMITS,
+    workers=max(settings.LLM_RATE_LIMIT_WORKERS, 1),
+    background_reserve=settings.LLM_BACKGROUND_RESERVE,
+    enabled=settings.LLM_SCHEDULER_ENABLED,
+)
@@ -0,0 +1,17 @@
+import math
+
+from rest_framework import serializers
+
+
+class TraceListQuerySerializer(serializers.Serializer):
+    """Query params of the trace list; out of range values are clamped."""
+    limit = serializers.IntegerField(default=50, help_text="Number of traces (at most 500)")
+    min_ms = serializers.FloatField(default=0, help_text="Only traces slower than this many milliseconds")
+
+    def validate_limit(self, value):
+        return min(max(value, 0), 500)
+
+    def validate_min_ms(self, value):
+        if not math.isfinite(value):
+            raise serializers.ValidationError("A finite number is required.")
+        return max(value, 0)
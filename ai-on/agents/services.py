@@ -5,38 +5,650 @@ Handles all business logic for agents, including:
 - Gemini configuration building
 - Function execution
 - Agent registry management
+- Shared Gemini client provider
+- generate_content wrappers (response cache, streaming)
+- Async (client.aio / async ORM) counterparts for the agent loop
+- Conversation history (windowed per agent, see history.py; turn journal, see journal.py)
 
 This separation avoids circular dependencies and keeps models.py clean.
 """
 
+import asyncio
+import atexit
+import contextvars
+import logging
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from asgiref.sync import sync_to_async
+from google import genai
 from google.genai import types
-from .models import agentModel, ConversationHistory
+from decouple import config
+from django.conf import settings
+from django.db import close_old_connections
+from .models import agentModel, ConversationHistory, ConversationSummary
+from .cache import response_cache, make_cache_key, serialize_response, deserialize_response, is_cacheable, get_cache_ttl
+from .history import get_history_policy, load_window
+from .history_cache import history_cache
+from .registry import AgentDefinition, agent_registry
+from .log import payload
+from .metrics import observe_first_chunk, observe_history, observe_llm_call, time_tool
+from .profiling import record_llm_call
+from .hedging import PRIMARY, HedgeSkipped, arun_hedged, get_hedge_policy, run_hedged
+from .routing import llm_operation, route_call, timed_route
+from .resilience import MODEL_ERRORS, ModelUnavailable, acall_model, call_model, raise_unavailable, retry_scope, unavailable_for, unavailable_result
+from .scheduler import BACKGROUND, INTERACTIVE, estimate_tokens, llm_priority, llm_scheduler
+from .tracing import finish_span, llm_attributes, start_span, trace_agent, trace_span
+from .journal import TurnJournal, new_history_row, wait_for_pending_writes, await_pending_writes
 from django.contrib.auth.models import User
 
 
-# Global registry to store function declarations and implementations per agent
-# Structure: {agent_id: {func_name: {'declaration': dict, 'function': callable}}}
-AGENT_FUNCTION_REGISTRY = {}
+logger = logging.getLogger(__name__)
+
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/"
+
+# Process-wide Gemini client. Built lazily (or warmed from AgentsConfig.ready)
+# and rebuilt if the worker process was forked after it was created.
+_genai_client = None
+_genai_http_pool = None
+_genai_client_pid = None
+_genai_client_lock = threading.Lock()
+
+# Async clients are bound to the event loop their connections were opened on,
+# so keep one per running loop (a single one under ASGI).
+_async_genai_clients = weakref.WeakKeyDictionary()
+
+# In-process stand-in used instead when GEMINI_BACKEND = 'fake' (agents.standin)
+_fake_genai_client = None
+
+# Record/replay wrapper used when GEMINI_CASSETTE_MODE is set (agents.cassette)
+_cassette_client = None
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.GEMINI_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.GEMINI_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=settings.GEMINI_POOL_KEEPALIVE_EXPIRY,
+    )
+
+
+def create_http_pool() -> httpx.Client:
+    """
+    Build the keep-alive HTTP connection pool used for Gemini requests.
+    
+    Returns:
+        httpx.Client sized from the GEMINI_POOL_* settings
+    """
+    return httpx.Client(limits=_pool_limits(), timeout=None, follow_redirects=True)
+
+
+def create_async_http_pool() -> httpx.AsyncClient:
+    """
+    Build the async counterpart of create_http_pool().
+    
+    Returns:
+        httpx.AsyncClient sized from the GEMINI_POOL_* settings
+    """
+    return httpx.AsyncClient(limits=_pool_limits(), timeout=None, follow_redirects=True)
 
 
-def register_agent_function(agent_id: int, func_name: str, function_declaration: dict, function: callable):
+def create_genai_client(
+    api_key: str = None,
+    base_url: str = None,
+    http_pool: httpx.Client = None,
+    async_http_pool: httpx.AsyncClient = None
+) -> genai.Client:
     """
-    Register a function for a specific agent.
+    Build a Gemini client on top of a keep-alive connection pool.
     
     Args:
-        agent_id: The ID of the agent
-        func_name: Name of the function
-        function_declaration: Gemini function declaration dict
-        function: The actual callable function
+        api_key: API key to use (defaults to GEMINI_API_KEY)
+        base_url: Optional endpoint override (e.g. a local stub)
+        http_pool: Connection pool to reuse (a new one is created if omitted)
+        async_http_pool: Async connection pool used by client.aio
+        
+    Returns:
+        genai.Client whose requests go through the given pools
+    """
+    if settings.GEMINI_BACKEND == 'standin':
+        # Real client, local stand-in server (agents.standin)
+        base_url = base_url or settings.GEMINI_STANDIN_URL
+        api_key = api_key or 'standin'
+    http_options = types.HttpOptions(
+        base_url=base_url,
+        httpx_client=http_pool or create_http_pool(),
+        httpx_async_client=async_http_pool,
+    )
+    return genai.Client(api_key=api_key or config('GEMINI_API_KEY'), http_options=http_options)
+
+
+def get_genai_client() -> genai.Client:
     """
-    if agent_id not in AGENT_FUNCTION_REGISTRY:
-        AGENT_FUNCTION_REGISTRY[agent_id] = {}
+    Get the shared Gemini client for this worker process.
+    
+    The client is thread-safe, so every agent reuses the same connection
+    pool instead of paying a new TLS handshake per call.
     
-    if func_name not in AGENT_FUNCTION_REGISTRY[agent_id]:
-        AGENT_FUNCTION_REGISTRY[agent_id][func_name] = {
-            'declaration': function_declaration,
-            'function': function
-        }
+    Returns:
+        The process-wide genai.Client (the cassette client when
+        GEMINI_CASSETTE_MODE is 'record' or 'replay')
+    """
+    if settings.GEMINI_CASSETTE_MODE != 'off':
+        return get_cassette_client()
+    return get_backend_genai_client()
+
+
+def get_backend_genai_client() -> genai.Client:
+    """
+    Get the client of the configured GEMINI_BACKEND, bypassing any cassette.
+    """
+    global _genai_client, _genai_http_pool, _genai_client_pid
+    
+    if settings.GEMINI_BACKEND == 'fake':
+        return get_fake_genai_client()
+    
+    pid = os.getpid()
+    if _genai_client is not None and _genai_client_pid == pid:
+        return _genai_client
+    
+    with _genai_client_lock:
+        if _genai_client is None or _genai_client_pid != pid:
+            # Never reuse sockets inherited from a parent process
+            _genai_http_pool = create_http_pool()
+            _genai_client = create_genai_client(http_pool=_genai_http_pool)
+            _genai_client_pid = pid
+    
+    return _genai_client
+
+
+def get_async_genai_client():
+    """
+    Get the async Gemini client (client.aio) for the running event loop.
+    
+    It shares the process-wide sync pool and keeps one async pool per loop.
+    Must be called from inside a coroutine.
+    
+    Returns:
+        genai AsyncClient bound to the current event loop
+    """
+    if settings.GEMINI_CASSETTE_MODE != 'off':
+        return get_cassette_client().aio
+    return get_backend_async_genai_client()
+
+
+def get_backend_async_genai_client():
+    """
+    Async counterpart of get_backend_genai_client().
+    """
+    if settings.GEMINI_BACKEND == 'fake':
+        return get_fake_genai_client().aio
+    
+    loop = asyncio.get_running_loop()
+    get_backend_genai_client()
+    
+    with _genai_client_lock:
+        client = _async_genai_clients.get(loop)
+        if client is None:
+            client = create_genai_client(
+                http_pool=_genai_http_pool,
+                async_http_pool=create_async_http_pool(),
+            ).aio
+            _async_genai_clients[loop] = client
+    
+    return client
+
+
+def get_fake_genai_client():
+    """
+    Get the process-wide in-process Gemini stand-in (GEMINI_BACKEND = 'fake').
+    
+    Returns:
+        agents.standin.FakeGenaiClient driven by GEMINI_STANDIN_SCENARIO
+    """
+    global _fake_genai_client
+    
+    with _genai_client_lock:
+        if _fake_genai_client is None:
+            from .standin import FakeGenaiClient
+            _fake_genai_client = FakeGenaiClient()
+    return _fake_genai_client
+
+
+def get_cassette_client():
+    """
+    Get the process-wide record/replay client (GEMINI_CASSETTE_MODE).
+    
+    When recording it forwards to the GEMINI_BACKEND clients; when replaying
+    it loads GEMINI_CASSETTE_DIR once and never opens a connection.
+    
+    Returns:
+        agents.cassette.CassetteClient
+    """
+    global _cassette_client
+    
+    with _genai_client_lock:
+        if _cassette_client is None:
+            from .cassette import Cassette, CassetteClient
+            mode = settings.GEMINI_CASSETTE_MODE
+            if mode not in ('record', 'replay'):
+                raise ValueError(f"Unknown GEMINI_CASSETTE_MODE '{mode}'")
+            cassette = Cassette(
+                settings.GEMINI_CASSETTE_DIR,
+                match=settings.GEMINI_CASSETTE_MATCH,
+                latency_scale=settings.GEMINI_CASSETTE_LATENCY_SCALE,
+            )
+            if mode == 'replay':
+                cassette.load()
+                _cassette_client = CassetteClient(cassette)
+            else:
+                atexit.register(cassette.close)
+                _cassette_client = CassetteClient(
+                    cassette, backend=get_backend_genai_client, async_backend=get_backend_async_genai_client
+                )
+    return _cassette_client
+
+
+def warm_genai_client(preconnect: bool = False):
+    """
+    Build the shared client ahead of the first request.
+    
+    Args:
+        preconnect: Also open a pooled connection to the Gemini endpoint
+            in a background thread, so the first call skips the handshake
+    """
+    get_genai_client()
+    if settings.GEMINI_CASSETTE_MODE == 'record':
+        get_backend_genai_client()
+    
+    if preconnect and _genai_http_pool is not None:
+        pool = _genai_http_pool
+        url = settings.GEMINI_STANDIN_URL if settings.GEMINI_BACKEND == 'standin' else GEMINI_BASE_URL
+        
+        def _preconnect():
+            try:
+                pool.head(url)
+            except httpx.HTTPError:
+                pass
+        
+        threading.Thread(target=_preconnect, name="gemini-preconnect", daemon=True).start()
+
+
+def warm_server_process():
+    """
+    Warm the Gemini client of a server process (GEMINI_CLIENT_WARMUP).
+    
+    Called when main.wsgi / main.asgi load the application, so management
+    commands (migrate, shell, ...) never build a client or open a connection.
+    """
+    if settings.GEMINI_CLIENT_WARMUP:
+        warm_genai_client(preconnect=settings.GEMINI_CLIENT_PRECONNECT)
+
+
+def _record_llm_call(agent: agentModel, model: str, seconds: float, response=None, outcome: str = "ok"):
+    # Agent metrics plus the request's Server-Timing profile
+    observe_llm_call(agent.name, model, seconds, response, outcome)
+    record_llm_call(seconds)
+
+
+def _admit(model: str, contents, config, leg: bool):
+    # Admission (may queue on the model's rate limits); a hedge or fallback
+    # leg is only sent if the model has room right now
+    tokens = estimate_tokens(contents, config)
+    if not leg:
+        return llm_scheduler.acquire(model, tokens)
+    admission = llm_scheduler.try_acquire(model, tokens)
+    if admission is None:
+        raise HedgeSkipped(f"no room on {model}")
+    return admission
+
+
+def _timed_generate_content(agent: agentModel, model: str, contents, config, race=None, leg: bool = False,
+                            **span_attributes) -> types.GenerateContentResponse:
+    # Admission, then one metrics observation and one trace span per Gemini
+    # call; a hedged primary arms its race's timers while the model has it
+    if race and race.decided:
+        # A leg answered while this primary waited out a retry backoff
+        raise HedgeSkipped(f"{PRIMARY} retry to {model} not sent")
+    admission = _admit(model, contents, config, leg)
+    span = start_span(model, "llm", agent=agent.name, queued_ms=round(admission.waited * 1000, 1), **span_attributes)
+    started = time.perf_counter()
+    if race:
+        race.arm()
+    try:
+        response = get_genai_client().models.generate_content(model=model, contents=contents, config=config)
+    except Exception as e:
+        llm_scheduler.refund(admission)
+        _record_llm_call(agent, model, time.perf_counter() - started, outcome="error")
+        finish_span(span, e)
+        raise
+    finally:
+        if race:
+            race.disarm()
+    llm_scheduler.settle(admission, response)
+    _record_llm_call(agent, model, time.perf_counter() - started, response)
+    finish_span(span, **llm_attributes(response))
+    return response
+
+
+async def _atimed_generate_content(agent: agentModel, model: str, contents, config, race=None, leg: bool = False,
+                                   **span_attributes) -> types.GenerateContentResponse:
+    if leg:
+        admission = _admit(model, contents, config, leg)
+    else:
+        admission = await llm_scheduler.aacquire(model, estimate_tokens(contents, config))
+    span = start_span(model, "llm", agent=agent.name, queued_ms=round(admission.waited * 1000, 1), **span_attributes)
+    started = time.perf_counter()
+    if race:
+        race.arm()
+    try:
+        response = await get_async_genai_client().models.generate_content(model=model, contents=contents, config=config)
+    except asyncio.CancelledError:
+        # An attempt that lost a hedged race
+        llm_scheduler.refund(admission)
+        finish_span(span, cancelled=True)
+        raise
+    except Exception as e:
+        llm_scheduler.refund(admission)
+        _record_llm_call(agent, model, time.perf_counter() - started, outcome="error")
+        finish_span(span, e)
+        raise
+    finally:
+        if race:
+            race.disarm()
+    llm_scheduler.settle(admission, response)
+    _record_llm_call(agent, model, time.perf_counter() - started, response)
+    finish_span(span, **llm_attributes(response))
+    return response
+
+
+def _generate(agent: agentModel, model: str, contents, config) -> types.GenerateContentResponse:
+    # One call (retried behind the model's circuit breaker), or that call as
+    # the primary of a race under the agent's hedge policy, whose hedge and
+    # fallback legs are a single attempt each
+    def attempt(attempt_model: str, kind: str = None, race=None):
+        leg = kind not in (None, PRIMARY)
+        span_attributes = {"attempt": kind} if kind else {}
+        return call_model(
+            attempt_model,
+            lambda: _timed_generate_content(agent, attempt_model, contents, config, race, leg, **span_attributes),
+            retries=not leg,
+        )
+    
+    policy = get_hedge_policy(agent.name, model, agent.gemini_model)
+    if policy is None:
+        return attempt(model)
+    return run_hedged(agent.name, model, policy, attempt)
+
+
+async def _agenerate(agent: agentModel, model: str, contents, config) -> types.GenerateContentResponse:
+    async def attempt(attempt_model: str, kind: str = None, race=None):
+        leg = kind not in (None, PRIMARY)
+        span_attributes = {"attempt": kind} if kind else {}
+        return await acall_model(
+            attempt_model,
+            lambda: _atimed_generate_content(agent, attempt_model, contents, config, race, leg, **span_attributes),
+            retries=not leg,
+        )
+    
+    policy = get_hedge_policy(agent.name, model, agent.gemini_model)
+    if policy is None:
+        return await attempt(model)
+    return await arun_hedged(agent.name, model, policy, attempt)
+
+
+def _observe_cache_hit(agent: agentModel, model: str):
+    observe_llm_call(agent.name, model, 0, outcome="cache_hit")
+    finish_span(start_span(model, "llm", agent=agent.name, cache_hit=True))
+
+
+def generate_content(
+    agent: agentModel,
+    contents,
+    config: types.GenerateContentConfig = None,
+    model: str = None,
+    cache_ttl: int = None,
+    bypass_cache: bool = False
+) -> types.GenerateContentResponse:
+    """
+    Call Gemini for an agent. Every agent's model calls go through here.
+    
+    Responses are served from / stored in the LLM response cache when the
+    agent has a TTL (see LLM_CACHE_TTLS).
+    
+    Args:
+        agent: The agent model instance making the call
+        contents: Contents to send
+        config: GenerateContentConfig for the call
+        model: Model override (defaults to agent.gemini_model, or the model
+            picked by the agent's LLM_ROUTES)
+        cache_ttl: TTL override in seconds (0 disables caching for this call)
+        bypass_cache: Skip the lookup; the fresh answer replaces the cached one
+        
+    Returns:
+        The GenerateContentResponse
+    """
+    route = None if model else route_call(agent.name, agent.gemini_model, contents, config)
+    if route:
+        model, config = route.model, route.config
+    model = model or agent.gemini_model
+    ttl = get_cache_ttl(agent.name) if cache_ttl is None else cache_ttl
+    
+    if ttl <= 0:
+        with timed_route(agent.name, route):
+            return _generate(agent, model, contents, config)
+    
+    key = make_cache_key(model, contents, config)
+    if not bypass_cache:
+        cached = response_cache.get(agent.name, key, ttl)
+        if cached is not None:
+            _observe_cache_hit(agent, model)
+            return deserialize_response(cached, config)
+    
+    with timed_route(agent.name, route):
+        response = _generate(agent, model, contents, config)
+    if is_cacheable(response):
+        response_cache.set(agent.name, key, serialize_response(response), ttl)
+    return response
+
+
+async def agenerate_content(
+    agent: agentModel,
+    contents,
+    config: types.GenerateContentConfig = None,
+    model: str = None,
+    cache_ttl: int = None,
+    bypass_cache: bool = False
+) -> types.GenerateContentResponse:
+    """
+    Async version of generate_content() built on client.aio.
+    """
+    route = None if model else route_call(agent.name, agent.gemini_model, contents, config)
+    if route:
+        model, config = route.model, route.config
+    model = model or agent.gemini_model
+    ttl = get_cache_ttl(agent.name) if cache_ttl is None else cache_ttl
+    
+    if ttl <= 0:
+        with timed_route(agent.name, route):
+            return await _agenerate(agent, model, contents, config)
+    
+    key = make_cache_key(model, contents, config)
+    if not bypass_cache:
+        cached = await response_cache.aget(agent.name, key, ttl)
+        if cached is not None:
+            _observe_cache_hit(agent, model)
+            return deserialize_response(cached, config)
+    
+    with timed_route(agent.name, route):
+        response = await _agenerate(agent, model, contents, config)
+    if is_cacheable(response):
+        await response_cache.aset(agent.name, key, serialize_response(response), ttl)
+    return response
+
+
+def merge_stream_chunks(chunks: list) -> types.GenerateContentResponse:
+    """
+    Fold generate_content_stream chunks into one response.
+    
+    Consecutive text parts are concatenated; function calls and other parts
+    are kept in order. Finish reason and usage come from the last chunk that
+    carries them.
+    
+    Args:
+        chunks: GenerateContentResponse chunks, in arrival order
+        
+    Returns:
+        A single GenerateContentResponse equivalent to the non-streamed call
+    """
+    parts = []
+    finish_reason = None
+    usage_metadata = None
+    for chunk in chunks:
+        if chunk.usage_metadata:
+            usage_metadata = chunk.usage_metadata
+        if not chunk.candidates:
+            continue
+        candidate = chunk.candidates[0]
+        if candidate.finish_reason:
+            finish_reason = candidate.finish_reason
+        for part in (candidate.content.parts or []) if candidate.content else []:
+            previous = parts[-1] if parts else None
+            if (part.text is not None and previous is not None and previous.text is not None
+                    and bool(part.thought) == bool(previous.thought)):
+                parts[-1] = previous.model_copy(update={"text": previous.text + part.text})
+            else:
+                parts.append(part)
+    
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(
+            content=types.Content(role="model", parts=parts),
+            finish_reason=finish_reason
+        )] if parts or finish_reason else None,
+        usage_metadata=usage_metadata
+    )
+
+
+def chunk_text(chunk: types.GenerateContentResponse) -> str:
+    """
+    Answer text carried by a streamed chunk (thoughts and function calls skipped).
+    """
+    if not chunk.candidates or not chunk.candidates[0].content:
+        return ""
+    return "".join(
+        part.text for part in (chunk.candidates[0].content.parts or [])
+        if part.text and not part.thought
+    )
+
+
+def _end_stream(agent: agentModel, model: str, admission, span, started: float, error: BaseException = None,
+                chunks: list = ()):
+    # Settle (or refund) a stream's admission, record it and finish its span
+    seconds = time.perf_counter() - started
+    if error is None:
+        usage = next((chunk for chunk in reversed(chunks) if chunk.usage_metadata), None)
+        llm_scheduler.settle(admission, usage)
+        _record_llm_call(agent, model, seconds, usage)
+        finish_span(span, chunks=len(chunks), **llm_attributes(usage))
+        return
+    llm_scheduler.refund(admission)
+    if isinstance(error, Exception):
+        _record_llm_call(agent, model, seconds, outcome="error")
+        finish_span(span, error)
+    else:
+        _record_llm_call(agent, model, seconds, outcome="cancelled")
+        finish_span(span, cancelled=True, chunks=len(chunks))
+
+
+async def agenerate_content_stream(
+    agent: agentModel,
+    contents,
+    config: types.GenerateContentConfig = None,
+    model: str = None,
+    cache_ttl: int = None,
+    bypass_cache: bool = False
+):
+    """
+    Streaming version of agenerate_content(): yields response chunks as they arrive.
+    
+    A cache hit is yielded as a single chunk. On a miss the chunks are merged
+    once the stream completes and stored like a regular response.
+    
+    Args:
+        Same as generate_content()
+        
+    Yields:
+        GenerateContentResponse chunks
+    """
+    route = None if model else route_call(agent.name, agent.gemini_model, contents, config)
+    if route:
+        model, config = route.model, route.config
+    model = model or agent.gemini_model
+    ttl = get_cache_ttl(agent.name) if cache_ttl is None else cache_ttl
+    
+    key = make_cache_key(model, contents, config) if ttl > 0 else None
+    if key and not bypass_cache:
+        cached = await response_cache.aget(agent.name, key, ttl)
+        if cached is not None:
+            _observe_cache_hit(agent, model)
+            yield deserialize_response(cached, config)
+            return
+    
+    async def open_stream():
+        # Retried (agents.resilience) up to the first chunk: nothing has been yielded yet
+        admission = await llm_scheduler.aacquire(model, estimate_tokens(contents, config))
+        span = start_span(model, "llm", agent=agent.name, stream=True, queued_ms=round(admission.waited * 1000, 1))
+        started = time.perf_counter()
+        stream = None
+        try:
+            stream = await get_async_genai_client().models.generate_content_stream(
+                model=model, contents=contents, config=config
+            )
+            first = await anext(stream, None)
+        except BaseException as e:
+            if stream is not None:
+                await stream.aclose()
+            _end_stream(agent, model, admission, span, started, e)
+            raise
+        return admission, span, started, stream, first
+    
+    with timed_route(agent.name, route):
+        admission, span, started, stream, first = await acall_model(model, open_stream)
+        chunks = []
+        error = None
+        try:
+            if first is not None:
+                observe_first_chunk(agent.name, model, time.perf_counter() - started)
+                chunks.append(first)
+                yield first
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        except BaseException as e:
+            # Including GeneratorExit (the client went away and the caller
+            # closed this generator) and CancelledError
+            error = e
+            raise
+        finally:
+            await stream.aclose()
+            _end_stream(agent, model, admission, span, started, error, chunks)
+    
+    if key:
+        response = merge_stream_chunks(chunks)
+        if is_cacheable(response):
+            await response_cache.aset(agent.name, key, serialize_response(response), ttl)
+
+
+def get_llm_cache_stats() -> dict:
+    """
+    Hit/miss counters of the LLM response cache, per agent.
+    """
+    return response_cache.stats()
 
 
 def get_agent_functions(agent_id: int) -> dict:
@@ -47,23 +659,22 @@ def get_agent_functions(agent_id: int) -> dict:
         agent_id: The ID of the agent
         
     Returns:
-        Dictionary of functions for this agent
+        Read-only mapping of func_name to {'declaration', 'function'}
     """
-    return AGENT_FUNCTION_REGISTRY.get(agent_id, {})
+    entry = agent_registry.by_id(agent_id)
+    return entry.functions if entry else {}
 
 
-def build_tools(agent: agentModel) -> types.Tool | None:
+def build_tools(functions: dict) -> types.Tool | None:
     """
-    Build Gemini Tool object from registered functions for an agent.
+    Build Gemini Tool object from an agent's functions.
     
     Args:
-        agent: The agent model instance
+        functions: The agent's tool table (see get_agent_functions)
         
     Returns:
         types.Tool object or None if no functions registered
     """
-    functions = get_agent_functions(agent.id)
-    
     if len(functions) == 0:
         return None
     
@@ -74,12 +685,16 @@ def build_tools(agent: agentModel) -> types.Tool | None:
     return types.Tool(function_declarations=tools)
 
 
-def build_config(agent: agentModel) -> types.GenerateContentConfig:
+def build_config(agent: agentModel, functions: dict = None) -> types.GenerateContentConfig:
     """
     Build Gemini configuration for an agent.
     
+    Called once per agent by the agent registry; request handling uses the
+    cached result via get_agent_config().
+    
     Args:
         agent: The agent model instance
+        functions: The agent's tool table (defaults to its registered functions)
         
     Returns:
         GenerateContentConfig object ready for Gemini API
@@ -93,7 +708,7 @@ def build_config(agent: agentModel) -> types.GenerateContentConfig:
         
     config = types.GenerateContentConfig(**config_args)
     
-    tools = build_tools(agent)
+    tools = build_tools(get_agent_functions(agent.id) if functions is None else functions)
     if tools:
         config.tools = [tools]
         config.tool_config = types.ToolConfig(
@@ -105,6 +720,20 @@ def build_config(agent: agentModel) -> types.GenerateContentConfig:
     return config
 
 
+def get_agent_config(agent: agentModel) -> types.GenerateContentConfig:
+    """
+    The agent's cached GenerateContentConfig (shared, do not mutate).
+    
+    Args:
+        agent: The agent model instance
+        
+    Returns:
+        GenerateContentConfig built by the agent registry
+    """
+    entry = agent_registry.by_id(agent.id)
+    return entry.config if entry else build_config(agent)
+
+
 def execute_function(agent: agentModel, func_name: str, args: dict):
     """
     Execute a registered function for an agent.
@@ -124,23 +753,197 @@ def execute_function(agent: agentModel, func_name: str, args: dict):
     func_entry = functions.get(func_name)
     
     if func_entry:
-        return func_entry['function'](**args)
+        with time_tool(agent.name, func_name), trace_span(func_name, "tool", agent=agent.name):
+            return func_entry['function'](**args)
     else:
         raise ValueError(f"Function '{func_name}' not found in agent '{agent.name}'.")
 
 
-def get_agent_history(agent: agentModel, user: User) -> list[types.Content]:
+async def arun_tool(func: callable, *args, **kwargs):
+    """
+    Run a blocking tool (ORM work, nested agent calls) from async code.
+    
+    Tools run in a worker thread rather than on the event loop or the shared
+    thread_sensitive executor, so a slow nested agent only holds its own thread.
+    
+    Args:
+        func: The callable to run
+        *args, **kwargs: Arguments passed to func
+        
+    Returns:
+        Result of func
+    """
+    def _call():
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    
+    return await sync_to_async(_call, thread_sensitive=False)()
+
+
+async def aexecute_function(agent: agentModel, func_name: str, args: dict):
+    """
+    Async version of execute_function(); the function runs via arun_tool().
+    """
+    return await arun_tool(execute_function, agent, func_name, args)
+
+
+def get_function_calls(response) -> list[types.FunctionCall]:
+    """
+    All function calls of a model response, in the order the model emitted them.
+    """
+    if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
+        return []
+    return [part.function_call for part in response.candidates[0].content.parts if part.function_call]
+
+
+def _serial_groups(calls: list) -> list[list[int]]:
+    # Calls to different functions are independent; repeated calls to the
+    # same function (e.g. two profile edits) keep their order.
+    groups = {}
+    for index, call in enumerate(calls):
+        groups.setdefault(call.name, []).append(index)
+    return list(groups.values())
+
+
+def run_function_calls(calls: list, run: callable) -> list:
+    """
+    Execute the function calls of one model turn.
+    
+    Calls to different functions run concurrently on a thread pool bounded by
+    AGENT_TOOL_MAX_WORKERS; a single call runs inline. An exception in any
+    call is re-raised once the others have finished.
+    
+    Args:
+        calls: types.FunctionCall list (see get_function_calls)
+        run: Callable taking one FunctionCall and returning its result
+        
+    Returns:
+        Results in the same order as calls
+    """
+    results = [None] * len(calls)
+    groups = _serial_groups(calls)
+    
+    def _run_group(indexes):
+        try:
+            for index in indexes:
+                results[index] = run(calls[index])
+        finally:
+            close_old_connections()
+    
+    if len(groups) <= 1:
+        for index in (groups[0] if groups else []):
+            results[index] = run(calls[index])
+        return results
+    
+    # A pool per turn: nested agents (a tool calling another agent that runs
+    # its own calls) can never starve each other of workers.
+    with ThreadPoolExecutor(max_workers=min(len(groups), settings.AGENT_TOOL_MAX_WORKERS)) as pool:
+        # Each group runs in a copy of the caller's context (request-scoped contextvars)
+        futures = [pool.submit(contextvars.copy_context().run, _run_group, indexes) for indexes in groups]
+    for future in futures:
+        future.result()
+    return results
+
+
+async def arun_function_calls(calls: list, run: callable) -> list:
+    """
+    Async version of run_function_calls(); `run` is a blocking callable and
+    each group of calls runs via arun_tool(), at most AGENT_TOOL_MAX_WORKERS at a time.
+    """
+    results = [None] * len(calls)
+    limit = asyncio.Semaphore(settings.AGENT_TOOL_MAX_WORKERS)
+    
+    async def _run_group(indexes):
+        async with limit:
+            for index in indexes:
+                results[index] = await arun_tool(run, calls[index])
+    
+    outcomes = await asyncio.gather(*(_run_group(indexes) for indexes in _serial_groups(calls)), return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+    return results
+
+
+def record_function_calls(journal: TurnJournal, history: list, calls: list, results: list):
+    """
+    Add one model turn's function calls and their responses to the journal
+    and to the in-flight history: a single model content holding every call,
+    then a single user content with the responses in the same order (the shape
+    Gemini expects for parallel function calling).
+    
+    Args:
+        journal: The turn's TurnJournal
+        history: The Content list sent to Gemini
+        calls: types.FunctionCall list
+        results: Result of each call, in the same order
+    """
+    call_parts = [{"function_call": {"name": call.name, "args": dict(call.args or {})}} for call in calls]
+    response_parts = [
+        {"function_response": {"name": call.name, "response": result}}
+        for call, result in zip(calls, results)
+    ]
+    journal.add(part={"parts": call_parts}, role="model")
+    journal.add(part={"parts": response_parts}, role="user")
+    
+    history.append(types.Content(
+        role="model",
+        parts=[types.Part(function_call=types.FunctionCall(name=call.name, args=dict(call.args or {}))) for call in calls]
+    ))
+    history.append(types.Content(
+        role="user",
+        parts=[
+            types.Part(function_response=types.FunctionResponse(name=call.name, response=result))
+            for call, result in zip(calls, results)
+        ]
+    ))
+
+
+def get_agent_history(agent: agentModel, user: User, full: bool = False) -> list[types.Content]:
     """
     Get conversation history for an agent and user.
     
+    Agents with an AGENT_HISTORY_POLICIES entry get a bounded window: a
+    rolling summary of older turns plus the most recent turns verbatim
+    (see agents.history).
+    
     Args:
         agent: The agent model instance
         user: The user
+        full: Return every stored message regardless of the agent's policy
+              (for displaying the conversation)
         
     Returns:
         List of Content objects for Gemini API
     """
-    contents = ConversationHistory.objects.filter(user=user, agent=agent).order_by('timestamp')
+    wait_for_pending_writes(agent, user)
+    policy = None if full else get_history_policy(agent.name)
+    if policy is not None:
+        window = load_window(agent, user, policy)
+        if window.fold:
+            try:
+                response = generate_content(
+                    agent,
+                    **window.summary_request(),
+                    model=settings.AGENT_HISTORY_SUMMARY_MODEL,
+                    cache_ttl=0
+                )
+                window.apply_summary(response.text)
+            except Exception as e:
+                logger.warning("History summary failed for %s: %s", agent.name, e)
+                window.summary_failed()
+        history = window.contents()
+        observe_history(agent.name, len(history))
+        return history
+    
+    if not full:
+        history = [row.content for row in history_cache.rows(agent, user)]
+        observe_history(agent.name, len(history))
+        return history
+    
+    contents = ConversationHistory.objects.filter(user=user, agent=agent).order_by('timestamp', 'id')
     content = []
     
     for m in contents:
@@ -154,22 +957,73 @@ def get_agent_history(agent: agentModel, user: User) -> list[types.Content]:
     return content
 
 
+async def aget_agent_history(agent: agentModel, user: User, full: bool = False) -> list[types.Content]:
+    """
+    Async version of get_agent_history().
+    """
+    await await_pending_writes(agent, user)
+    policy = None if full else get_history_policy(agent.name)
+    if policy is not None:
+        window = await sync_to_async(load_window)(agent, user, policy)
+        if window.fold:
+            try:
+                response = await agenerate_content(
+                    agent,
+                    **window.summary_request(),
+                    model=settings.AGENT_HISTORY_SUMMARY_MODEL,
+                    cache_ttl=0
+                )
+                await sync_to_async(window.apply_summary)(response.text)
+            except Exception as e:
+                logger.warning("History summary failed for %s: %s", agent.name, e)
+                window.summary_failed()
+        history = window.contents()
+        observe_history(agent.name, len(history))
+        return history
+    
+    if not full:
+        rows = await sync_to_async(history_cache.rows)(agent, user)
+        observe_history(agent.name, len(rows))
+        return [row.content for row in rows]
+    
+    content = []
+    
+    async for m in ConversationHistory.objects.filter(user=user, agent=agent).order_by('timestamp', 'id'):
+        content.append(
+            types.Content(
+                role=m.role,
+                parts=m.content_data.get('parts', []),
+            ),
+        )
+    
+    return content
+
+
 def add_to_history(agent: agentModel, user: User, part: dict, role: str):
     """
     Add a message to conversation history.
     
+    Agent turns that write several parts should record them in a
+    TurnJournal instead (one INSERT per turn).
+    
     Args:
         agent: The agent model instance
         user: The user
         part: Content data to store
         role: 'user' or 'model'
     """
-    ConversationHistory.objects.create(
-        user=user,
-        agent=agent,
-        role=role,
-        content_data=part
-    )
+    row = new_history_row(agent, user, part, role)
+    row.save()
+    history_cache.append(agent, user, [row])
+
+
+async def aadd_to_history(agent: agentModel, user: User, part: dict, role: str):
+    """
+    Async version of add_to_history().
+    """
+    row = new_history_row(agent, user, part, role)
+    await row.asave()
+    history_cache.append(agent, user, [row])
 
 
 def clear_agent_history(agent: agentModel, user: User):
@@ -180,17 +1034,7 @@ def clear_agent_history(agent: agentModel, user: User):
         agent: The agent model instance
         user: The user
     """
+    wait_for_pending_writes(agent, user)
     ConversationHistory.objects.filter(user=user, agent=agent).delete()
-
-
-
-def clear_agent_functions(agent_id: int):
-    """
-    Clear all registered functions for an agent.
-    Useful for testing or reinitialization.
-    
-    Args:
-        agent_id: The ID of the agent
-    """
-    if agent_id in AGENT_FUNCTION_REGISTRY:
-        del AGENT_FUNCTION_REGISTRY[agent_id]
+    ConversationSummary.objects.filter(user=user, agent=agent).delete()
+    history_cache.invalidate(agent, user)
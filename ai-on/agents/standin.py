@@ -0,0 +1,590 @@
+"""
+Gemini Stand-in
+
+Offline replacement for the Gemini API, used to exercise and load-test the
+real agent code paths without quotas or cost. Selected with GEMINI_BACKEND:
+
+- 'fake': get_genai_client() returns FakeGenaiClient, an in-process client
+  with the generate_content / generate_content_stream surfaces (sync and
+  client.aio) the agents use
+- 'standin': the real google-genai client talks HTTP to the stand-in server
+  (`python manage.py gemini_standin`) at GEMINI_STANDIN_URL, so the SDK,
+  connection pool and SSE parsing are exercised too
+
+Both are driven by the same scenario (GEMINI_STANDIN_SCENARIO, JSON):
+
+    {
+      "latency": {"distribution": "lognormal", "median_ms": 800, "sigma": 0.5,
+                  "models": {"gemini-2.5-pro": {"median_ms": 2500}}},
+      "stream": {"chunks": 4, "first_chunk": 0.3},
+      "errors": {"rate": 0.02, "statuses": [429, 503]},
+      "reply_words": 40,
+      "rules": [
+        {"agent": "You are the **Chatbot Agent**", "match": "(?i)spent|paid",
+         "function_calls": [{"name": "call_expense_manager", "args": {"message": "{message}"}}]},
+        {"agent": "You are the **Expense Manager Agent**", "json": {"expenses": []}},
+        {"agent": "You are the **Advisor Agent**", "error": 503}
+      ]
+    }
+
+Rules are tried in order against the system instruction (`agent`, a
+case-insensitive substring; use the agent's identity line, other agents'
+names appear in most instructions) and the last user message (`match`, a regex).
+By default they only answer user messages; set "on": "function_response"
+or "any" to script the turn after a tool ran. "{message}" in a rule's
+output is replaced by the last user message.
+
+Without a matching rule the stand-in calls the first declared function when
+function calling is forced (mode ANY), returns JSON generated from the
+response schema for structured output, and plain text otherwise.
+
+Latency distributions: fixed (ms), uniform (min_ms, max_ms), normal
+(mean_ms, stddev_ms), lognormal (median_ms, sigma).
+"""
+
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from google.genai import errors, types
+from pydantic import BaseModel
+
+
+ERROR_STATUSES = {
+    400: "INVALID_ARGUMENT",
+    429: "RESOURCE_EXHAUSTED",
+    500: "INTERNAL",
+    503: "UNAVAILABLE",
+    504: "DEADLINE_EXCEEDED",
+}
+
+DEFAULT_SCENARIO = {
+    "latency": {"distribution": "fixed", "ms": 0},
+    "stream": {"chunks": 4, "first_chunk": 0.3},
+    "errors": {"rate": 0.0, "statuses": [429, 503]},
+    "reply_words": 40,
+    "rules": [],
+}
+
+FILLER = (
+    "Based on your recent spending your budget looks healthy overall and "
+    "you still have room in most categories this month so keep tracking "
+    "daily expenses and review the plan again next week"
+).split()
+
+
+def load_scenario(path=None) -> dict:
+    """
+    Read a scenario file, filling in defaults.
+
+    Args:
+        path: JSON file (defaults to GEMINI_STANDIN_SCENARIO; None for the built-in defaults)
+
+    Returns:
+        Scenario dict
+    """
+    path = path if path is not None else settings.GEMINI_STANDIN_SCENARIO
+    scenario = dict(DEFAULT_SCENARIO)
+    if path:
+        with open(path) as f:
+            scenario.update(json.load(f))
+    return scenario
+
+
+class StandinError(Exception):
+    """
+    An injected API error, mapped to the HTTP status / SDK exception Gemini would produce.
+    """
+
+    def __init__(self, code: int, message: str = "Injected by the Gemini stand-in", latency: float = 0.0):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        # How long the failing call takes before the error is returned
+        self.latency = latency
+
+    def response_json(self) -> dict:
+        return {"error": {"code": self.code, "message": self.message, "status": ERROR_STATUSES.get(self.code, "UNKNOWN")}}
+
+    def to_api_error(self) -> errors.APIError:
+        error_class = errors.ServerError if self.code >= 500 else errors.ClientError
+        return error_class(self.code, self.response_json())
+
+
+def _get(data: dict, *keys, default=None):
+    # The SDK mixes camelCase and snake_case keys on the wire
+    for key in keys:
+        if key in data:
+            return data[key]
+    return default
+
+
+class StandinRequest:
+    """
+    A generate_content call normalized from SDK objects or a REST body.
+    """
+
+    def __init__(self, model: str, system: str, contents: list, functions: list, mode: str, mime: str, schema):
+        self.model = model
+        self.system = system
+        self.contents = contents
+        self.functions = functions
+        self.mode = (mode or "AUTO").upper()
+        self.mime = mime
+        self.schema = schema
+
+    @property
+    def last_text(self) -> str:
+        for content in reversed(self.contents):
+            texts = [part["text"] for part in content.get("parts", []) if part.get("text")]
+            if content.get("role", "user") == "user" and texts:
+                return "\n".join(texts)
+        return ""
+
+    @property
+    def answers_function_response(self) -> bool:
+        if not self.contents:
+            return False
+        return any(_get(part, "function_response", "functionResponse") for part in self.contents[-1].get("parts", []))
+
+    @property
+    def prompt_words(self) -> int:
+        return len(json.dumps(self.contents, default=str).split()) + len(self.system.split())
+
+    @classmethod
+    def from_sdk(cls, model: str, contents, config: types.GenerateContentConfig = None) -> "StandinRequest":
+        if isinstance(contents, (str, types.Content, types.Part)):
+            contents = [contents]
+        normalized = []
+        for content in contents or []:
+            if isinstance(content, str):
+                normalized.append({"role": "user", "parts": [{"text": content}]})
+            elif isinstance(content, types.Part):
+                normalized.append({"role": "user", "parts": [content.model_dump(mode="json", exclude_none=True)]})
+            elif isinstance(content, types.Content):
+                normalized.append(content.model_dump(mode="json", exclude_none=True))
+            else:
+                normalized.append(content)
+
+        config = config or types.GenerateContentConfig()
+        system = config.system_instruction or ""
+        if isinstance(system, types.Content):
+            system = " ".join(part.text or "" for part in system.parts or [])
+
+        functions = []
+        for tool in config.tools or []:
+            tool = tool if isinstance(tool, types.Tool) else types.Tool.model_validate(tool)
+            for declaration in tool.function_declarations or []:
+                functions.append(declaration.model_dump(mode="json", exclude_none=True))
+
+        mode = None
+        if config.tool_config and config.tool_config.function_calling_config:
+            mode = config.tool_config.function_calling_config.mode
+            mode = getattr(mode, "value", mode)
+
+        schema = config.response_schema
+        if isinstance(schema, type) and issubclass(schema, BaseModel):
+            schema = schema.model_json_schema()
+        elif isinstance(schema, types.Schema):
+            schema = schema.model_dump(mode="json", exclude_none=True)
+
+        return cls(model, str(system), normalized, functions, mode, config.response_mime_type, schema)
+
+    @classmethod
+    def from_rest(cls, model: str, body: dict) -> "StandinRequest":
+        system = _get(body, "systemInstruction", "system_instruction", default={}) or {}
+        system = " ".join(part.get("text", "") for part in system.get("parts", []))
+        functions = []
+        for tool in body.get("tools", []):
+            functions.extend(_get(tool, "functionDeclarations", "function_declarations", default=[]))
+        tool_config = _get(body, "toolConfig", "tool_config", default={}) or {}
+        calling = _get(tool_config, "functionCallingConfig", "function_calling_config", default={}) or {}
+        generation = _get(body, "generationConfig", "generation_config", default={}) or {}
+        return cls(
+            model,
+            system,
+            body.get("contents", []),
+            functions,
+            calling.get("mode"),
+            _get(generation, "responseMimeType", "response_mime_type"),
+            _get(generation, "responseSchema", "response_schema", "responseJsonSchema"),
+        )
+
+
+def synthesize(schema: dict, defs: dict = None, name: str = "value", required_only: bool = False):
+    """
+    Build a value matching a response/parameter schema (Gemini Schema or JSON Schema).
+    """
+    if not schema:
+        return None
+    defs = defs if defs is not None else schema.get("$defs", {})
+    if "$ref" in schema:
+        return synthesize(defs.get(schema["$ref"].split("/")[-1], {}), defs, name, required_only)
+    for key in ("anyOf", "any_of"):
+        if key in schema:
+            options = [option for option in schema[key] if str(option.get("type", "")).lower() != "null"]
+            return synthesize(options[0] if options else {}, defs, name, required_only)
+    if schema.get("enum"):
+        return schema["enum"][0]
+
+    kind = str(schema.get("type", "object")).lower()
+    if kind == "object":
+        properties = schema.get("properties", {})
+        required = schema.get("required", [])
+        keys = [key for key in properties if key in required] if required_only else list(properties)
+        return {key: synthesize(properties[key], defs, key, required_only) for key in keys}
+    if kind == "array":
+        return [synthesize(schema.get("items", {}), defs, name, required_only)]
+    if kind == "string":
+        return f"Stand-in {name.replace('_', ' ')}"
+    if kind == "number":
+        return 100.0
+    if kind == "integer":
+        return 1
+    if kind == "boolean":
+        return True
+    return None
+
+
+def _fill(value, message: str):
+    if isinstance(value, str):
+        return value.replace("{message}", message)
+    if isinstance(value, list):
+        return [_fill(item, message) for item in value]
+    if isinstance(value, dict):
+        return {key: _fill(item, message) for key, item in value.items()}
+    return value
+
+
+class LatencyModel:
+
+    def __init__(self, spec: dict, rng: random.Random):
+        self.spec = spec or {}
+        self.rng = rng
+
+    def sample(self, model: str) -> float:
+        """
+        Seconds of simulated model latency for one call.
+        """
+        spec = {**self.spec, **self.spec.get("models", {}).get(model, {})}
+        distribution = spec.get("distribution", "fixed")
+        if distribution == "uniform":
+            ms = self.rng.uniform(spec.get("min_ms", 0), spec.get("max_ms", 0))
+        elif distribution == "normal":
+            ms = self.rng.gauss(spec.get("mean_ms", 0), spec.get("stddev_ms", 0))
+        elif distribution == "lognormal":
+            ms = self.rng.lognormvariate(math.log(max(spec.get("median_ms", 1), 1)), spec.get("sigma", 0.5))
+        else:
+            ms = spec.get("ms", 0)
+        return max(ms, 0) / 1000
+
+
+class StandinResponder:
+    """
+    Decides the answer, latency and injected errors for each call.
+    """
+
+    def __init__(self, scenario: dict = None, seed: int = None):
+        self.scenario = scenario if scenario is not None else load_scenario()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.latency = LatencyModel(self.scenario.get("latency"), self._rng)
+        self.stats = {"requests": 0, "errors": 0}
+
+    def _rule_for(self, request: StandinRequest) -> dict | None:
+        for rule in self.scenario.get("rules", []):
+            on = rule.get("on", "message")
+            if on == "message" and request.answers_function_response:
+                continue
+            if on == "function_response" and not request.answers_function_response:
+                continue
+            if rule.get("model") and rule["model"] != request.model:
+                continue
+            if rule.get("agent") and rule["agent"].lower() not in request.system.lower():
+                continue
+            if rule.get("match") and not re.search(rule["match"], request.last_text):
+                continue
+            return rule
+        return None
+
+    def _reply_text(self, request: StandinRequest) -> str:
+        if request.answers_function_response:
+            names = [
+                _get(part, "function_response", "functionResponse")["name"]
+                for part in request.contents[-1].get("parts", [])
+                if _get(part, "function_response", "functionResponse")
+            ]
+            lead = f"Done, I ran {', '.join(names)} for you."
+        else:
+            lead = f"Stand-in answer to: {request.last_text[-80:].strip()}"
+        words = self.scenario.get("reply_words", 40)
+        return " ".join([lead] + [FILLER[i % len(FILLER)] for i in range(words)])
+
+    def respond(self, request: StandinRequest) -> tuple[list, float]:
+        """
+        Plan one call.
+
+        Args:
+            request: The normalized call
+
+        Returns:
+            (parts, latency_seconds), parts as SDK-style dicts
+
+        Raises:
+            StandinError: An injected error (after its latency)
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+            latency = self.latency.sample(request.model)
+            error_spec = self.scenario.get("errors", {})
+            injected = self._rng.random() < error_spec.get("rate", 0)
+            status = self._rng.choice(error_spec.get("statuses") or [503]) if injected else None
+
+        rule = self._rule_for(request)
+        if rule and "latency_ms" in rule:
+            latency = rule["latency_ms"] / 1000
+        if rule and "error" in rule:
+            status = rule["error"]
+        if status:
+            with self._lock:
+                self.stats["errors"] += 1
+            raise StandinError(status, latency=latency)
+
+        message = request.last_text
+        if rule and "function_calls" in rule:
+            parts = [{"function_call": _fill(call, message)} for call in rule["function_calls"]]
+        elif rule and "json" in rule:
+            parts = [{"text": json.dumps(_fill(rule["json"], message))}]
+        elif rule and "text" in rule:
+            parts = [{"text": _fill(rule["text"], message)}]
+        elif request.mode == "ANY" and request.functions:
+            declaration = request.functions[0]
+            args = synthesize(declaration.get("parameters") or {}, name=declaration["name"], required_only=True) or {}
+            parts = [{"function_call": {"name": declaration["name"], "args": args}}]
+        elif request.schema:
+            parts = [{"text": json.dumps(synthesize(request.schema))}]
+        elif request.mime == "application/json":
+            parts = [{"text": "{}"}]
+        else:
+            parts = [{"text": self._reply_text(request)}]
+        return parts, latency
+
+    def stream_chunks(self, parts: list) -> list[list]:
+        """
+        Split an answer into stream chunks: the text in `stream.chunks`
+        pieces, function calls in the last chunk.
+        """
+        count = max(self.scenario.get("stream", {}).get("chunks", 4), 1)
+        text = "".join(part["text"] for part in parts if "text" in part)
+        calls = [part for part in parts if "text" not in part]
+        words = re.findall(r"\S+\s*", text)
+        size = max(math.ceil(len(words) / count), 1)
+        chunks = [[{"text": "".join(words[i:i + size])}] for i in range(0, len(words), size)]
+        if calls:
+            chunks.append(calls)
+        return chunks or [[{"text": ""}]]
+
+    def chunk_delays(self, latency: float, count: int) -> list[float]:
+        """
+        Sleep before each chunk: `stream.first_chunk` of the latency before the first one.
+        """
+        first = latency * self.scenario.get("stream", {}).get("first_chunk", 0.3)
+        rest = (latency - first) / max(count - 1, 1)
+        return [first] + [rest] * (count - 1)
+
+
+def build_response(request: StandinRequest, parts: list, config: types.GenerateContentConfig = None,
+                   final: bool = True) -> types.GenerateContentResponse:
+    """
+    Wrap planned parts in a GenerateContentResponse.
+    """
+    output_words = sum(len(json.dumps(part).split()) for part in parts)
+    response = types.GenerateContentResponse(
+        candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[types.Part.model_validate(part) for part in parts]),
+            finish_reason="STOP" if final else None,
+        )],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=request.prompt_words,
+            candidates_token_count=output_words,
+            total_token_count=request.prompt_words + output_words,
+        ),
+        model_version=f"{request.model}-standin",
+    )
+    schema = config.response_schema if config else None
+    if final and isinstance(schema, type) and issubclass(schema, BaseModel) and response.text:
+        # What the SDK does for pydantic response schemas
+        response.parsed = schema.model_validate_json(response.text)
+    return response
+
+
+class _FakeModels:
+
+    def __init__(self, responder: StandinResponder):
+        self._responder = responder
+
+    def generate_content(self, *, model: str, contents, config: types.GenerateContentConfig = None):
+        request = StandinRequest.from_sdk(model, contents, config)
+        try:
+            parts, latency = self._responder.respond(request)
+        except StandinError as e:
+            time.sleep(e.latency)
+            raise e.to_api_error()
+        time.sleep(latency)
+        return build_response(request, parts, config)
+
+    def generate_content_stream(self, *, model: str, contents, config: types.GenerateContentConfig = None):
+        request = StandinRequest.from_sdk(model, contents, config)
+        try:
+            parts, latency = self._responder.respond(request)
+        except StandinError as e:
+            time.sleep(e.latency)
+            raise e.to_api_error()
+        chunks = self._responder.stream_chunks(parts)
+        for delay, chunk in zip(self._responder.chunk_delays(latency, len(chunks)), chunks):
+            time.sleep(delay)
+            yield build_response(request, chunk, final=chunk is chunks[-1])
+
+
+class _FakeAsyncModels:
+
+    def __init__(self, responder: StandinResponder):
+        self._responder = responder
+
+    async def generate_content(self, *, model: str, contents, config: types.GenerateContentConfig = None):
+        request = StandinRequest.from_sdk(model, contents, config)
+        try:
+            parts, latency = self._responder.respond(request)
+        except StandinError as e:
+            await asyncio.sleep(e.latency)
+            raise e.to_api_error()
+        await asyncio.sleep(latency)
+        return build_response(request, parts, config)
+
+    async def generate_content_stream(self, *, model: str, contents, config: types.GenerateContentConfig = None):
+        request = StandinRequest.from_sdk(model, contents, config)
+        try:
+            parts, latency = self._responder.respond(request)
+        except StandinError as e:
+            await asyncio.sleep(e.latency)
+            raise e.to_api_error()
+        chunks = self._responder.stream_chunks(parts)
+        delays = self._responder.chunk_delays(latency, len(chunks))
+
+        async def _stream():
+            for delay, chunk in zip(delays, chunks):
+                await asyncio.sleep(delay)
+                yield build_response(request, chunk, final=chunk is chunks[-1])
+
+        return _stream()
+
+
+class _FakeAsyncClient:
+
+    def __init__(self, responder: StandinResponder):
+        self.models = _FakeAsyncModels(responder)
+
+
+class FakeGenaiClient:
+    """
+    In-process stand-in for genai.Client (client.models and client.aio.models).
+    """
+
+    def __init__(self, responder: StandinResponder = None):
+        self.responder = responder or StandinResponder()
+        self.models = _FakeModels(self.responder)
+        self.aio = _FakeAsyncClient(self.responder)
+
+
+# ---------------------------------------------------------------------------
+# HTTP stand-in server (REST surface of generativelanguage.googleapis.com)
+# ---------------------------------------------------------------------------
+
+ROUTE = re.compile(r"^/v1(?:beta|alpha)?/models/(?P<model>[^:/]+):(?P<method>generateContent|streamGenerateContent)")
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+    Answers generateContent (JSON) and streamGenerateContent (SSE, chunked)
+    over keep-alive HTTP/1.1. The server's `responder` decides the answers.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        route = ROUTE.match(self.path)
+        if not route:
+            self._send_json(404, StandinError(404, f"Unknown path {self.path}").response_json())
+            return
+
+        responder = self.server.responder
+        request = StandinRequest.from_rest(route["model"], json.loads(body or b"{}"))
+        try:
+            parts, latency = responder.respond(request)
+        except StandinError as e:
+            time.sleep(e.latency)
+            self._send_json(e.code, e.response_json())
+            return
+
+        if route["method"] == "generateContent":
+            time.sleep(latency)
+            response = build_response(request, parts)
+            self._send_json(200, response.model_dump(mode="json", by_alias=True, exclude_none=True))
+            return
+
+        chunks = responder.stream_chunks(parts)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for delay, chunk in zip(responder.chunk_delays(latency, len(chunks)), chunks):
+            time.sleep(delay)
+            payload = build_response(request, chunk, final=chunk is chunks[-1])
+            self._write_chunk(f"data: {json.dumps(payload.model_dump(mode='json', by_alias=True, exclude_none=True))}\r\n\r\n".encode())
+        self._write_chunk(b"")
+
+    def do_HEAD(self):
+        # Connection warm-up (warm_genai_client(preconnect=True))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_standin_server(host: str = "127.0.0.1", port: int = 0, responder: StandinResponder = None) -> ThreadingHTTPServer:
+    """
+    Build (not start) the HTTP stand-in server.
+
+    Args:
+        host: Interface to bind
+        port: Port (0 picks a free one; see server.server_port)
+        responder: Shared responder (built from the configured scenario if omitted)
+
+    Returns:
+        ThreadingHTTPServer; call serve_forever() (e.g. in a thread)
+    """
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.responder = responder or StandinResponder()
+    return server
@@ -0,0 +1,82 @@
+"""
+Server-Sent Events
+
+Helpers for streaming agent output to clients as text/event-stream.
+
+Streaming services are async generators of (event, data) tuples:
+- ("delta", {"text": ...})   a piece of the answer, flushed as it arrives
+- ("tool", {"name": ...})    the agent is running a function call
+- ("file", {...})            one file of a batch upload was processed
+- ("done", {...})            the final payload (same shape as the non-streaming endpoint)
+- ("error", {...})           the request failed; the stream ends
+
+Serve under ASGI (uvicorn main.asgi:application) so chunks are flushed as
+they are produced; WSGI servers buffer async streams until they finish.
+"""
+
+import json
+import logging
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(event: str, data) -> str:
+    """
+    Format one SSE frame.
+
+    Args:
+        event: Event name
+        data: JSON-serializable payload
+
+    Returns:
+        The encoded frame, terminated by a blank line
+    """
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def _encode(events):
+    # An initial comment gets headers and the first byte out before the
+    # service starts its DB and model work.
+    yield ": stream open\n\n"
+    try:
+        async for event, data in events:
+            yield sse_event(event, data)
+    except Exception as e:
+        logger.exception("Error while streaming")
+        yield sse_event("error", {"error": str(e)})
+    finally:
+        # Runs when the client disconnects too: close the service (and the
+        # Gemini stream it is reading) now rather than when it is collected
+        await events.aclose()
+
+
+def event_stream_response(events) -> StreamingHttpResponse:
+    """
+    Wrap an async generator of (event, data) tuples in an SSE response.
+    """
+    response = StreamingHttpResponse(_encode(events), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Disable proxy buffering (nginx) so each frame is forwarded immediately
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets DRF negotiate `Accept: text/event-stream`.
+
+    Successful streams bypass rendering (they return a StreamingHttpResponse);
+    this only renders early errors (400/401/...) as a single error event.
+    """
+    media_type = "text/event-stream"
+    format = "sse"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return sse_event("error", data).encode(self.charset)
@@ -1,3 +1,645 @@
-from django.test import TestCase
+import asyncio
+import io
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from google.genai import errors, types
+from pydantic import BaseModel
+from rest_framework.test import APIClient
+
+from budget.services import process_budget_generation
+from chat.services import astream_chatbot_message, process_chatbot_message
+from users.models import UserProfile
+
+from . import resilience, services
+from .services import get_agent_history
+from .hedging import FALLBACK, PRIMARY, run_hedged
+from .cassette import Cassette, CassetteClient, CassetteMiss
+from .history import load_window
+from .log import QueuedHandler
+from .history_cache import history_cache
+from .journal import TurnJournal, wait_for_pending_writes
+from .models import ConversationHistory, ConversationSummary, agentModel
+from .registry import agent_registry
+from .standin import DEFAULT_SCENARIO, FakeGenaiClient, StandinResponder
+
+
+def fake_gemini(*rules, **scenario):
+    """
+    Patch the agents onto an in-process stand-in answering by `rules` (see agents.standin).
+    """
+    client = FakeGenaiClient(StandinResponder({**DEFAULT_SCENARIO, "rules": list(rules), **scenario}, seed=1))
+    return mock.patch.object(services, "_fake_genai_client", client)
+
+
+@override_settings(GEMINI_BACKEND="fake", GEMINI_CASSETTE_MODE="off", LLM_CACHE_TTLS={}, LLM_HEDGE_POLICIES={},
+                   TRACING_ENABLED=False)
+class AgentTestCase(TestCase):
+
+    def setUp(self):
+        # Per-process state would outlive each test's rolled back rows
+        agent_registry.invalidate()
+        history_cache.clear()
+        self.user = User.objects.create_user("alice")
+        UserProfile.objects.create(user=self.user)
+        self.agent = agentModel.objects.create(
+            name="test_agent", description="", system_instruction="You are a test agent", gemini_model="gemini-2.5-flash"
+        )
+
+    def history(self, agent=None) -> list:
+        return list(
+            ConversationHistory.objects.filter(user=self.user, agent=agent or self.agent)
+            .order_by("id").values_list("role", "content_data")
+        )
+
+
+class TurnJournalTests(AgentTestCase):
+
+    def record_turn(self, journal: TurnJournal):
+        journal.add({"parts": [{"text": "I spent 300 on coffee"}]}, "user")
+        journal.add({"parts": [{"function_call": {"name": "call_expense_manager", "args": {}}}]}, "model")
+        journal.add({"parts": [{"function_response": {"name": "call_expense_manager", "response": {}}}]}, "user")
+        journal.add({"parts": [{"text": "Recorded."}]}, "model")
+
+    def test_turn_is_written_with_one_bulk_create(self):
+        with mock.patch.object(ConversationHistory.objects, "bulk_create",
+                               wraps=ConversationHistory.objects.bulk_create) as bulk_create:
+            with TurnJournal(self.agent, self.user) as journal:
+                self.record_turn(journal)
+                self.assertEqual(self.history(), [])
+
+        bulk_create.assert_called_once()
+        self.assertEqual([role for role, _ in self.history()], ["user", "model", "user", "model"])
+        self.assertTrue(ConversationHistory.objects.filter(user=self.user).order_by("id").first().is_turn_start)
+
+    def test_failed_turn_is_rolled_back(self):
+        with self.assertRaises(RuntimeError):
+            with TurnJournal(self.agent, self.user) as journal:
+                self.record_turn(journal)
+                raise RuntimeError("tool failed")
+
+        self.assertEqual(self.history(), [])
+
+    def test_flush_failed_writes_nothing(self):
+        journal = TurnJournal(self.agent, self.user)
+        self.record_turn(journal)
+        journal.flush(failed=True)
+        journal.flush()
+
+        self.assertEqual(self.history(), [])
+
+    def test_discarded_turn_is_not_written(self):
+        with TurnJournal(self.agent, self.user) as journal:
+            self.record_turn(journal)
+            journal.discard()
+
+        self.assertEqual(self.history(), [])
+
+    def test_model_error_leaves_no_user_turn_behind(self):
+        # A 400 is not retried: the budget task answers with an error result
+        with fake_gemini({"agent": "You are the **Budget Agent**", "error": 400}):
+            result = process_budget_generation(self.user, "Make me a budget")
+
+        self.assertEqual(result["type"], "error")
+        self.assertFalse(ConversationHistory.objects.filter(user=self.user).exists())
+
+    def test_chat_turn_through_the_fake_client(self):
+        rules = [
+            {"agent": "You are the **Chatbot Agent**", "match": "(?i)budget",
+             "function_calls": [{"name": "call_main_coordinator", "args": {"message": "{message}"}}]},
+            {"agent": "You are the **Main AI Coordinator**", "text": "Your budget looks fine."},
+        ]
+        with fake_gemini(*rules), mock.patch.object(
+                ConversationHistory.objects, "bulk_create", wraps=ConversationHistory.objects.bulk_create) as bulk_create:
+            result = process_chatbot_message(self.user, "How is my budget?")
+
+        self.assertEqual(result["type"], "success")
+        chatbot = agentModel.objects.get(name="chatbot_agent")
+        self.assertEqual([role for role, _ in self.history(chatbot)], ["user", "model", "user", "model"])
+        # One write per agent turn: the chatbot's and the coordinator's
+        self.assertEqual(bulk_create.call_count, 2)
+
+
+@override_settings(LLM_RETRY_ATTEMPTS=1)
+class NestedHopUnavailableTests(AgentTestCase):
+    # The coordinator's model stays down while the chatbot's answers
+    rules = [
+        {"agent": "You are the **Chatbot Agent**", "on": "message",
+         "function_calls": [{"name": "call_main_coordinator", "args": {"message": "{message}"}}]},
+        {"agent": "You are the **Main AI Coordinator**", "error": 503},
+    ]
+
+    def setUp(self):
+        super().setUp()
+        # Fresh circuits, so these failures don't open them for other tests
+        breakers = mock.patch.dict(resilience._breakers, clear=True)
+        breakers.start()
+        self.addCleanup(breakers.stop)
+
+    def test_chat_turn_fails_with_retry_after(self):
+        with fake_gemini(*self.rules):
+            result = process_chatbot_message(self.user, "How is my budget?")
+
+        self.assertEqual(result["type"], "error")
+        self.assertGreaterEqual(result["data"]["retry_after"], 1)
+        self.assertFalse(ConversationHistory.objects.filter(user=self.user).exists())
+
+    def test_chat_view_answers_503(self):
+        api = APIClient()
+        api.force_authenticate(self.user)
+        with fake_gemini(*self.rules):
+            response = api.post("/api/chat/", {"msg": "How is my budget?"}, format="json")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+
+    def test_stream_ends_with_an_error_event(self):
+        async def events():
+            return [event async for event in astream_chatbot_message(self.user, "How is my budget?")]
+
+        with fake_gemini(*self.rules):
+            events = async_to_sync(events)()
+
+        self.assertEqual([name for name, _ in events], ["tool", "error"])
+        self.assertGreaterEqual(events[-1][1]["retry_after"], 1)
+        self.assertFalse(ConversationHistory.objects.filter(user=self.user).exists())
+
+
+class HistoryWindowTests(AgentTestCase):
+    policy = {"keep_turns": 2, "max_tokens": 10000, "summarize_every": 3}
+
+    def add_turns(self, count: int, text: str = "message", tool: bool = False) -> list:
+        # Each turn as the agents write it; returns the ids of its rows
+        turns = []
+        for i in range(count):
+            with TurnJournal(self.agent, self.user) as journal:
+                journal.add({"parts": [{"text": f"{text} {i}"}]}, "user")
+                if tool:
+                    journal.add({"parts": [{"function_call": {"name": "call_advisor", "args": {}}}]}, "model")
+                    journal.add({"parts": [{"function_response": {"name": "call_advisor", "response": {}}}]}, "user")
+                journal.add({"parts": [{"text": f"answer {i}"}]}, "model")
+                rows = journal.rows
+            turns.append([row.id for row in rows])
+        return turns
+
+    def ids(self, rows: list) -> list:
+        return [row.id for row in rows]
+
+    def test_few_old_turns_stay_verbatim(self):
+        turns = self.add_turns(4)
+
+        window = load_window(self.agent, self.user, self.policy)
+
+        self.assertFalse(window.fold)
+        self.assertEqual(window.pending, [])
+        self.assertEqual(self.ids(window.verbatim), sum(turns, []))
+
+    def test_old_turns_are_folded_once_enough_accumulate(self):
+        turns = self.add_turns(5)
+
+        window = load_window(self.agent, self.user, self.policy)
+
+        self.assertTrue(window.fold)
+        self.assertEqual(self.ids(window.pending), sum(turns[:3], []))
+        self.assertEqual(self.ids(window.verbatim), sum(turns[3:], []))
+        self.assertEqual(window.covered_until, turns[2][-1])
+
+    def test_function_call_stays_with_its_turn(self):
+        turns = self.add_turns(3) + self.add_turns(2, tool=True)
+
+        window = load_window(self.agent, self.user, self.policy)
+
+        self.assertEqual(self.ids(window.verbatim), sum(turns[3:], []))
+        self.assertEqual(window.verbatim[0].role, "user")
+        self.assertTrue(window.verbatim[0].is_turn_start)
+
+    def test_token_budget_drops_oldest_turns_but_keeps_one(self):
+        turns = self.add_turns(3, text="x" * 4000)
+        policy = {**self.policy, "keep_turns": 3, "max_tokens": 100}
+
+        window = load_window(self.agent, self.user, policy)
+
+        self.assertTrue(window.fold)
+        self.assertTrue(window.token_budget_exceeded)
+        self.assertEqual(self.ids(window.verbatim), turns[-1])
+        self.assertEqual(self.ids(window.pending), sum(turns[:2], []))
+
+    def test_summarized_rows_are_not_read_again(self):
+        turns = self.add_turns(6)
+        ConversationSummary.objects.create(
+            user=self.user, agent=self.agent, summary="Likes coffee.", covered_until=turns[2][-1]
+        )
+
+        window = load_window(self.agent, self.user, self.policy)
+
+        self.assertEqual(window.summary, "Likes coffee.")
+        self.assertFalse(window.fold)
+        self.assertEqual(self.ids(window.verbatim), sum(turns[3:], []))
+
+    def test_history_is_folded_through_the_summary_model(self):
+        turns = self.add_turns(5)
+        summary_rule = {"model": settings.AGENT_HISTORY_SUMMARY_MODEL, "text": "The user asked five questions."}
+
+        with override_settings(AGENT_HISTORY_POLICIES={self.agent.name: self.policy}), fake_gemini(summary_rule):
+            history = get_agent_history(self.agent, self.user)
+
+        summary = ConversationSummary.objects.get(user=self.user, agent=self.agent)
+        self.assertEqual(summary.summary, "The user asked five questions.")
+        self.assertEqual(summary.covered_until, turns[2][-1])
+        self.assertIn("The user asked five questions.", history[0].parts[0].text)
+        self.assertEqual(len(history), 1 + len(sum(turns[3:], [])))
+
+    def test_failed_summary_keeps_the_turns_verbatim(self):
+        turns = self.add_turns(5)
+        summary_rule = {"model": settings.AGENT_HISTORY_SUMMARY_MODEL, "error": 400}
+
+        with override_settings(AGENT_HISTORY_POLICIES={self.agent.name: self.policy}), fake_gemini(summary_rule):
+            history = get_agent_history(self.agent, self.user)
+
+        self.assertFalse(ConversationSummary.objects.exists())
+        self.assertEqual(len(history), len(sum(turns, [])))
+
+
+@override_settings(GEMINI_BACKEND="fake", GEMINI_CASSETTE_MODE="off", TRACING_ENABLED=False)
+class BackgroundJournalTests(TransactionTestCase):
+    # The writer thread commits on its own connection
+
+    def setUp(self):
+        history_cache.clear()
+        self.user = User.objects.create_user("bob")
+        self.agent = agentModel.objects.create(
+            name="test_agent", description="", system_instruction="", gemini_model="gemini-2.5-flash"
+        )
+
+    def test_reads_wait_for_pending_writes(self):
+        with TurnJournal(self.agent, self.user, durable=False) as journal:
+            journal.add({"parts": [{"text": "hello"}]}, "user")
+            journal.add({"parts": [{"text": "hi"}]}, "model")
+
+        wait_for_pending_writes(self.agent, self.user)
+        self.assertEqual(ConversationHistory.objects.filter(user=self.user, agent=self.agent).count(), 2)
+
+    def test_failed_turn_is_not_queued(self):
+        with self.assertRaises(RuntimeError):
+            with TurnJournal(self.agent, self.user, durable=False) as journal:
+                journal.add({"parts": [{"text": "hello"}]}, "user")
+                raise RuntimeError("model failed")
+
+        wait_for_pending_writes(self.agent, self.user)
+        self.assertFalse(ConversationHistory.objects.filter(user=self.user).exists())
+
+
+class Reply(BaseModel):
+    amount: float
+    title: str
+
+
+class RunHedgedTests(SimpleTestCase):
+    policy = {"deadline": 0.05, "fallback_model": "gemini-2.5-flash"}
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def attempt(self, model, kind, race=None):
+        # A primary stuck with the model until released
+        if race is None:
+            return kind
+        race.arm()
+        try:
+            if not self.release.wait(5):
+                raise errors.ServerError(503, {"error": {"message": "timeout"}})
+            return kind
+        finally:
+            race.disarm()
+
+    def test_first_answer_wins(self):
+        started = time.monotonic()
+
+        response = run_hedged("budget_agent", "gemini-2.5-pro", self.policy, self.attempt)
+
+        self.assertEqual(response, FALLBACK)
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_primary_answer_before_the_deadline(self):
+        self.release.set()
+
+        self.assertEqual(run_hedged("budget_agent", "gemini-2.5-pro", self.policy, self.attempt), PRIMARY)
+
+
+class QueuedHandlerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = QueuedHandler(structured=True, stream=self.stream)
+        self.logger = logging.getLogger("agents.tests.queued")
+        self.logger.addHandler(self.handler)
+        self.logger.propagate = False
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def records(self) -> list:
+        self.handler.listener.stop()
+        atexit.unregister(self.handler.listener.stop)
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_messages_are_formatted_by_the_listener(self):
+        threads = []
+
+        class Argument:
+            def __str__(self):
+                threads.append(threading.current_thread())
+                return "argument"
+
+        self.logger.warning("Got %s", Argument())
+
+        self.assertEqual(self.records()[0]["msg"], "Got argument")
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_traceback_is_its_own_key(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            self.logger.exception("Tool failed")
+
+        record = self.records()[0]
+        self.assertEqual(record["msg"], "Tool failed")
+        self.assertIn("ValueError: boom", record["exc"])
+
+
+@override_settings(TRACE_SINK="db")
+class TraceListViewTests(TestCase):
+
+    def setUp(self):
+        self.api = APIClient()
+        self.api.force_authenticate(User.objects.create_user("admin", is_staff=True))
+
+    def test_invalid_params_are_a_400(self):
+        for params in ({"limit": "abc"}, {"min_ms": "slow"}, {"min_ms": "nan"}):
+            response = self.api.get("/api/agents/traces/", params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_negative_params_are_clamped(self):
+        response = self.api.get("/api/agents/traces/", {"limit": "-5", "min_ms": "-1"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+
+@override_settings(DEBUG=False, METRICS_TOKEN="")
+class MetricsViewTests(TestCase):
+
+    def test_closed_without_a_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+        self.client.force_login(User.objects.create_user("admin", is_staff=True))
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer secret"}).status_code, 200)
+
+
+class StandinTests(SimpleTestCase):
+
+    def fake_client(self, *rules, **scenario) -> FakeGenaiClient:
+        return FakeGenaiClient(StandinResponder({**DEFAULT_SCENARIO, "rules": list(rules), **scenario}, seed=1))
+
+    def config(self, system: str = "You are the **Chatbot Agent**", **options) -> types.GenerateContentConfig:
+        return types.GenerateContentConfig(system_instruction=system, **options)
+
+    def test_function_call_rule_fills_in_the_message(self):
+        client = self.fake_client({"agent": "you are the **chatbot agent**", "match": "spent",
+                              "function_calls": [{"name": "call_expense_manager", "args": {"message": "{message}"}}]})
+
+        response = client.models.generate_content(model="gemini-2.5-flash", contents="I spent 300", config=self.config())
+
+        call = response.function_calls[0]
+        self.assertEqual((call.name, call.args), ("call_expense_manager", {"message": "I spent 300"}))
+
+    def test_rules_answer_user_messages_unless_asked_otherwise(self):
+        client = self.fake_client({"text": "first answer"}, {"on": "function_response", "text": "after the tool"})
+        contents = [
+            types.Content(role="user", parts=[types.Part(text="hello")]),
+            types.Content(role="model", parts=[types.Part.from_function_call(name="call_advisor", args={})]),
+            types.Content(role="user", parts=[types.Part.from_function_response(name="call_advisor", response={})]),
+        ]
+
+        first = client.models.generate_content(model="gemini-2.5-flash", contents="hello", config=self.config())
+        second = client.models.generate_content(model="gemini-2.5-flash", contents=contents, config=self.config())
+
+        self.assertEqual(first.text, "first answer")
+        self.assertEqual(second.text, "after the tool")
+
+    def test_structured_output_is_parsed(self):
+        client = self.fake_client({"json": {"amount": 12.5, "title": "{message}"}})
+        config = self.config(response_mime_type="application/json", response_schema=Reply)
+
+        scripted = client.models.generate_content(model="gemini-2.5-flash", contents="Coffee", config=config)
+        synthesized = self.fake_client().models.generate_content(model="gemini-2.5-flash", contents="Coffee", config=config)
+
+        self.assertEqual(scripted.parsed, Reply(amount=12.5, title="Coffee"))
+        self.assertIsInstance(synthesized.parsed, Reply)
+
+    def test_forced_function_calling_calls_the_first_declaration(self):
+        declaration = types.FunctionDeclaration(
+            name="record_expense",
+            parameters=types.Schema(type="OBJECT", properties={"amount": types.Schema(type="NUMBER")}, required=["amount"]),
+        )
+        config = self.config(
+            tools=[types.Tool(function_declarations=[declaration])],
+            tool_config=types.ToolConfig(function_calling_config=types.FunctionCallingConfig(mode="ANY")),
+        )
+
+        response = self.fake_client().models.generate_content(model="gemini-2.5-flash", contents="hi", config=config)
+
+        self.assertEqual(response.function_calls[0].name, "record_expense")
+        self.assertIn("amount", response.function_calls[0].args)
+
+    def test_injected_errors_are_sdk_errors(self):
+        client = self.fake_client({"match": "bad", "error": 400}, {"match": "busy", "error": 503})
+
+        with self.assertRaises(errors.ClientError) as bad:
+            client.models.generate_content(model="gemini-2.5-flash", contents="bad request", config=self.config())
+        with self.assertRaises(errors.ServerError) as busy:
+            client.models.generate_content(model="gemini-2.5-flash", contents="busy", config=self.config())
+
+        self.assertEqual((bad.exception.code, busy.exception.code), (400, 503))
+
+    def test_error_rate_is_reproducible_with_a_seed(self):
+        scenario = {"errors": {"rate": 0.5, "statuses": [429]}}
+
+        def outcomes():
+            client = self.fake_client(**scenario)
+            results = []
+            for _ in range(20):
+                try:
+                    client.models.generate_content(model="gemini-2.5-flash", contents="hi", config=self.config())
+                    results.append("ok")
+                except errors.ClientError as e:
+                    results.append(e.code)
+            return results
+
+        first = outcomes()
+        self.assertEqual(first, outcomes())
+        self.assertIn(429, first)
+        self.assertIn("ok", first)
+
+    def test_async_stream_yields_the_whole_answer(self):
+        client = self.fake_client({"text": "one two three four five six seven eight"})
+
+        async def stream():
+            chunks = await client.aio.models.generate_content_stream(
+                model="gemini-2.5-flash", contents="hi", config=self.config()
+            )
+            return [chunk.text async for chunk in chunks]
+
+        chunks = asyncio.run(stream())
+
+        self.assertEqual(len(chunks), DEFAULT_SCENARIO["stream"]["chunks"])
+        self.assertEqual("".join(chunks), "one two three four five six seven eight")
+
+
+class CassetteTests(SimpleTestCase):
+    chatbot = "You are the **Chatbot Agent**"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        backend = FakeGenaiClient(StandinResponder({**DEFAULT_SCENARIO, "rules": [
+            {"match": "busy", "error": 503},
+            {"agent": self.chatbot, "text": "Answer to {message}"},
+            {"text": "Advice on {message}"},
+        ]}, seed=1))
+        recorder = CassetteClient(Cassette(self.path), backend=lambda: backend, async_backend=lambda: backend.aio)
+        self.recorded = []
+        for message, system in [("hello", self.chatbot), ("budget", self.chatbot), ("laptop", "You are the **Advisor Agent**")]:
+            self.recorded.append(recorder.models.generate_content(
+                model="gemini-2.5-flash", contents=message, config=self.config(system)
+            ).text)
+        with self.assertRaises(errors.ServerError):
+            recorder.models.generate_content(model="gemini-2.5-flash", contents="busy", config=self.config())
+        self.recorded_chunks = [chunk.text for chunk in recorder.models.generate_content_stream(
+            model="gemini-2.5-flash", contents="stream me", config=self.config()
+        )]
+        recorder.cassette.close()
+
+    def config(self, system: str = chatbot) -> types.GenerateContentConfig:
+        return types.GenerateContentConfig(system_instruction=system)
+
+    def player(self, match: str = "agent") -> CassetteClient:
+        cassette = Cassette(self.path, match=match, latency_scale=0)
+        self.assertEqual(cassette.load(), 5)
+        return CassetteClient(cassette)
+
+    def test_recorded_answers_are_replayed(self):
+        player = self.player()
+
+        replayed = [
+            player.models.generate_content(model="gemini-2.5-flash", contents=message, config=self.config(system)).text
+            for message, system in [("hello", self.chatbot), ("budget", self.chatbot), ("laptop", "You are the **Advisor Agent**")]
+        ]
+
+        self.assertEqual(replayed, self.recorded)
+        self.assertEqual(player.cassette.stats()["replayed"], 3)
+
+    def test_errors_and_streams_are_replayed(self):
+        player = self.player()
+
+        with self.assertRaises(errors.ServerError) as error:
+            player.models.generate_content(model="gemini-2.5-flash", contents="busy", config=self.config())
+        chunks = [chunk.text for chunk in player.models.generate_content_stream(
+            model="gemini-2.5-flash", contents="stream me", config=self.config()
+        )]
+
+        self.assertEqual(error.exception.code, 503)
+        self.assertEqual(chunks, self.recorded_chunks)
+        self.assertGreater(len(chunks), 1)
+
+    def test_async_replay(self):
+        player = self.player()
+
+        async def replay():
+            response = await player.aio.models.generate_content(
+                model="gemini-2.5-flash", contents="hello", config=self.config()
+            )
+            stream = await player.aio.models.generate_content_stream(
+                model="gemini-2.5-flash", contents="stream me", config=self.config()
+            )
+            return response.text, [chunk.text async for chunk in stream]
+
+        text, chunks = asyncio.run(replay())
+
+        self.assertEqual(text, self.recorded[0])
+        self.assertEqual(chunks, self.recorded_chunks)
+
+    def test_unknown_request_falls_back_to_the_agent(self):
+        player = self.player()
+
+        # The first answer recorded for the agent (and model) not served yet
+        fallback = player.models.generate_content(model="gemini-2.5-flash", contents="new message",
+                                                  config=self.config("You are the **Advisor Agent**"))
+
+        self.assertEqual(fallback.text, self.recorded[2])
+        self.assertEqual(player.cassette.stats()["fallbacks"], 1)
+        with self.assertRaises(CassetteMiss):
+            player.models.generate_content(model="gemini-2.5-flash", contents="again",
+                                           config=self.config("You are the **Advisor Agent**"))
+
+    def test_exact_match_misses(self):
+        player = self.player(match="exact")
+
+        with self.assertRaises(CassetteMiss):
+            player.models.generate_content(model="gemini-2.5-flash", contents="new message", config=self.config())
+        self.assertEqual(player.cassette.stats()["misses"], 1)
+
+
+@override_settings(TRACING_ENABLED=False)
+class LoadtestCommandTests(TransactionTestCase):
+    # Sessions run on worker threads, each with its own connection; one at a
+    # time, as the in-memory test database locks whole tables
+
+    def setUp(self):
+        agent_registry.invalidate()
+        history_cache.clear()
+
+    def run_loadtest(self, **options) -> dict:
+        self.out = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "report.json")
+            call_command("loadtest", users=2, concurrency=1, latency_scale=0, seed=1, json=path,
+                         stdout=self.out, **options)
+            with open(path) as f:
+                return json.load(f)
+
+    def test_sessions_run_against_the_stand_in(self):
+        report = self.run_loadtest()
+
+        self.assertGreater(report["summary"]["requests"], 0)
+        self.assertEqual(report["summary"]["errors"], 0, self.out.getvalue())
+        self.assertIn("POST /api/chat/", report["endpoints"])
+        self.assertFalse(User.objects.filter(username__startswith="loadtest_").exists())
+
+    def test_failed_requests_are_reported_by_type(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump({"rules": [{"agent": "You are the **Budget Agent**", "error": 400}]}, f)
+        self.addCleanup(os.remove, f.name)
+
+        report = self.run_loadtest(scenario=f.name)
+
+        errors = {endpoint: row["error_types"] for endpoint, row in report["endpoints"].items() if row["errors"]}
+        self.assertTrue(errors)
+        for error_types in errors.values():
+            self.assertTrue(all(kind.startswith("HTTP ") for kind in error_types))
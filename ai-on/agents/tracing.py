@@ -0,0 +1,548 @@
+"""
+Agent Tracing
+
+Spans for every request, agent invocation, LLM call and tool execution,
+linked by a trace id that follows the nested calls:
+
+    POST /api/chat/                       request
+      chatbot_agent                       agent
+        gemini-2.5-flash-lite             llm
+        call_main_coordinator             tool
+          main_ai_coordinator             agent
+            gemini-2.5-flash-lite         llm
+            call_budget_agent             tool
+              budget_agent                agent
+                gemini-2.5-pro            llm
+
+The current span lives in a contextvar, so it follows sync_to_async /
+async_to_sync hops and the tool thread pool (run_function_calls copies the
+context). Work outside a request (management commands, nested calls made
+from a shell) starts its own trace.
+
+Sampling (decided when the root span starts):
+- TRACE_SAMPLE_RATE: share of traces kept
+- TRACE_SLOW_MS: unsampled traces are still recorded in memory and kept when
+  the root span is slower than this (0 to record nothing for them)
+- TRACE_KEEP_ERRORS: keep unsampled traces with a failed span
+- TRACE_FORCE_HEADER: an `X-Trace: 1` request header forces sampling
+
+Kept traces are written by a background thread to the TraceSpan table
+(TRACE_SINK = 'db', pruned after TRACE_RETENTION_DAYS) or appended to
+TRACE_JSONL_PATH ('jsonl'). Browse them at /api/agents/traces/ (admin only).
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+
+_current_span = contextvars.ContextVar("agent_trace_span", default=None)
+
+# Spans of one trace written by the background writer in one go
+WRITER_BATCH_SIZE = 200
+
+PRUNE_INTERVAL = 3600  # seconds between retention deletes
+
+
+class Trace:
+
+    def __init__(self, sampled: bool):
+        self.trace_id = uuid.uuid4().hex
+        self.sampled = sampled
+        self.failed = False
+        self.finished = False
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span: "Span"):
+        with self._lock:
+            if not self.finished:
+                self.spans.append(span)
+
+
+class Span:
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "started_at", "_start",
+                 "duration_ms", "status", "attributes")
+
+    def __init__(self, trace: Trace, parent_id: str, name: str, kind: str, attributes: dict):
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+        self.status = "ok"
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error: BaseException | str):
+        self.status = "error"
+        self.attributes["error"] = str(error)[:500]
+        self.trace.failed = True
+
+    def as_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id or "",
+            "name": self.name,
+            "kind": self.kind,
+            "status": self.status,
+            "started_at": datetime.fromtimestamp(self.started_at, tz=dt_timezone.utc).isoformat(),
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+        }
+
+
+class _NotRecorded:
+    """
+    Current span of a trace that is not recorded: its descendants are not
+    recorded either (rather than starting traces of their own).
+    """
+    trace = None
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def fail(self, error):
+        pass
+
+
+NOT_RECORDED = _NotRecorded()
+
+
+def current_span() -> Span | None:
+    span = _current_span.get()
+    return None if span is NOT_RECORDED else span
+
+
+def _new_trace(force: bool = False) -> Trace | None:
+    if not settings.TRACING_ENABLED:
+        return None
+    sampled = force or random.random() < settings.TRACE_SAMPLE_RATE
+    if not sampled and settings.TRACE_SLOW_MS <= 0 and not settings.TRACE_KEEP_ERRORS:
+        # Nothing could make this trace worth keeping: record nothing
+        return None
+    return Trace(sampled)
+
+
+def start_span(name: str, kind: str, force: bool = False, **attributes) -> Span | _NotRecorded:
+    """
+    Open a span under the current one (or as the root of a new trace).
+
+    The span is not made current: use trace_span() / trace_agent() for spans
+    that have children, and finish_span() to close it.
+
+    Returns:
+        The Span, or NOT_RECORDED when tracing is off or the trace is not recorded
+    """
+    parent = _current_span.get()
+    if parent is NOT_RECORDED:
+        return NOT_RECORDED
+    if parent is None:
+        trace = _new_trace(force)
+        if trace is None:
+            return NOT_RECORDED
+        return Span(trace, None, name, kind, attributes)
+    return Span(parent.trace, parent.span_id, name, kind, attributes)
+
+
+def finish_span(span: Span | _NotRecorded, error: BaseException = None, **attributes):
+    """
+    Close a span; closing a root span decides whether its trace is kept.
+    """
+    if span is NOT_RECORDED:
+        return
+    span.duration_ms = (time.perf_counter() - span._start) * 1000
+    if attributes:
+        span.attributes.update(attributes)
+    if error is not None:
+        span.fail(error)
+    span.trace.add(span)
+    if span.parent_id is None:
+        _finish_trace(span)
+
+
+def _finish_trace(root: Span):
+    trace = root.trace
+    with trace._lock:
+        trace.finished = True
+        spans = trace.spans
+        trace.spans = []
+    keep = (
+        trace.sampled
+        or (settings.TRACE_SLOW_MS > 0 and root.duration_ms >= settings.TRACE_SLOW_MS)
+        or (settings.TRACE_KEEP_ERRORS and trace.failed)
+    )
+    if keep:
+        trace_writer.submit([span.as_dict() for span in spans])
+
+
+def _activate(span: Span | _NotRecorded):
+    # set() rather than a reset token: generators may resume in another context
+    previous = _current_span.get()
+    _current_span.set(span)
+    return previous
+
+
+@contextmanager
+def trace_span(name: str, kind: str = "internal", **attributes):
+    """
+    Span around a block, current for the code inside it:
+
+        with trace_span(func_name, "tool", agent=agent.name):
+            result = function(**args)
+    """
+    span = start_span(name, kind, **attributes)
+    previous = _activate(span)
+    error = None
+    try:
+        yield span
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current_span.set(previous)
+        finish_span(span, error)
+
+
+def _user_id(args, kwargs):
+    user = kwargs.get("user", args[0] if args else None)
+    return getattr(user, "id", None)
+
+
+def trace_agent(agent_name: str):
+    """
+    Decorator: an "agent" span around each call of an agent entry point.
+
+    Works on plain functions, coroutine functions and async generators
+    (streaming agents); for the latter the span stays open until the stream
+    ends and is current only while the generator runs.
+    """
+    def decorator(func):
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def stream_wrapper(*args, **kwargs):
+                span = start_span(agent_name, "agent", user_id=_user_id(args, kwargs))
+                stream = func(*args, **kwargs)
+                error = None
+                try:
+                    while True:
+                        previous = _activate(span)
+                        try:
+                            item = await stream.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            _current_span.set(previous)
+                        yield item
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    await stream.aclose()
+                    finish_span(span, error)
+            return stream_wrapper
+
+        if iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with trace_span(agent_name, "agent", user_id=_user_id(args, kwargs)):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(agent_name, "agent", user_id=_user_id(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def llm_attributes(response) -> dict:
+    """
+    Span attributes of a Gemini response (token usage, finish reason).
+    """
+    attributes = {}
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        attributes["prompt_tokens"] = usage.prompt_token_count
+        attributes["completion_tokens"] = usage.candidates_token_count
+    if response is not None and response.candidates and response.candidates[0].finish_reason:
+        reason = response.candidates[0].finish_reason
+        attributes["finish_reason"] = str(getattr(reason, "value", reason))
+    return attributes
+
+
+# ---------------------------------------------------------------------------
+# Request spans
+# ---------------------------------------------------------------------------
+
+class TracingMiddleware:
+    """
+    Root "request" span per HTTP request; adds an X-Trace-Id response header.
+
+    For streamed responses (SSE) the span stays open, and current, while the
+    body is produced, since that is where the agent work happens.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _start(self, request) -> Span | _NotRecorded:
+        force = settings.TRACE_FORCE_HEADER and request.headers.get("X-Trace") == "1"
+        return start_span(f"{request.method} {request.path}", "request", force=force, method=request.method)
+
+    def _finish(self, span: Span | _NotRecorded, response):
+        span.set(status_code=response.status_code)
+        if response.status_code >= 500:
+            span.fail(f"HTTP {response.status_code}")
+        if span.trace is not None:
+            response["X-Trace-Id"] = span.trace.trace_id
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = _atraced_stream(response.streaming_content, span)
+            else:
+                response.streaming_content = _traced_stream(response.streaming_content, span)
+        else:
+            finish_span(span)
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        span = self._start(request)
+        previous = _activate(span)
+        try:
+            response = self.get_response(request)
+        except BaseException as e:
+            finish_span(span, e)
+            raise
+        finally:
+            _current_span.set(previous)
+        return self._finish(span, response)
+
+    async def __acall__(self, request):
+        span = self._start(request)
+        previous = _activate(span)
+        try:
+            response = await self.get_response(request)
+        except BaseException as e:
+            finish_span(span, e)
+            raise
+        finally:
+            _current_span.set(previous)
+        return self._finish(span, response)
+
+
+def _traced_stream(content, span: Span):
+    error = None
+    iterator = iter(content)
+    try:
+        while True:
+            previous = _activate(span)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                _current_span.set(previous)
+            yield chunk
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        finish_span(span, error)
+
+
+async def _atraced_stream(content, span: Span):
+    error = None
+    iterator = content.__aiter__()
+    try:
+        while True:
+            previous = _activate(span)
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                _current_span.set(previous)
+            yield chunk
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        finish_span(span, error)
+
+
+# ---------------------------------------------------------------------------
+# Sinks
+# ---------------------------------------------------------------------------
+
+class DatabaseSink:
+
+    def __init__(self):
+        self._pruned_at = 0.0
+
+    def write(self, spans: list):
+        from .models import TraceSpan
+        TraceSpan.objects.bulk_create([TraceSpan(**span) for span in spans])
+        if time.monotonic() - self._pruned_at > PRUNE_INTERVAL:
+            self._pruned_at = time.monotonic()
+            cutoff = timezone.now() - timedelta(days=settings.TRACE_RETENTION_DAYS)
+            TraceSpan.objects.filter(started_at__lt=cutoff).delete()
+
+    def recent(self, limit: int, min_ms: float = 0) -> list:
+        from .models import TraceSpan
+        roots = TraceSpan.objects.filter(parent_id="", duration_ms__gte=min_ms).order_by("-started_at")[:limit]
+        return [root.as_dict() for root in roots]
+
+    def spans(self, trace_id: str) -> list:
+        from .models import TraceSpan
+        return [span.as_dict() for span in TraceSpan.objects.filter(trace_id=trace_id).order_by("started_at", "id")]
+
+
+class JsonlSink:
+    """
+    One JSON object per span. Meant for development and for shipping to an
+    external tool; the viewer scans the whole file.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def write(self, spans: list):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as fh:
+            for span in spans:
+                fh.write(json.dumps(span, separators=(",", ":"), default=str) + "\n")
+
+    def _read(self):
+        if not self.path.exists():
+            return
+        with open(self.path, encoding="utf-8") as fh:
+            for line in fh:
+                if line.strip():
+                    yield json.loads(line)
+
+    def recent(self, limit: int, min_ms: float = 0) -> list:
+        roots = [span for span in self._read() if not span["parent_id"] and span["duration_ms"] >= min_ms]
+        return sorted(roots, key=lambda span: span["started_at"], reverse=True)[:limit]
+
+    def spans(self, trace_id: str) -> list:
+        return sorted((span for span in self._read() if span["trace_id"] == trace_id), key=lambda span: span["started_at"])
+
+
+def get_trace_sink():
+    if settings.TRACE_SINK == "jsonl":
+        return JsonlSink(settings.TRACE_JSONL_PATH)
+    return _database_sink
+
+
+_database_sink = DatabaseSink()
+
+
+class _TraceWriter:
+    """
+    Per-process writer thread, so persisting a trace never adds to request latency.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, spans: list):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+                self._thread.start()
+        self._queue.put(spans)
+
+    def drain(self, timeout: float = 5.0):
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _run(self):
+        while True:
+            batches = [self._queue.get()]
+            size = len(batches[0])
+            while size < WRITER_BATCH_SIZE:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                size += len(batches[-1])
+
+            close_old_connections()
+            try:
+                get_trace_sink().write([span for spans in batches for span in spans])
+            except Exception as e:
+                logger.warning("Dropping %d trace spans: %s", size, e)
+            finally:
+                close_old_connections()
+                for _ in batches:
+                    self._queue.task_done()
+
+
+trace_writer = _TraceWriter()
+
+
+def build_trace_tree(spans: list) -> dict:
+    """
+    Arrange a trace's spans for the viewer: depth-first order with each
+    span's depth and offset from the trace start, plus a text waterfall.
+    """
+    if not spans:
+        return {"spans": [], "waterfall": []}
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent_id"], []).append(span)
+    starts = {span["span_id"]: datetime.fromisoformat(str(span["started_at"])) for span in spans}
+    origin = min(starts.values())
+
+    ordered = []
+
+    def visit(parent_id: str, depth: int):
+        for span in sorted(children.get(parent_id, []), key=lambda s: starts[s["span_id"]]):
+            offset = (starts[span["span_id"]] - origin).total_seconds() * 1000
+            ordered.append({**span, "depth": depth, "offset_ms": round(offset, 1)})
+            visit(span["span_id"], depth + 1)
+
+    visit("", 0)
+    waterfall = [
+        f"{span['offset_ms']:>9.1f}ms {span['duration_ms']:>9.1f}ms  {'  ' * span['depth']}"
+        f"{span['kind']}: {span['name']}{' [error]' if span['status'] == 'error' else ''}"
+        for span in ordered
+    ]
+    return {"spans": ordered, "waterfall": waterfall}
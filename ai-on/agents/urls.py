@@ -0,0 +1,8 @@
+from django.urls import path
+from .views import LLMCacheStatsView, TraceListView, TraceDetailView
+
+urlpatterns = [
+    path('cache/stats/', LLMCacheStatsView.as_view(), name='llm-cache-stats'),
+    path('traces/', TraceListView.as_view(), name='trace-list'),
+    path('traces/<str:trace_id>/', TraceDetailView.as_view(), name='trace-detail'),
+]
@@ -1,3 +1,146 @@
-from django.shortcuts import render
+"""
+Agent Views
 
-# Create your views here.
+Shared view infrastructure for the agent endpoints.
+"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from drf_spectacular.utils import extend_schema
+from rest_framework import permissions
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .metrics import metrics
+from .serializers import TraceListQuerySerializer
+from .services import get_llm_cache_stats
+from .tracing import build_trace_tree, get_trace_sink
+from .streaming import EventStreamRenderer
+
+
+def unavailable_response(data: dict) -> Response:
+    """
+    503 with Retry-After for an agent error result whose model stayed rate
+    limited or down (agents.resilience.unavailable_result()).
+    """
+    return Response(data, status=503, headers={'Retry-After': str(data['retry_after'])})
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose HTTP handlers are coroutines.
+
+    Authentication, permission and throttle checks still run synchronously
+    (they hit the ORM), but off the event loop. The handler itself is awaited,
+    so an LLM-bound request does not hold a worker thread while it waits on
+    Gemini. Under ASGI a single worker can keep many of these in flight.
+
+    All handlers on a subclass must be `async def` (Django rejects views
+    that mix sync and async handlers).
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(),
+                                  self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            # OPTIONS and 405 handlers are inherited sync methods
+            if asyncio.iscoroutine(response):
+                response = await response
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+class AsyncStreamView(AsyncAPIView):
+    """
+    AsyncAPIView for Server-Sent Events endpoints.
+
+    Handlers return agents.streaming.event_stream_response(...). Clients may
+    send `Accept: text/event-stream`; validation and auth errors are then
+    delivered as a single `error` event.
+    """
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+
+
+class LLMCacheStatsView(APIView):
+    """
+    Hit/miss counters of the LLM response cache (admin only).
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    @extend_schema(
+        description="Per-agent memory/persistent hits, misses and hit rate of the LLM response cache for this worker."
+    )
+    def get(self, request):
+        return Response(get_llm_cache_stats())
+
+
+class TraceListView(APIView):
+    """
+    Most recent kept traces (their root spans), newest first (admin only).
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    @extend_schema(
+        parameters=[TraceListQuerySerializer],
+        description="Root spans of the latest kept traces. Query params: limit (default 50), min_ms (only slower traces)."
+    )
+    def get(self, request):
+        query = TraceListQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=400)
+        return Response(get_trace_sink().recent(query.validated_data['limit'], query.validated_data['min_ms']))
+
+
+class TraceDetailView(APIView):
+    """
+    Every span of one trace as a tree with offsets, plus a text waterfall (admin only).
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    @extend_schema(
+        description="Spans of a trace in depth-first order with depth and offset_ms, and a waterfall rendering."
+    )
+    def get(self, request, trace_id):
+        spans = get_trace_sink().spans(trace_id)
+        if not spans:
+            return Response({'error': 'Trace not found'}, status=404)
+        return Response({'trace_id': trace_id, **build_trace_tree(spans)})
+
+
+def metrics_view(request):
+    """
+    Agent metrics in the Prometheus text format (see agents.metrics).
+
+    A plain Django view: no DRF negotiation or authentication classes on the
+    scrape path. Protected by METRICS_TOKEN when it is set; without one, only
+    staff (logged in to the admin) may read it, unless DEBUG is on.
+    """
+    if settings.METRICS_TOKEN:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        if not constant_time_compare(request.headers.get("Authorization", ""), expected):
+            return HttpResponse(status=401)
+    elif not settings.DEBUG and not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
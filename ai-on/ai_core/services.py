@@ -5,8 +5,9 @@ Handles the creation and management of the Main AI Coordinator agent.
 This agent acts as the central orchestrator for all other agents in the AION system.
 """
 
+import logging
 from agents.models import agentModel
-from agents.services import register_agent_function, build_config, execute_function, get_agent_history, add_to_history
+from agents.services import AgentDefinition, agent_registry, get_agent_config, execute_function, get_function_calls, run_function_calls, record_function_calls, get_agent_history, generate_content, TurnJournal, trace_agent, payload, MODEL_ERRORS, raise_unavailable, unavailable_result
 from .tools import (
     call_budget_agent,
     call_budget_agent_declaration,
@@ -14,11 +15,11 @@ from .tools import (
     send_message_to_agent_declaration
 )
 from django.contrib.auth.models import User
-from google import genai
 from google.genai import types
-from decouple import config
 
-API_KEY = config('GEMINI_API_KEY')
+
+logger = logging.getLogger(__name__)
+
 
 COORDINATOR_SYSTEM_INSTRUCTION = '''
 IDENTITY
@@ -50,47 +51,30 @@ GUIDELINES
 '''
 
 
+COORDINATOR_AGENT = AgentDefinition(
+    name="main_ai_coordinator",
+    description="Central orchestrator that coordinates all specialized agents in the AION system",
+    system_instruction=COORDINATOR_SYSTEM_INSTRUCTION,
+    gemini_model="gemini-2.5-flash-lite",
+    thinking_budget=0,
+    tools=lambda: [
+        ("call_budget_agent", call_budget_agent_declaration, call_budget_agent),
+        ("send_message_to_agent", send_message_to_agent_declaration, send_message_to_agent),
+    ]
+)
+
+
 def get_or_create_coordinator_agent() -> agentModel:
     """
-    Get or create the Main AI Coordinator agent and register its functions.
+    Get the Main AI Coordinator agent from the agent registry.
     
     Returns:
         The coordinator agent model instance
     """
-    agent, created = agentModel.objects.get_or_create(
-        name="main_ai_coordinator",
-        defaults={
-            "description": "Central orchestrator that coordinates all specialized agents in the AION system",
-            "system_instruction": COORDINATOR_SYSTEM_INSTRUCTION,
-            "gemini_model": "gemini-2.5-flash-lite",
-            "thinking_budget": 0
-        }
-    )
-    
-    # Update model if it exists but configuration is different
-    if not created and (agent.gemini_model != "gemini-2.5-flash-lite" or agent.thinking_budget != 0):
-        agent.gemini_model = "gemini-2.5-flash-lite"
-        agent.thinking_budget = 0
-        agent.save()
-    
-    # Register functions
-    register_agent_function(
-        agent_id=agent.id,
-        func_name="call_budget_agent",
-        function_declaration=call_budget_agent_declaration,
-        function=call_budget_agent
-    )
-    
-    register_agent_function(
-        agent_id=agent.id,
-        func_name="send_message_to_agent",
-        function_declaration=send_message_to_agent_declaration,
-        function=send_message_to_agent
-    )
-    
-    return agent
+    return agent_registry.get(COORDINATOR_AGENT.name).agent
 
 
+@trace_agent(COORDINATOR_AGENT.name)
 def process_coordinator_message(user: User, user_message: str) -> dict:
     """
     Process a message sent to the Main AI Coordinator.
@@ -102,118 +86,95 @@ def process_coordinator_message(user: User, user_message: str) -> dict:
     Returns:
         Dictionary with either:
         - {"type": "response", "data": {"message": str, "agent_called": str|None}}
-        - {"type": "error", "data": {"error": str}}
+        - {"type": "error", "data": {"error": str}}, with "retry_after" when
+          Gemini stayed unavailable (agents.resilience.unavailable_result())
     """
-    print(f"DEBUG: Main AI Coordinator is running now... processing message: {user_message}")
+    logger.debug("Main AI Coordinator is running now... processing message: %s", payload(user_message))
     # Get or create agent
     agent = get_or_create_coordinator_agent()
     
     # Get conversation history
     history = get_agent_history(agent, user)
     
-    # Add user message to history
-    add_to_history(
-        agent=agent,
-        user=user,
-        part={"parts": [{"text": user_message}]},
-        role="user"
-    )
-    history.append(types.Content(
-        role="user",
-        parts=[types.Part(text=user_message)]
-    ))
-    
-    # Build config
-    config_obj = build_config(agent)
-    
-    # Create Gemini client
-    client = genai.Client(api_key=API_KEY)
-    
-    # Track which agents were called
-    agents_called = []
-    
-    # Generate response (may involve multiple function calls)
-    max_iterations = 5  # Prevent infinite loops
-    iteration = 0
-    
-    while iteration < max_iterations:
-        iteration += 1
-        
-        response = client.models.generate_content(
-            model=agent.gemini_model,
-            contents=history,
-            config=config_obj
+    # All parts of this turn are written in one go when the turn ends
+    with TurnJournal(agent, user) as journal:
+        # Add user message to history
+        journal.add(
+            part={"parts": [{"text": user_message}]},
+            role="user"
         )
+        history.append(types.Content(
+            role="user",
+            parts=[types.Part(text=user_message)]
+        ))
+        
+        # Build config
+        config_obj = get_agent_config(agent)
+        
+        
+        # Track which agents were called
+        agents_called = []
+        
+        # Generate response (may involve multiple function calls)
+        max_iterations = 5  # Prevent infinite loops
+        iteration = 0
         
-        # Check if there are function calls
-        has_function_call = False
-        if response.candidates[0].content.parts:
-            for part in response.candidates[0].content.parts:
-                if hasattr(part, 'function_call') and part.function_call:
-                    has_function_call = True
-                    func_call = part.function_call
-                    func_name = func_call.name
-                    func_args = dict(func_call.args)
-                    
-                    # Add user to args for function execution
-                    func_args['user'] = user
-                    
+        while iteration < max_iterations:
+            iteration += 1
+            
+            try:
+                response = generate_content(agent, history, config_obj)
+            except MODEL_ERRORS as e:
+                journal.discard()
+                return unavailable_result(COORDINATOR_AGENT.name, e)
+            
+            # Collect every function call of this turn
+            function_calls = get_function_calls(response)
+            
+            if function_calls:
+                for func_call in function_calls:
                     # Track which agent is being called
-                    if func_name == "call_budget_agent":
+                    if func_call.name == "call_budget_agent":
                         agents_called.append("budget_agent")
-                    elif func_name == "send_message_to_agent":
-                        agents_called.append(func_args.get('agent_name', 'unknown'))
-                    
-                    # Execute the function
-                    print(f"DEBUG: Main AI Coordinator calling {func_name} with args: {func_args}...")
-                    result = execute_function(agent, func_name, func_args)
-                    
-                    # Prepare args for history (without user object - not JSON serializable)
-                    func_args_for_history = {k: v for k, v in func_args.items() if k != 'user'}
-                    
-                    # Add function call to history
-                    add_to_history(
-                        agent=agent,
-                        user=user,
-                        part={"parts": [{"function_call": {"name": func_name, "args": func_args_for_history}}]},
-                        role="model"
+                    elif func_call.name == "send_message_to_agent":
+                        agents_called.append((func_call.args or {}).get('agent_name', 'unknown'))
+                    logger.debug("Main AI Coordinator calling %s with args: %s", func_call.name, payload(func_call.args))
+                
+                # Independent calls run concurrently; user is added for execution only
+                # (not JSON serializable, so it never reaches the history)
+                try:
+                    results = run_function_calls(
+                        function_calls,
+                        lambda call: execute_function(agent, call.name, {**(call.args or {}), 'user': user})
                     )
-                    
-                    # Add function response to history
-                    add_to_history(
-                        agent=agent,
-                        user=user,
-                        part={"parts": [{"function_response": {"name": func_name, "response": result}}]},
-                        role="user"
-                    )
-                    
-                    # Update history for next iteration with proper types
-                    history.append(types.Content(
-                        role="model",
-                        parts=[types.Part(function_call=types.FunctionCall(name=func_name, args=func_args_for_history))]
-                    ))
-                    history.append(types.Content(
-                        role="user",
-                        parts=[types.Part(function_response=types.FunctionResponse(name=func_name, response=result))]
-                    ))
-        
-        # If no function call, we have the final response
-        if not has_function_call:
-            # Save model response to history
-            add_to_history(
-                agent=agent,
-                user=user,
-                part={"parts": [{"text": response.text if response.text else ""}]},
-                role="model"
-            )
+                    raise_unavailable(results)
+                except MODEL_ERRORS as e:
+                    # A specialist's model is down: so is this turn
+                    journal.discard()
+                    return unavailable_result(COORDINATOR_AGENT.name, e)
+                
+                # One model turn with every call, one user turn with the responses in order
+                record_function_calls(journal, history, function_calls, results)
             
-            return {
-                "type": "response",
-                "data": {
-                    "message": response.text if response.text else "I've processed your request.",
-                    "agents_called": agents_called if agents_called else None
+            # If no function call, we have the final response
+            if not function_calls:
+                # Save model response to history
+                journal.add(
+                    part={"parts": [{"text": response.text if response.text else ""}]},
+                    role="model"
+                )
+                
+                return {
+                    "type": "response",
+                    "data": {
+                        "message": response.text if response.text else "I've processed your request.",
+                        "agents_called": agents_called if agents_called else None
+                    }
                 }
-            }
+        
+        # No final answer (empty response or out of iterations): the turn
+        # stays out of the history
+        journal.discard()
     
     # If we hit max iterations, return what we have
     return {
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class BudgetConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'budget'
+
+    def ready(self):
+        # Declare this app's agents; the agent registry loads them once per process
+        from agents.registry import agent_registry
+        from .services import BUDGET_AGENT
+        agent_registry.define(BUDGET_AGENT)
@@ -4,17 +4,32 @@ Budget Agent Service
 Handles the creation and management of the Budget AI agent.
 """
 
+import logging
 from pydantic import BaseModel, Field
 from typing import List, Optional, Literal
 from agents.models import agentModel
-from agents.services import build_config, get_agent_history, add_to_history
+from agents.services import (
+    get_agent_config,
+    AgentDefinition,
+    agent_registry,
+    get_agent_history,
+    generate_content,
+    agenerate_content,
+    aget_agent_history,
+    TurnJournal,
+    trace_agent,
+    payload,
+    MODEL_ERRORS,
+    unavailable_result
+)
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
-from google import genai
 from google.genai import types
-from decouple import config
 from .models import Budget
 
-API_KEY = config('GEMINI_API_KEY')
+
+logger = logging.getLogger(__name__)
+
 
 # Pydantic Models for Structured Output
 class BudgetOperation(BaseModel):
@@ -77,26 +92,41 @@ BEHAVIOR
 *   The `spent` field should generally be 0 for new budgets, unless you are processing historical data.
 '''
 
-def get_or_create_budget_agent() -> agentModel:
+def _budget_config(agent: agentModel, functions: dict = None) -> types.GenerateContentConfig:
     """
-    Get or create the budget agent.
+    Structured-output config shared by the sync and async budget task runners.
     """
-    agent, created = agentModel.objects.get_or_create(
-        name="budget_agent",
-        defaults={
-            "description": "Generates and manages user budgets and categories.",
-            "system_instruction": BUDGET_SYSTEM_INSTRUCTION,
-            "gemini_model": "gemini-2.5-pro",
-            "thinking_budget": 1
-        }
+    return types.GenerateContentConfig(
+        system_instruction=agent.system_instruction,
+        response_mime_type="application/json",
+        response_schema=BudgetGenerationResponse,
+        temperature=0.7,
     )
-    # Update model if it exists but is different (optional, but good for dev)
-    if not created and (agent.gemini_model != "gemini-2.5-pro" or agent.thinking_budget != 1):
-        agent.gemini_model = "gemini-2.5-pro"
-        agent.thinking_budget = 1
-        agent.save()
-        
-    return agent
+
+
+BUDGET_AGENT = AgentDefinition(
+    name="budget_agent",
+    description="Generates and manages user budgets and categories.",
+    system_instruction=BUDGET_SYSTEM_INSTRUCTION,
+    gemini_model="gemini-2.5-pro",
+    thinking_budget=1,
+    config=_budget_config
+)
+
+
+def get_or_create_budget_agent() -> agentModel:
+    """
+    Get the budget agent from the agent registry (no DB query once loaded).
+    """
+    return agent_registry.get(BUDGET_AGENT.name).agent
+
+
+async def aget_or_create_budget_agent() -> agentModel:
+    """
+    Async version of get_or_create_budget_agent().
+    """
+    return (await agent_registry.aget(BUDGET_AGENT.name)).agent
+
 
 def get_user_financial_profile(user: User) -> str:
     """
@@ -119,33 +149,67 @@ def get_user_financial_profile(user: User) -> str:
     except Exception:
         return "User profile not found or incomplete."
 
+def _apply_budget_operations(user: User, generated_content: BudgetGenerationResponse | None):
+    """
+    Update/Create/Delete budgets in DB based on the agent's operations.
+    """
+    if not generated_content or not generated_content.operations:
+        return
+    
+    for operation in generated_content.operations:
+        if operation.operation == "add":
+            # Create new budget
+            Budget.objects.create(
+                user=user,
+                title=operation.title,
+                budget=operation.budget,
+                spent=operation.spent if operation.spent is not None else 0,
+                description=operation.description
+            )
+        elif operation.operation == "edit":
+            # Update existing budget
+            try:
+                budget = Budget.objects.get(user=user, title=operation.title)
+                if operation.budget is not None:
+                    budget.budget = operation.budget
+                if operation.spent is not None:
+                    budget.spent = operation.spent
+                if operation.description is not None:
+                    budget.description = operation.description
+                budget.save()
+            except Budget.DoesNotExist:
+                # If budget doesn't exist, log or handle gracefully
+                pass
+        elif operation.operation == "delete":
+            # Delete budget
+            Budget.objects.filter(user=user, title=operation.title).delete()
+
+
+def _budget_result(generated_content: BudgetGenerationResponse | None) -> dict:
+    return {
+        "type": "success",
+        "data": {
+            "message": generated_content.message if generated_content else "Budget updated.",
+            "operations": [{"operation": op.operation, "title": op.title, "budget": op.budget, "spent": op.spent} for op in generated_content.operations] if generated_content else []
+        }
+    }
+
+
 def _execute_agent_task(user: User, prompt: str, agent: agentModel) -> dict:
     """
     Helper to execute a task with the Budget Agent.
     """
-    print(f"DEBUG: Budget Agent is running now... executing task: {prompt}")
+    logger.debug("Budget Agent is running now... executing task: %s", payload(prompt))
     history = get_agent_history(agent, user)
     
     # Inject User Profile if history is empty
     if not history:
         profile_context = get_user_financial_profile(user)
-        initial_msg = f"{profile_context}\n\nTASK: {prompt}"
-        
-        add_to_history(
-            agent=agent,
-            user=user,
-            part={"parts": [{"text": initial_msg}]},
-            role="user"
-        )
-        history.append(types.Content(
-            role="user",
-            parts=[types.Part(text=initial_msg)]
-        ))
-    else:
-        # Just add the new prompt
-        add_to_history(
-            agent=agent,
-            user=user,
+        prompt = f"{profile_context}\n\nTASK: {prompt}"
+    
+    # Prompt and answer are written in one go (or not at all)
+    with TurnJournal(agent, user) as journal:
+        journal.add(
             part={"parts": [{"text": prompt}]},
             role="user"
         )
@@ -154,70 +218,27 @@ def _execute_agent_task(user: User, prompt: str, agent: agentModel) -> dict:
             parts=[types.Part(text=prompt)]
         ))
 
-    config_obj = types.GenerateContentConfig(
-        system_instruction=agent.system_instruction,
-        response_mime_type="application/json",
-        response_schema=BudgetGenerationResponse,
-        temperature=0.7,
-    )
-    
-    client = genai.Client(api_key=API_KEY)
-    
-    # try:
-    response = client.models.generate_content(
-        model=agent.gemini_model,
-        contents=history,
-        config=config_obj
-    )
-    
-    generated_content = response.parsed
+        config_obj = get_agent_config(agent)
+        
+        try:
+            response = generate_content(agent, history, config_obj)
+        except MODEL_ERRORS as e:
+            journal.discard()
+            return unavailable_result(BUDGET_AGENT.name, e)
+        
+        generated_content = response.parsed
+        
+        journal.add(
+            part={"parts": [{"text": response.text}]},
+            role="model"
+        )
     
-    add_to_history(
-        agent=agent,
-        user=user,
-        part={"parts": [{"text": response.text}]},
-        role="model"
-    )
+    _apply_budget_operations(user, generated_content)
     
-    # Update/Create/Delete budgets in DB based on operations
-    if generated_content and generated_content.operations:
-        for operation in generated_content.operations:
-            if operation.operation == "add":
-                # Create new budget
-                Budget.objects.create(
-                    user=user,
-                    title=operation.title,
-                    budget=operation.budget,
-                    spent=operation.spent if operation.spent is not None else 0,
-                    description=operation.description
-                )
-            elif operation.operation == "edit":
-                # Update existing budget
-                try:
-                    budget = Budget.objects.get(user=user, title=operation.title)
-                    if operation.budget is not None:
-                        budget.budget = operation.budget
-                    if operation.spent is not None:
-                        budget.spent = operation.spent
-                    if operation.description is not None:
-                        budget.description = operation.description
-                    budget.save()
-                except Budget.DoesNotExist:
-                    # If budget doesn't exist, log or handle gracefully
-                    pass
-            elif operation.operation == "delete":
-                # Delete budget
-                Budget.objects.filter(user=user, title=operation.title).delete()
-        
-    return {
-        "type": "success",
-        "data": {
-            "message": generated_content.message if generated_content else "Budget updated.",
-            "operations": [{"operation": op.operation, "title": op.title, "budget": op.budget, "spent": op.spent} for op in generated_content.operations] if generated_content else []
-        }
-    }
+    return _budget_result(generated_content)
 
 
+@trace_agent(BUDGET_AGENT.name)
 def process_budget_operation(user: User, message: str) -> dict:
     """
     Unified function to handle budget operations (edit/delete) with natural language messages.
@@ -248,6 +269,7 @@ def process_budget_operation(user: User, message: str) -> dict:
     return _execute_agent_task(user, prompt, agent)
 
 
+@trace_agent(BUDGET_AGENT.name)
 def process_budget_generation(user: User, user_message: str = None) -> dict:
     """
     Process a request to generate budgets.
@@ -255,3 +277,53 @@ def process_budget_generation(user: User, user_message: str = None) -> dict:
     agent = get_or_create_budget_agent()
     prompt = user_message if user_message else "Generate budget based on available info."
     return _execute_agent_task(user, prompt, agent)
+
+
+async def _aexecute_agent_task(user: User, prompt: str, agent: agentModel) -> dict:
+    """
+    Async version of _execute_agent_task().
+    """
+    logger.debug("Budget Agent (async) is running now... executing task: %s", payload(prompt))
+    history = await aget_agent_history(agent, user)
+    
+    if not history:
+        profile_context = await sync_to_async(get_user_financial_profile)(user)
+        prompt = f"{profile_context}\n\nTASK: {prompt}"
+    
+    # Prompt and answer are written in one go (or not at all)
+    async with TurnJournal(agent, user) as journal:
+        journal.add(
+            part={"parts": [{"text": prompt}]},
+            role="user"
+        )
+        history.append(types.Content(
+            role="user",
+            parts=[types.Part(text=prompt)]
+        ))
+        
+        try:
+            response = await agenerate_content(agent, history, get_agent_config(agent))
+        except MODEL_ERRORS as e:
+            journal.discard()
+            return unavailable_result(BUDGET_AGENT.name, e)
+        
+        generated_content = response.parsed
+        
+        journal.add(
+            part={"parts": [{"text": response.text}]},
+            role="model"
+        )
+    
+    await sync_to_async(_apply_budget_operations)(user, generated_content)
+    
+    return _budget_result(generated_content)
+
+
+@trace_agent(BUDGET_AGENT.name)
+async def aprocess_budget_generation(user: User, user_message: str = None) -> dict:
+    """
+    Async version of process_budget_generation().
+    """
+    agent = await aget_or_create_budget_agent()
+    prompt = user_message if user_message else "Generate budget based on available info."
+    return await _aexecute_agent_task(user, prompt, agent)
@@ -1,13 +1,14 @@
 from rest_framework import viewsets, status
-from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from drf_spectacular.utils import extend_schema
 from .models import Budget
 from .serializers import BudgetSerializer, BudgetListSerializer
-from .services import process_budget_generation, process_budget_operation
+from .services import aprocess_budget_generation, process_budget_operation
+from agents.services import BACKGROUND, llm_operation, llm_priority
+from agents.views import AsyncAPIView, unavailable_response
 
-class BudgetGenerateView(APIView):
+class BudgetGenerateView(AsyncAPIView):
     """
     Endpoint to generate budgets using AI based on user profile and history.
     """
@@ -18,10 +19,12 @@ class BudgetGenerateView(APIView):
         responses={200: BudgetSerializer(many=True)},
         description="Generate budgets using AI based on user profile and history."
     )
-    def post(self, request):
-        result = process_budget_generation(request.user)
+    async def post(self, request):
+        result = await aprocess_budget_generation(request.user)
         if result['type'] == 'success':
             return Response(result['data'], status=status.HTTP_200_OK)
+        elif 'retry_after' in result['data']:
+            return unavailable_response(result['data'])
         else:
             return Response(result['data'], status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -62,7 +65,10 @@ class BudgetViewSet(viewsets.ModelViewSet):
             if updated_instance.spent > updated_instance.budget:
                 message += f". Note: This is overspending (spent {updated_instance.spent} exceeds budget {updated_instance.budget})."
             
-            process_budget_operation(self.request.user, message)
+            # Rebalancing is background work: it yields the model quota to chat,
+            # and a single-category edit is routed to a lighter model
+            with llm_priority(BACKGROUND), llm_operation("edit"):
+                process_budget_operation(self.request.user, message)
 
     def perform_destroy(self, instance):
         user = self.request.user
@@ -73,4 +79,5 @@ class BudgetViewSet(viewsets.ModelViewSet):
         
         # Call AI with natural language message
         message = f"I want to delete '{title}'"
-        process_budget_operation(user, message)
+        with llm_priority(BACKGROUND), llm_operation("delete"):
+            process_budget_operation(user, message)
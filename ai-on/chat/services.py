@@ -4,17 +4,43 @@ Chatbot Agent Service
 Handles the creation and management of the Chatbot AI agent.
 """
 
+import logging
+from contextlib import aclosing
 from pydantic import BaseModel, Field
 from typing import Optional
 from agents.models import agentModel
-from agents.services import build_config, get_agent_history, add_to_history, register_agent_function
+from agents.services import (
+    get_agent_config,
+    AgentDefinition,
+    agent_registry,
+    get_agent_history,
+    generate_content,
+    agenerate_content,
+    agenerate_content_stream,
+    merge_stream_chunks,
+    chunk_text,
+    aget_agent_history,
+    get_function_calls,
+    run_function_calls,
+    arun_function_calls,
+    record_function_calls,
+    time_tool,
+    trace_span,
+    TurnJournal,
+    trace_agent,
+    payload,
+    MODEL_ERRORS,
+    raise_unavailable,
+    unavailable_for
+)
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
-from google import genai
 from google.genai import types
-from decouple import config
 import re
 
-API_KEY = config('GEMINI_API_KEY')
+
+logger = logging.getLogger(__name__)
+
 
 # Pydantic Model for Structured Output
 class ChatbotResponse(BaseModel):
@@ -74,28 +100,8 @@ OUTPUT FORMAT:
 - Use markdown formatting if needed (**, *, -, etc.) but NEVER HTML
 '''
 
-def get_or_create_chatbot_agent() -> agentModel:
-    """
-    Get or create the chatbot agent.
-    """
-    agent, created = agentModel.objects.get_or_create(
-        name="chatbot_agent",
-        defaults={
-            "description": "Primary conversational interface for users in the AION system.",
-            "system_instruction": CHATBOT_SYSTEM_INSTRUCTION,
-            "gemini_model": "gemini-2.5-flash-lite",
-            "thinking_budget": 0
-        }
-    )
-    
-    # Update model if it exists but is different
-    if not created and (agent.gemini_model != "gemini-2.5-flash-lite" or agent.thinking_budget != 0 or agent.system_instruction != CHATBOT_SYSTEM_INSTRUCTION):
-        agent.gemini_model = "gemini-2.5-flash-lite"
-        agent.thinking_budget = 0
-        agent.system_instruction = CHATBOT_SYSTEM_INSTRUCTION
-        agent.save()
-    
-    # Register tools
+def _chatbot_tools() -> list:
+    # Imported at registry load time: chat.tools calls back into this module
     from chat.tools import (
         edit_user_profile, 
         edit_user_profile_declaration,
@@ -109,42 +115,37 @@ def get_or_create_chatbot_agent() -> agentModel:
         call_advisor_declaration
     )
     
-    register_agent_function(
-        agent_id=agent.id,
-        func_name="edit_user_profile",
-        function_declaration=edit_user_profile_declaration,
-        function=edit_user_profile
-    )
-    
-    register_agent_function(
-        agent_id=agent.id,
-        func_name="call_main_coordinator",
-        function_declaration=call_main_coordinator_declaration,
-        function=call_main_coordinator
-    )
-    
-    register_agent_function(
-        agent_id=agent.id,
-        func_name="call_expense_manager",
-        function_declaration=call_expense_manager_declaration,
-        function=call_expense_manager
-    )
-    
-    register_agent_function(
-        agent_id=agent.id,
-        func_name="call_report_agent",
-        function_declaration=call_report_agent_declaration,
-        function=call_report_agent
-    )
-    
-    register_agent_function(
-        agent_id=agent.id,
-        func_name="call_advisor",
-        function_declaration=call_advisor_declaration,
-        function=call_advisor
-    )
-    
-    return agent
+    return [
+        ("edit_user_profile", edit_user_profile_declaration, edit_user_profile),
+        ("call_main_coordinator", call_main_coordinator_declaration, call_main_coordinator),
+        ("call_expense_manager", call_expense_manager_declaration, call_expense_manager),
+        ("call_report_agent", call_report_agent_declaration, call_report_agent),
+        ("call_advisor", call_advisor_declaration, call_advisor),
+    ]
+
+
+CHATBOT_AGENT = AgentDefinition(
+    name="chatbot_agent",
+    description="Primary conversational interface for users in the AION system.",
+    system_instruction=CHATBOT_SYSTEM_INSTRUCTION,
+    gemini_model="gemini-2.5-flash-lite",
+    thinking_budget=0,
+    tools=_chatbot_tools
+)
+
+
+def get_or_create_chatbot_agent() -> agentModel:
+    """
+    Get the chatbot agent from the agent registry (no DB query once loaded).
+    """
+    return agent_registry.get(CHATBOT_AGENT.name).agent
+
+
+async def aget_or_create_chatbot_agent() -> agentModel:
+    """
+    Async version of get_or_create_chatbot_agent().
+    """
+    return (await agent_registry.aget(CHATBOT_AGENT.name)).agent
 
 
 def get_user_financial_profile(user: User) -> str:
@@ -191,6 +192,90 @@ def clean_html_tags(text: str) -> str:
     return clean_text.strip()
 
 
+class _StreamingTagStripper:
+    """
+    Incremental clean_html_tags() for streamed text, where a tag may be
+    split across chunks. Text after an unclosed '<' is held back until the
+    tag closes (or grows too long to be one).
+    """
+    MAX_TAG_LENGTH = 200
+
+    def __init__(self):
+        self._pending = ""
+        self._started = False
+
+    def feed(self, text: str) -> str:
+        text = self._pending + text
+        self._pending = ""
+        cut = text.rfind('<')
+        if cut != -1 and '>' not in text[cut:] and len(text) - cut <= self.MAX_TAG_LENGTH:
+            text, self._pending = text[:cut], text[cut:]
+        text = re.sub(r'<[^>]+>', '', text)
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+    def flush(self) -> str:
+        text, self._pending = self._pending, ""
+        return text if self._started else text.lstrip()
+
+
+def _run_chatbot_tool(user: User, func_name: str, func_args: dict) -> dict:
+    """
+    Execute one of the chatbot's tools on behalf of the user.
+    
+    Args:
+        user: The Django User object
+        func_name: Name of the tool the model called
+        func_args: Arguments from the model's function call
+        
+    Returns:
+        The tool's result dictionary
+    """
+    from chat.tools import (
+        edit_user_profile,
+        call_main_coordinator,
+        call_expense_manager,
+        call_report_agent,
+        call_advisor
+    )
+    
+    with time_tool(CHATBOT_AGENT.name, func_name), trace_span(func_name, "tool", agent=CHATBOT_AGENT.name):
+        if func_name == "edit_user_profile":
+            return edit_user_profile(user, **func_args)
+        elif func_name == "call_main_coordinator":
+            return call_main_coordinator(user, **func_args)
+        elif func_name == "call_expense_manager":
+            return call_expense_manager(user, **func_args)
+        elif func_name == "call_report_agent":
+            return call_report_agent(user, **func_args)
+        elif func_name == "call_advisor":
+            return call_advisor(user, **func_args)
+        
+        logger.warning("Unknown function %s", func_name)
+        return {"type": "error", "data": {"error": f"Unknown function: {func_name}"}}
+
+
+def _model_error_result(error: Exception) -> dict:
+    # Gemini stayed rate limited or down through the retries (agents.resilience)
+    logger.warning("Chatbot Agent model call failed: %s", error)
+    return {
+        "type": "error",
+        "data": {
+            "message": "I'm a bit overloaded right now. Please try again in a moment.",
+            "retry_after": unavailable_for(error)
+        }
+    }
+
+
+def _model_error_event(error: Exception) -> dict:
+    # The stream's counterpart: an "error" event the client can retry after
+    data = _model_error_result(error)["data"]
+    return {"msg": data["message"], "retry_after": data["retry_after"]}
+
+
+@trace_agent(CHATBOT_AGENT.name)
 def process_chatbot_message(user: User, message: str) -> dict:
     """
     Process a message from the user to the chatbot.
@@ -202,30 +287,18 @@ def process_chatbot_message(user: User, message: str) -> dict:
     Returns:
         Dictionary containing the chatbot's response
     """
-    print(f"DEBUG: Chatbot Agent is running now... processing message: {message}")
+    logger.debug("Chatbot Agent is running now... processing message: %s", payload(message))
     agent = get_or_create_chatbot_agent()
     history = get_agent_history(agent, user)
     
     # Inject User Profile on first message
     if not history:
         profile_context = get_user_financial_profile(user)
-        initial_msg = f"{profile_context}\n\nUSER MESSAGE: {message}"
-        
-        add_to_history(
-            agent=agent,
-            user=user,
-            part={"parts": [{"text": initial_msg}]},
-            role="user"
-        )
-        history.append(types.Content(
-            role="user",
-            parts=[types.Part(text=initial_msg)]
-        ))
-    else:
-        # Just add the new message
-        add_to_history(
-            agent=agent,
-            user=user,
+        message = f"{profile_context}\n\nUSER MESSAGE: {message}"
+    
+    # All parts of this turn are written in one go when the turn ends
+    with TurnJournal(agent, user) as journal:
+        journal.add(
             part={"parts": [{"text": message}]},
             role="user"
         )
@@ -233,137 +306,302 @@ def process_chatbot_message(user: User, message: str) -> dict:
             role="user",
             parts=[types.Part(text=message)]
         ))
-    
-    # Use the helper function from agents.services to build config with proper tool settings
-    config_obj = build_config(agent)
-    
-    client = genai.Client(api_key=API_KEY)
-    
-    # Handle multi-turn function calling
-    max_iterations = 5
-    iteration = 0
-    
-    while iteration < max_iterations:
-        iteration += 1
         
-        response = client.models.generate_content(
-            model=agent.gemini_model,
-            contents=history,
-            config=config_obj
-        )
+        # Cached config (tools and function calling settings) from the agent registry
+        config_obj = get_agent_config(agent)
         
-        print(f"DEBUG: Model response iteration {iteration}: {response}")
         
-        # Check if response has valid content
-        if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
-            print("DEBUG: Model returned empty response, breaking loop")
-            break
+        # Handle multi-turn function calling
+        max_iterations = 5
+        iteration = 0
         
-        # Check for function calls in ANY part of the content
-        function_call_part = None
-        for part in response.candidates[0].content.parts:
-            if part.function_call:
-                function_call_part = part.function_call
-                break
-        
-        if function_call_part:
-            function_call = function_call_part
-            func_name = function_call.name
-            func_args = dict(function_call.args)    
-            print(f"DEBUG: Chatbot Agent calling {func_name} with args: {func_args}...")
+        while iteration < max_iterations:
+            iteration += 1
             
-            # Add function call to history
-            add_to_history(
-                agent=agent,
-                user=user,
-                part={"parts": [{"function_call": {"name": func_name, "args": func_args}}]},
-                role="model"
-            )
-            history.append(types.Content(
-                role="model",
-                parts=[types.Part(function_call=function_call)]
-            ))
+            try:
+                response = generate_content(agent, history, config_obj)
+            except MODEL_ERRORS as e:
+                journal.discard()
+                return _model_error_result(e)
             
-            # Execute the function - import tools and call directly
-            from chat.tools import (
-                edit_user_profile,
-                call_main_coordinator,
-                call_expense_manager,
-                call_report_agent,
-                call_advisor
-            )
+            logger.debug("Model response iteration %d: %s", iteration, payload(response))
             
-            if func_name == "edit_user_profile":
-                result = edit_user_profile(user, **func_args)
-            elif func_name == "call_main_coordinator":
-                result = call_main_coordinator(user, **func_args)
-            elif func_name == "call_expense_manager":
-                result = call_expense_manager(user, **func_args)
-            elif func_name == "call_report_agent":
-                result = call_report_agent(user, **func_args)
-            elif func_name == "call_advisor":
-                result = call_advisor(user, **func_args)
-            else:
-                result = {"type": "error", "data": {"error": f"Unknown function: {func_name}"}}
-                print(f"DEBUG: Unknown function {func_name}")
-            
-            print(f"DEBUG: Function {func_name} returned: {result}")
+            # Check if response has valid content
+            if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
+                logger.debug("Model returned empty response, breaking loop")
+                break
             
-            # Add function call to history (model's action)
-            add_to_history(
-                agent=agent,
-                user=user,
-                part={"parts": [{"function_call": {"name": func_name, "args": func_args}}]},
-                role="model"
-            )
+            # Collect every function call in the content (the model may ask for several at once)
+            function_calls = get_function_calls(response)
             
-            # Add function response to history (function's result)
-            add_to_history(
-                agent=agent,
-                user=user,
-                part={"parts": [{"function_response": {"name": func_name, "response": result}}]},
-                role="user"
-            )
+            if function_calls:
+                for function_call in function_calls:
+                    logger.debug("Chatbot Agent calling %s with args: %s", function_call.name, payload(function_call.args))
+                
+                # Independent calls (e.g. record an expense and build a report) run concurrently;
+                # a nested agent whose model is down fails the turn like our own model would
+                try:
+                    results = run_function_calls(
+                        function_calls,
+                        lambda call: _run_chatbot_tool(user, call.name, dict(call.args or {}))
+                    )
+                    raise_unavailable(results)
+                except MODEL_ERRORS as e:
+                    journal.discard()
+                    return _model_error_result(e)
+                
+                for function_call, result in zip(function_calls, results):
+                    logger.debug("Function %s returned: %s", function_call.name, payload(result))
+                
+                # One model turn with every call, one user turn with the responses in order
+                record_function_calls(journal, history, function_calls, results)
+            else:
+                # No function calls, we have the final response
+                try:
+                    final_message = response.text
+                except (AttributeError, ValueError) as e:
+                    logger.warning("Error accessing response.text: %s", e)
+                    final_message = "I apologize, but I encountered an issue processing your request. Please try again."
+                
+                # Clean any HTML tags from the response
+                final_message = clean_html_tags(final_message)
+                logger.debug("Final cleaned message: %s", payload(final_message))
+                
+                journal.add(
+                    part={"parts": [{"text": final_message}]},
+                    role="model"
+                )
+                
+                return {
+                    "type": "success",
+                    "data": {
+                        "message": final_message
+                    }
+                }
+        
+        # No final answer (empty response or out of iterations): the turn
+        # stays out of the history
+        journal.discard()
+    
+    # If we hit max iterations
+    return {
+        "type": "error",
+        "data": {
+            "message": "I apologize, but I'm having trouble processing your request. Could you please try rephrasing it?"
+        }
+    }
+
+
+@trace_agent(CHATBOT_AGENT.name)
+async def aprocess_chatbot_message(user: User, message: str) -> dict:
+    """
+    Async version of process_chatbot_message().
+    
+    Model calls go through client.aio and history through the async ORM, so
+    the event loop stays free while Gemini is thinking. Tools (which may call
+    other agents synchronously) run in worker threads.
+    
+    Args:
+        user: The Django User object
+        message: The user's message
+        
+    Returns:
+        Dictionary containing the chatbot's response
+    """
+    logger.debug("Chatbot Agent (async) is running now... processing message: %s", payload(message))
+    agent = await aget_or_create_chatbot_agent()
+    history = await aget_agent_history(agent, user)
+    
+    # Inject User Profile on first message
+    if not history:
+        profile_context = await sync_to_async(get_user_financial_profile)(user)
+        message = f"{profile_context}\n\nUSER MESSAGE: {message}"
+    
+    # All parts of this turn are written in one go when the turn ends
+    async with TurnJournal(agent, user) as journal:
+        journal.add(
+            part={"parts": [{"text": message}]},
+            role="user"
+        )
+        history.append(types.Content(
+            role="user",
+            parts=[types.Part(text=message)]
+        ))
+        
+        config_obj = get_agent_config(agent)
+        
+        max_iterations = 5
+        iteration = 0
+        
+        while iteration < max_iterations:
+            iteration += 1
             
-            # Update history for next iteration with proper types
-            history.append(types.Content(
-                role="model",
-                parts=[types.Part(function_call=types.FunctionCall(name=func_name, args=func_args))]
-            ))
-            history.append(types.Content(
-                role="user",
-                parts=[types.Part(function_response=types.FunctionResponse(name=func_name, response=result))]
-            ))
-        else:
-            # No function calls, we have the final response
             try:
-                final_message = response.text
-            except (AttributeError, ValueError) as e:
-                print(f"DEBUG: Error accessing response.text: {e}")
-                final_message = "I apologize, but I encountered an issue processing your request. Please try again."
+                response = await agenerate_content(agent, history, config_obj)
+            except MODEL_ERRORS as e:
+                journal.discard()
+                return _model_error_result(e)
             
-            # Clean any HTML tags from the response
-            final_message = clean_html_tags(final_message)
-            print(f"DEBUG: Final cleaned message: {final_message}")
+            if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
+                logger.debug("Model returned empty response, breaking loop")
+                break
             
-            add_to_history(
-                agent=agent,
-                user=user,
-                part={"parts": [{"text": final_message}]},
-                role="model"
-            )
+            function_calls = get_function_calls(response)
             
-            return {
-                "type": "success",
-                "data": {
-                    "message": final_message
+            if function_calls:
+                for function_call in function_calls:
+                    logger.debug("Chatbot Agent calling %s with args: %s", function_call.name, payload(function_call.args))
+                
+                try:
+                    results = await arun_function_calls(
+                        function_calls,
+                        lambda call: _run_chatbot_tool(user, call.name, dict(call.args or {}))
+                    )
+                    raise_unavailable(results)
+                except MODEL_ERRORS as e:
+                    journal.discard()
+                    return _model_error_result(e)
+                
+                record_function_calls(journal, history, function_calls, results)
+            else:
+                try:
+                    final_message = response.text
+                except (AttributeError, ValueError) as e:
+                    logger.warning("Error accessing response.text: %s", e)
+                    final_message = "I apologize, but I encountered an issue processing your request. Please try again."
+                
+                final_message = clean_html_tags(final_message)
+                
+                journal.add(
+                    part={"parts": [{"text": final_message}]},
+                    role="model"
+                )
+                
+                return {
+                    "type": "success",
+                    "data": {
+                        "message": final_message
+                    }
                 }
-            }
+        
+        # No final answer (empty response or out of iterations): the turn
+        # stays out of the history
+        journal.discard()
     
-    # If we hit max iterations
     return {
         "type": "error",
         "data": {
             "message": "I apologize, but I'm having trouble processing your request. Could you please try rephrasing it?"
         }
     }
+
+
+@trace_agent(CHATBOT_AGENT.name)
+async def astream_chatbot_message(user: User, message: str):
+    """
+    Streaming version of aprocess_chatbot_message().
+    
+    Text is yielded as Gemini produces it. Function-call turns are executed
+    and recorded exactly as in the non-streaming loop; the final answer is
+    written to ConversationHistory once its stream completes.
+    
+    Args:
+        user: The Django User object
+        message: The user's message
+        
+    Yields:
+        (event, data) tuples, see agents.streaming
+    """
+    logger.debug("Chatbot Agent (stream) is running now... processing message: %s", payload(message))
+    agent = await aget_or_create_chatbot_agent()
+    history = await aget_agent_history(agent, user)
+    
+    # Inject User Profile on first message
+    if not history:
+        profile_context = await sync_to_async(get_user_financial_profile)(user)
+        message = f"{profile_context}\n\nUSER MESSAGE: {message}"
+    
+    # All parts of this turn are written in one go when the turn ends
+    async with TurnJournal(agent, user) as journal:
+        journal.add(
+            part={"parts": [{"text": message}]},
+            role="user"
+        )
+        history.append(types.Content(
+            role="user",
+            parts=[types.Part(text=message)]
+        ))
+        
+        config_obj = get_agent_config(agent)
+        
+        max_iterations = 5
+        iteration = 0
+        
+        while iteration < max_iterations:
+            iteration += 1
+            
+            stripper = _StreamingTagStripper()
+            chunks = []
+            try:
+                async with aclosing(agenerate_content_stream(agent, history, config_obj)) as stream:
+                    async for chunk in stream:
+                        chunks.append(chunk)
+                        delta = stripper.feed(chunk_text(chunk))
+                        if delta:
+                            yield "delta", {"text": delta}
+            except MODEL_ERRORS as e:
+                journal.discard()
+                yield "error", _model_error_event(e)
+                return
+            response = merge_stream_chunks(chunks)
+            
+            if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
+                logger.debug("Model returned empty response, breaking loop")
+                break
+            
+            function_calls = get_function_calls(response)
+            
+            if function_calls:
+                # Any text streamed in this turn is superseded by the tools' follow-up answer
+                for function_call in function_calls:
+                    logger.debug("Chatbot Agent calling %s with args: %s", function_call.name, payload(function_call.args))
+                    yield "tool", {"name": function_call.name}
+                
+                try:
+                    results = await arun_function_calls(
+                        function_calls,
+                        lambda call: _run_chatbot_tool(user, call.name, dict(call.args or {}))
+                    )
+                    raise_unavailable(results)
+                except MODEL_ERRORS as e:
+                    journal.discard()
+                    yield "error", _model_error_event(e)
+                    return
+                
+                record_function_calls(journal, history, function_calls, results)
+            else:
+                tail = stripper.flush()
+                if tail:
+                    yield "delta", {"text": tail}
+                
+                final_message = clean_html_tags(chunk_text(response))
+                if not final_message:
+                    final_message = "I apologize, but I encountered an issue processing your request. Please try again."
+                
+                journal.add(
+                    part={"parts": [{"text": final_message}]},
+                    role="model"
+                )
+                # Persist before announcing completion
+                await journal.aflush()
+                
+                yield "done", {"msg": final_message}
+                return
+        
+        # No final answer (empty response or out of iterations): the turn
+        # stays out of the history
+        journal.discard()
+    
+    yield "error", {
+        "msg": "I apologize, but I'm having trouble processing your request. Could you please try rephrasing it?"
+    }
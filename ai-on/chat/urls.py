@@ -1,8 +1,9 @@
 from django.urls import path
-from .views import ChatView, ChatHistoryView, ChatResetView
+from .views import ChatView, ChatStreamView, ChatHistoryView, ChatResetView
 
 urlpatterns = [
     path('', ChatView.as_view(), name='chat'),
+    path('stream/', ChatStreamView.as_view(), name='chat-stream'),
     path('history/', ChatHistoryView.as_view(), name='chat-history'),
     path('reset/', ChatResetView.as_view(), name='chat-reset'),
 ]
\ No newline at end of file
@@ -4,11 +4,13 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 from drf_spectacular.utils import extend_schema, OpenApiResponse
 from .serializers import ChatMessageSerializer, ChatResponseSerializer, ChatHistoryItemSerializer
-from .services import process_chatbot_message, get_or_create_chatbot_agent
+from .services import aprocess_chatbot_message, astream_chatbot_message, get_or_create_chatbot_agent
 from agents.services import get_agent_history, clear_agent_history
+from agents.streaming import event_stream_response
+from agents.views import AsyncAPIView, AsyncStreamView
 
 
-class ChatView(APIView):
+class ChatView(AsyncAPIView):
     """
     Endpoint to send messages to the chatbot and receive responses.
     """
@@ -18,24 +20,32 @@ class ChatView(APIView):
         request=ChatMessageSerializer,
         responses={
             200: ChatResponseSerializer,
-            500: OpenApiResponse(description="Internal server error")
+            500: OpenApiResponse(description="Internal server error"),
+            503: OpenApiResponse(description="Gemini is unavailable; retry after the Retry-After header")
         },
         description="Send a message to the chatbot and receive a response. The chatbot can handle general conversation, profile updates, and delegate complex tasks to specialized agents."
     )
-    def post(self, request):
+    async def post(self, request):
         serializer = ChatMessageSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         user_message = serializer.validated_data['msg']
         
-        result = process_chatbot_message(request.user, user_message)
+        result = await aprocess_chatbot_message(request.user, user_message)
         
         if result['type'] == 'success':
             return Response(
                 {"msg": result['data']['message']},
                 status=status.HTTP_200_OK
             )
+        elif 'retry_after' in result['data']:
+            # Gemini is rate limited or down: tell the client when to try again
+            return Response(
+                {"msg": result['data']['message']},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': str(result['data']['retry_after'])}
+            )
         else:
             return Response(
                 {"msg": result['data'].get('message', 'An error occurred')},
@@ -43,6 +53,29 @@ class ChatView(APIView):
             )
 
 
+class ChatStreamView(AsyncStreamView):
+    """
+    Streaming variant of ChatView (Server-Sent Events).
+    """
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request=ChatMessageSerializer,
+        responses={
+            (200, 'text/event-stream'): OpenApiResponse(description="SSE stream: `delta` events with {text}, `tool` events with {name}, then `done` with {msg} or `error` with {msg}")
+        },
+        description="Send a message to the chatbot and receive the response as it is generated. Function calls are handled as in the regular endpoint; the final message is saved to the chat history when the stream completes."
+    )
+    async def post(self, request):
+        serializer = ChatMessageSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        return event_stream_response(
+            astream_chatbot_message(request.user, serializer.validated_data['msg'])
+        )
+
+
 class ChatHistoryView(APIView):
     """
     Endpoint to retrieve chat history (excluding function calls).
@@ -57,7 +90,7 @@ class ChatHistoryView(APIView):
     )
     def get(self, request):
         agent = get_or_create_chatbot_agent()
-        history = get_agent_history(agent, request.user)
+        history = get_agent_history(agent, request.user, full=True)
         
         # Filter out function calls and format for response
         filtered_history = []
@@ -1,6 +1,6 @@
 from django.contrib import admin
-from .models import Expense
+from .models import Expense, Receipt
 # Register your models here.
 
 admin.site.register(Expense)
-
+admin.site.register(Receipt)
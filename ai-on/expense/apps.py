@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ExpenseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'expense'
+
+    def ready(self):
+        # Declare this app's agents; the agent registry loads them once per process
+        from agents.registry import agent_registry
+        from .services import EXPENSE_AGENT, REPORT_AGENT
+        agent_registry.define(EXPENSE_AGENT)
+        agent_registry.define(REPORT_AGENT)
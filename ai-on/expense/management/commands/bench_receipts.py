@@ -0,0 +1,215 @@
+"""
+Benchmark: receipt preprocessing (expense.receipts) over a receipt corpus.
+
+For each receipt, reports the bytes and pixels received and sent to Gemini,
+the preprocessing time and the image tokens Gemini bills (258 per started
+768px tile, an estimate). With --extract, also times the Expense Manager
+extraction through the configured backend (GEMINI_BACKEND) with the
+original and the preprocessed receipt, alternating which goes first, and
+reports the prompt tokens from usage_metadata.
+
+Without --corpus, a synthetic corpus of phone photos (12MP and 8MP JPEGs,
+half of them stored sideways with an EXIF orientation, a paper receipt on a
+darker table) and e-receipt screenshots (PNG) is generated.
+
+Usage:
+    python manage.py bench_receipts --corpus ~/receipts
+    python manage.py bench_receipts --samples 12 --extract --repeat 3
+"""
+
+import io
+import math
+import random
+import statistics
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from google.genai import types
+from PIL import Image, ImageDraw, ImageOps
+
+from agents.services import agent_registry, generate_content, get_agent_config
+from expense.receipts import preprocess_receipt, sniff_mime_type
+from expense.services import EXPENSE_AGENT, _expense_contents
+
+
+TILE_EDGE = 768
+TILE_TOKENS = 258
+
+BENCH_MESSAGE = "Process this receipt."
+BENCH_BUDGETS = "User's existing budget categories: Groceries, Transport, Dining, Utilities. Try to match these."
+
+
+def _image_tokens(data: bytes, mime_type: str) -> tuple:
+    # ((width, height), estimated image tokens), or (None, None) for PDFs and unreadable files
+    try:
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    except Exception:
+        return None, None
+    width, height = image.size
+    if width <= 384 and height <= 384:
+        return image.size, TILE_TOKENS
+    return image.size, math.ceil(width / TILE_EDGE) * math.ceil(height / TILE_EDGE) * TILE_TOKENS
+
+
+def _receipt_paper(rng: random.Random, width: int, height: int) -> Image.Image:
+    paper = Image.new("RGB", (width, height), (246, 243, 236))
+    draw = ImageDraw.Draw(paper)
+    size = width // 28
+    draw.text((width // 2, size * 2), "SUPERETTE EL AMANE", fill="black", font_size=size * 1.4, anchor="mm")
+    y, total = size * 5, 0
+    while y < height - size * 6:
+        amount = rng.randint(40, 2500)
+        total += amount
+        draw.text((size, y), f"{rng.choice(['LAIT', 'PAIN', 'CAFE', 'HUILE', 'RIZ', 'SUCRE', 'OEUFS'])} x{rng.randint(1, 4)}",
+                  fill=(20, 20, 20), font_size=size)
+        draw.text((width - size, y), f"{amount:,}.00", fill=(20, 20, 20), font_size=size, anchor="ra")
+        y += int(size * 1.6)
+    draw.text((size, height - size * 4), "TOTAL DZD", fill="black", font_size=size * 1.3)
+    draw.text((width - size, height - size * 4), f"{total:,}.00", fill="black", font_size=size * 1.3, anchor="ra")
+    return paper
+
+
+def _synthetic_photo(rng: random.Random, width: int, height: int, sideways: bool) -> bytes:
+    table = ImageOps.colorize(Image.effect_noise((width, height), 45), black=(35, 28, 22), white=(125, 100, 75))
+    paper = _receipt_paper(rng, int(width * rng.uniform(0.4, 0.55)), int(height * rng.uniform(0.6, 0.8)))
+    paper = paper.convert("RGBA").rotate(rng.uniform(-4, 4), expand=True, resample=Image.Resampling.BICUBIC)
+    table.paste(paper, (rng.randint(0, width - paper.width), rng.randint(0, height - paper.height)), paper)
+    exif = Image.Exif()
+    if sideways:
+        # Stored as the sensor saw it; the viewer rotates it back upright
+        table = table.rotate(90, expand=True)
+        exif[0x0112] = 6
+    buffer = io.BytesIO()
+    table.save(buffer, "JPEG", quality=92, exif=exif)
+    return buffer.getvalue()
+
+
+def _synthetic_screenshot(rng: random.Random) -> bytes:
+    buffer = io.BytesIO()
+    _receipt_paper(rng, 1080, 2400).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _synthetic_corpus(samples: int, seed: int) -> list:
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(samples):
+        kind = index % 4
+        if kind == 3:
+            corpus.append((f"screenshot_{index:02d}.png", _synthetic_screenshot(rng)))
+        else:
+            width, height = (3024, 4032) if kind != 2 else (2448, 3264)
+            corpus.append((f"photo_{index:02d}.jpg", _synthetic_photo(rng, width, height, sideways=kind == 0)))
+    return corpus
+
+
+def _load_corpus(directory: str) -> list:
+    corpus = []
+    for path in sorted(Path(directory).expanduser().iterdir()):
+        if path.is_file():
+            data = path.read_bytes()
+            if sniff_mime_type(data[:16]):
+                corpus.append((path.name, data))
+    if not corpus:
+        raise CommandError(f"No images or PDFs found in {directory}")
+    return corpus
+
+
+def _percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = "Measure receipt preprocessing: bytes, pixels and tokens saved, its cost, and (--extract) extraction latency."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--corpus", help="Directory of receipt images/PDFs (default: a synthetic corpus)")
+        parser.add_argument("--samples", type=int, default=8, help="Size of the synthetic corpus")
+        parser.add_argument("--seed", type=int, default=7)
+        parser.add_argument("--extract", action="store_true", help="Also time the extraction call (original vs preprocessed)")
+        parser.add_argument("--repeat", type=int, default=1, help="Extraction calls per receipt and variant")
+
+    def handle(self, *args, **options):
+        if options["corpus"]:
+            corpus = _load_corpus(options["corpus"])
+        else:
+            self.stdout.write(f"Generating {options['samples']} synthetic receipts...")
+            corpus = _synthetic_corpus(options["samples"], options["seed"])
+
+        self.stdout.write(
+            f"max edge {settings.RECEIPT_MAX_EDGE}px, grayscale {settings.RECEIPT_GRAYSCALE}, "
+            f"crop {settings.RECEIPT_CROP}, target {settings.RECEIPT_TARGET_BYTES // 1000} KB\n"
+            f"{'receipt':<20}{'in KB':>9}{'out KB':>9}{'saved':>7}{'in px':>12}{'out px':>12}"
+            f"{'ms':>7}{'~tok in':>9}{'~tok out':>10}"
+        )
+        rows = []
+        for name, data in corpus:
+            mime_type = sniff_mime_type(data[:16])
+            started = time.perf_counter()
+            processed, processed_type = preprocess_receipt(data, mime_type)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            size_in, tokens_in = _image_tokens(data, mime_type)
+            size_out, tokens_out = _image_tokens(processed, processed_type)
+            rows.append((name, data, mime_type, processed, processed_type, elapsed_ms, tokens_in, tokens_out))
+
+            pixels = lambda size: f"{size[0]}x{size[1]}" if size else "-"
+            self.stdout.write(
+                f"{name:<20}{len(data) / 1000:>9.0f}{len(processed) / 1000:>9.0f}"
+                f"{1 - len(processed) / len(data):>7.0%}{pixels(size_in):>12}{pixels(size_out):>12}"
+                f"{elapsed_ms:>7.0f}{tokens_in or '-':>9}{tokens_out or '-':>10}"
+            )
+
+        bytes_in = sum(len(row[1]) for row in rows)
+        bytes_out = sum(len(row[3]) for row in rows)
+        timings = [row[5] for row in rows]
+        tokens_in = sum(row[6] or 0 for row in rows)
+        tokens_out = sum(row[7] or 0 for row in rows)
+        self.stdout.write(self.style.SUCCESS(
+            f"Bytes: {bytes_in / 1e6:.1f} MB -> {bytes_out / 1e6:.1f} MB ({1 - bytes_out / bytes_in:.0%} saved); "
+            f"image tokens ~{tokens_in} -> ~{tokens_out}; preprocessing mean {statistics.mean(timings):.0f} ms, "
+            f"p95 {_percentile(timings, 95):.0f} ms"
+        ))
+
+        if options["extract"]:
+            self._bench_extraction(rows, options["repeat"])
+
+    def _bench_extraction(self, rows: list, repeat: int):
+        agent = agent_registry.get(EXPENSE_AGENT.name).agent
+        config = get_agent_config(agent)
+        budgets = types.Part.from_text(text=BENCH_BUDGETS)
+        latencies = {"original": [], "preprocessed": []}
+        prompt_tokens = {"original": [], "preprocessed": []}
+
+        def extract(variant: str, data: bytes, mime_type: str):
+            contents = _expense_contents(BENCH_MESSAGE, types.Part.from_bytes(data=data, mime_type=mime_type), budgets)
+            started = time.perf_counter()
+            response = generate_content(agent, contents, config, cache_ttl=0)
+            latencies[variant].append((time.perf_counter() - started) * 1000)
+            usage = response.usage_metadata
+            if usage and usage.prompt_token_count:
+                prompt_tokens[variant].append(usage.prompt_token_count)
+
+        self.stdout.write(f"Extraction through the '{settings.GEMINI_BACKEND}' backend, {repeat} call(s) per variant...")
+        for index, (name, data, mime_type, processed, processed_type, *_) in enumerate(rows):
+            variants = [("original", data, mime_type), ("preprocessed", processed, processed_type)]
+            for attempt in range(repeat):
+                # Alternate the order so warm connections favour neither variant
+                for variant in (variants if (index + attempt) % 2 == 0 else variants[::-1]):
+                    extract(*variant)
+
+        self.stdout.write(f"{'variant':<14}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'prompt tok':>12}")
+        for variant, samples in latencies.items():
+            tokens = f"{statistics.mean(prompt_tokens[variant]):.0f}" if prompt_tokens[variant] else "-"
+            self.stdout.write(
+                f"{variant:<14}{statistics.mean(samples):>10.0f}{_percentile(samples, 50):>10.0f}"
+                f"{_percentile(samples, 95):>10.0f}{tokens:>12}"
+            )
+        original, preprocessed = statistics.mean(latencies["original"]), statistics.mean(latencies["preprocessed"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Extraction latency {original:.0f} ms -> {preprocessed:.0f} ms ({preprocessed / original - 1:+.0%}), "
+            f"preprocessing included in neither (see the table above)"
+        ))
@@ -2,9 +2,38 @@ from django.db import models
 from django.contrib.auth.models import User
 from budget.models import Budget
 
+class Receipt(models.Model):
+    """
+    A receipt file the Expense Manager extracted, addressed by its content
+    (see expense.receipts.read_receipt): uploading it again reuses the
+    extraction instead of booking its expenses twice.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='receipts')
+    name = models.CharField(max_length=255, blank=True, default="")
+    # SHA-256 of the uploaded bytes
+    sha256 = models.CharField(max_length=64)
+    # 64-bit difference hash (hex) and width / height of the image sent to
+    # Gemini; empty for PDFs and HEIC
+    phash = models.CharField(max_length=16, blank=True, default="")
+    aspect = models.FloatField(null=True, blank=True)
+    # The expenses the model extracted (category, product_name, amount, description)
+    extraction = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'sha256'], name='receipt_sha256_idx'),
+            # Perceptual hash candidates: the user's recent receipts
+            models.Index(fields=['user', 'created_at'], name='receipt_recent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name or 'Receipt'} ({self.sha256[:12]})"
+
 class Expense(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='expenses')
     budget = models.ForeignKey(Budget, on_delete=models.SET_NULL, null=True, blank=True, related_name='expenses')
+    receipt = models.ForeignKey(Receipt, on_delete=models.SET_NULL, null=True, blank=True, related_name='expenses')
     product_name = models.CharField(max_length=255)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.TextField(blank=True, null=True)
@@ -0,0 +1,310 @@
+"""
+Text Expense Parser
+
+Books simple text expenses ("I spent 500 on coffee", "taxi 300 DA",
+"j'ai payé 1 200 DA pour le pain") without asking the Expense Manager.
+parse_expense() pulls out the amount, the product and the budget with
+precompiled patterns, and only says yes when nothing is ambiguous:
+
+- exactly one number in the message, of EXPENSE_RULES_MIN_AMOUNT to
+  EXPENSE_RULES_MAX_AMOUNT DZD: "1 500", "1.500", "1,500", "1500,50", "2.5k"
+- the number marked as DZD (DA, DZD, dinars, دج), or right after a spend
+  verb ("spent 500", "paid 300"); even then not a count or a time: a bare
+  number before a plural ("bought 2 pizzas", "2 people") or after at / for
+  ("lunch at 12", "taxi for 2") is left to the model
+- no foreign currency, and none of the colloquial scales amounts are often
+  spoken in (alf / mille, centimes, melyoun: "20 alf" may well be 200 DA)
+- none of the words that make the message something else than one expense
+  already paid (budget, salary, refund, will, how, ...), no question
+- a product of 1 to MAX_PRODUCT_WORDS words once the verb, the amount and
+  the small words around them are taken off
+- exactly one of the user's budgets: named in the message, or the only one
+  titled like the category of a word it knows (coffee: Food / Dining,
+  taxi: Transport, pain: Groceries, then Food, ...)
+
+Anything else comes back with the reason it was passed on, and the message
+goes to the model as before.
+"""
+
+import re
+import unicodedata
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+
+
+HIT = "hit"
+
+MAX_PRODUCT_WORDS = 4
+
+_CURRENCY = r"(?:dzd|da|dinars?|دج|د\.ج|دينار)"
+
+# One amount with its DZD currency, if any: 500, 1 500, 1.500,50, 12,000.00,
+# 1500,50, 2.5k, DA 500, 500da, 500 دج
+_AMOUNT = re.compile(
+    r"(?<![\w.,])"
+    rf"(?:(?P<before>{_CURRENCY})\s*)?"
+    r"(?P<number>\d{1,3}(?:[ ,.]\d{3})+|\d+)(?:[.,](?P<cents>\d{1,2}))?(?P<thousands>k)?"
+    rf"(?:\s*(?P<after>{_CURRENCY}))?"
+    r"(?!\w)",
+    re.IGNORECASE,
+)
+_DIGIT = re.compile(r"\d")
+# Words, with French elisions (j', d', l') split off as their own word
+_WORD = re.compile(r"aujourd['’]hui|[^\W\d_]+['’]?")
+_SPACES = re.compile(r"\s+")
+
+_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹", "01234567890123456789")
+
+FOREIGN_CURRENCY = frozenset({
+    "eur", "euro", "euros", "usd", "dollar", "dollars", "gbp",
+    "mad", "dirham", "dirhams", "tnd", "tunisian", "tunisien", "tunisiens",
+})
+SCALE_WORDS = frozenset({
+    "alf", "alef", "alaf", "mille", "milles", "mil", "centime", "centimes", "cts",
+    "million", "millions", "melyoun", "mlayen", "ألف", "الف", "مليون", "ملايين", "سنتيم",
+})
+NOT_AN_EXPENSE = frozenset({
+    "budget", "budgets", "limit", "limite", "income", "salary", "salaire", "revenu", "received", "recu",
+    "earned", "gagne", "refund", "refunded", "rembourse", "remboursement", "owe", "owes", "lent",
+    "lend", "prete", "borrowed", "emprunte", "debt", "dette", "delete", "remove", "supprimer", "supprime",
+    "cancel", "annuler", "undo", "change", "modifier", "edit", "update", "how", "combien", "what", "why",
+    "quoi", "pourquoi", "when", "quand", "report", "rapport", "not", "pas", "never", "jamais", "don'",
+    "didn'", "n'", "will", "vais", "going", "plan", "planning", "want", "veux", "should", "could",
+    "would", "if", "si", "save", "saving", "economiser", "transfer", "virement", "split", "each", "per",
+    "every", "chaque", "monthly", "weekly", "daily", "mensuel",
+})
+# Verbs that make a bare number right after them the amount paid
+SPEND_VERBS = frozenset({
+    "spent", "spend", "paid", "pay", "bought", "purchased", "cost", "costs", "paye", "payee", "depense",
+    "achete", "dfa3t", "khlast", "khalast",
+})
+# A bare number right after these is a time or a count
+COUNT_BEFORE = frozenset({"at", "for", "a", "pour", "vers", "around", "about", "environ"})
+# Counted nouns that don't end in s
+COUNT_NOUNS = frozenset({"people", "person", "persons", "x", "kg", "kilo", "kilos", "l", "litre", "litres", "fois", "times"})
+# Taken off both ends of what is left once the amount is removed
+EDGE_WORDS = frozenset({
+    "i", "i'", "ve", "have", "just", "the", "user", "today", "yesterday", "tonight", "this", "morning",
+    "evening", "spent", "spend", "paid", "pay", "bought", "buy", "purchased", "got", "track", "log",
+    "add", "record", "expense", "expenses", "an", "a", "my", "some", "of", "on", "for", "at", "in", "to",
+    "with", "from", "j'", "ai", "je", "juste", "depense", "depenses", "paye", "achete", "un", "une",
+    "le", "la", "les", "l'", "du", "de", "des", "d'", "pour", "sur", "chez", "au", "aux", "a", "en",
+    "avec", "aujourd'hui", "hier", "ce", "matin", "soir", "dzd", "da", "dinar", "dinars", "دج", "دينار",
+})
+# Title words too common to name a budget
+TITLE_STOPWORDS = frozenset({"and", "et", "the", "les", "des", "for", "pour", "other", "autres"})
+
+# Category words, and the budget titles they go to (tried in order: a
+# further tier is only used when the user has no budget of the previous one)
+CATEGORIES = {
+    "food": {
+        "words": {
+            "coffee", "cafe", "tea", "lunch", "dinner", "breakfast", "dejeuner", "restaurant", "resto",
+            "pizza", "sandwich", "burger", "kebab", "shawarma", "chawarma", "tacos", "snack", "croissant",
+            "juice", "jus", "soda", "coca", "pepsi", "kahwa", "qahwa", "قهوة", "مطعم",
+        },
+        "titles": [{
+            "food", "dining", "restaurant", "restaurants", "restauration", "eating", "meals", "repas",
+            "alimentation", "nourriture", "cafe",
+        }],
+    },
+    "groceries": {
+        "words": {
+            "bread", "pain", "khobz", "milk", "lait", "hlib", "egg", "eggs", "oeuf", "oeufs", "vegetables",
+            "legumes", "fruit", "fruits", "meat", "viande", "chicken", "poulet", "fish", "poisson", "rice",
+            "riz", "sugar", "sucre", "oil", "huile", "semoule", "couscous", "pasta", "pates", "flour",
+            "farine", "cheese", "fromage", "yogurt", "yaourt", "butter", "beurre", "groceries", "grocery",
+            "courses", "supermarket", "superette", "supermarche", "epicerie", "market", "marche",
+            "tomatoes", "tomates", "potatoes", "patates", "onions", "oignons", "خبز", "حليب",
+        },
+        "titles": [
+            {"groceries", "grocery", "courses", "supermarket", "epicerie", "provisions", "market"},
+            {"food", "alimentation", "nourriture"},
+        ],
+    },
+    "transport": {
+        "words": {
+            "taxi", "bus", "tram", "tramway", "metro", "train", "fuel", "petrol", "essence", "gasoil",
+            "diesel", "mazout", "carburant", "parking", "uber", "yassir", "heetch", "toll", "peage", "fare",
+            "navette", "تاكسي", "بنزين",
+        },
+        "titles": [{
+            "transport", "transportation", "travel", "commute", "fuel", "car", "voiture", "carburant",
+            "deplacement", "deplacements",
+        }],
+    },
+    "utilities": {
+        "words": {
+            "electricity", "electricite", "sonelgaz", "internet", "wifi", "adsl", "idoom", "fibre", "phone",
+            "telephone", "mobilis", "djezzy", "ooredoo", "recharge", "flexy", "bill", "facture", "كهرباء",
+        },
+        "titles": [{"utilities", "utility", "bills", "bill", "factures", "charges", "internet", "phone", "telephone"}],
+    },
+    "health": {
+        "words": {
+            "pharmacy", "pharmacie", "medicine", "medicines", "medicament", "medicaments", "doctor", "medecin",
+            "dentist", "dentiste", "clinic", "clinique", "hospital", "hopital", "analyses", "دواء", "صيدلية",
+        },
+        "titles": [{"health", "healthcare", "medical", "sante", "pharmacy", "pharmacie"}],
+    },
+    "entertainment": {
+        "words": {"cinema", "movie", "movies", "film", "netflix", "spotify", "concert", "game", "games", "jeux", "theatre", "theater"},
+        "titles": [{"entertainment", "leisure", "loisirs", "fun", "divertissement", "sorties"}],
+    },
+    "shopping": {
+        "words": {
+            "clothes", "clothing", "shirt", "shoes", "sneakers", "jeans", "pants", "dress", "jacket",
+            "vetements", "chaussures", "robe", "pantalon", "veste",
+        },
+        "titles": [{"shopping", "clothes", "clothing", "vetements", "habillement"}],
+    },
+    "rent": {
+        "words": {"rent", "loyer", "كراء"},
+        "titles": [{"rent", "housing", "loyer", "logement", "home", "house"}],
+    },
+    "education": {
+        "words": {"books", "book", "livre", "tuition", "school", "ecole", "fournitures", "university", "universite"},
+        "titles": [{"education", "school", "ecole", "etudes", "studies", "books"}],
+    },
+}
+
+
+class ParsedExpense:
+    """
+    What parse_expense() made of a message: outcome is HIT, or why it
+    needs the model.
+    """
+    __slots__ = ("outcome", "amount", "product", "budget_id")
+
+    def __init__(self, outcome: str, amount: Decimal = None, product: str = None, budget_id: int = None):
+        self.outcome = outcome
+        self.amount = amount
+        self.product = product
+        self.budget_id = budget_id
+
+    @property
+    def hit(self) -> bool:
+        return self.outcome == HIT
+
+
+def _fold(text: str) -> str:
+    # Lower case without accents: "Café" and "cafe" are the same word
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).replace("’", "'")
+
+
+def _variants(words: set) -> set:
+    # The words with their singular, the rough way
+    return words | {word[:-1] for word in words if len(word) > 3 and word.endswith("s")}
+
+
+def _amount(match: re.Match) -> Decimal | None:
+    number = re.sub(r"[ ,.]", "", match.group("number"))
+    cents = match.group("cents")
+    try:
+        amount = Decimal(f"{number}.{cents}" if cents else number)
+    except InvalidOperation:
+        return None
+    if match.group("thousands"):
+        amount *= 1000
+    return amount
+
+
+def _bare_amount(text: str, match: re.Match) -> bool:
+    # Whether a number without a currency is the amount paid, not a count or a time
+    before = _WORD.findall(_fold(text[:match.start()]))
+    after = _WORD.findall(_fold(text[match.end():]))
+    previous = before[-1] if before else None
+    following = after[0] if after else ""
+    if previous in COUNT_BEFORE:
+        return False
+    if not match.group("thousands") and (following in COUNT_NOUNS or (len(following) > 3 and following.endswith("s"))):
+        return False
+    return previous in SPEND_VERBS
+
+
+def _title_words(title: str) -> set:
+    return {word for word in _variants({_fold(w) for w in _WORD.findall(title)})
+            if len(word) >= 3 and word not in TITLE_STOPWORDS}
+
+
+def _resolve_budget(words: set, budgets: list) -> tuple[str, int | None]:
+    """
+    (outcome, budget id) of the budget a message's words point to.
+    """
+    titles = [(budget_id, _title_words(title)) for budget_id, title in budgets]
+
+    named = {budget_id for budget_id, title_words in titles if title_words & words}
+    if len(named) == 1:
+        return HIT, named.pop()
+    if named:
+        return "several_budgets", None
+
+    categories = [category for category in CATEGORIES.values() if category["words"] & words]
+    if len(categories) > 1:
+        return "several_categories", None
+    for tier in categories[0]["titles"] if categories else ():
+        candidates = {budget_id for budget_id, title_words in titles if title_words & tier}
+        if len(candidates) == 1:
+            return HIT, candidates.pop()
+        if candidates:
+            return "several_budgets", None
+    return "no_budget", None
+
+
+def parse_expense(message: str, budgets: list) -> ParsedExpense:
+    """
+    Parse a one-expense text message without the model.
+
+    Args:
+        message: The expense as typed ("I spent 500 on coffee")
+        budgets: The user's budgets, as (id, title)
+
+    Returns:
+        The ParsedExpense: amount (DZD), product and budget id on a hit
+    """
+    text = message.translate(_DIGITS).replace("\u00a0", " ").replace("\u202f", " ").strip()
+    folded = _fold(text)
+    words = _WORD.findall(folded)
+    if not words or len(words) > settings.EXPENSE_RULES_MAX_WORDS:
+        return ParsedExpense("long" if words else "no_product")
+
+    word_set = set(words)
+    if word_set & FOREIGN_CURRENCY or any(symbol in text for symbol in "€$£"):
+        return ParsedExpense("currency")
+    if word_set & SCALE_WORDS:
+        return ParsedExpense("scale")
+    if word_set & NOT_AN_EXPENSE or "?" in text or "%" in text:
+        return ParsedExpense("not_expense")
+
+    matches = list(_AMOUNT.finditer(text))
+    if not matches:
+        return ParsedExpense("no_amount")
+    if len(matches) > 1:
+        return ParsedExpense("several_amounts")
+    match = matches[0]
+    rest = f"{text[:match.start()]} {text[match.end():]}"
+    if _DIGIT.search(rest):
+        return ParsedExpense("several_amounts")
+    amount = _amount(match)
+    if amount is None or not settings.EXPENSE_RULES_MIN_AMOUNT <= amount <= settings.EXPENSE_RULES_MAX_AMOUNT:
+        return ParsedExpense("no_amount")
+    if not (match.group("before") or match.group("after")) and not _bare_amount(text, match):
+        return ParsedExpense("bare_number")
+
+    spans = [(found.start(), found.end(), _fold(found.group())) for found in _WORD.finditer(rest)]
+    while spans and spans[0][2] in EDGE_WORDS:
+        spans.pop(0)
+    while spans and spans[-1][2] in EDGE_WORDS:
+        spans.pop()
+    if not spans:
+        return ParsedExpense("no_product")
+    if len(spans) > MAX_PRODUCT_WORDS:
+        return ParsedExpense("long")
+    product = _SPACES.sub(" ", rest[spans[0][0]:spans[-1][1]])
+
+    outcome, budget_id = _resolve_budget(_variants(word_set), budgets)
+    if outcome != HIT:
+        return ParsedExpense(outcome, amount, product)
+    return ParsedExpense(HIT, amount, product[:1].upper() + product[1:], budget_id)
@@ -0,0 +1,324 @@
+"""
+Receipt Uploads
+
+Turns an uploaded receipt into the inline Gemini Part sent to the Expense
+Manager, without staging it in default_storage:
+
+- Django keeps uploads up to FILE_UPLOAD_MAX_MEMORY_SIZE in memory and
+  spools larger ones to a temporary file it deletes with the request
+- the upload is read once, into the bytes the Part carries (types.Blob only
+  takes bytes; for an in-memory upload that's the BytesIO buffer itself,
+  not a copy)
+- the MIME type is sniffed from the leading bytes, not from the file name
+- photos (JPEG, PNG, WEBP) are then shrunk by preprocess_receipt(): EXIF
+  orientation applied, cropped to the paper, grayscale, downscaled to
+  RECEIPT_MAX_EDGE and recompressed as JPEG (quality lowered from
+  RECEIPT_JPEG_QUALITY towards RECEIPT_MIN_JPEG_QUALITY until it fits
+  RECEIPT_TARGET_BYTES). PDFs, HEIC and images that wouldn't get smaller
+  are sent as they are.
+
+read_receipt() also fingerprints the upload for the receipt store
+(expense.models.Receipt): SHA-256 of the uploaded bytes, and a perceptual
+hash of the preprocessed image, which stays within a few bits when a photo
+is resent through a messaging app (recompressed, downscaled) or the same
+paper is photographed again.
+
+Preprocessing time and bytes received/sent are exported as
+receipt_preprocess_seconds and receipt_bytes_total;
+`python manage.py bench_receipts` measures a receipt corpus.
+"""
+
+import hashlib
+import io
+import logging
+import math
+import time
+
+from django.conf import settings
+from google.genai import types
+from PIL import Image, ImageFilter, ImageOps
+
+from agents.metrics import observe_receipt
+from agents.tracing import finish_span, start_span
+
+
+logger = logging.getLogger(__name__)
+
+
+# Leading bytes needed by sniff_mime_type()
+SNIFF_BYTES = 16
+
+# ISO-BMFF brands of HEIC / HEIF images (bytes 8-12, after "ftyp")
+HEIC_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"hevm", b"hevs")
+HEIF_BRANDS = (b"mif1", b"msf1")
+
+# Formats preprocess_receipt() re-encodes (Pillow can't read HEIC without a plugin)
+PREPROCESSED_TYPES = ("image/jpeg", "image/png", "image/webp")
+
+# Long edge of the thumbnail the paper is looked for in
+CROP_PROBE_EDGE = 256
+# Crops keeping more than this share of the photo aren't worth it, and
+# boxes under the minimum share are more likely glare than paper
+CROP_MAX_AREA = 0.9
+CROP_MIN_AREA = 0.15
+CROP_MARGIN = 0.02
+
+# perceptual_hash() compares HASH_SIZE + 1 columns on HASH_SIZE rows (64 bits)
+HASH_SIZE = 8
+
+
+class UnsupportedReceipt(ValueError):
+    """The upload isn't an image or PDF Gemini can read."""
+
+
+def sniff_mime_type(head: bytes) -> str | None:
+    """
+    MIME type of a receipt from its first SNIFF_BYTES bytes.
+
+    Returns:
+        application/pdf, image/jpeg, image/png, image/webp, image/heic,
+        image/heif, or None for anything else
+    """
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp":
+        if head[8:12] in HEIC_BRANDS:
+            return "image/heic"
+        if head[8:12] in HEIF_BRANDS:
+            return "image/heif"
+    return None
+
+
+def sniff_upload(upload) -> str | None:
+    """
+    sniff_mime_type() of an uploaded file, leaving it at position 0.
+    """
+    upload.seek(0)
+    head = upload.read(SNIFF_BYTES)
+    upload.seek(0)
+    return sniff_mime_type(head)
+
+
+def _read_all(upload) -> bytes:
+    buffer = getattr(upload, "file", None)
+    if isinstance(buffer, io.BytesIO):
+        # Shares the buffer instead of copying it
+        return buffer.getvalue()
+    upload.seek(0)
+    return upload.read()
+
+
+def _otsu_threshold(histogram: list) -> int:
+    # Gray level that best separates the histogram into dark and bright pixels
+    total = sum(histogram)
+    weighted_total = sum(level * count for level, count in enumerate(histogram))
+    dark_count = dark_weighted = 0
+    best_level, best_variance = 0, 0.0
+    for level, count in enumerate(histogram):
+        dark_count += count
+        bright_count = total - dark_count
+        if not dark_count:
+            continue
+        if not bright_count:
+            break
+        dark_weighted += level * count
+        dark_mean = dark_weighted / dark_count
+        bright_mean = (weighted_total - dark_weighted) / bright_count
+        variance = dark_count * bright_count * (dark_mean - bright_mean) ** 2
+        if variance > best_variance:
+            best_level, best_variance = level, variance
+    return best_level
+
+
+def _document_box(image: Image.Image) -> tuple | None:
+    """
+    Bounding box of the (bright) paper on a darker background, or None.
+    """
+    factor = max(1, max(image.size) // CROP_PROBE_EDGE)
+    probe = image.convert("L").reduce(factor)
+    threshold = _otsu_threshold(probe.histogram())
+    # Eroded so specks and thin reflections don't stretch the box
+    mask = probe.point(lambda level: 255 if level > threshold else 0).filter(ImageFilter.MinFilter(5))
+    box = mask.getbbox()
+    if box is None:
+        return None
+    left, top, right, bottom = box
+    area = (right - left) * (bottom - top) / (probe.width * probe.height)
+    if not CROP_MIN_AREA <= area <= CROP_MAX_AREA:
+        return None
+    margin = CROP_MARGIN * max(probe.size)
+    scale_x, scale_y = image.width / probe.width, image.height / probe.height
+    return (
+        max(0, int((left - margin) * scale_x)),
+        max(0, int((top - margin) * scale_y)),
+        min(image.width, math.ceil((right + margin) * scale_x)),
+        min(image.height, math.ceil((bottom + margin) * scale_y)),
+    )
+
+
+def _encode(image: Image.Image) -> bytes:
+    quality = settings.RECEIPT_JPEG_QUALITY
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality, optimize=True)
+        if buffer.tell() <= settings.RECEIPT_TARGET_BYTES or quality <= settings.RECEIPT_MIN_JPEG_QUALITY:
+            return buffer.getvalue()
+        quality = max(quality - 10, settings.RECEIPT_MIN_JPEG_QUALITY)
+
+
+def _scale_box(box: tuple, source: Image.Image, target: Image.Image) -> tuple:
+    scale_x, scale_y = target.width / source.width, target.height / source.height
+    left, top, right, bottom = box
+    return (int(left * scale_x), int(top * scale_y),
+            min(target.width, math.ceil(right * scale_x)), min(target.height, math.ceil(bottom * scale_y)))
+
+
+def _shrink(data: bytes) -> bytes | None:
+    # The recompressed receipt, or None when it is already small enough
+    max_edge = settings.RECEIPT_MAX_EDGE
+    mode = "L" if settings.RECEIPT_GRAYSCALE else "RGB"
+    image = Image.open(io.BytesIO(data))
+    if len(data) <= settings.RECEIPT_TARGET_BYTES and max(image.size) <= max_edge:
+        return None
+
+    box = None
+    if image.format == "JPEG":
+        # The paper is found on a 1/8 scale decode; the full decode is then
+        # scaled down by the JPEG decoder (1/2, 1/4 or 1/8) as far as the
+        # cropped region's long edge stays >= max_edge
+        probe = Image.open(io.BytesIO(data))
+        probe.draft("L", (math.ceil(probe.width / 8), math.ceil(probe.height / 8)))
+        probe = ImageOps.exif_transpose(probe)
+        box = _document_box(probe) if settings.RECEIPT_CROP else None
+        left, top, right, bottom = box or (0, 0, probe.width, probe.height)
+        region = max(right - left, bottom - top) * max(image.size) / max(probe.size)
+        if region > max_edge:
+            ratio = max_edge / region
+            image.draft(mode, (math.ceil(image.width * ratio), math.ceil(image.height * ratio)))
+        image = ImageOps.exif_transpose(image)
+        if box is not None:
+            box = _scale_box(box, probe, image)
+    else:
+        image = ImageOps.exif_transpose(image)
+        box = _document_box(image) if settings.RECEIPT_CROP else None
+
+    image = image.convert(mode)
+    if box is not None:
+        image = image.crop(box)
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge))
+    return _encode(image)
+
+
+def preprocess_receipt(data: bytes, mime_type: str) -> tuple[bytes, str]:
+    """
+    Shrink a receipt photo before it is sent to Gemini.
+
+    Args:
+        data: The uploaded bytes
+        mime_type: Their sniffed MIME type
+
+    Returns:
+        (data, mime_type) to send: a recompressed JPEG, or the input when
+        preprocessing is off, doesn't apply, fails or wouldn't save bytes
+    """
+    if not settings.RECEIPT_PREPROCESS_ENABLED or mime_type not in PREPROCESSED_TYPES:
+        return data, mime_type
+
+    span = start_span("receipt_preprocess", "internal", mime_type=mime_type, bytes_in=len(data))
+    started = time.perf_counter()
+    try:
+        processed = _shrink(data)
+    except Exception as e:
+        # Corrupt, truncated or oversized (decompression bomb) images: Gemini gets the original
+        logger.warning("Receipt preprocessing failed, sending the original: %s", e)
+        observe_receipt(time.perf_counter() - started, "failed", len(data), len(data))
+        finish_span(span, failed=type(e).__name__)
+        return data, mime_type
+
+    seconds = time.perf_counter() - started
+    if processed is None or len(processed) >= len(data):
+        observe_receipt(seconds, "kept", len(data), len(data))
+        finish_span(span, bytes_out=len(data))
+        return data, mime_type
+    observe_receipt(seconds, "shrunk", len(data), len(processed))
+    finish_span(span, bytes_out=len(processed))
+    logger.debug("Receipt shrunk from %d to %d bytes in %.0fms", len(data), len(processed), seconds * 1000)
+    return processed, "image/jpeg"
+
+
+def perceptual_hash(data: bytes) -> tuple[int, float] | None:
+    """
+    64-bit difference hash of an image, and its aspect ratio (width / height).
+
+    Computed on the image sent to Gemini (cropped to the paper, grayscale),
+    so a resent, recompressed or downscaled copy of a photo lands a few bits
+    from the original. Receipts printed from the same template can land as
+    close: a match is a reason to ask, not proof.
+
+    Returns:
+        (hash, aspect), or None when the image can't be read
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.format == "JPEG":
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+        image = ImageOps.exif_transpose(image).convert("L")
+        aspect = image.width / image.height
+        pixels = image.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX).tobytes()
+    except Exception as e:
+        logger.warning("Receipt perceptual hash failed: %s", e)
+        return None
+
+    bits = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for column in range(HASH_SIZE):
+            bits = bits << 1 | (pixels[offset + column] > pixels[offset + column + 1])
+    return bits, aspect
+
+
+class ReceiptFile:
+    """
+    An uploaded receipt, read: the Part sent to Gemini and the fingerprints
+    the receipt store (expense.models.Receipt) is searched by.
+    """
+    __slots__ = ("name", "part", "sha256", "phash", "aspect")
+
+    def __init__(self, name: str, part: types.Part, sha256: str, phash: int = None, aspect: float = None):
+        self.name = name
+        self.part = part
+        self.sha256 = sha256
+        self.phash = phash
+        self.aspect = aspect
+
+    @property
+    def phash_hex(self) -> str:
+        return "" if self.phash is None else f"{self.phash:016x}"
+
+
+def read_receipt(upload) -> ReceiptFile:
+    """
+    Read an uploaded receipt (a Django UploadedFile, or any binary file
+    object): SHA-256 of the uploaded bytes, then an inline Part
+    preprocessed by preprocess_receipt() and the perceptual_hash() of
+    what it carries (none for PDFs and HEIC).
+
+    Raises:
+        UnsupportedReceipt: the content isn't a supported image or a PDF
+    """
+    name = getattr(upload, "name", None) or ""
+    mime_type = sniff_upload(upload)
+    if mime_type is None:
+        raise UnsupportedReceipt(f"{name or 'The file'} is not a JPEG, PNG, WEBP, HEIC image or a PDF")
+    data = _read_all(upload)
+    sha256 = hashlib.sha256(data).hexdigest()
+    data, mime_type = preprocess_receipt(data, mime_type)
+    fingerprint = perceptual_hash(data) if mime_type in PREPROCESSED_TYPES else None
+    return ReceiptFile(name, types.Part.from_bytes(data=data, mime_type=mime_type), sha256, *(fingerprint or ()))
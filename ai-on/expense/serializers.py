@@ -18,3 +18,24 @@ class ExpenseUploadSerializer(serializers.Serializer):
         required=False,
         help_text="Receipt image (JPEG, PNG) or PDF. AI will extract expense details from the file."
     )
+    allow_duplicate = serializers.BooleanField(
+        required=False,
+        default=False,
+        help_text="Record the receipt even if it was uploaded before (an exact copy reuses the earlier extraction)."
+    )
+
+class ExpenseBatchUploadSerializer(serializers.Serializer):
+    files = serializers.ListField(
+        child=serializers.FileField(),
+        help_text="Receipt images (JPEG, PNG) and PDFs. Each file is extracted separately."
+    )
+    message = serializers.CharField(
+        required=False,
+        default='Process this receipt.',
+        help_text="Instruction sent with each receipt."
+    )
+    allow_duplicate = serializers.BooleanField(
+        required=False,
+        default=False,
+        help_text="Record receipts even if they were uploaded before or repeat in the batch."
+    )
@@ -1,18 +1,44 @@
+import asyncio
 import json
+import logging
 import os
+import time
+from contextlib import aclosing
 from django.contrib.auth.models import User
 from django.conf import settings
-from .models import Expense
+from django.db import transaction
+from django.utils import timezone
+from .models import Expense, Receipt
+from .parsing import parse_expense
+from .receipts import ReceiptFile, read_receipt
 from budget.models import Budget
 from agents.models import agentModel
-from agents.services import get_agent_history, add_to_history
-from google import genai
+from agents.services import (
+    get_agent_history,
+    add_to_history,
+    generate_content,
+    agenerate_content,
+    agenerate_content_stream,
+    chunk_text,
+    get_agent_config,
+    AgentDefinition,
+    agent_registry,
+    trace_agent,
+    payload,
+    llm_priority,
+    BACKGROUND,
+    MODEL_ERRORS,
+    unavailable_result
+)
+from agents.metrics import observe_expense_rules, observe_receipt_duplicate, observe_text_expense
+from asgiref.sync import sync_to_async
 from google.genai import types
-from decouple import config
-from decimal import Decimal
-from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from datetime import datetime, timedelta
+
+
+logger = logging.getLogger(__name__)
 
-API_KEY = config('GEMINI_API_KEY')
 
 EXPENSE_MANAGER_SYSTEM_INSTRUCTION = """
 IDENTITY
@@ -54,169 +80,219 @@ OUTPUT FORMAT
 Return the report in Markdown.
 """
 
-def get_or_create_expense_agent() -> agentModel:
-    agent, created = agentModel.objects.get_or_create(
-        name="expense_manager",
-        defaults={
-            "description": "Agent that manages expenses and extracts info from receipts",
-            "system_instruction": EXPENSE_MANAGER_SYSTEM_INSTRUCTION,
-            "gemini_model": "gemini-2.5-flash",
-            "thinking_budget": 0
-        }
+def _expense_config(agent: agentModel, functions: dict = None) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        system_instruction=agent.system_instruction
     )
-    if not created and agent.gemini_model != "gemini-2.5-flash":
-        agent.gemini_model = "gemini-2.5-flash"
-        agent.save()
-    return agent
 
-def get_or_create_report_agent() -> agentModel:
-    agent, created = agentModel.objects.get_or_create(
-        name="report_agent",
-        defaults={
-            "description": "Agent that generates financial reports",
-            "system_instruction": REPORT_AGENT_SYSTEM_INSTRUCTION,
-            "gemini_model": "gemini-2.5-flash",
-            "thinking_budget": 0
-        }
+
+def _report_config(agent: agentModel, functions: dict = None) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        system_instruction=agent.system_instruction
     )
-    if not created and agent.gemini_model != "gemini-2.5-flash":
-        agent.gemini_model = "gemini-2.5-flash"
-        agent.save()
-    return agent
 
-def process_expense_management(user: User, message: str, file_path: str = None, manual_data: dict = None) -> dict:
+
+EXPENSE_AGENT = AgentDefinition(
+    name="expense_manager",
+    description="Agent that manages expenses and extracts info from receipts",
+    system_instruction=EXPENSE_MANAGER_SYSTEM_INSTRUCTION,
+    gemini_model="gemini-2.5-flash",
+    thinking_budget=0,
+    config=_expense_config
+)
+
+REPORT_AGENT = AgentDefinition(
+    name="report_agent",
+    description="Agent that generates financial reports",
+    system_instruction=REPORT_AGENT_SYSTEM_INSTRUCTION,
+    gemini_model="gemini-2.5-flash",
+    thinking_budget=0,
+    config=_report_config
+)
+
+
+def get_or_create_expense_agent() -> agentModel:
     """
-    Process an expense request.
-    The message might contain a file path if it came from an API upload,
-    or the message string itself might contain info.
-    If manual_data is provided (amount, product_name), it bypasses AI extraction.
+    Get the expense agent from the agent registry (no DB query once loaded).
+    """
+    return agent_registry.get(EXPENSE_AGENT.name).agent
+
+
+async def aget_or_create_expense_agent() -> agentModel:
+    """
+    Async version of get_or_create_expense_agent().
+    """
+    return (await agent_registry.aget(EXPENSE_AGENT.name)).agent
+
+
+def get_or_create_report_agent() -> agentModel:
+    """
+    Get the report agent from the agent registry (no DB query once loaded).
+    """
+    return agent_registry.get(REPORT_AGENT.name).agent
+
+
+async def aget_or_create_report_agent() -> agentModel:
+    """
+    Async version of get_or_create_report_agent().
+    """
+    return (await agent_registry.aget(REPORT_AGENT.name)).agent
+
+
+def _manual_expenses(manual_data: dict = None) -> list | None:
+    """
+    Build the expense list from manual data, or None if AI extraction is needed.
     """
-    print(f"DEBUG: Expense Manager Agent is running now... processing message: {message}, file_path: {file_path}, manual_data: {manual_data}")
-    agent = get_or_create_expense_agent()
-    
-    expenses_data = []
-    
-    # Check for manual data override
     if manual_data and manual_data.get('amount') and manual_data.get('product_name'):
-        print("DEBUG: Using manual data, skipping Gemini extraction.")
-        expenses_data.append({
+        return [{
             "category": None, # Will be handled by budget_id lookup
             "product_name": manual_data.get('product_name'),
             "amount": float(manual_data.get('amount')),
             "description": manual_data.get('description', ''),
             "budget_id": manual_data.get('budget_id')
-        })
-    else:
-        # Prepare content for Gemini
-        contents = []
-        if file_path:
-            # Load file
-            try:
-                with open(file_path, "rb") as f:
-                    file_content = f.read()
-                    # Determine mime type based on extension
-                    mime_type = "application/pdf" if file_path.endswith(".pdf") else "image/jpeg"
-                    contents.append(types.Part.from_bytes(data=file_content, mime_type=mime_type))
-            except Exception as e:
-                return {"type": "error", "data": {"error": f"Failed to read file: {str(e)}"}}
-                
-        contents.append(types.Part.from_text(text=message))
-        
-        # Add user's existing budgets to context
-        budgets = Budget.objects.filter(user=user)
-        budget_list = ", ".join([b.title for b in budgets])
-        context_msg = f"User's existing budget categories: {budget_list}. Try to match these."
-        contents.append(types.Part.from_text(text=context_msg))
+        }]
+    return None
 
-        client = genai.Client(api_key=API_KEY)
-        
-        try:
-            response = client.models.generate_content(
-                model=agent.gemini_model,
-                contents=[types.Content(role="user", parts=contents)],
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    system_instruction=agent.system_instruction
-                )
-            )
-            
-            result_json = json.loads(response.text)
-            print(f"DEBUG: Gemini response for expenses: {result_json}")
-            expenses_data = result_json.get("expenses", [])
-            
-        except Exception as e:
-            print(f"DEBUG: Error in process_expense_management: {str(e)}")
-            return {"type": "error", "data": {"error": str(e)}}
 
+def _rule_expense(user: User, message: str) -> dict | None:
+    """
+    Book a simple text expense parsed locally (expense.parsing), without
+    asking the model.
+    
+    Returns:
+        The _record_expenses() result, or None when the message needs the model
+    """
+    if not settings.EXPENSE_RULES_ENABLED or not message:
+        return None
+    
+    parsed = parse_expense(message, list(Budget.objects.filter(user=user).values_list('id', 'title')))
+    observe_expense_rules(parsed.outcome)
+    if not parsed.hit:
+        logger.debug("Expense rules passed the message to the model (%s): %s", parsed.outcome, payload(message))
+        return None
+    
+    logger.debug("Expense rules booked %s DZD of %s (budget %s) without the model", parsed.amount, parsed.product, parsed.budget_id)
+    return _record_expenses(user, [{
+        "category": None,
+        "product_name": parsed.product,
+        "amount": parsed.amount,
+        "description": message,
+        "budget_id": parsed.budget_id
+    }])
+
+
+def _budget_context_part(user: User) -> types.Part:
+    """
+    Add user's existing budgets to context so the model can match categories.
+    """
+    budgets = Budget.objects.filter(user=user)
+    budget_list = ", ".join([b.title for b in budgets])
+    context_msg = f"User's existing budget categories: {budget_list}. Try to match these."
+    return types.Part.from_text(text=context_msg)
+
+
+def _budget_alert(user: User, budget: Budget) -> str | None:
+    """
+    Notify the user when a budget is overspent or close to its limit.
+    
+    Returns:
+        The overspending alert for the response, if any
+    """
+    from notify.services import create_notification
+    
+    # Check for overspending
+    if budget.spent > budget.budget:
+        # Create high-priority notification for overspending
+        create_notification(
+            user=user,
+            notification_type='budget_alert',
+            priority='high',
+            title=f'⚠️ Overspending in {budget.title}',
+            message=f'You have exceeded your budget for {budget.title}. Budget: {budget.budget} DZD, Spent: {budget.spent} DZD',
+            related_budget_id=budget.id,
+            action_url=f'/budget/{budget.id}'
+        )
+        return f"Overspending detected in {budget.title}. Budget: {budget.budget}, Spent: {budget.spent}"
+    
+    # Check for budget warnings (80% threshold)
+    if budget.spent >= budget.budget * Decimal('0.8'):
+        percentage = (budget.spent / budget.budget) * 100
+        create_notification(
+            user=user,
+            notification_type='expense_alert',
+            priority='medium',
+            title=f'📊 Approaching budget limit: {budget.title}',
+            message=f'You have used {percentage:.0f}% of your {budget.title} budget. Remaining: {budget.budget - budget.spent} DZD',
+            related_budget_id=budget.id,
+            action_url=f'/budget/{budget.id}'
+        )
+    return None
+
+
+def _record_expenses(user: User, expenses_data: list) -> dict:
+    """
+    Create Expense rows for extracted or manual expenses, update budget
+    spending and raise budget alerts, in one transaction.
+    
+    Each budget is saved and checked once, after all of its expenses are
+    added (a batch of receipts raises one alert per budget, not one per receipt).
+    """
     # Process extracted or manual expenses
     try:
         processed_expenses = []
         alerts = []
         
-        for item in expenses_data:
-            category_name = item.get("category")
-            product_name = item.get("product_name", "Unknown Product")
-            amount = Decimal(str(item.get("amount", 0)))
-            description = item.get("description", "")
-            
-            # Find or create budget
-            budget = None
-            if item.get("budget_id"):
-                budget = Budget.objects.filter(user=user, id=item.get("budget_id")).first()
-            elif category_name:
-                budget = Budget.objects.filter(user=user, title__iexact=category_name).first()
-            
-            # Create Expense
-            expense = Expense.objects.create(
-                user=user,
-                budget=budget,
-                product_name=product_name,
-                amount=amount,
-                description=description
-            )
+        with transaction.atomic():
+            budgets = {budget.id: budget for budget in Budget.objects.filter(user=user)}
+            by_title = {}
+            for budget in budgets.values():
+                by_title.setdefault(budget.title.lower(), budget)
+            touched = {}
             
-            # Update Budget Spent
-            if budget:
-                budget.spent += amount
-                budget.save()
+            for item in expenses_data:
+                category_name = item.get("category")
+                product_name = item.get("product_name", "Unknown Product")
+                amount = Decimal(str(item.get("amount", 0)))
+                description = item.get("description", "")
                 
-                # Create notifications for budget alerts
-                from notify.services import create_notification
+                # Find budget
+                budget = None
+                if item.get("budget_id"):
+                    budget = budgets.get(int(item["budget_id"]))
+                elif category_name:
+                    budget = by_title.get(category_name.lower())
                 
-                # Check for overspending
-                if budget.spent > budget.budget:
-                    alerts.append(f"Overspending detected in {budget.title}. Budget: {budget.budget}, Spent: {budget.spent}")
-                    
-                    # Create high-priority notification for overspending
-                    create_notification(
-                        user=user,
-                        notification_type='budget_alert',
-                        priority='high',
-                        title=f'⚠️ Overspending in {budget.title}',
-                        message=f'You have exceeded your budget for {budget.title}. Budget: {budget.budget} DZD, Spent: {budget.spent} DZD',
-                        related_budget_id=budget.id,
-                        action_url=f'/budget/{budget.id}'
-                    )
+                # Create Expense
+                expense = Expense.objects.create(
+                    user=user,
+                    budget=budget,
+                    receipt=item.get("receipt"),
+                    product_name=product_name,
+                    amount=amount,
+                    description=description
+                )
                 
-                # Check for budget warnings (80% threshold)
-                elif budget.spent >= budget.budget * Decimal('0.8') and budget.spent <= budget.budget:
-                    percentage = (budget.spent / budget.budget) * 100
-                    create_notification(
-                        user=user,
-                        notification_type='expense_alert',
-                        priority='medium',
-                        title=f'📊 Approaching budget limit: {budget.title}',
-                        message=f'You have used {percentage:.0f}% of your {budget.title} budget. Remaining: {budget.budget - budget.spent} DZD',
-                        related_budget_id=budget.id,
-                        action_url=f'/budget/{budget.id}'
-                    )
+                if budget:
+                    budget.spent += amount
+                    touched[budget.id] = budget
+                
+                processed = {
+                    "id": expense.id,
+                    "product": product_name,
+                    "amount": float(amount),
+                    "category": budget.title if budget else "Uncategorized"
+                }
+                if item.get("source"):
+                    processed["source"] = item["source"]
+                processed_expenses.append(processed)
             
-            processed_expenses.append({
-                "id": expense.id,
-                "product": product_name,
-                "amount": float(amount),
-                "category": budget.title if budget else "Uncategorized"
-            })
+            # Update Budget Spent, then check the alerts once per budget
+            for budget in touched.values():
+                budget.save()
+                alert = _budget_alert(user, budget)
+                if alert:
+                    alerts.append(alert)
             
         return {
             "type": "response",
@@ -228,21 +304,468 @@ def process_expense_management(user: User, message: str, file_path: str = None,
         }
         
     except Exception as e:
-        print(f"DEBUG: Error in process_expense_management: {str(e)}")
+        logger.exception("Error in process_expense_management")
         return {"type": "error", "data": {"error": str(e)}}
 
-def process_report_generation(user: User, message: str) -> dict:
-    print(f"DEBUG: Report Agent is running now... processing message: {message}")
-    agent = get_or_create_report_agent()
+
+def _similar(receipt_file: ReceiptFile, phash: int | None, aspect: float | None) -> int | None:
+    """
+    Distance between an upload's perceptual hash and another receipt's, or
+    None when they aren't similar.
+    """
+    if receipt_file.phash is None or phash is None or aspect is None:
+        return None
+    # Same paper, same proportions: a longer or wider receipt is another one
+    if abs(aspect - receipt_file.aspect) > settings.RECEIPT_SIMILAR_ASPECT * receipt_file.aspect:
+        return None
+    distance = (phash ^ receipt_file.phash).bit_count()
+    return distance if distance <= settings.RECEIPT_SIMILAR_DISTANCE else None
+
+
+def _same_expenses(items: list, stored: list) -> bool:
+    """
+    Whether two extractions book the same amounts (product names vary
+    between model calls; the amounts are what would be counted twice).
+    """
+    def amounts(expenses):
+        return sorted(Decimal(str(item.get("amount", 0))).quantize(Decimal("0.01")) for item in expenses)
+    try:
+        return bool(items) and amounts(items) == amounts(stored)
+    except (InvalidOperation, AttributeError):
+        # Not an extraction _record_expenses() could book either
+        return False
+
+
+def _find_duplicate(user: User, receipt_file: ReceiptFile, expenses: list = None) -> tuple | None:
+    """
+    Look an upload up in the user's receipt store.
     
-    # Gather data
+    Args:
+        expenses: The upload's extraction; similar receipts are only
+            looked for once it is known
+    
+    Returns:
+        (Receipt, "exact") for the same bytes, (Receipt, "similar") for the
+        closest receipt of the last RECEIPT_SIMILAR_DAYS within
+        RECEIPT_SIMILAR_DISTANCE bits and RECEIPT_SIMILAR_ASPECT of its
+        perceptual hash whose extraction has the same amounts, or None
+    """
+    if not settings.RECEIPT_DEDUP_ENABLED:
+        return None
+    receipts = Receipt.objects.filter(user=user)
+    exact = receipts.filter(sha256=receipt_file.sha256).order_by('-created_at').first()
+    if exact is not None:
+        return exact, "exact"
+    if expenses is None or receipt_file.phash is None or not settings.RECEIPT_SIMILAR_DAYS:
+        return None
+    
+    since = timezone.now() - timedelta(days=settings.RECEIPT_SIMILAR_DAYS)
+    closest = None
+    candidates = receipts.filter(created_at__gte=since).exclude(phash="").values_list('id', 'phash', 'aspect', 'extraction')
+    for receipt_id, phash, aspect, extraction in candidates:
+        distance = _similar(receipt_file, int(phash, 16), aspect)
+        if distance is None or not _same_expenses(expenses, extraction):
+            continue
+        if closest is None or distance < closest[0]:
+            closest = (distance, receipt_id)
+    if closest is None:
+        return None
+    return Receipt.objects.get(id=closest[1]), "similar"
+
+
+def _repeats(receipt_file: ReceiptFile, items: list, earlier: ReceiptFile, earlier_items: list) -> str | None:
+    """
+    "exact" or "similar" when an upload repeats an earlier one of the same
+    request, else None (the same rules as _find_duplicate()).
+    """
+    if not settings.RECEIPT_DEDUP_ENABLED:
+        return None
+    if receipt_file.sha256 == earlier.sha256:
+        return "exact"
+    if (settings.RECEIPT_SIMILAR_DAYS and _similar(receipt_file, earlier.phash, earlier.aspect) is not None
+            and _same_expenses(items, earlier_items)):
+        return "similar"
+    return None
+
+
+def _duplicate_of(receipt: Receipt, match: str) -> dict:
+    """
+    What the user is shown about the stored receipt an upload repeats.
+    """
+    expenses = receipt.expenses.select_related('budget').order_by('id')
+    return {
+        "receipt_id": receipt.id,
+        "match": match,
+        "file": receipt.name,
+        "uploaded_at": receipt.created_at.isoformat(),
+        "expenses": [{
+            "id": expense.id,
+            "product": expense.product_name,
+            "amount": float(expense.amount),
+            "category": expense.budget.title if expense.budget else "Uncategorized"
+        } for expense in expenses]
+    }
+
+
+def _flagged(receipt_file: ReceiptFile, stored: Receipt, match: str) -> dict:
+    observe_receipt_duplicate(match, "flagged")
+    logger.info("Receipt %s matches receipt %s (%s), flagged", receipt_file.name, stored.id, match)
+    seen = "was already uploaded" if match == "exact" else "looks like one uploaded"
+    return {
+        "type": "duplicate",
+        "data": {
+            "message": f"This receipt {seen} on {stored.created_at.date()}; nothing was recorded. "
+                       f"Send it again with allow_duplicate to record it anyway.",
+            "duplicate_of": _duplicate_of(stored, match)
+        }
+    }
+
+
+def _check_receipt(user: User, receipt_file: ReceiptFile, allow_duplicate: bool = False) -> dict | None:
+    """
+    Check an upload against the receipt store before it is extracted (same
+    bytes only; see _check_extraction() for similar receipts).
+    
+    Returns:
+        None to extract it; a "duplicate" result (nothing is recorded) when
+        it matches a stored receipt; or, for an exact match the user
+        confirmed with allow_duplicate, the stored extraction as a
+        "response" result, with "receipt" the stored Receipt
+    """
+    duplicate = _find_duplicate(user, receipt_file)
+    if duplicate is None:
+        return None
+    
+    stored, match = duplicate
+    if not allow_duplicate:
+        return _flagged(receipt_file, stored, match)
+    # Same bytes, same expenses: the model isn't asked again
+    observe_receipt_duplicate(match, "reused")
+    return {"type": "response", "data": {"expenses": stored.extraction}, "receipt": stored}
+
+
+def _check_extraction(user: User, receipt_file: ReceiptFile, expenses: list, allow_duplicate: bool = False) -> dict | None:
+    """
+    Check an extracted upload against the similar receipts of the store.
+    
+    Receipts printed from the same template can hash as close as a resent
+    photo of one receipt, so a perceptual match is only a duplicate when
+    the extraction books the same amounts as well.
+    
+    Returns:
+        A "duplicate" result (nothing is recorded), or None to record it
+    """
+    if allow_duplicate or receipt_file is None:
+        return None
+    duplicate = _find_duplicate(user, receipt_file, expenses)
+    if duplicate is None:
+        return None
+    return _flagged(receipt_file, *duplicate)
+
+
+def _record_receipts(user: User, extracted: list, allow_duplicate: bool = False) -> dict:
+    """
+    Store new receipts with their extraction and record their expenses
+    (_record_expenses()), in one transaction.
+    
+    Uploads were checked against the store before extraction; a file
+    repeating an earlier one of the same batch is skipped here. The check
+    is done in memory before the transaction, which then starts with a
+    write (SQLite can't turn a read transaction into a write one while
+    another request writes).
+    
+    Args:
+        extracted: (source, receipt, expenses) per message or file, in order;
+            receipt is the ReceiptFile to store, the stored Receipt whose
+            extraction was reused, or None for a text message
+        allow_duplicate: Record repeated files anyway
+    
+    Returns:
+        The _record_expenses() result, with "duplicates": the skipped files,
+        as {"file", "duplicate_of"}
+    """
+    entries = []
+    new_files = []
+    repeated = []
+    for source, receipt, items in extracted:
+        if isinstance(receipt, ReceiptFile):
+            if not items:
+                # Nothing extracted, nothing to remember
+                receipt = None
+            else:
+                earlier = None
+                if not allow_duplicate:
+                    earlier = next(((f, match) for f, f_items in new_files
+                                    if (match := _repeats(receipt, items, f, f_items))), None)
+                if earlier is not None:
+                    observe_receipt_duplicate(earlier[1], "flagged")
+                    repeated.append((source or receipt.name, *earlier))
+                    continue
+                new_files.append((receipt, items))
+        entries.append((source, receipt, items))
+    
+    try:
+        stored = {}
+        with transaction.atomic():
+            expenses_data = []
+            for source, receipt, items in entries:
+                if isinstance(receipt, ReceiptFile):
+                    stored[id(receipt)] = Receipt.objects.create(
+                        user=user,
+                        name=receipt.name[:255],
+                        sha256=receipt.sha256,
+                        phash=receipt.phash_hex,
+                        aspect=receipt.aspect,
+                        extraction=items
+                    )
+                    receipt = stored[id(receipt)]
+                expenses_data.extend({**item, "source": source, "receipt": receipt} for item in items)
+            
+            result = _record_expenses(user, expenses_data)
+            if result["type"] == "error":
+                # Receipts are only stored along with their expenses
+                transaction.set_rollback(True)
+                return result
+    
+    except Exception as e:
+        logger.exception("Error in process_expense_management")
+        return {"type": "error", "data": {"error": str(e)}}
+    
+    result["data"]["duplicates"] = [
+        {"file": name, "duplicate_of": _duplicate_of(stored[id(earlier)], match)}
+        for name, earlier, match in repeated
+    ]
+    return result
+
+
+def _expense_contents(message: str, receipt: types.Part = None, budget_context: types.Part = None) -> list:
+    parts = [receipt] if receipt is not None else []
+    parts.append(types.Part.from_text(text=message))
+    parts.append(budget_context)
+    return [types.Content(role="user", parts=parts)]
+
+
+def _parse_expenses(response) -> list:
+    result_json = json.loads(response.text)
+    logger.debug("Gemini response for expenses: %s", payload(result_json))
+    return result_json.get("expenses", [])
+
+
+@trace_agent(EXPENSE_AGENT.name)
+def process_expense_management(user: User, message: str, receipt=None, manual_data: dict = None,
+                               allow_duplicate: bool = False) -> dict:
+    """
+    Process an expense request.
+    The receipt is the uploaded file (image or PDF) if it came from an API
+    upload, or the message string itself might contain info.
+    If manual_data is provided (amount, product_name), it bypasses AI extraction,
+    and so do simple text expenses the local parser is sure about.
+    A receipt already in the user's receipt store isn't recorded again (a
+    "duplicate" result) unless allow_duplicate is set.
+    """
+    logger.debug("Expense Manager Agent is running now... processing message: %s, receipt: %s, manual_data: %s", payload(message), getattr(receipt, "name", None), payload(manual_data))
+    agent = get_or_create_expense_agent()
+    
+    # Check for manual data override
+    expenses_data = _manual_expenses(manual_data)
+    if expenses_data is not None:
+        logger.debug("Using manual data, skipping Gemini extraction.")
+        return _record_expenses(user, expenses_data)
+    
+    started = time.perf_counter()
+    receipt_file = None
+    if receipt is None:
+        result = _rule_expense(user, message)
+        if result is not None:
+            observe_text_expense("rules", time.perf_counter() - started)
+            return result
+    else:
+        try:
+            receipt_file = read_receipt(receipt)
+        except Exception as e:
+            return {"type": "error", "data": {"error": f"Failed to read file: {str(e)}"}}
+        checked = _check_receipt(user, receipt_file, allow_duplicate)
+        if checked is not None:
+            if checked["type"] == "duplicate":
+                return checked
+            return _record_receipts(user, [(None, checked["receipt"], checked["data"]["expenses"])], allow_duplicate)
+    
+    # Prepare content for Gemini
+    try:
+        response = generate_content(
+            agent,
+            _expense_contents(message, receipt_file.part if receipt_file else None, _budget_context_part(user)),
+            get_agent_config(agent)
+        )
+        expenses_data = _parse_expenses(response)
+        
+    except MODEL_ERRORS as e:
+        return unavailable_result(EXPENSE_AGENT.name, e)
+    except Exception as e:
+        logger.exception("Error in process_expense_management")
+        return {"type": "error", "data": {"error": str(e)}}
+
+    checked = _check_extraction(user, receipt_file, expenses_data, allow_duplicate)
+    if checked is not None:
+        return checked
+    result = _record_receipts(user, [(None, receipt_file, expenses_data)], allow_duplicate)
+    if receipt is None:
+        observe_text_expense("model", time.perf_counter() - started)
+    return result
+
+
+async def _aextract_expenses(agent: agentModel, user: User, message: str, receipt, budget_context: types.Part,
+                             allow_duplicate: bool = False) -> dict:
+    """
+    Extract the expenses of one message / receipt file (nothing is recorded).
+    
+    Returns:
+        {"type": "response", "data": {"expenses": [...]}, "receipt": ...}
+        ("receipt": the ReceiptFile read, the stored Receipt whose
+        extraction was reused, or None), a "duplicate" result (see
+        _check_receipt() and _check_extraction()) or an error result
+    """
+    receipt_file = None
+    if receipt is not None:
+        try:
+            # Not DB work: spooled uploads are read outside the sync thread
+            receipt_file = await sync_to_async(read_receipt, thread_sensitive=False)(receipt)
+        except Exception as e:
+            return {"type": "error", "data": {"error": f"Failed to read file: {str(e)}"}}
+        checked = await sync_to_async(_check_receipt)(user, receipt_file, allow_duplicate)
+        if checked is not None:
+            return checked
+    
+    try:
+        response = await agenerate_content(
+            agent,
+            _expense_contents(message, receipt_file.part if receipt_file else None, budget_context),
+            get_agent_config(agent)
+        )
+        expenses = _parse_expenses(response)
+    
+    except MODEL_ERRORS as e:
+        return unavailable_result(EXPENSE_AGENT.name, e)
+    except Exception as e:
+        logger.exception("Error in aprocess_expense_management")
+        return {"type": "error", "data": {"error": str(e)}}
+    
+    checked = await sync_to_async(_check_extraction)(user, receipt_file, expenses, allow_duplicate)
+    if checked is not None:
+        return checked
+    return {"type": "response", "data": {"expenses": expenses}, "receipt": receipt_file}
+
+
+@trace_agent(EXPENSE_AGENT.name)
+async def aprocess_expense_management(user: User, message: str, receipt=None, manual_data: dict = None,
+                                      allow_duplicate: bool = False) -> dict:
+    """
+    Async version of process_expense_management().
+    """
+    logger.debug("Expense Manager Agent (async) is running now... processing message: %s, receipt: %s, manual_data: %s", payload(message), getattr(receipt, "name", None), payload(manual_data))
+    agent = await aget_or_create_expense_agent()
+    
+    expenses_data = _manual_expenses(manual_data)
+    if expenses_data is not None:
+        return await sync_to_async(_record_expenses)(user, expenses_data)
+    
+    started = time.perf_counter()
+    if receipt is None:
+        result = await sync_to_async(_rule_expense)(user, message)
+        if result is not None:
+            observe_text_expense("rules", time.perf_counter() - started)
+            return result
+    
+    budget_context = await sync_to_async(_budget_context_part)(user)
+    result = await _aextract_expenses(agent, user, message, receipt, budget_context, allow_duplicate)
+    if result["type"] != "response":
+        return result
+    result = await sync_to_async(_record_receipts)(
+        user, [(None, result["receipt"], result["data"]["expenses"])], allow_duplicate
+    )
+    if receipt is None:
+        observe_text_expense("model", time.perf_counter() - started)
+    return result
+
+
+@trace_agent(EXPENSE_AGENT.name)
+async def astream_expense_batch(user: User, files: list, message: str = "Process this receipt.",
+                                allow_duplicate: bool = False):
+    """
+    Extract the expenses of many receipts concurrently, then record them all.
+    
+    Up to EXPENSE_BATCH_CONCURRENCY extractions run at a time, in the
+    background lane of the Gemini scheduler (so a month of receipts can't
+    starve chat of quota). Budgets are updated, and alerts checked, in one
+    transaction once every file is done. Receipts already in the user's
+    receipt store, or repeated within the batch, are skipped unless
+    allow_duplicate is set.
+    
+    Args:
+        user: The Django User object
+        files: The uploaded receipts (read one at a time, as their turn comes)
+        message: Instruction sent with each receipt
+        allow_duplicate: Record duplicate receipts anyway
+    
+    Yields:
+        ("file", {"index", "file", "type", ...}) as each file finishes (the
+        extracted expenses, its error, or the receipt it duplicates), then
+        ("done", {...}) with the recorded expenses, alerts, the files that
+        failed and the duplicates skipped
+    """
+    logger.debug("Expense Manager Agent (batch) is running now... %d files", len(files))
+    agent = await aget_or_create_expense_agent()
+    budget_context = await sync_to_async(_budget_context_part)(user)
+    limit = asyncio.Semaphore(settings.EXPENSE_BATCH_CONCURRENCY)
+    
+    async def extract(index: int, receipt):
+        async with limit:
+            return index, receipt.name, await _aextract_expenses(
+                agent, user, message, receipt, budget_context, allow_duplicate
+            )
+    
+    # Tasks copy the context they are created in (the lane included)
+    with llm_priority(BACKGROUND):
+        tasks = [asyncio.ensure_future(extract(index, receipt)) for index, receipt in enumerate(files)]
+    
+    extracted = {}
+    failed = []
+    duplicates = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, name, result = await next_done
+            if result["type"] == "error":
+                failed.append(name)
+            elif result["type"] == "duplicate":
+                duplicates.append({"file": name, "duplicate_of": result["data"]["duplicate_of"]})
+            else:
+                extracted[index] = (name, result["receipt"], result["data"]["expenses"])
+            yield "file", {"index": index, "file": name, "type": result["type"], **result["data"]}
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    # In upload order, so the first of two copies in the batch is the one kept
+    result = await sync_to_async(_record_receipts)(
+        user, [extracted[index] for index in sorted(extracted)], allow_duplicate
+    )
+    if result["type"] == "error":
+        yield "error", result["data"]
+        return
+    yield "done", {**result["data"], "failed": failed, "duplicates": duplicates + result["data"]["duplicates"]}
+
+
+def _build_report_prompt(user: User, message: str) -> str:
+    """
+    Gather the user's budgets and expenses into the Report Agent prompt.
+    """
     expenses = Expense.objects.filter(user=user).order_by('-date')
     budgets = Budget.objects.filter(user=user)
     
     expense_summary = "\n".join([f"- {e.date.date()}: {e.product_name} ({e.amount}) - {e.budget.title if e.budget else 'No Category'}" for e in expenses])
     budget_summary = "\n".join([f"- {b.title}: Budget {b.budget}, Spent {b.spent}" for b in budgets])
     
-    prompt = f"""
+    return f"""
     Generate a financial report for the user based on the following data:
     
     Budgets (Goals):
@@ -253,15 +776,52 @@ def process_report_generation(user: User, message: str) -> dict:
     
     User Request: {message}
     """
+
+
+@trace_agent(REPORT_AGENT.name)
+def process_report_generation(user: User, message: str, bypass_cache: bool = False) -> dict:
+    logger.debug("Report Agent is running now... processing message: %s", payload(message))
+    agent = get_or_create_report_agent()
+    
+    # Gather data
+    prompt = _build_report_prompt(user, message)
+    
+    try:
+        response = generate_content(
+            agent,
+            [types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+            get_agent_config(agent),
+            bypass_cache=bypass_cache
+        )
+    except MODEL_ERRORS as e:
+        return unavailable_result(REPORT_AGENT.name, e)
+    
+    return {
+        "type": "response",
+        "data": {
+            "report": response.text
+        }
+    }
+
+
+@trace_agent(REPORT_AGENT.name)
+async def aprocess_report_generation(user: User, message: str, bypass_cache: bool = False) -> dict:
+    """
+    Async version of process_report_generation().
+    """
+    logger.debug("Report Agent (async) is running now... processing message: %s", payload(message))
+    agent = await aget_or_create_report_agent()
+    prompt = await sync_to_async(_build_report_prompt)(user, message)
     
-    client = genai.Client(api_key=API_KEY)
-    response = client.models.generate_content(
-        model=agent.gemini_model,
-        contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
-        config=types.GenerateContentConfig(
-            system_instruction=agent.system_instruction
+    try:
+        response = await agenerate_content(
+            agent,
+            [types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+            get_agent_config(agent),
+            bypass_cache=bypass_cache
         )
-    )
+    except MODEL_ERRORS as e:
+        return unavailable_result(REPORT_AGENT.name, e)
     
     return {
         "type": "response",
@@ -269,3 +829,36 @@ def process_report_generation(user: User, message: str) -> dict:
             "report": response.text
         }
     }
+
+
+@trace_agent(REPORT_AGENT.name)
+async def astream_report_generation(user: User, message: str, bypass_cache: bool = False):
+    """
+    Streaming version of aprocess_report_generation().
+    
+    Yields:
+        (event, data) tuples, see agents.streaming
+    """
+    logger.debug("Report Agent (stream) is running now... processing message: %s", payload(message))
+    agent = await aget_or_create_report_agent()
+    prompt = await sync_to_async(_build_report_prompt)(user, message)
+    
+    report = []
+    stream = agenerate_content_stream(
+        agent,
+        [types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+        get_agent_config(agent),
+        bypass_cache=bypass_cache
+    )
+    try:
+        async with aclosing(stream):
+            async for chunk in stream:
+                text = chunk_text(chunk)
+                if text:
+                    report.append(text)
+                    yield "delta", {"text": text}
+    except MODEL_ERRORS as e:
+        yield "error", unavailable_result(REPORT_AGENT.name, e)["data"]
+        return
+    
+    yield "done", {"report": "".join(report)}
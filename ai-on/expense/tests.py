@@ -1,3 +1,253 @@
-from django.test import TestCase
+import io
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from PIL import Image, ImageDraw
+
+from agents.history_cache import history_cache
+from agents.registry import agent_registry
+from agents.tests import fake_gemini
+from budget.models import Budget
+
+from .models import Expense, Receipt
+from .parsing import HIT, parse_expense
+from .receipts import read_receipt
+from .services import _find_duplicate, _record_receipts, _similar, process_expense_management
+
+
+BUDGETS = [(1, "Food & Dining"), (2, "Transport"), (3, "Groceries")]
+
+
+class ParseExpenseTests(SimpleTestCase):
+
+    def assertHit(self, message: str, amount: str, product: str, budget_id: int, budgets: list = BUDGETS):
+        parsed = parse_expense(message, budgets)
+        self.assertEqual(parsed.outcome, HIT, message)
+        self.assertEqual((parsed.amount, parsed.product, parsed.budget_id), (Decimal(amount), product, budget_id))
+
+    def assertPassed(self, message: str, outcome: str, budgets: list = BUDGETS):
+        parsed = parse_expense(message, budgets)
+        self.assertEqual(parsed.outcome, outcome, message)
+        self.assertFalse(parsed.hit)
+
+    def test_simple_expenses_are_booked(self):
+        self.assertHit("I spent 500 on coffee", "500", "Coffee", 1)
+        self.assertHit("taxi 300 DA", "300", "Taxi", 2)
+        self.assertHit("j'ai payé 1 200 DA pour le pain", "1200", "Pain", 3)
+        self.assertHit("paid 400 transport", "400", "Transport", 2)
+
+    def test_amount_formats(self):
+        self.assertHit("paid 2.5k for fuel", "2500", "Fuel", 2)
+        self.assertHit("1.500,50 DA pizza", "1500.50", "Pizza", 1)
+        self.assertHit("٣٠٠ دج taxi", "300", "Taxi", 2)
+
+    def test_category_tiers(self):
+        # Bread goes to Groceries, or to Food when there is no Groceries budget
+        self.assertHit("bread 100 DA", "100", "Bread", 7, budgets=[(7, "Food"), (8, "Transport")])
+        self.assertPassed("coffee 300 DA", "several_budgets", budgets=[(1, "Food"), (2, "Dining out")])
+
+    def test_ambiguous_amounts_go_to_the_model(self):
+        self.assertPassed("coffee 5 euros", "currency")
+        self.assertPassed("coffee 5$", "currency")
+        self.assertPassed("20 alf taxi", "scale")
+        self.assertPassed("taxi 300 and bus 200", "several_amounts")
+        self.assertPassed("0 taxi", "no_amount")
+        self.assertPassed("taxi 5 DA", "no_amount")
+        self.assertPassed("2000000 taxi", "no_amount")
+        self.assertPassed("coffee", "no_amount")
+
+    def test_counts_and_times_are_not_amounts(self):
+        for message in ("bought 2 pizzas", "I bought 3 coffees", "lunch at 12", "taxi for 2 people", "had 3 coffees today"):
+            self.assertFalse(parse_expense(message, BUDGETS).hit, message)
+        # Over the minimum amount too
+        self.assertPassed("bought 12 eggs", "bare_number")
+        self.assertPassed("paid for 20 people", "bare_number")
+        self.assertPassed("dinner at 20", "bare_number")
+        self.assertPassed("bought 20 x coffee", "bare_number")
+        # Neither DA nor a spend verb
+        self.assertPassed("Transport 400", "bare_number")
+        self.assertPassed("٣٠٠ taxi", "bare_number")
+
+    def test_other_requests_go_to_the_model(self):
+        self.assertPassed("budget 500 food", "not_expense")
+        self.assertPassed("how much did I spend on coffee?", "not_expense")
+        self.assertPassed("I will pay 500 for taxi", "not_expense")
+        self.assertPassed("refund of 500 for the taxi", "not_expense")
+
+    def test_unclear_products_go_to_the_model(self):
+        self.assertPassed("paid 500", "no_product")
+        self.assertPassed("bought a new phone case for my sister 800 DA", "long")
+        self.assertPassed("spent 500 on stuff", "no_budget")
+        self.assertPassed("I spent 300 on coffee and bread", "several_categories")
+
+
+@override_settings(GEMINI_BACKEND="fake", GEMINI_CASSETTE_MODE="off", LLM_CACHE_TTLS={}, TRACING_ENABLED=False)
+class ExpenseManagerTests(TestCase):
+
+    def setUp(self):
+        agent_registry.invalidate()
+        history_cache.clear()
+        self.user = User.objects.create_user("alice")
+        self.food = Budget.objects.create(user=self.user, title="Food", budget=10000, description="")
+
+    def test_parsed_expense_is_booked_without_the_model(self):
+        with fake_gemini() as client:
+            result = process_expense_management(self.user, "I spent 500 on coffee")
+
+        self.assertEqual(client.responder.stats["requests"], 0)
+        self.assertEqual(result["data"]["expenses"][0]["product"], "Coffee")
+        self.food.refresh_from_db()
+        self.assertEqual(self.food.spent, Decimal("500"))
+
+    def test_other_messages_are_extracted_by_the_model(self):
+        extraction = {"expenses": [{"product_name": "Coffee", "amount": 250, "category": "Food", "budget_id": None}]}
+        with fake_gemini({"agent": "You are the **Expense Manager Agent**", "json": extraction}) as client:
+            result = process_expense_management(self.user, "coffee for 2 people, 125 each")
+
+        self.assertEqual(client.responder.stats["requests"], 1)
+        self.assertEqual(result["type"], "response")
+        self.assertEqual(Expense.objects.get(user=self.user).amount, Decimal("250"))
+
+    @override_settings(EXPENSE_RULES_ENABLED=False)
+    def test_parser_can_be_turned_off(self):
+        with fake_gemini({"agent": "You are the **Expense Manager Agent**", "json": {"expenses": []}}) as client:
+            process_expense_management(self.user, "I spent 500 on coffee")
+
+        self.assertEqual(client.responder.stats["requests"], 1)
+
+
+def receipt_image(line_widths: list, image_format: str = "PNG", scale: float = 1.0, quality: int = 90) -> bytes:
+    """
+    A receipt of the synthetic shop template: logo, one bar per line item, total.
+    """
+    image = Image.new("L", (800, 1200), 40)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((100, 100, 700, 1100), fill=245)
+    draw.rectangle((250, 140, 550, 200), fill=30)
+    for i, width in enumerate(line_widths):
+        top = 260 + i * 60
+        draw.rectangle((140, top, 140 + width, top + 25), fill=60)
+        draw.rectangle((560, top, 660, top + 25), fill=60)
+    draw.rectangle((140, 1000, 660, 1040), fill=20)
+    if scale != 1.0:
+        image = image.resize((int(image.width * scale), int(image.height * scale)))
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, quality=quality)
+    return buffer.getvalue()
+
+
+# Two receipts printed from the same template: only one line item differs
+FIRST_RECEIPT = [300, 200, 350, 150, 250, 300, 200, 320, 180, 260, 240, 300]
+SECOND_RECEIPT = [300, 200, 350, 150, 250, 300, 200, 320, 180, 260, 240, 290]
+# Another receipt of the template, further off
+OTHER_RECEIPT = [120, 380, 90, 400, 100, 380, 330, 100, 360, 120, 60, 380]
+
+
+def extraction(*amounts) -> dict:
+    return {"expenses": [{"product_name": f"Item {i}", "amount": amount, "category": "Groceries", "budget_id": None}
+                         for i, amount in enumerate(amounts)]}
+
+
+@override_settings(GEMINI_BACKEND="fake", GEMINI_CASSETTE_MODE="off", LLM_CACHE_TTLS={}, TRACING_ENABLED=False,
+                   RECEIPT_DEDUP_ENABLED=True, RECEIPT_SIMILAR_DAYS=30)
+class ReceiptDedupTests(TestCase):
+    rules = [
+        {"agent": "You are the **Expense Manager Agent**", "match": "first", "json": extraction(300, 150)},
+        {"agent": "You are the **Expense Manager Agent**", "match": "second", "json": extraction(450)},
+    ]
+
+    def setUp(self):
+        agent_registry.invalidate()
+        history_cache.clear()
+        self.user = User.objects.create_user("alice")
+        Budget.objects.create(user=self.user, title="Groceries", budget=10000, description="")
+
+    def upload(self, data: bytes, message: str, **options) -> dict:
+        with fake_gemini(*self.rules) as client:
+            result = process_expense_management(
+                self.user, message, receipt=SimpleUploadedFile("receipt.png", data), **options
+            )
+        self.model_calls = client.responder.stats["requests"]
+        return result
+
+    def receipt_file(self, data: bytes):
+        return read_receipt(SimpleUploadedFile("receipt.png", data))
+
+    def test_same_image_is_flagged_before_extraction(self):
+        data = receipt_image(FIRST_RECEIPT)
+        self.upload(data, "first receipt")
+
+        result = self.upload(data, "first receipt")
+
+        self.assertEqual(result["type"], "duplicate")
+        self.assertEqual(result["data"]["duplicate_of"]["match"], "exact")
+        self.assertEqual(self.model_calls, 0)
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 2)
+
+    def test_confirmed_exact_copy_reuses_the_extraction(self):
+        data = receipt_image(FIRST_RECEIPT)
+        self.upload(data, "first receipt")
+
+        result = self.upload(data, "first receipt", allow_duplicate=True)
+
+        self.assertEqual(result["type"], "response")
+        self.assertEqual(self.model_calls, 0)
+        self.assertEqual(Receipt.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 4)
+
+    def test_resent_photo_is_flagged_once_its_amounts_match(self):
+        self.upload(receipt_image(FIRST_RECEIPT), "first receipt")
+        # Resent through a messaging app: downscaled and recompressed
+        resent = receipt_image(FIRST_RECEIPT, image_format="JPEG", scale=0.5, quality=50)
+
+        result = self.upload(resent, "first receipt")
+
+        self.assertEqual(result["type"], "duplicate")
+        self.assertEqual(result["data"]["duplicate_of"]["match"], "similar")
+        self.assertEqual(self.model_calls, 1)
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 2)
+
+    def test_receipts_of_one_template_are_both_booked(self):
+        first, second = receipt_image(FIRST_RECEIPT), receipt_image(SECOND_RECEIPT)
+        # Within the perceptual hash distance of each other...
+        first_file = self.receipt_file(first)
+        self.assertIsNotNone(_similar(self.receipt_file(second), first_file.phash, first_file.aspect))
+        self.upload(first, "first receipt")
+
+        # ...but not the same amounts
+        result = self.upload(second, "second receipt")
+
+        self.assertEqual(result["type"], "response")
+        self.assertEqual(Receipt.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 3)
+
+    def test_similar_distance_threshold(self):
+        self.upload(receipt_image(FIRST_RECEIPT), "first receipt")
+        stored = Receipt.objects.get(user=self.user)
+        other = self.receipt_file(receipt_image(OTHER_RECEIPT))
+        distance = (other.phash ^ int(stored.phash, 16)).bit_count()
+        self.assertGreater(distance, 0)
+        same_amounts = extraction(300, 150)["expenses"]
+
+        with self.settings(RECEIPT_SIMILAR_DISTANCE=distance - 1):
+            self.assertIsNone(_find_duplicate(self.user, other, same_amounts))
+        with self.settings(RECEIPT_SIMILAR_DISTANCE=distance):
+            self.assertEqual(_find_duplicate(self.user, other, same_amounts), (stored, "similar"))
+            # Before extraction only the same bytes match
+            self.assertIsNone(_find_duplicate(self.user, other))
+
+    def test_repeats_within_a_batch(self):
+        first, second = receipt_image(FIRST_RECEIPT), receipt_image(SECOND_RECEIPT)
+        extracted = [
+            ("a.png", self.receipt_file(first), extraction(300, 150)["expenses"]),
+            ("b.png", self.receipt_file(second), extraction(450)["expenses"]),
+            ("a copy.png", self.receipt_file(first), extraction(300, 150)["expenses"]),
+        ]
+
+        result = _record_receipts(self.user, extracted)
+
+        self.assertEqual([duplicate["file"] for duplicate in result["data"]["duplicates"]], ["a copy.png"])
+        self.assertEqual(Receipt.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(Expense.objects.filter(user=self.user).count(), 3)
@@ -1,7 +1,9 @@
 from django.urls import path
-from .views import ExpenseListCreateView, ReportView
+from .views import ExpenseListCreateView, ExpenseBatchView, ReportView, ReportStreamView
 
 urlpatterns = [
     path('', ExpenseListCreateView.as_view(), name='expense-list-create'),
+    path('batch/', ExpenseBatchView.as_view(), name='expense-batch'),
     path('report/', ReportView.as_view(), name='expense-report'),
+    path('report/stream/', ReportStreamView.as_view(), name='expense-report-stream'),
 ]
@@ -1,56 +1,115 @@
 from rest_framework import generics, status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from asgiref.sync import sync_to_async
 from .models import Expense
-from .serializers import ExpenseSerializer, ExpenseUploadSerializer
-from .services import process_expense_management, process_report_generation
-from django.core.files.storage import default_storage
-from drf_spectacular.utils import extend_schema
-import os
+from .serializers import ExpenseSerializer, ExpenseUploadSerializer, ExpenseBatchUploadSerializer
+from .receipts import sniff_upload
+from .services import aprocess_expense_management, aprocess_report_generation, astream_report_generation, astream_expense_batch
+from agents.streaming import event_stream_response
+from agents.views import AsyncAPIView, AsyncStreamView, unavailable_response
+from django.conf import settings
+from drf_spectacular.utils import extend_schema, OpenApiResponse
 
-class ExpenseListCreateView(APIView):
+class ExpenseListCreateView(AsyncAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
-    def get(self, request):
-        expenses = Expense.objects.filter(user=request.user).order_by('-date')
+    def _list_expenses(self, user):
+        expenses = Expense.objects.filter(user=user).order_by('-date')
         serializer = ExpenseSerializer(expenses, many=True)
-        return Response(serializer.data)
+        return serializer.data
+
+    async def get(self, request):
+        data = await sync_to_async(self._list_expenses)(request.user)
+        return Response(data)
 
     @extend_schema(
         request=ExpenseUploadSerializer,
-        responses=ExpenseSerializer(many=True),
-        description="Upload an expense via natural language message or receipt file (image/PDF). AI will automatically extract amount, category, product name, and description."
+        responses={
+            201: ExpenseSerializer(many=True),
+            409: OpenApiResponse(description="The receipt was uploaded before (or looks like one that was): {message, duplicate_of: {receipt_id, match, file, uploaded_at, expenses}}; nothing was recorded"),
+            503: OpenApiResponse(description="Gemini is unavailable; retry after the Retry-After header"),
+        },
+        description="Upload an expense via natural language message or receipt file (image/PDF). AI will automatically extract amount, category, product name, and description. A receipt already uploaded is flagged (409) unless `allow_duplicate` is set."
     )
-    def post(self, request):
+    async def post(self, request):
         message = request.data.get('message', 'Process this expense.')
         file_obj = request.FILES.get('file')
         
-        file_path = None
-        if file_obj:
-            # Save file temporarily
-            file_name = default_storage.save(f"temp/{file_obj.name}", file_obj)
-            file_path = default_storage.path(file_name)
-            
-        # Process with AI - no manual data
-        result = process_expense_management(request.user, message, file_path, manual_data=None)
-        
-        # Clean up temp file
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
+        # Process with AI - no manual data. The upload is read straight
+        # from Django's in-memory or spooled file, never saved to storage.
+        result = await aprocess_expense_management(
+            request.user, message, receipt=file_obj, manual_data=None, allow_duplicate=_is_true(request, 'allow_duplicate')
+        )
             
+        if result['type'] == 'error' and 'retry_after' in result['data']:
+            return unavailable_response(result['data'])
         if result['type'] == 'error':
             return Response(result['data'], status=status.HTTP_400_BAD_REQUEST)
+        if result['type'] == 'duplicate':
+            return Response(result['data'], status=status.HTTP_409_CONFLICT)
             
         return Response(result['data'], status=status.HTTP_201_CREATED)
 
-class ReportView(APIView):
+class ExpenseBatchView(AsyncStreamView):
+    """
+    Many receipts in one request, streamed back (Server-Sent Events) as each is extracted.
+    """
     permission_classes = [permissions.IsAuthenticated]
 
-    def post(self, request):
+    @extend_schema(
+        request=ExpenseBatchUploadSerializer,
+        responses={
+            (200, 'text/event-stream'): OpenApiResponse(description="SSE stream: a `file` event per receipt as it is extracted ({index, file, type, expenses}, {index, file, type, error} or {index, file, type: duplicate, message, duplicate_of}), then `done` with {message, expenses, alerts, failed, duplicates}"),
+            400: OpenApiResponse(description="No files, too many files or an unsupported file type"),
+        },
+        description="Upload many receipt images/PDFs (multipart field `files`). Receipts are extracted concurrently; budgets are updated, and alerts raised, once every file is processed. Receipts already uploaded, or repeated in the batch, are skipped unless `allow_duplicate` is set."
+    )
+    async def post(self, request):
+        files = request.FILES.getlist('files')
+        if not files:
+            return Response({'error': 'No files uploaded.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(files) > settings.EXPENSE_BATCH_MAX_FILES:
+            return Response({'error': f'At most {settings.EXPENSE_BATCH_MAX_FILES} files per batch.'}, status=status.HTTP_400_BAD_REQUEST)
+        # Checked from the content, not the declared content type
+        unsupported = [f.name for f in files if sniff_upload(f) is None]
+        if unsupported:
+            return Response({'error': 'Only images and PDFs are supported.', 'files': unsupported}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # The uploads stay open (and spooled ones on disk) until the stream is closed
+        message = request.data.get('message', 'Process this receipt.')
+        return event_stream_response(
+            astream_expense_batch(request.user, files, message, allow_duplicate=_is_true(request, 'allow_duplicate'))
+        )
+
+def _is_true(request, field: str) -> bool:
+    return str(request.data.get(field, '')).lower() in ('1', 'true', 'yes')
+
+def _wants_refresh(request) -> bool:
+    return _is_true(request, 'refresh')
+
+class ReportView(AsyncAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    async def post(self, request):
         message = request.data.get('message', 'Generate a full financial report.')
-        result = process_report_generation(request.user, message)
+        result = await aprocess_report_generation(request.user, message, bypass_cache=_wants_refresh(request))
         
+        if result['type'] == 'error' and 'retry_after' in result['data']:
+            return unavailable_response(result['data'])
         if result['type'] == 'error':
             return Response(result['data'], status=status.HTTP_400_BAD_REQUEST)
             
         return Response(result['data'])
+
+class ReportStreamView(AsyncStreamView):
+    """
+    Streaming variant of ReportView (Server-Sent Events).
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    async def post(self, request):
+        message = request.data.get('message', 'Generate a full financial report.')
+        return event_stream_response(
+            astream_report_generation(request.user, message, bypass_cache=_wants_refresh(request))
+        )
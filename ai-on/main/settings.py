@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 
+from decouple import Csv, config
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -60,6 +62,7 @@ INSTALLED_APPS = [
 CORS_ALLOW_ALL_ORIGINS = True
 
 MIDDLEWARE = [
+    'agents.profiling.ServerTimingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -68,6 +71,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'agents.tracing.TracingMiddleware',
+    'agents.resilience.RetryBudgetMiddleware',
 ]
 ROOT_URLCONF = 'main.urls'
 
@@ -169,3 +174,249 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=365), # 1 years for refresh token
     'AUTH_HEADER_TYPES': ('Bearer',),                # Token type in requests
 }
+
+
+# Gemini client connection pool (one per worker process, see agents.services)
+GEMINI_POOL_MAX_CONNECTIONS = 20
+GEMINI_POOL_MAX_KEEPALIVE = 10
+GEMINI_POOL_KEEPALIVE_EXPIRY = 120  # seconds
+# Built when a server process loads main.wsgi / main.asgi, never by management commands
+GEMINI_CLIENT_WARMUP = True
+GEMINI_CLIENT_PRECONNECT = False
+
+# Which Gemini the agents talk to (agents.standin): 'gemini' (the real API),
+# 'fake' (in-process stand-in) or 'standin' (the real client against the
+# stand-in server, `python manage.py gemini_standin`). Stand-in answers,
+# latency and injected errors come from the scenario file.
+GEMINI_BACKEND = config('GEMINI_BACKEND', default='gemini')
+GEMINI_STANDIN_URL = config('GEMINI_STANDIN_URL', default='http://127.0.0.1:8765/')
+GEMINI_STANDIN_SCENARIO = config('GEMINI_STANDIN_SCENARIO', default=str(BASE_DIR / 'agents' / 'standin_scenario.json'))
+
+# Record/replay of the agents' Gemini traffic (agents.cassette): 'off',
+# 'record' (forward to GEMINI_BACKEND and append to GEMINI_CASSETTE_DIR) or
+# 'replay' (answer from the cassette, sleeping the recorded latency times
+# GEMINI_CASSETTE_LATENCY_SCALE). GEMINI_CASSETTE_MATCH 'agent' falls back to
+# the same agent's next recorded answer when a request hash is not found,
+# 'exact' fails instead.
+GEMINI_CASSETTE_MODE = config('GEMINI_CASSETTE_MODE', default='off')
+GEMINI_CASSETTE_DIR = config('GEMINI_CASSETTE_DIR', default=str(BASE_DIR / '.cache' / 'cassettes'))
+GEMINI_CASSETTE_MATCH = config('GEMINI_CASSETTE_MATCH', default='agent')
+GEMINI_CASSETTE_LATENCY_SCALE = config('GEMINI_CASSETTE_LATENCY_SCALE', default=1.0, cast=float)
+
+
+# Caches. 'llm_responses' is the persistent tier of the LLM response cache
+# (agents.cache); swap it for a DatabaseCache/Redis alias to share it across hosts.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'llm_responses': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / '.cache' / 'llm_responses',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+}
+
+# LLM response cache
+LLM_CACHE_ENABLED = True
+LLM_CACHE_BACKEND = 'llm_responses'  # None keeps only the in-memory tier
+LLM_CACHE_MEMORY_ENTRIES = 512
+# Per-agent TTLs in seconds; agents not listed are never cached. Only agents
+# whose answers are a pure function of the prompt belong here.
+LLM_CACHE_TTLS = {
+    'advisor_agent': 6 * 60 * 60,
+    'report_agent': 60 * 60,
+}
+
+# LLM admission (agents.scheduler): requests and tokens per minute per model
+# (the project's Gemini quota; models not listed are not limited), split
+# evenly between LLM_RATE_LIMIT_WORKERS worker processes. Calls over the
+# limit queue instead of failing. Background calls (budget edits) leave
+# LLM_BACKGROUND_RESERVE of each bucket to interactive ones.
+LLM_SCHEDULER_ENABLED = config('LLM_SCHEDULER_ENABLED', default=True, cast=bool)
+LLM_RATE_LIMITS = {
+    'gemini-2.5-flash-lite': {'rpm': 4000, 'tpm': 4_000_000},
+    'gemini-2.5-flash': {'rpm': 1000, 'tpm': 1_000_000},
+    'gemini-2.5-pro': {'rpm': 150, 'tpm': 2_000_000},
+}
+LLM_RATE_LIMIT_WORKERS = config('LLM_RATE_LIMIT_WORKERS', default=1, cast=int)
+LLM_BACKGROUND_RESERVE = 0.2
+LLM_OUTPUT_TOKENS_ESTIMATE = 1000  # expected output when max_output_tokens isn't set
+
+# Model routing (agents.routing): per agent, rules tried in order pick the
+# model and thinking budget of a call from its operation (llm_operation()),
+# input length, attached file and history size; no match keeps the agent's
+# model. Only calls that don't pass an explicit model are routed.
+LLM_ROUTING_ENABLED = config('LLM_ROUTING_ENABLED', default=True, cast=bool)
+LLM_ROUTES = {
+    'budget_agent': [
+        # Single-category edits from the budget endpoints
+        {'name': 'edit', 'operation': ['edit', 'delete'], 'max_history': 16,
+         'model': 'gemini-2.5-flash', 'thinking_budget': 0},
+    ],
+    'expense_manager': [
+        # A short text expense ("coffee 300") with no receipt attached
+        {'name': 'short_text', 'has_file': False, 'max_input_chars': 600,
+         'model': 'gemini-2.5-flash-lite', 'thinking_budget': 0},
+    ],
+}
+
+# Hedged Gemini calls (agents.hedging), opt-in per agent: hedge_after: seconds
+# the agent's model has had the request (once admitted) before it is sent
+# again; deadline: seconds before fallback_model (a faster tier) is asked too.
+# Hedge and fallback legs are single attempts, skipped when their model has
+# no room. Agents not listed call their model once. For example:
+#     'budget_agent': {'hedge_after': 12.0, 'deadline': 25.0, 'fallback_model': 'gemini-2.5-flash'},
+#     'advisor_agent': {'hedge_after': 8.0, 'deadline': 15.0, 'fallback_model': 'gemini-2.5-flash-lite'},
+#     'chatbot_agent': {'hedge_after': 10.0},
+LLM_HEDGING_ENABLED = config('LLM_HEDGING_ENABLED', default=True, cast=bool)
+LLM_HEDGE_POLICIES = {}
+# Threads sending the legs of sync calls (the primary runs on the caller's)
+LLM_HEDGE_MAX_WORKERS = 32
+
+# Retries and circuit breaking of Gemini calls (agents.resilience): transient
+# errors (429/5xx, timeouts) get LLM_RETRY_ATTEMPTS attempts with jittered
+# exponential backoff, honouring Retry-After up to LLM_RETRY_MAX_SECONDS. All
+# the agent hops of a request share LLM_RETRY_BUDGET retries. After
+# LLM_BREAKER_FAILURES consecutive failures a model fails fast for
+# LLM_BREAKER_COOLDOWN seconds.
+LLM_RETRY_ATTEMPTS = 3
+LLM_RETRY_BASE_SECONDS = 0.5
+LLM_RETRY_MAX_SECONDS = 8.0
+LLM_RETRY_BUDGET = 4
+LLM_BREAKER_FAILURES = 5
+LLM_BREAKER_COOLDOWN = 30.0
+
+# Conversation history window per agent (agents.history). Agents not listed
+# send their full history. keep_turns: recent turns sent verbatim;
+# max_tokens: estimated budget for summary + verbatim turns; summarize_every:
+# fold older turns into the rolling summary once this many have accumulated.
+AGENT_HISTORY_POLICIES = {
+    'chatbot_agent': {'keep_turns': 12, 'max_tokens': 12000, 'summarize_every': 6},
+    'main_ai_coordinator': {'keep_turns': 8, 'max_tokens': 12000, 'summarize_every': 6},
+    'budget_agent': {'keep_turns': 6, 'max_tokens': 16000, 'summarize_every': 4},
+}
+AGENT_HISTORY_SUMMARY_MODEL = 'gemini-2.5-flash-lite'
+AGENT_HISTORY_SUMMARY_MAX_TOKENS = 800
+# Turns before the window summarized on first contact with a long legacy history
+AGENT_HISTORY_SUMMARY_MAX_TURNS = 50
+
+# How agent turns are persisted (agents.journal). 'sync': one bulk insert per
+# turn, committed before the response is returned. 'background': handed to a
+# per-process writer thread that batches turns (faster, fewer SQLite write
+# locks, but a crash can lose the last few turns).
+AGENT_HISTORY_WRITE_MODE = 'sync'
+
+# Per-process cache of converted conversation history (agents.history_cache),
+# LRU-evicted past this estimated size
+AGENT_HISTORY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Function calls of one model turn that target different tools run
+# concurrently, at most this many at a time per turn (agents.services)
+AGENT_TOOL_MAX_WORKERS = 4
+
+# Batch receipt uploads (POST /api/expenses/batch/): at most
+# EXPENSE_BATCH_MAX_FILES files per request, extracted
+# EXPENSE_BATCH_CONCURRENCY at a time (still under LLM_RATE_LIMITS)
+EXPENSE_BATCH_MAX_FILES = 50
+EXPENSE_BATCH_CONCURRENCY = 4
+
+# Receipt photos are shrunk before extraction (expense.receipts): EXIF
+# orientation, crop to the paper, grayscale, long edge down to
+# RECEIPT_MAX_EDGE, then JPEG quality stepped down from RECEIPT_JPEG_QUALITY
+# (to RECEIPT_MIN_JPEG_QUALITY at most) until it fits RECEIPT_TARGET_BYTES.
+RECEIPT_PREPROCESS_ENABLED = config('RECEIPT_PREPROCESS_ENABLED', default=True, cast=bool)
+RECEIPT_MAX_EDGE = config('RECEIPT_MAX_EDGE', default=1536, cast=int)
+RECEIPT_GRAYSCALE = True
+RECEIPT_CROP = True
+RECEIPT_JPEG_QUALITY = 85
+RECEIPT_MIN_JPEG_QUALITY = 60
+RECEIPT_TARGET_BYTES = 300_000
+
+# Receipt store (expense.models.Receipt): an upload with the same bytes
+# (SHA-256) as a receipt the user already sent is flagged before
+# extraction. One whose preprocessed image is within
+# RECEIPT_SIMILAR_DISTANCE bits of a 64-bit perceptual hash and
+# RECEIPT_SIMILAR_ASPECT (relative) of the aspect ratio of one sent in the
+# last RECEIPT_SIMILAR_DAYS (0: exact matches only) is flagged after it,
+# if the same amounts were extracted (receipts of one template hash alike).
+# Resent with allow_duplicate, an exact match reuses the stored extraction
+# (no model call); a similar one is booked.
+RECEIPT_DEDUP_ENABLED = config('RECEIPT_DEDUP_ENABLED', default=True, cast=bool)
+RECEIPT_SIMILAR_DISTANCE = 4
+RECEIPT_SIMILAR_ASPECT = 0.03
+RECEIPT_SIMILAR_DAYS = config('RECEIPT_SIMILAR_DAYS', default=30, cast=int)
+
+# Simple text expenses ("I spent 500 on coffee") are parsed locally
+# (expense.parsing) and booked without a model call when the amount, product
+# and budget are unambiguous; anything else goes to the Expense Manager.
+# Messages over EXPENSE_RULES_MAX_WORDS words, or amounts outside
+# EXPENSE_RULES_MIN_AMOUNT..EXPENSE_RULES_MAX_AMOUNT DZD, always do.
+EXPENSE_RULES_ENABLED = config('EXPENSE_RULES_ENABLED', default=True, cast=bool)
+EXPENSE_RULES_MAX_WORDS = 12
+EXPENSE_RULES_MIN_AMOUNT = 10
+EXPENSE_RULES_MAX_AMOUNT = 1_000_000
+
+# Agent metrics (agents.metrics) served in the Prometheus text format at
+# /metrics. Set METRICS_TOKEN to require `Authorization: Bearer <token>`;
+# without it only staff sessions can read it (anyone when DEBUG is on).
+AGENT_METRICS_ENABLED = config('AGENT_METRICS_ENABLED', default=True, cast=bool)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# Request traces (agents.tracing): spans for each request, agent, LLM call and
+# tool, browsable at /api/agents/traces/. A TRACE_SAMPLE_RATE share of
+# traces is kept, plus unsampled ones slower than TRACE_SLOW_MS (0: off) or
+# with an error. TRACE_SINK is 'db' (TraceSpan table) or 'jsonl'.
+TRACING_ENABLED = config('TRACING_ENABLED', default=True, cast=bool)
+TRACE_SAMPLE_RATE = config('TRACE_SAMPLE_RATE', default=0.05, cast=float)
+TRACE_SLOW_MS = config('TRACE_SLOW_MS', default=10000, cast=int)
+TRACE_KEEP_ERRORS = True
+TRACE_FORCE_HEADER = DEBUG  # honour `X-Trace: 1` request headers
+TRACE_SINK = config('TRACE_SINK', default='db')
+TRACE_JSONL_PATH = config('TRACE_JSONL_PATH', default=str(BASE_DIR / '.cache' / 'traces.jsonl'))
+TRACE_RETENTION_DAYS = 7
+
+# Server-Timing: every response carries its DB time and query count, Gemini
+# time and call count, render (serialization) and total time. Requests
+# slower than SERVER_TIMING_SLOW_MS (0: off) are logged with their most
+# repeated query. Timing-Allow-Origin lets cross-origin frontends read it.
+SERVER_TIMING_ENABLED = config('SERVER_TIMING_ENABLED', default=True, cast=bool)
+SERVER_TIMING_SLOW_MS = config('SERVER_TIMING_SLOW_MS', default=0, cast=int)
+SERVER_TIMING_ALLOW_ORIGIN = '*' if CORS_ALLOW_ALL_ORIGINS else ''
+
+# Logging (agents.log): the project apps log through a queue drained by a
+# background thread. LOG_LEVEL applies to every app, LOG_LEVELS overrides it
+# per module ("chat=DEBUG,agents.tracing=WARNING"). Prompts, model responses
+# and tool results are cut to LOG_PAYLOAD_CHARS (0: type only). DEBUG records
+# are sampled with LOG_DEBUG_SAMPLE_RATE. LOG_FORMAT is 'text' or 'json'.
+LOG_LEVEL = config('LOG_LEVEL', default='DEBUG' if DEBUG else 'INFO')
+LOG_LEVELS = dict(
+    item.split('=', 1) for item in config('LOG_LEVELS', default='', cast=Csv()) if '=' in item
+)
+LOG_FORMAT = config('LOG_FORMAT', default='text')
+LOG_PAYLOAD_CHARS = config('LOG_PAYLOAD_CHARS', default=500, cast=int)
+LOG_DEBUG_SAMPLE_RATE = config('LOG_DEBUG_SAMPLE_RATE', default=1.0, cast=float)
+
+LOG_APPS = ['users', 'agents', 'ai_core', 'onboarding', 'budget', 'expense', 'advisor', 'forecast', 'chat', 'notify']
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'trace_context': {'()': 'agents.log.TraceContextFilter'},
+        'debug_sample': {'()': 'agents.log.SampleFilter', 'rate': LOG_DEBUG_SAMPLE_RATE},
+    },
+    'handlers': {
+        'agents': {
+            '()': 'agents.log.QueuedHandler',
+            'structured': LOG_FORMAT == 'json',
+            'filters': ['debug_sample', 'trace_context'],
+        },
+    },
+    'loggers': {
+        **{name: {'level': level.upper()} for name, level in LOG_LEVELS.items()},
+        **{
+            app: {'handlers': ['agents'], 'level': LOG_LEVELS.get(app, LOG_LEVEL).upper(), 'propagate': False}
+            for app in LOG_APPS
+        },
+    },
+}
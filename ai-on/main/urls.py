@@ -21,6 +21,7 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
+from agents.views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -37,4 +38,6 @@ urlpatterns = [
     path('api/chat/', include('chat.urls')),
     path('api/notify/', include('notify.urls')),
     path('api/expenses/', include('expense.urls')),
+    path('api/agents/', include('agents.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main.settings')
 
 application = get_wsgi_application()
+
+# Build the shared Gemini client once per worker instead of on the first request
+from agents.services import warm_server_process  # noqa: E402
+
+warm_server_process()
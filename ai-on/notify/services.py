@@ -4,12 +4,16 @@ Notify Service
 Centralized notification service that all agents can use to create and manage notifications.
 """
 
+import logging
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
 from .models import Notification
 
 
+logger = logging.getLogger(__name__)
+
+
 def create_notification(
     user: User,
     notification_type: str,
@@ -52,7 +56,7 @@ def create_notification(
         action_data=action_data
     )
     
-    print(f"DEBUG: Created notification for {user.username}: {title}")
+    logger.debug("Created notification for %s: %s", user.username, title)
     return notification
 
 
@@ -91,7 +95,7 @@ def mark_all_as_read(user: User) -> int:
     # Update all at once
     unread_notifications.update(is_read=True, read_at=timezone.now())
     
-    print(f"DEBUG: Marked {count} notifications as read for {user.username}")
+    logger.debug("Marked %d notifications as read for %s", count, user.username)
     return count
 
 
@@ -125,7 +129,7 @@ def delete_old_notifications(days: int = 30) -> int:
     count = old_notifications.count()
     old_notifications.delete()
     
-    print(f"DEBUG: Deleted {count} notifications older than {days} days")
+    logger.info("Deleted %d notifications older than %d days", count, days)
     return count
 
 
@@ -1,8 +1,6 @@
-from google import genai
 from google.genai import types
-from decouple import config 
+from agents.services import get_genai_client
 
-API_KEY = config('GEMINI_API_KEY')
 ONBOARDING_SYSTEM_INSTRUCTION = '''
 IDENTITY
 You are the Onboarding Agent in the AION personal finance management system. Your sole purpose is to collect required financial information from new users and hand them off to the main system.
@@ -52,5 +50,5 @@ Explain the "why" behind each question
 '''
 model = "gemini-2.5-flash"  # limt 250 requests per day 
 
-client = genai.Client(api_key=API_KEY)
+client = get_genai_client()
     
\ No newline at end of file
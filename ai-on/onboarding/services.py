@@ -4,8 +4,24 @@ Onboarding Agent Service
 Handles the creation and management of the onboarding AI agent.
 """
 
+import logging
 from agents.models import agentModel
-from agents.services import register_agent_function, build_config, execute_function, get_agent_history, add_to_history
+from agents.services import (
+    build_config,
+    get_agent_config,
+    AgentDefinition,
+    agent_registry,
+    execute_function,
+    get_agent_history,
+    generate_content,
+    agenerate_content,
+    aget_agent_history,
+    aexecute_function,
+    TurnJournal,
+    trace_agent,
+    payload
+)
+from asgiref.sync import sync_to_async
 from .tools import (
     ask_question, 
     ask_question_declaration,
@@ -13,11 +29,11 @@ from .tools import (
     finish_onboarding_declaration
 )
 from django.contrib.auth.models import User
-from google import genai
 from google.genai import types
-from decouple import config
 
-API_KEY = config('GEMINI_API_KEY')
+
+logger = logging.getLogger(__name__)
+
 
 ONBOARDING_SYSTEM_INSTRUCTION = '''
 IDENTITY
@@ -65,113 +81,51 @@ Friendly and welcoming, Clear and concise, Patient and encouraging, Professional
 '''
 
 
-def get_or_create_onboarding_agent() -> agentModel:
-    """
-    Get or create the onboarding agent and register its functions.
-    
-    Returns:
-        The onboarding agent model instance
-    """
-    agent, created = agentModel.objects.get_or_create(
-        name="onboarding_agent",
-        defaults={
-            "description": "Collects financial information from new users during onboarding",
-            "system_instruction": ONBOARDING_SYSTEM_INSTRUCTION,
-            "gemini_model": "gemini-2.5-flash",
-            "thinking_budget": 0
-        }
-    )
-    
-    if not created and agent.gemini_model != "gemini-2.5-flash":
-        agent.gemini_model = "gemini-2.5-flash"
-        agent.save()
-    
-    
-    # Register functions if newly created or not already registered
-    register_agent_function(
-        agent_id=agent.id,
-        func_name="ask_question",
-        function_declaration=ask_question_declaration,
-        function=ask_question
-    )
-    
-    register_agent_function(
-        agent_id=agent.id,
-        func_name="finish_onboarding_and_save_info",
-        function_declaration=finish_onboarding_declaration,
-        function=finish_onboarding_and_save_info
-    )
-    
-    return agent
-
-
-def process_onboarding_turn(user: User, user_message: str = None) -> dict:
+def _onboarding_config(agent: agentModel, functions: dict = None) -> types.GenerateContentConfig:
     """
-    Process one turn of the onboarding conversation.
-    
-    Args:
-        user: The Django User object
-        user_message: The user's message/answer (None for first turn)
-        
-    Returns:
-        Dictionary with either:
-        - {"type": "question", "data": {question, question_type, options}}
-        - {"type": "completed", "data": {success, message}}
-        - {"type": "error", "data": {error}}
+    Build config; the onboarding agent must always answer with a function call.
     """
-    print(f"DEBUG: Onboarding Agent is running now... processing message: {user_message}")
-    # Get or create agent
-    agent = get_or_create_onboarding_agent()
-    
-    # Get conversation history
-    history = get_agent_history(agent, user)
-    
-    # Add user message to history if provided
-    if user_message:
-        add_to_history(
-            agent=agent,
-            user=user,
-            part={"parts": [{"text": user_message}]},
-            role="user"
-        )
-        history.append(types.Content(
-            role="user",
-            parts=[types.Part(text=user_message)]
-        ))
-    
-    # Ensure the last message is from the user (Gemini API requirement)
-    if not history or history[-1].role == "model":
-        start = "start"
-        add_to_history(
-            agent=agent,
-            user=user,
-            part={"parts": [{"text": start}]},
-            role="user"
-        )
-        history.append(types.Content(
-            role="user",
-            parts=[types.Part(text=start)]
-        ))
-    
-    # Build config
-    config_obj = build_config(agent)
+    config_obj = build_config(agent, functions)
     config_obj.tool_config = types.ToolConfig(
             function_calling_config=types.FunctionCallingConfig(
                 mode="ANY"
             )
         )
-    
-    # Create Gemini client
-    client = genai.Client(api_key=API_KEY)
-    
-    # Generate response
-    response = client.models.generate_content(
-        model=agent.gemini_model,
-        contents=history,
-        config=config_obj
-    )
-    
-    # Save model response to history
+    return config_obj
+
+
+ONBOARDING_AGENT = AgentDefinition(
+    name="onboarding_agent",
+    description="Collects financial information from new users during onboarding",
+    system_instruction=ONBOARDING_SYSTEM_INSTRUCTION,
+    gemini_model="gemini-2.5-flash",
+    thinking_budget=0,
+    tools=lambda: [
+        ("ask_question", ask_question_declaration, ask_question),
+        ("finish_onboarding_and_save_info", finish_onboarding_declaration, finish_onboarding_and_save_info),
+    ],
+    config=_onboarding_config
+)
+
+
+def get_or_create_onboarding_agent() -> agentModel:
+    """
+    Get the onboarding agent from the agent registry (no DB query once loaded).
+    """
+    return agent_registry.get(ONBOARDING_AGENT.name).agent
+
+
+async def aget_or_create_onboarding_agent() -> agentModel:
+    """
+    Async version of get_or_create_onboarding_agent().
+    """
+    return (await agent_registry.aget(ONBOARDING_AGENT.name)).agent
+
+
+def _model_parts_for_history(response) -> list[dict]:
+    """
+    Convert the model response into JSON parts for ConversationHistory.
+    """
     model_parts = []
     if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
         for part in response.candidates[0].content.parts:
@@ -191,50 +145,180 @@ def process_onboarding_turn(user: User, user_message: str = None) -> dict:
     # Fallback
     if not model_parts:
         model_parts.append({"text": response.text if response.text else ""})
-
-    print(f"DEBUG: Saving model response to history: {model_parts}")
-    add_to_history(
-        agent=agent,
-        user=user,
-        part={"parts": model_parts},
-        role="model"
-    )
-    print("Model response:", response)
     
-    # Check if there are function calls
+    return model_parts
+
+
+def _onboarding_function_calls(response, user: User) -> list[tuple[str, dict]]:
+    """
+    Extract (func_name, func_args) pairs from the model response.
+    """
+    calls = []
     if response.candidates[0].content.parts:
-        
         for part in response.candidates[0].content.parts:
             if hasattr(part, 'function_call') and part.function_call:
-                func_call = part.function_call
-                func_name = func_call.name
-                func_args = dict(func_call.args)
+                func_name = part.function_call.name
+                func_args = dict(part.function_call.args)
                 
                 # Add user to args for finish_onboarding
                 if func_name == "finish_onboarding_and_save_info":
                     func_args['user'] = user
                 
-                
-                # Execute the function
-                print(f"DEBUG: Onboarding Agent calling {func_name} with args: {func_args}...")
-                result = execute_function(agent, func_name, func_args)
-                
-                # If it's ask_question, return the question
-                if func_name == "ask_question":
-                    return {
-                        "type": "question",
-                        "data": result
-                    }
-                
-                # If it's finish_onboarding, return completion
-                elif func_name == "finish_onboarding_and_save_info":
-                    return {
-                        "type": "finsh",
-                        "data": result
-                    }
+                calls.append((func_name, func_args))
+    return calls
+
+
+def _onboarding_turn_result(func_name: str, result) -> dict | None:
+    """
+    Map an executed onboarding function to the turn result, if it ends the turn.
+    """
+    # If it's ask_question, return the question
+    if func_name == "ask_question":
+        return {
+            "type": "question",
+            "data": result
+        }
     
-    # If no function call, return error
+    # If it's finish_onboarding, return completion
+    elif func_name == "finish_onboarding_and_save_info":
+        return {
+            "type": "finsh",
+            "data": result
+        }
+    
+    return None
+
+
+def _no_function_call_error() -> dict:
     return {
         "type": "error",
         "data": {"error": "Agent did not call a function. Please try again."}
     }
+
+
+@trace_agent(ONBOARDING_AGENT.name)
+def process_onboarding_turn(user: User, user_message: str = None) -> dict:
+    """
+    Process one turn of the onboarding conversation.
+    
+    Args:
+        user: The Django User object
+        user_message: The user's message/answer (None for first turn)
+        
+    Returns:
+        Dictionary with either:
+        - {"type": "question", "data": {question, question_type, options}}
+        - {"type": "completed", "data": {success, message}}
+        - {"type": "error", "data": {error}}
+    """
+    logger.debug("Onboarding Agent is running now... processing message: %s", payload(user_message))
+    # Get or create agent
+    agent = get_or_create_onboarding_agent()
+    
+    # Get conversation history
+    history = get_agent_history(agent, user)
+    
+    # All parts of this turn are written in one go
+    with TurnJournal(agent, user) as journal:
+        # Add user message to history if provided
+        if user_message:
+            journal.add(
+                part={"parts": [{"text": user_message}]},
+                role="user"
+            )
+            history.append(types.Content(
+                role="user",
+                parts=[types.Part(text=user_message)]
+            ))
+        
+        # Ensure the last message is from the user (Gemini API requirement)
+        if not history or history[-1].role == "model":
+            start = "start"
+            journal.add(
+                part={"parts": [{"text": start}]},
+                role="user"
+            )
+            history.append(types.Content(
+                role="user",
+                parts=[types.Part(text=start)]
+            ))
+        
+        # Build config
+        config_obj = get_agent_config(agent)
+        
+        
+        # Generate response
+        response = generate_content(agent, history, config_obj)
+        
+        # Save model response to history
+        model_parts = _model_parts_for_history(response)
+
+        logger.debug("Saving model response to history: %s", payload(model_parts))
+        journal.add(
+            part={"parts": model_parts},
+            role="model"
+        )
+    logger.debug("Model response: %s", payload(response))
+    
+    # Check if there are function calls
+    for func_name, func_args in _onboarding_function_calls(response, user):
+        # Execute the function
+        logger.debug("Onboarding Agent calling %s with args: %s", func_name, payload(func_args))
+        result = execute_function(agent, func_name, func_args)
+        
+        turn_result = _onboarding_turn_result(func_name, result)
+        if turn_result:
+            return turn_result
+    
+    # If no function call, return error
+    return _no_function_call_error()
+
+
+@trace_agent(ONBOARDING_AGENT.name)
+async def aprocess_onboarding_turn(user: User, user_message: str = None) -> dict:
+    """
+    Async version of process_onboarding_turn().
+    """
+    logger.debug("Onboarding Agent (async) is running now... processing message: %s", payload(user_message))
+    agent = await aget_or_create_onboarding_agent()
+    history = await aget_agent_history(agent, user)
+    
+    # All parts of this turn are written in one go
+    async with TurnJournal(agent, user) as journal:
+        if user_message:
+            journal.add(
+                part={"parts": [{"text": user_message}]},
+                role="user"
+            )
+            history.append(types.Content(
+                role="user",
+                parts=[types.Part(text=user_message)]
+            ))
+        
+        # Ensure the last message is from the user (Gemini API requirement)
+        if not history or history[-1].role == "model":
+            start = "start"
+            journal.add(
+                part={"parts": [{"text": start}]},
+                role="user"
+            )
+            history.append(types.Content(
+                role="user",
+                parts=[types.Part(text=start)]
+            ))
+        
+        response = await agenerate_content(agent, history, get_agent_config(agent))
+        
+        journal.add(
+            part={"parts": _model_parts_for_history(response)},
+            role="model"
+        )
+    
+    for func_name, func_args in _onboarding_function_calls(response, user):
+        result = await aexecute_function(agent, func_name, func_args)
+        
+        turn_result = _onboarding_turn_result(func_name, result)
+        if turn_result:
+            return turn_result
+    
+    return _no_function_call_error()
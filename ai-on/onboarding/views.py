@@ -5,9 +5,10 @@ from rest_framework import status
 from drf_spectacular.utils import extend_schema, OpenApiResponse
 from users.models import UserProfile
 from .serializers import OnboardingQuestionResponseSerializer, OnboardingAnswerSerializer
+from agents.views import AsyncAPIView
 
 
-class OnboardingView(APIView):
+class OnboardingView(AsyncAPIView):
     """
     Onboarding conversation endpoint.
     
@@ -40,10 +41,10 @@ class OnboardingView(APIView):
         },
         tags=["Onboarding"]
     )
-    def get(self, request):
+    async def get(self, request):
         """Get current onboarding question."""
         user = request.user
-        profile, created = UserProfile.objects.get_or_create(user=user)
+        profile, created = await UserProfile.objects.aget_or_create(user=user)
         
         # Check if onboarding is already completed
         if profile.onboarding_status == 'completed':
@@ -54,12 +55,12 @@ class OnboardingView(APIView):
         # Start onboarding if not started
         if profile.onboarding_status == 'not_started':
             profile.onboarding_status = 'in_progress'
-            profile.save()
+            await profile.asave()
         
         # Call AI agent to get first/next question
-        from .services import process_onboarding_turn
+        from .services import aprocess_onboarding_turn
         
-        result = process_onboarding_turn(user=user, user_message=None)
+        result = await aprocess_onboarding_turn(user=user, user_message=None)
         
         if result["type"] == "question":
             return Response(result["data"], status=status.HTTP_200_OK)
@@ -99,12 +100,12 @@ class OnboardingView(APIView):
         },
         tags=["Onboarding"]
     )
-    def post(self, request):
+    async def post(self, request):
         """Submit answer and get next question."""
         user = request.user
         
         try:
-            profile = UserProfile.objects.get(user=user)
+            profile = await UserProfile.objects.aget(user=user)
         except UserProfile.DoesNotExist:
             return Response({
                 "detail": "Profile not found. Call GET first to start onboarding."
@@ -135,9 +136,9 @@ class OnboardingView(APIView):
             user_message = str(answer)
         
         # Call AI agent with user's answer
-        from .services import process_onboarding_turn
+        from .services import aprocess_onboarding_turn
         
-        result = process_onboarding_turn(user=user, user_message=user_message)
+        result = await aprocess_onboarding_turn(user=user, user_message=user_message)
         
         if result["type"] == "question":
             # Return next question